@@ -0,0 +1 @@
+Sequential downloads of immutable files now fetch the following segments ahead of time.
@@ -0,0 +1 @@
+Repairing an immutable file now only erasure-codes and uploads the missing shares.
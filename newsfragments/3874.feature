@@ -0,0 +1 @@
+With ``[storage]share_index`` enabled, lease expiration only visits the buckets with expired leases instead of crawling every share.
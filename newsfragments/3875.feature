@@ -0,0 +1 @@
+Storage servers accept an ``add_leases`` operation which adds or renews leases on many storage indexes at once, and clients use it to batch the leases they add while checking files.
@@ -0,0 +1 @@
+The web API has a new ``POST /uri/$DIRCAP?t=edit`` operation, which links, unlinks and renames many children of a directory with a single write of the directory.
@@ -0,0 +1 @@
+Large MDMF mutable files are now downloaded with several segments in flight at once.
@@ -0,0 +1 @@
+Publishing MDMF mutable files now encrypts and encodes segments while earlier ones are being sent.
@@ -0,0 +1 @@
+Writes to MDMF mutable files which do not change their size now rewrite only the segments and hashes they touch, and writes made together are published together.
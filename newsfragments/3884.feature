@@ -0,0 +1 @@
+``tahoe backup`` now uploads several files at once over persistent connections; ``--parallelism``/``-j`` sets how many.
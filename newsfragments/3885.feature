@@ -0,0 +1 @@
+``tahoe backup`` no longer uploads again a file whose contents were already backed up under another name.
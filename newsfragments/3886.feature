@@ -0,0 +1 @@
+The SFTP frontend now reads only the parts of a file that are asked for, rather than downloading the whole file first.
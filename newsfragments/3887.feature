@@ -0,0 +1 @@
+Immutable uploads with ``PUT ...?convergent=false`` use a random encryption key, and are uploaded as the request body arrives instead of being spooled to disk first.
@@ -0,0 +1 @@
+The web API now answers requests for several byte ranges with a ``multipart/byteranges`` response, and accepts a ``Content-Range`` header on PUTs to mutable files.
@@ -0,0 +1 @@
+Storage server latencies are now kept as histograms, which ``/statistics?t=openmetrics`` exports as OpenMetrics histograms.
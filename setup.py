@@ -143,6 +143,9 @@ install_requires = [
 
     # HTTP server and client
     "klein",
+    # Range header parsing and URL routing for the HTTP storage server; klein
+    # depends on it already, but we use it directly too.
+    "werkzeug",
     "treq",
     "cbor2"
 ]
@@ -40,11 +40,16 @@ from allmydata.storage.server import StorageServer, FoolscapStorageServer
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
 from allmydata.immutable.offloaded import Helper
+from allmydata.immutable.downloader.segmentcache import SegmentCache
+from allmydata.mutable.servermapcache import ServermapCache
+from allmydata.mutable.keycache import KeyCache
+from allmydata.dirnode import DirectoryIndexCache
+from allmydata.deep_traversal import DEFAULT_PARALLELISM, DEFAULT_FRONTIER_SIZE
 from allmydata.introducer.client import IntroducerClient
 from allmydata.util import (
     hashutil, base32, pollmixin, log, idlib,
     yamlutil, configutil,
-    fileutil,
+    fileutil, cputhreadpool,
 )
 from allmydata.util.encodingutil import get_filesystem_encoding
 from allmydata.util.abbreviate import parse_abbreviated_size
@@ -87,6 +92,14 @@ def _is_valid_section(section_name):
 _client_config = configutil.ValidConfiguration(
     static_valid_sections={
         "client": (
+            "cpu-threads",
+            "deep_traversal.frontier_size",
+            "deep_traversal.parallelism",
+            "dirnode.index_cache_size",
+            "download.segment_cache_size",
+            "mutable.servermap_cache_ttl",
+            "mutable.servermap_cache_entries",
+            "mutable.key_cache_entries",
             "helper.furl",
             "introducer.furl",
             "key_generator.furl",
@@ -110,6 +123,7 @@ _client_config = configutil.ValidConfiguration(
             "expire.override_lease_duration",
             "readonly",
             "reserved_space",
+            "share_index",
             "storage_dir",
             "plugins",
         ),
@@ -806,6 +820,9 @@ class _Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        share_index = self.config.get_config("storage", "share_index", False,
+                                             boolean=True)
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -815,7 +832,8 @@ class _Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           share_index=share_index)
         ss.setServiceParent(self)
         return ss
 
@@ -903,6 +921,11 @@ class _Client(node.Node, pollmixin.PollMixin):
         DEP["n"] = int(self.config.get_config("client", "shares.total", DEP["n"]))
         DEP["happy"] = int(self.config.get_config("client", "shares.happy", DEP["happy"]))
 
+        cpu_threads = self.config.get_config("client", "cpu-threads", None)
+        if cpu_threads is not None:
+            cputhreadpool.set_max_threads(
+                cputhreadpool.parse_max_threads(cpu_threads))
+
         # for the CLI to authenticate to local JSON endpoints
         self._create_auth_token()
 
@@ -968,6 +991,14 @@ class _Client(node.Node, pollmixin.PollMixin):
             self.mutable_file_default = MDMF_VERSION
         else:
             self.mutable_file_default = SDMF_VERSION
+        self.init_segment_cache()
+        self.init_servermap_cache()
+        self.init_dirnode_index_cache()
+        self.init_key_cache()
+        parallelism = int(self.config.get_config(
+            "client", "deep_traversal.parallelism", DEFAULT_PARALLELISM))
+        frontier_size = int(self.config.get_config(
+            "client", "deep_traversal.frontier_size", DEFAULT_FRONTIER_SIZE))
         self.nodemaker = NodeMaker(self.storage_broker,
                                    self._secret_holder,
                                    self.get_history(),
@@ -976,7 +1007,61 @@ class _Client(node.Node, pollmixin.PollMixin):
                                    self.get_encoding_parameters(),
                                    self.mutable_file_default,
                                    self._key_generator,
-                                   self.blacklist)
+                                   self.blacklist,
+                                   self.segment_cache,
+                                   self.servermap_cache,
+                                   parallelism,
+                                   frontier_size,
+                                   self.dirnode_index_cache,
+                                   self.key_cache)
+
+    def init_segment_cache(self):
+        data = self.config.get_config("client", "download.segment_cache_size",
+                                      None)
+        try:
+            size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]download.segment_cache_size= contains"
+                    " unparseable value %s" % data)
+            raise
+        self.segment_cache = None
+        if size:
+            self.segment_cache = SegmentCache(size)
+            self.stats_provider.register_producer(self.segment_cache)
+
+    def init_dirnode_index_cache(self):
+        data = self.config.get_config("client", "dirnode.index_cache_size",
+                                      "32MiB")
+        try:
+            size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]dirnode.index_cache_size= contains"
+                    " unparseable value %s" % data)
+            raise
+        self.dirnode_index_cache = None
+        if size:
+            self.dirnode_index_cache = DirectoryIndexCache(size)
+            self.stats_provider.register_producer(self.dirnode_index_cache)
+
+    def init_servermap_cache(self):
+        ttl = int(self.config.get_config("client", "mutable.servermap_cache_ttl",
+                                         "0"))
+        entries = int(self.config.get_config("client",
+                                             "mutable.servermap_cache_entries",
+                                             "1000"))
+        self.servermap_cache = None
+        if ttl > 0 and entries > 0:
+            self.servermap_cache = ServermapCache(ttl, entries)
+            self.stats_provider.register_producer(self.servermap_cache)
+
+    def init_key_cache(self):
+        entries = int(self.config.get_config("client",
+                                             "mutable.key_cache_entries",
+                                             "1000"))
+        self.key_cache = None
+        if entries > 0:
+            self.key_cache = KeyCache(entries)
+            self.stats_provider.register_producer(self.key_cache)
 
     def get_history(self):
         return self.history
@@ -13,8 +13,7 @@ if PY2:
     from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
 from zope.interface import implementer
-from twisted.internet import defer
-from allmydata.util import mathutil
+from allmydata.util import mathutil, cputhreadpool
 from allmydata.util.assertutil import precondition
 from allmydata.interfaces import ICodecEncoder, ICodecDecoder
 import zfec
@@ -53,9 +52,10 @@ class CRSEncoder(object):
 
         for inshare in inshares:
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
-        shares = self.encoder.encode(inshares, desired_share_ids)
-
-        return defer.succeed((shares, desired_share_ids))
+        d = cputhreadpool.defer_to_thread(self.encoder.encode, inshares,
+                                          desired_share_ids)
+        d.addCallback(lambda shares: (shares, desired_share_ids))
+        return d
 
     def encode_proposal(self, data, desired_share_ids=None):
         raise NotImplementedError()
@@ -82,9 +82,8 @@ class CRSDecoder(object):
                      len(some_shares), len(their_shareids))
         precondition(len(some_shares) == self.required_shares,
                      len(some_shares), self.required_shares)
-        data = self.decoder.decode(some_shares,
-                                   [int(s) for s in their_shareids])
-        return defer.succeed(data)
+        return cputhreadpool.defer_to_thread(self.decoder.decode, some_shares,
+                                             [int(s) for s in their_shareids])
 
 def parse_params(serializedparams):
     pieces = serializedparams.split(b"-")
@@ -0,0 +1,224 @@
+"""
+The engine behind ``DirectoryNode.deep_traverse``.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import hashlib
+import sqlite3
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from foolscap.api import eventually
+
+from allmydata.interfaces import IDirectoryNode
+from allmydata.unknown import UnknownNode
+from allmydata.util import jsonbytes as json
+
+# the number of nodes being processed at the same time
+DEFAULT_PARALLELISM = 10
+# the number of frontier entries kept in memory before the rest are spilled
+# to disk
+DEFAULT_FRONTIER_SIZE = 10000
+
+
+class Frontier(object):
+    """I am a stack of (node, path) pairs which are waiting to be visited.
+
+    I keep up to max_size entries in memory. Beyond that, I move the oldest
+    half of them to a temporary SQLite database (which SQLite keeps on disk
+    once it outgrows its page cache) as (cap, path) rows, and recreate the
+    nodes with the nodemaker when they come back, so the memory I use does
+    not depend on the size of the tree.
+    """
+
+    def __init__(self, nodemaker, max_size=DEFAULT_FRONTIER_SIZE):
+        self._nodemaker = nodemaker
+        self._max_size = max(max_size, 2)
+        self._memory = []
+        self._db = None
+        self._spilled = 0
+
+    def __len__(self):
+        return len(self._memory) + self._spilled
+
+    def push(self, node, path):
+        self._memory.append((node, path))
+        if len(self._memory) > self._max_size:
+            self._spill()
+
+    def pop(self):
+        """Return the most recently pushed (node, path) pair."""
+        if not self._memory and self._spilled:
+            self._unspill()
+        return self._memory.pop()
+
+    def _spill(self):
+        if self._db is None:
+            # an empty filename gives a private, temporary database
+            self._db = sqlite3.connect("")
+            self._db.execute("CREATE TABLE frontier"
+                             " (id INTEGER PRIMARY KEY, cap BLOB, path TEXT)")
+        count = len(self._memory) // 2
+        self._db.executemany("INSERT INTO frontier (cap, path) VALUES (?,?)",
+                             [(node.get_uri(), json.dumps(path))
+                              for (node, path) in self._memory[:count]])
+        del self._memory[:count]
+        self._spilled += count
+
+    def _unspill(self):
+        rows = self._db.execute("SELECT id, cap, path FROM frontier"
+                                " ORDER BY id DESC LIMIT ?",
+                                (self._max_size // 2,)).fetchall()
+        self._db.execute("DELETE FROM frontier WHERE id >= ?", (rows[-1][0],))
+        self._spilled -= len(rows)
+        for (_, cap, path) in reversed(rows):
+            node = self._nodemaker.create_from_cap(bytes(cap))
+            self._memory.append((node, json.loads(path)))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class FoundSet(object):
+    """I remember which verifier caps a traversal has already reached.
+
+    I store a 16-byte hash of each verifier cap in a temporary SQLite
+    database, rather than the caps themselves in a Python set, which keeps
+    the memory used by a traversal of millions of nodes small.
+    """
+
+    def __init__(self):
+        self._db = sqlite3.connect("")
+        self._db.execute("CREATE TABLE found (digest BLOB PRIMARY KEY)"
+                         " WITHOUT ROWID")
+
+    def add(self, verifier):
+        """Remember the given IVerifierURI. Return True if it is new, False if
+        I had already seen it."""
+        digest = hashlib.sha256(verifier.to_string()).digest()[:16]
+        c = self._db.execute("INSERT OR IGNORE INTO found (digest) VALUES (?)",
+                             (digest,))
+        return c.rowcount == 1
+
+    def close(self):
+        self._db.close()
+
+
+class DeepTraversal(object):
+    """I walk the tree below a directory, visiting up to 'parallelism' nodes
+    at the same time, and tell a walker about everything I find (see
+    ``DirectoryNode.deep_traverse`` for the protocol).
+
+    Each node waiting to be visited sits in a Frontier. Visiting a file
+    means calling walker.add_node() on it. Visiting a directory also means
+    reading its children (and calling walker.enter_directory()), and pushing
+    the ones which have not been seen before. With a parallelism of 1, the
+    walker sees the nodes in the same depth-first order as the old serial
+    traversal.
+    """
+
+    # the number of visits started in a single reactor turn, to avoid
+    # unbounded recursion when the walker handles nodes synchronously
+    MAX_VISITS_PER_TURN = 100
+
+    def __init__(self, root, walker, monitor, nodemaker,
+                 parallelism=DEFAULT_PARALLELISM,
+                 frontier_size=DEFAULT_FRONTIER_SIZE):
+        self._walker = walker
+        self._monitor = monitor
+        self._parallelism = max(parallelism, 1)
+        self._frontier = Frontier(nodemaker, frontier_size)
+        self._found = FoundSet()
+        if root.get_verify_cap() is not None:
+            self._found.add(root.get_verify_cap())
+        self._frontier.push(root, [])
+        self._in_flight = 0
+        self._launching = False
+        self._failure = None
+        self._done = defer.Deferred()
+
+    def run(self):
+        """Start the traversal. I return a Deferred which fires (with None)
+        when every node has been visited, or errbacks with the first
+        failure."""
+        self._launch()
+        return self._done
+
+    def _launch(self):
+        self._launching = True
+        started = 0
+        while (self._failure is None and self._frontier
+               and self._in_flight < self._parallelism):
+            if started >= self.MAX_VISITS_PER_TURN:
+                self._launching = False
+                eventually(self._launch)
+                return
+            (node, path) = self._frontier.pop()
+            self._in_flight += 1
+            started += 1
+            d = defer.maybeDeferred(self._visit, node, path)
+            d.addBoth(self._visited)
+        self._launching = False
+        if not self._in_flight:
+            self._finish()
+
+    def _visited(self, res):
+        self._in_flight -= 1
+        if isinstance(res, Failure) and self._failure is None:
+            self._failure = res
+        if not self._launching:
+            self._launch()
+
+    def _finish(self):
+        if self._done.called:
+            return
+        self._frontier.close()
+        self._found.close()
+        if self._failure is not None:
+            self._done.errback(self._failure)
+        else:
+            self._done.callback(None)
+
+    def _visit(self, node, path):
+        self._monitor.raise_if_cancelled()
+        d = defer.maybeDeferred(self._walker.add_node, node, path)
+        if IDirectoryNode.providedBy(node):
+            d.addCallback(lambda ignored: node.list())
+            d.addCallback(self._visit_children, node, path)
+        return d
+
+    def _visit_children(self, children, parent, path):
+        self._monitor.raise_if_cancelled()
+        d = defer.maybeDeferred(self._walker.enter_directory, parent, children)
+        new = []
+        for name, (child, metadata) in sorted(children.items()):
+            childpath = path + [name]
+            if isinstance(child, UnknownNode):
+                self._walker.add_node(child, childpath)
+                continue
+            verifier = child.get_verify_cap()
+            # allow LIT files (for which verifier==None) to be processed
+            if (verifier is not None) and not self._found.add(verifier):
+                continue
+            new.append((child, childpath))
+        # we visit file-like children first, so we can drop their FileNode
+        # objects as quickly as possible, and then the directories in
+        # order. The frontier is a stack, so push them in reverse.
+        dirkids = [(child, childpath) for (child, childpath) in new
+                   if IDirectoryNode.providedBy(child)]
+        filekids = [(child, childpath) for (child, childpath) in new
+                    if not IDirectoryNode.providedBy(child)]
+        for (child, childpath) in reversed(filekids + dirkids):
+            self._frontier.push(child, childpath)
+        return d
@@ -13,20 +13,23 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, list, object, range, str, max, min  # noqa: F401
 from past.builtins import unicode
 
+import hashlib
 import time
+from collections import OrderedDict
 
 from zope.interface import implementer
 from twisted.internet import defer
-from foolscap.api import fireEventually
 
 from allmydata.crypto import aes
 from allmydata.deep_stats import DeepStats
+from allmydata.deep_traversal import DeepTraversal
 from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.filenode import MutableFileNode
-from allmydata.unknown import UnknownNode, strip_prefix_for_ro
+from allmydata.unknown import strip_prefix_for_ro
 from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
      ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
-     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
+     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError, \
+     IStatsProducer
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
@@ -229,6 +232,87 @@ class Adder(object):
         new_contents = self.node._pack_contents(children)
         return new_contents
 
+
+class Editor(object):
+    """I apply a list of edits (adding, deleting and renaming children) to a
+    directory in a single modify() cycle, so that they are all published
+    together, however many there are.
+
+    An edit which cannot be applied (because the child it names does not
+    exist, or would overwrite an existing one, etc) is skipped and does not
+    stop the others. After modify(), self.results has one entry per edit:
+    None if it was applied, or the exception which prevented it.
+    """
+    def __init__(self, node, edits, create_readonly_node=None):
+        self.node = node
+        self.edits = edits
+        self.create_readonly_node = create_readonly_node
+        self.results = []
+
+    def modify(self, old_contents, servermap, first_time):
+        children = self.node._unpack_contents(old_contents)
+        now = time.time()
+        self.results = []
+        for edit in self.edits:
+            try:
+                if edit[0] == "set":
+                    (_, namex, child, metadata, overwrite) = edit
+                    self._set(children, normalize(namex), child, metadata,
+                              overwrite, now)
+                elif edit[0] == "delete":
+                    (_, namex) = edit
+                    self._delete(children, normalize(namex), first_time)
+                elif edit[0] == "rename":
+                    (_, from_namex, to_namex, overwrite) = edit
+                    self._rename(children, normalize(from_namex),
+                                 normalize(to_namex), overwrite, now,
+                                 first_time)
+            except (ExistingChildError, NoSuchChildError,
+                    CapConstraintError) as e:
+                self.results.append(e)
+            else:
+                self.results.append(None)
+        if all(result is not None for result in self.results):
+            return None # nothing changed
+        return self.node._pack_contents(children)
+
+    def _set(self, children, name, child, new_metadata, overwrite, now):
+        # this follows Adder.modify
+        child.raise_error()
+        metadata = None
+        if name in children:
+            if not overwrite:
+                raise ExistingChildError("child %s already exists" % quote_output(name, encoding='utf-8'))
+            if overwrite == ONLY_FILES and IDirectoryNode.providedBy(children[name][0]):
+                raise ExistingChildError("child %s already exists as a directory" % quote_output(name, encoding='utf-8'))
+            metadata = children[name][1].copy()
+        metadata = update_metadata(metadata, new_metadata, now)
+        if self.create_readonly_node and metadata.get('no-write', False):
+            child = self.create_readonly_node(child, name)
+        children[name] = (child, metadata)
+
+    def _delete(self, children, name, first_time):
+        if name not in children:
+            # if this is a retry, our earlier attempt may have removed it
+            if first_time:
+                raise NoSuchChildError(name)
+            return
+        del children[name]
+
+    def _rename(self, children, from_name, to_name, overwrite, now,
+                first_time):
+        if from_name not in children:
+            if not first_time and to_name in children:
+                # our earlier attempt already renamed it
+                return
+            raise NoSuchChildError(from_name)
+        if from_name == to_name:
+            return
+        (child, metadata) = children[from_name]
+        self._set(children, to_name, child, metadata, overwrite, now)
+        del children[from_name]
+
+
 def _encrypt_rw_uri(writekey, rw_uri):
     precondition(isinstance(rw_uri, bytes), rw_uri)
     precondition(isinstance(writekey, bytes), writekey)
@@ -311,6 +395,109 @@ def _pack_normalized_children(children, writekey, deep_immutable=False):
         entries.append(netstring(entry))
     return b"".join(entries)
 
+
+def _netstring_bounds(data, position, limit=None):
+    """Find the netstring which starts at data[position]. Return (start, end,
+    next), where data[start:end] is its contents and data[next] is the first
+    byte after it. This is like split_netstring, but does not copy the
+    contents."""
+    if limit is None:
+        limit = len(data)
+    colon = data.index(b":", position, limit)
+    start = colon + 1
+    end = start + int(data[position:colon])
+    if end >= limit or data[end:end+1] != b",":
+        raise ValueError("malformed netstring at position %d" % (position,))
+    return (start, end, end + 1)
+
+
+class DirectoryIndex(object):
+    """I locate the children in the packed contents of a directory, without
+    decoding them.
+
+    Building me takes a single pass over the contents which only decodes the
+    names of the children. Decrypting a child's writecap, parsing its
+    metadata and creating its node are left to DirectoryNode, which only
+    does them for the children it is asked about.
+    """
+
+    def __init__(self, data):
+        assert isinstance(data, bytes), (repr(data), type(data))
+        self._data = data
+        self._entries = {} # name -> (start, end) of the packed entry
+        position = 0
+        while position < len(data):
+            (start, end, position) = _netstring_bounds(data, position)
+            (name_start, name_end, _) = _netstring_bounds(data, start, end)
+            # see DirectoryNode._unpack_entry about normalization
+            name = normalize(data[name_start:name_end].decode("utf-8"))
+            self._entries[name] = (start, end)
+
+    def get_size(self):
+        return len(self._data)
+
+    def get_names(self):
+        """Return the names of my children, in the order they were packed."""
+        return list(self._entries)
+
+    def get_entry(self, name):
+        """Return the packed entry for the named child, or None if there is
+        no such child."""
+        bounds = self._entries.get(name)
+        if bounds is None:
+            return None
+        return self._data[bounds[0]:bounds[1]]
+
+
+@implementer(IStatsProducer)
+class DirectoryIndexCache(object):
+    """I hold the most recently used DirectoryIndex objects, keyed by the
+    storage index of the directory and a hash of its contents (which
+    identifies the version they came from), so that looking up children in
+    the same version of a directory does not parse it again.
+
+    I evict the least recently used indexes to keep the total size of the
+    directories they describe at or below max_size bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._indexes = OrderedDict() # (si, hash) -> DirectoryIndex
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_index(self, storage_index, data):
+        """Return a DirectoryIndex of the given directory contents."""
+        key = (storage_index, hashlib.sha256(data).digest())
+        index = self._indexes.pop(key, None)
+        if index is not None:
+            self.hits += 1
+            # re-insert it, so it becomes the most recently used
+            self._indexes[key] = index
+            return index
+        self.misses += 1
+        index = DirectoryIndex(data)
+        if index.get_size() <= self.max_size:
+            self._indexes[key] = index
+            self._size += index.get_size()
+            while self._size > self.max_size:
+                (_, evicted) = self._indexes.popitem(last=False)
+                self._size -= evicted.get_size()
+                self.evictions += 1
+        return index
+
+    def get_stats(self):
+        return {
+            "dirnode.index_cache.hits": self.hits,
+            "dirnode.index_cache.misses": self.misses,
+            "dirnode.index_cache.evictions": self.evictions,
+            "dirnode.index_cache.indexes": len(self._indexes),
+            "dirnode.index_cache.size": self._size,
+        }
+
+
 @implementer(IDirectoryNode, ICheckable, IDeepCheckable)
 class DirectoryNode(object):
     filenode_class = MutableFileNode
@@ -340,15 +527,28 @@ class DirectoryNode(object):
         a Deferred that fires with the result."""
         return self._node.get_current_size()
 
-    def _read(self):
+    def _download(self):
         if self._node.is_mutable():
             # use the IMutableFileNode API.
-            d = self._node.download_best_version()
-        else:
-            d = download_to_data(self._node)
+            return self._node.download_best_version()
+        return download_to_data(self._node)
+
+    def _read(self):
+        d = self._download()
         d.addCallback(self._unpack_contents)
         return d
 
+    def _read_index(self):
+        d = self._download()
+        d.addCallback(self._index_contents)
+        return d
+
+    def _index_contents(self, data):
+        cache = self._nodemaker.dirnode_index_cache
+        if cache is None:
+            return DirectoryIndex(data)
+        return cache.get_index(self.get_storage_index(), data)
+
     def _decrypt_rwcapdata(self, encwrcap):
         salt = encwrcap[:16]
         crypttext = encwrcap[16:-32]
@@ -372,64 +572,72 @@ class DirectoryNode(object):
         return self._create_and_validate_node(None, node.get_readonly_uri(), name=name)
 
     def _unpack_contents(self, data):
+        assert isinstance(data, bytes), (repr(data), type(data))
+        children = AuxValueDict()
+        index = DirectoryIndex(data)
+        for name in index.get_names():
+            entry = index.get_entry(name)
+            child = self._unpack_entry(name, entry)
+            if child is not None:
+                children.set_with_aux(name, child, auxilliary=entry)
+        return children
+
+    def _unpack_child(self, index, name):
+        """Return the (node, metadata) pair for the named child in the given
+        DirectoryIndex, or None if there is no such child."""
+        entry = index.get_entry(name)
+        if entry is None:
+            return None
+        return self._unpack_entry(name, entry)
+
+    def _unpack_entry(self, name, entry):
         # the directory is serialized as a list of netstrings, one per child.
         # Each child is serialized as a list of four netstrings: (name, ro_uri,
         # rwcapdata, metadata), in which the name, ro_uri, metadata are in
         # cleartext. The 'name' is UTF-8 encoded, and should be normalized to NFC.
         # The rwcapdata is formatted as:
         # pack("16ss32s", iv, AES(H(writekey+iv), plaintext_rw_uri), mac)
-        assert isinstance(data, bytes), (repr(data), type(data))
-        # an empty directory is serialized as an empty string
-        if data == b"":
-            return AuxValueDict()
-        writeable = not self.is_readonly()
-        mutable = self.is_mutable()
-        children = AuxValueDict()
-        position = 0
-        while position < len(data):
-            entries, position = split_netstring(data, 1, position)
-            entry = entries[0]
-            (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
-            if not mutable and len(rwcapdata) > 0:
-                raise ValueError("the rwcapdata field of a dirnode in an immutable directory was not empty")
-
-            # A name containing characters that are unassigned in one version of Unicode might
-            # not be normalized wrt a later version. See the note in section 'Normalization Stability'
-            # at <http://unicode.org/policies/stability_policy.html>.
-            # Therefore we normalize names going both in and out of directories.
-            name = normalize(namex_utf8.decode("utf-8"))
-
-            rw_uri = b""
-            if writeable:
-                rw_uri = self._decrypt_rwcapdata(rwcapdata)
-
-            # Since the encryption uses CTR mode, it currently leaks the length of the
-            # plaintext rw_uri -- and therefore whether it is present, i.e. whether the
-            # dirnode is writeable (ticket #925). By stripping trailing spaces in
-            # Tahoe >= 1.6.0, we may make it easier for future versions to plug this leak.
-            # ro_uri is treated in the same way for consistency.
-            # rw_uri and ro_uri will be either None or a non-empty string.
-
-            rw_uri = rw_uri.rstrip(b' ') or None
-            ro_uri = ro_uri.rstrip(b' ') or None
-
-            try:
-                child = self._create_and_validate_node(rw_uri, ro_uri, name)
-                if mutable or child.is_allowed_in_immutable_directory():
-                    metadata = json.loads(metadata_s)
-                    assert isinstance(metadata, dict)
-                    children[name] = (child, metadata)
-                    children.set_with_aux(name, (child, metadata), auxilliary=entry)
-                else:
-                    log.msg(format="mutable cap for child %(name)s unpacked from an immutable directory",
-                            name=quote_output(name, encoding='utf-8'),
-                            facility="tahoe.webish", level=log.UNUSUAL)
-            except CapConstraintError as e:
-                log.msg(format="unmet constraint on cap for child %(name)s unpacked from a directory:\n"
-                               "%(message)s", message=e.args[0], name=quote_output(name, encoding='utf-8'),
-                               facility="tahoe.webish", level=log.UNUSUAL)
-
-        return children
+        #
+        # A name containing characters that are unassigned in one version of Unicode might
+        # not be normalized wrt a later version. See the note in section 'Normalization Stability'
+        # at <http://unicode.org/policies/stability_policy.html>.
+        # Therefore we normalize names going both in and out of directories
+        # (DirectoryIndex has already done that for 'name').
+        #
+        # I return (child, metadata), or None if the child is to be ignored.
+        (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
+        if not self.is_mutable() and len(rwcapdata) > 0:
+            raise ValueError("the rwcapdata field of a dirnode in an immutable directory was not empty")
+
+        rw_uri = b""
+        if not self.is_readonly():
+            rw_uri = self._decrypt_rwcapdata(rwcapdata)
+
+        # Since the encryption uses CTR mode, it currently leaks the length of the
+        # plaintext rw_uri -- and therefore whether it is present, i.e. whether the
+        # dirnode is writeable (ticket #925). By stripping trailing spaces in
+        # Tahoe >= 1.6.0, we may make it easier for future versions to plug this leak.
+        # ro_uri is treated in the same way for consistency.
+        # rw_uri and ro_uri will be either None or a non-empty string.
+
+        rw_uri = rw_uri.rstrip(b' ') or None
+        ro_uri = ro_uri.rstrip(b' ') or None
+
+        try:
+            child = self._create_and_validate_node(rw_uri, ro_uri, name)
+            if self.is_mutable() or child.is_allowed_in_immutable_directory():
+                metadata = json.loads(metadata_s)
+                assert isinstance(metadata, dict)
+                return (child, metadata)
+            else:
+                log.msg(format="mutable cap for child %(name)s unpacked from an immutable directory",
+                        name=quote_output(name, encoding='utf-8'),
+                        facility="tahoe.webish", level=log.UNUSUAL)
+        except CapConstraintError as e:
+            log.msg(format="unmet constraint on cap for child %(name)s unpacked from a directory:\n"
+                           "%(message)s", message=e.args[0], name=quote_output(name, encoding='utf-8'),
+                           facility="tahoe.webish", level=log.UNUSUAL)
+        return None
 
     def _pack_contents(self, children):
         # expects children in the same format as _unpack_contents returns
@@ -493,18 +701,15 @@ class DirectoryNode(object):
         """I return a Deferred that fires with a boolean, True if there
         exists a child of the given name, False if not."""
         name = normalize(namex)
-        d = self._read()
-        d.addCallback(lambda children: name in children)
+        d = self._read_index()
+        d.addCallback(lambda index: self._unpack_child(index, name) is not None)
         return d
 
-    def _get(self, children, name):
-        child = children.get(name)
-        if child is None:
-            raise NoSuchChildError(name)
-        return child[0]
+    def _get(self, index, name):
+        return self._get_with_metadata(index, name)[0]
 
-    def _get_with_metadata(self, children, name):
-        child = children.get(name)
+    def _get_with_metadata(self, index, name):
+        child = self._unpack_child(index, name)
         if child is None:
             raise NoSuchChildError(name)
         return child
@@ -513,7 +718,7 @@ class DirectoryNode(object):
         """I return a Deferred that fires with the named child node,
         which is an IFilesystemNode."""
         name = normalize(namex)
-        d = self._read()
+        d = self._read_index()
         d.addCallback(self._get, name)
         return d
 
@@ -522,14 +727,14 @@ class DirectoryNode(object):
         the named child. The node is an IFilesystemNode, and the metadata
         is a dictionary."""
         name = normalize(namex)
-        d = self._read()
+        d = self._read_index()
         d.addCallback(self._get_with_metadata, name)
         return d
 
     def get_metadata_for(self, namex):
         name = normalize(namex)
-        d = self._read()
-        d.addCallback(lambda children: children[name][1])
+        d = self._read_index()
+        d.addCallback(lambda index: self._get_with_metadata(index, name)[1])
         return d
 
     def set_metadata_for(self, namex, metadata):
@@ -635,6 +840,33 @@ class DirectoryNode(object):
         d.addCallback(lambda res: child)
         return d
 
+    def apply_edits(self, edits):
+        """I apply a list of edits to my children, all in one modify cycle.
+        Each edit is one of:
+
+         ("set", name, child, metadata, overwrite)
+         ("delete", name)
+         ("rename", from_name, to_name, overwrite)
+
+        where 'child' is an IFilesystemNode, and 'metadata' and 'overwrite'
+        are as for set_node(). I return a Deferred that fires with a list
+        with one entry per edit: None if it was applied, or the exception
+        (ExistingChildError, NoSuchChildError, ...) which prevented it.
+
+        If this directory node is read-only, the Deferred will errback with a
+        NotWriteableError."""
+        if self.is_readonly():
+            return defer.fail(NotWriteableError())
+        for edit in edits:
+            precondition(edit[0] in ("set", "delete", "rename"), edit)
+            if edit[0] == "set":
+                precondition(IFilesystemNode.providedBy(edit[2]), edit)
+        editor = Editor(self, edits,
+                        create_readonly_node=self._create_readonly_node)
+        d = self._node.modify(editor.modify)
+        d.addCallback(lambda res: editor.results)
+        return d
+
     def set_nodes(self, entries, overwrite=True):
         precondition(isinstance(entries, dict), entries)
         if self.is_readonly():
@@ -761,6 +993,11 @@ class DirectoryNode(object):
         directory structure, this may appear to under-count or miss some of
         them.
 
+        I work on several nodes at the same time (as many as the nodemaker's
+        deep_traversal_parallelism), so the walker must not assume that one
+        add_node() call has finished before the next one starts, nor that
+        nodes arrive in depth-first order.
+
         I return a Monitor which can be used to wait for the operation to
         finish, learn about its progress, or cancel the operation.
         """
@@ -770,74 +1007,25 @@ class DirectoryNode(object):
         # fanout to 10 simultaneous operations, but the memory load of the
         # queued operations was excessive (in one case, with 330k dirnodes,
         # it caused the process to run into the 3.0GB-ish per-process 32bit
-        # linux memory limit, and crashed). So we use a single big Deferred
-        # chain, and do a strict depth-first traversal, one node at a time.
-        # This can be slower, because we aren't pipelining directory reads,
-        # but it brought the memory footprint down by roughly 50%.
+        # linux memory limit, and crashed). DeepTraversal keeps a bounded
+        # number of operations in flight instead, and holds the nodes which
+        # are waiting for their turn (and the verifier-caps it has seen) in
+        # temporary databases which spill to disk.
 
         monitor = Monitor()
         walker.set_monitor(monitor)
 
-        found = set([self.get_verify_cap()])
-        d = self._deep_traverse_dirnode(self, [], walker, monitor, found)
+        traversal = DeepTraversal(
+            self, walker, monitor, self._nodemaker,
+            parallelism=self._nodemaker.deep_traversal_parallelism,
+            frontier_size=self._nodemaker.deep_traversal_frontier_size)
+        d = traversal.run()
         d.addCallback(lambda ignored: walker.finish())
         d.addBoth(monitor.finish)
         d.addErrback(lambda f: None)
 
         return monitor
 
-    def _deep_traverse_dirnode(self, node, path, walker, monitor, found):
-        # process this directory, then walk its children
-        monitor.raise_if_cancelled()
-        d = defer.maybeDeferred(walker.add_node, node, path)
-        d.addCallback(lambda ignored: node.list())
-        d.addCallback(self._deep_traverse_dirnode_children, node, path,
-                      walker, monitor, found)
-        return d
-
-    def _deep_traverse_dirnode_children(self, children, parent, path,
-                                        walker, monitor, found):
-        monitor.raise_if_cancelled()
-        d = defer.maybeDeferred(walker.enter_directory, parent, children)
-        # we process file-like children first, so we can drop their FileNode
-        # objects as quickly as possible. Tests suggest that a FileNode (held
-        # in the client's nodecache) consumes about 2440 bytes. dirnodes (not
-        # in the nodecache) seem to consume about 2000 bytes.
-        dirkids = []
-        filekids = []
-        for name, (child, metadata) in sorted(children.items()):
-            childpath = path + [name]
-            if isinstance(child, UnknownNode):
-                walker.add_node(child, childpath)
-                continue
-            verifier = child.get_verify_cap()
-            # allow LIT files (for which verifier==None) to be processed
-            if (verifier is not None) and (verifier in found):
-                continue
-            found.add(verifier)
-            if IDirectoryNode.providedBy(child):
-                dirkids.append( (child, childpath) )
-            else:
-                filekids.append( (child, childpath) )
-        for i, (child, childpath) in enumerate(filekids):
-            d.addCallback(lambda ignored, child=child, childpath=childpath:
-                          walker.add_node(child, childpath))
-            # to work around the Deferred tail-recursion problem
-            # (specifically the defer.succeed flavor) requires us to avoid
-            # doing more than 158 LIT files in a row. We insert a turn break
-            # once every 100 files (LIT or CHK) to preserve some stack space
-            # for other code. This is a different expression of the same
-            # Twisted problem as in #237.
-            if i % 100 == 99:
-                d.addCallback(lambda ignored: fireEventually())
-        for (child, childpath) in dirkids:
-            d.addCallback(lambda ignored, child=child, childpath=childpath:
-                          self._deep_traverse_dirnode(child, childpath,
-                                                      walker, monitor,
-                                                      found))
-        return d
-
-
     def build_manifest(self):
         """Return a Monitor, with a ['status'] that will be a list of (path,
         cap) tuples, for all nodes (directories and files) reachable from
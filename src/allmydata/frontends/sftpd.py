@@ -11,7 +11,8 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
 import six
-import heapq, traceback, stat, struct
+import traceback, stat, struct
+from collections import OrderedDict
 from stat import S_IFREG, S_IFDIR
 from time import time, strftime, localtime
 
@@ -38,10 +39,12 @@ from foolscap.api import eventually
 from allmydata.util import deferredutil
 
 from allmydata.util.assertutil import _assert, precondition
-from allmydata.util.consumer import download_to_data
+from allmydata.util.consumer import MemoryConsumer, download_to_data
 from allmydata.util.encodingutil import get_filesystem_encoding
+from allmydata.util.observer import OneShotObserverList
+from allmydata.util.spans import Spans
 from allmydata.interfaces import IFileNode, IDirectoryNode, ExistingChildError, \
-     NoSuchChildError, ChildOfWrongTypeError
+     NoSuchChildError, ChildOfWrongTypeError, DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.immutable.upload import FileHandle
@@ -306,38 +309,207 @@ def _direntry_for(filenode_or_parent, childname, filenode=None):
 
 
 @implementer(IConsumer)
-class OverwriteableFileConsumer(PrefixingLogMixin):
-    """I act both as a consumer for the download of the original file contents, and as a
-    wrapper for a temporary file that records the downloaded data and any overwrites.
-    I use a priority queue to keep track of which regions of the file have been overwritten
-    but not yet downloaded, so that the download does not clobber overwritten data.
-    I use another priority queue to record milestones at which to make callbacks
-    indicating that a given number of bytes have been downloaded.
+class _CacheFiller(object):
+    """I consume a download of a run of whole blocks into a SparseFileCache,
+    telling it about each block as soon as it is complete."""
+
+    def __init__(self, cache, first_block):
+        self.cache = cache
+        self.offset = first_block * cache.BLOCK_SIZE
+        self.next_block = first_block
+        self.done = False
+
+    def registerProducer(self, p, streaming):
+        if streaming:
+            # call resumeProducing once to start things off
+            p.resumeProducing()
+        else:
+            while not self.done:
+                p.resumeProducing()
+
+    def write(self, data):
+        self.cache._write(self.offset, data)
+        self.offset += len(data)
+        while (self.next_block + 1) * self.cache.BLOCK_SIZE <= self.offset or \
+              (self.offset >= self.cache.size and self.next_block * self.cache.BLOCK_SIZE < self.cache.size):
+            self.cache._got_block(self.next_block)
+            self.next_block += 1
+
+    def unregisterProducer(self):
+        self.done = True
+
+
+class SparseFileCache(PrefixingLogMixin):
+    """I hold those parts of the contents of a readable version of a file that
+    have been fetched from the grid, in a temporary file, so that each part is
+    only fetched once. I fetch whole blocks of BLOCK_SIZE bytes (the default
+    segment size) when they are first read, using ranged reads of the version,
+    so reading a small part of a large file only downloads the segments that
+    cover it. Reads of blocks that are already being fetched wait for that
+    fetch rather than starting another.
+
+    The contents of an immutable file never change, so I may be shared by
+    every handle that reads it; see get_file_cache. self.users counts those
+    handles."""
+
+    BLOCK_SIZE = DEFAULT_MAX_SEGMENT_SIZE
+
+    def __init__(self, version, tempfile_maker, key=None):
+        PrefixingLogMixin.__init__(self, facility="tahoe.sftp")
+        if noisy: self.log(".__init__(%r, %r)" % (version, tempfile_maker), level=NOISY)
+        self.version = version
+        self.key = key
+        self.size = version.get_size()
+        _assert(self.size is not None)
+        self.f = tempfile_maker()
+        self.blocks = set()  # blocks that are in self.f
+        self.fetching = {}   # block -> OneShotObserverList, for blocks being fetched
+        self.users = 0
+        self.is_closed = False
+
+    def get_size(self):
+        return self.size
+
+    def get_cached_size(self):
+        """Return roughly how many bytes of my temporary file are in use."""
+        return len(self.blocks) * self.BLOCK_SIZE
+
+    def read(self, offset, length):
+        """Return a Deferred that fires with the length bytes at offset, or
+        fewer if they extend past the end of the file."""
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return defer.succeed(b"")
+
+        first = offset // self.BLOCK_SIZE
+        last = (end - 1) // self.BLOCK_SIZE
+        run_start = None
+        fetches = []
+        for block in range(first, last + 2):
+            missing = (block <= last and block not in self.blocks and block not in self.fetching)
+            if missing and run_start is None:
+                run_start = block
+            elif not missing and run_start is not None:
+                fetches.append(self._fetch(run_start, block - 1))
+                run_start = None
+
+        # A fetch that fails synchronously has already given up its blocks,
+        # so its own Deferred is the only place that its failure is reported.
+        d = deferredutil.gatherResults(fetches +
+                                       [self.fetching[block].when_fired()
+                                        for block in range(first, last + 1)
+                                        if block in self.fetching])
+        def _fetched(ign):
+            missing = [block for block in range(first, last + 1) if block not in self.blocks]
+            if missing:
+                raise EOFError("blocks %r of the file could not be fetched" % (missing,))
+            self.f.seek(offset)
+            return self.f.read(end - offset)
+        d.addCallback(_fetched)
+        return d
+
+    def read_without_caching(self, offset, length):
+        """Like read, except that the parts of the range which I do not hold
+        or am not already fetching are downloaded into memory and returned,
+        rather than being added to me. This is for reads that will not be
+        repeated, such as filling in the rest of a file that is about to be
+        uploaded, which would otherwise be written to disk twice."""
+        end = min(offset + length, self.size)
+        pieces = []
+        start = offset
+        while start < end:
+            held = self._holds(start // self.BLOCK_SIZE)
+            run_end = start
+            while run_end < end and self._holds(run_end // self.BLOCK_SIZE) == held:
+                run_end = min((run_end // self.BLOCK_SIZE + 1) * self.BLOCK_SIZE, end)
+            if held:
+                pieces.append(self.read(start, run_end - start))
+            else:
+                d = self.version.read(MemoryConsumer(), start, run_end - start)
+                d.addCallback(lambda mc: b"".join(mc.chunks))
+                pieces.append(d)
+            start = run_end
+
+        d = deferredutil.gatherResults(pieces)
+        d.addCallback(lambda data: b"".join(data))
+        return d
+
+    def _holds(self, block):
+        return block in self.blocks or block in self.fetching
+
+    def _fetch(self, first, last):
+        if noisy: self.log("._fetch(%r, %r)" % (first, last), level=NOISY)
+        for block in range(first, last + 1):
+            self.fetching[block] = OneShotObserverList()
+
+        start = first * self.BLOCK_SIZE
+        end = min((last + 1) * self.BLOCK_SIZE, self.size)
+        filler = _CacheFiller(self, first)
+        d = self.version.read(filler, start, end - start)
+        def _check(res):
+            if filler.next_block <= last and not isinstance(res, Failure):
+                # the download succeeded, but did not give us all that we asked for
+                res = Failure(EOFError("download ended early at offset %r of %r" % (filler.offset, end)))
+            if isinstance(res, Failure):
+                for block in range(filler.next_block, last + 1):
+                    # these may be fetched again by a later read
+                    self.fetching.pop(block).fire(res)
+                return res
+            return None
+        d.addBoth(_check)
+        return d
+
+    def _write(self, offset, data):
+        if self.is_closed:
+            # a fetch finished after the last handle using me was closed
+            return
+        self.f.seek(offset)
+        self.f.write(data)
+
+    def close(self):
+        if not self.is_closed:
+            self.is_closed = True
+            try:
+                self.f.close()
+            except Exception as e:
+                self.log("suppressed %r from close of temporary file %r" % (e, self.f), level=WEIRD)
+
+    def _got_block(self, block):
+        self.blocks.add(block)
+        self.fetching.pop(block).fire(None)
+
+
+class OverwriteableFile(PrefixingLogMixin):
+    """I represent the contents of a file that is open for reading and maybe
+    writing. Data that has not been overwritten is read from a SparseFileCache
+    of the original file, if there is one; overwrites are recorded in a
+    temporary file, along with the regions that they cover.
 
     The temporary file reflects the contents of the file that I represent, except that:
-     - regions that have neither been downloaded nor overwritten, if present,
-       contain garbage.
+     - regions that have not been overwritten, if present, contain garbage.
      - the temporary file may be shorter than the represented file (it is never longer).
        The latter's current size is stored in self.current_size.
 
+    fill() copies every region that has not been overwritten into the temporary
+    file, which can then be used as the complete contents of the file. Data at
+    offsets of download_size or more has always been overwritten, since it was
+    written or truncated-and-extended by the client.
+
     This abstraction is mostly independent of SFTP. Consider moving it, if it is found
     useful for other frontends."""
 
-    def __init__(self, download_size, tempfile_maker):
+    FILL_SIZE = 32 * SparseFileCache.BLOCK_SIZE
+
+    def __init__(self, source, tempfile_maker):
         PrefixingLogMixin.__init__(self, facility="tahoe.sftp")
-        if noisy: self.log(".__init__(%r, %r)" % (download_size, tempfile_maker), level=NOISY)
-        self.download_size = download_size
-        self.current_size = download_size
+        if noisy: self.log(".__init__(%r, %r)" % (source, tempfile_maker), level=NOISY)
+        self.source = source
+        self.download_size = source.get_size() if source else 0
+        self.current_size = self.download_size
         self.f = tempfile_maker()
-        self.downloaded = 0
-        self.milestones = []  # empty heap of (offset, d)
-        self.overwrites = []  # empty heap of (start, end)
+        self.overwritten = Spans()
         self.is_closed = False
 
-        self.done = defer.Deferred()
-        self.done_status = None  # None -> not complete, Failure -> download failed, str -> download succeeded
-        self.producer = None
-
     def get_file(self):
         return self.f
 
@@ -345,10 +517,11 @@ class OverwriteableFileConsumer(PrefixingLogMixin):
         return self.current_size
 
     def set_current_size(self, size):
-        if noisy: self.log(".set_current_size(%r), current_size = %r, downloaded = %r" %
-                           (size, self.current_size, self.downloaded), level=NOISY)
-        if size < self.current_size or size < self.downloaded:
+        if noisy: self.log(".set_current_size(%r), current_size = %r, download_size = %r" %
+                           (size, self.current_size, self.download_size), level=NOISY)
+        if size < self.current_size:
             self.f.truncate(size)
+            self.overwritten.remove(size, self.current_size - size)
         if size > self.current_size:
             self.overwrite(self.current_size, b"\x00" * (size - self.current_size))
         self.current_size = size
@@ -357,96 +530,10 @@ class OverwriteableFileConsumer(PrefixingLogMixin):
         if size < self.download_size:
             self.download_size = size
 
-        if self.downloaded >= self.download_size:
-            self.download_done(b"size changed")
-
-    def registerProducer(self, p, streaming):
-        if noisy: self.log(".registerProducer(%r, streaming=%r)" % (p, streaming), level=NOISY)
-        if self.producer is not None:
-            raise RuntimeError("producer is already registered")
-
-        self.producer = p
-        if streaming:
-            # call resumeProducing once to start things off
-            p.resumeProducing()
-        else:
-            def _iterate():
-                if self.done_status is None:
-                    p.resumeProducing()
-                    eventually(_iterate)
-            _iterate()
-
-    def write(self, data):
-        if noisy: self.log(".write(<data of length %r>)" % (len(data),), level=NOISY)
-        if self.is_closed:
-            return
-
-        if self.downloaded >= self.download_size:
-            return
-
-        next_downloaded = self.downloaded + len(data)
-        if next_downloaded > self.download_size:
-            data = data[:(self.download_size - self.downloaded)]
-
-        while len(self.overwrites) > 0:
-            (start, end) = self.overwrites[0]
-            if start >= next_downloaded:
-                # This and all remaining overwrites are after the data we just downloaded.
-                break
-            if start > self.downloaded:
-                # The data we just downloaded has been partially overwritten.
-                # Write the prefix of it that precedes the overwritten region.
-                self.f.seek(self.downloaded)
-                self.f.write(data[:(start - self.downloaded)])
-
-            # This merges consecutive overwrites if possible, which allows us to detect the
-            # case where the download can be stopped early because the remaining region
-            # to download has already been fully overwritten.
-            heapq.heappop(self.overwrites)
-            while len(self.overwrites) > 0:
-                (start1, end1) = self.overwrites[0]
-                if start1 > end:
-                    break
-                end = end1
-                heapq.heappop(self.overwrites)
-
-            if end >= next_downloaded:
-                # This overwrite extends past the downloaded data, so there is no
-                # more data to consider on this call.
-                heapq.heappush(self.overwrites, (next_downloaded, end))
-                self._update_downloaded(next_downloaded)
-                return
-            elif end >= self.downloaded:
-                data = data[(end - self.downloaded):]
-                self._update_downloaded(end)
-
-        self.f.seek(self.downloaded)
-        self.f.write(data)
-        self._update_downloaded(next_downloaded)
-
-    def _update_downloaded(self, new_downloaded):
-        self.downloaded = new_downloaded
-        milestone = new_downloaded
-        if len(self.overwrites) > 0:
-            (start, end) = self.overwrites[0]
-            if start <= new_downloaded and end > milestone:
-                milestone = end
-
-        while len(self.milestones) > 0:
-            (next_, d) = self.milestones[0]
-            if next_ > milestone:
-                return
-            if noisy: self.log("MILESTONE %r %r" % (next_, d), level=NOISY)
-            heapq.heappop(self.milestones)
-            eventually_callback(d)(b"reached")
-
-        if milestone >= self.download_size:
-            self.download_done(b"reached download size")
-
     def overwrite(self, offset, data):
         if noisy: self.log(".overwrite(%r, <data of length %r>)" % (offset, len(data)), level=NOISY)
         if self.is_closed:
-            self.log("overwrite called on a closed OverwriteableFileConsumer", level=WEIRD)
+            self.log("overwrite called on a closed OverwriteableFile", level=WEIRD)
             raise createSFTPError(FX_BAD_MESSAGE, "cannot write to a closed file handle")
 
         if offset > self.current_size:
@@ -467,17 +554,16 @@ class OverwriteableFileConsumer(PrefixingLogMixin):
         self.f.write(data)
         end = offset + len(data)
         self.current_size = max(self.current_size, end)
-        if end > self.downloaded:
-            heapq.heappush(self.overwrites, (start, end))
+        if end > start:
+            self.overwritten.add(start, end - start)
 
     def read(self, offset, length):
         """When the data has been read, callback the Deferred that we return with this data.
-        Otherwise errback the Deferred that we return.
-        The caller must perform no more overwrites until the Deferred has fired."""
+        Otherwise errback the Deferred that we return."""
 
         if noisy: self.log(".read(%r, %r), current_size = %r" % (offset, length, self.current_size), level=NOISY)
         if self.is_closed:
-            self.log("read called on a closed OverwriteableFileConsumer", level=WEIRD)
+            self.log("read called on a closed OverwriteableFile", level=WEIRD)
             raise createSFTPError(FX_BAD_MESSAGE, "cannot read from a closed file handle")
 
         # Note that the overwrite method is synchronous. When a write request is processed
@@ -492,70 +578,61 @@ class OverwriteableFileConsumer(PrefixingLogMixin):
         if offset + length > self.current_size:
             length = self.current_size - offset
             if noisy: self.log("truncating read to %r bytes" % (length,), level=NOISY)
-
-        needed = min(offset + length, self.download_size)
-
-        # If we fail to reach the needed number of bytes, the read request will fail.
-        d = self.when_reached_or_failed(needed)
-        def _reached_in_read(res):
-            # It is not necessarily the case that self.downloaded >= needed, because
-            # the file might have been truncated (thus truncating the download) and
-            # then extended.
-
-            _assert(self.current_size >= offset + length,
-                    current_size=self.current_size, offset=offset, length=length)
-            if noisy: self.log("_reached_in_read(%r), self.f = %r" % (res, self.f,), level=NOISY)
-            self.f.seek(offset)
-            return self.f.read(length)
-        d.addCallback(_reached_in_read)
-        return d
-
-    def when_reached_or_failed(self, index):
-        if noisy: self.log(".when_reached_or_failed(%r)" % (index,), level=NOISY)
-        def _reached(res):
-            if noisy: self.log("reached %r with result %r" % (index, res), level=NOISY)
-            return res
-
-        if self.done_status is not None:
-            return defer.execute(_reached, self.done_status)
-        if index <= self.downloaded:  # already reached successfully
-            if noisy: self.log("already reached %r successfully" % (index,), level=NOISY)
-            return defer.succeed("already reached successfully")
-        d = defer.Deferred()
-        d.addCallback(_reached)
-        heapq.heappush(self.milestones, (index, d))
-        return d
-
-    def when_done(self):
-        d = defer.Deferred()
-        self.done.addCallback(lambda ign: eventually_callback(d)(self.done_status))
+        if length <= 0:
+            return defer.succeed(b"")
+
+        gaps = list(Spans(offset, length) - self.overwritten)
+        if not gaps:
+            return defer.succeed(self._read_overwritten(offset, length, []))
+
+        (fetch_start, _) = gaps[0]
+        fetch_end = sum(gaps[-1])
+        d = self.source.read(fetch_start, fetch_end - fetch_start)
+        def _fetched(data):
+            # Overwrites or truncations may have happened while we waited,
+            # but they can only have shrunk the gaps.
+            end = min(offset + length, self.current_size)
+            if offset >= end:
+                raise EOFError("read past end of file")
+            pieces = [(start, data[start - fetch_start:start - fetch_start + gap_length])
+                      for (start, gap_length) in Spans(offset, end - offset) - self.overwritten]
+            return self._read_overwritten(offset, end - offset, pieces)
+        d.addCallback(_fetched)
         return d
 
-    def download_done(self, res):
-        _assert(isinstance(res, (bytes, Failure)), res=res)
-        # Only the first call to download_done counts, but we log subsequent calls
-        # (multiple calls are normal).
-        if self.done_status is not None:
-            self.log("IGNORING extra call to download_done with result %r; previous result was %r"
-                     % (res, self.done_status), level=OPERATIONAL)
-            return
-
-        self.log("DONE with result %r" % (res,), level=OPERATIONAL)
-
-        # We avoid errbacking self.done so that we are not left with an 'Unhandled error in Deferred'
-        # in case when_done() is never called. Instead we stash the failure in self.done_status,
-        # from where the callback added in when_done() can retrieve it.
-        self.done_status = res
-        eventually_callback(self.done)(None)
-
-        while len(self.milestones) > 0:
-            (next_, d) = self.milestones[0]
-            if noisy: self.log("MILESTONE FINISH %r %r %r" % (next_, d, res), level=NOISY)
-            heapq.heappop(self.milestones)
-            # The callback means that the milestone has been reached if
-            # it is ever going to be. Note that the file may have been
-            # truncated to before the milestone.
-            eventually_callback(d)(res)
+    def _read_overwritten(self, offset, length, pieces):
+        # Read from the temporary file, then patch in the (start, data) pieces
+        # for the regions that have not been overwritten.
+        self.f.seek(offset)
+        data = bytearray(self.f.read(length))
+        data.extend(b"\x00" * (length - len(data)))
+        for (start, piece) in pieces:
+            data[start - offset:start - offset + len(piece)] = piece
+        return bytes(data)
+
+    @defer.inlineCallbacks
+    def fill(self):
+        """Copy the regions that have not been overwritten into the temporary
+        file, FILL_SIZE bytes at a time. The Deferred I return fires when it
+        holds all of the contents, or fails if they could not be read."""
+        while True:
+            gaps = list(Spans(0, self.download_size) - self.overwritten) if self.download_size else []
+            if not gaps:
+                return
+            (start, length) = gaps[0]
+            length = min(length, self.FILL_SIZE)
+            data = yield self.source.read_without_caching(start, length)
+            _assert(len(data) == length, start=start, length=length, got=len(data))
+            if self.is_closed:
+                raise createSFTPError(FX_BAD_MESSAGE, "cannot fill a closed file handle")
+            # The gap may have been overwritten or truncated while we waited.
+            length = min(length, self.download_size - start)
+            if length <= 0:
+                continue
+            for (gap_start, gap_length) in Spans(start, length) - self.overwritten:
+                self.f.seek(gap_start)
+                self.f.write(data[gap_start - start:gap_start - start + gap_length])
+                self.overwritten.add(gap_start, gap_length)
 
     def close(self):
         if not self.is_closed:
@@ -564,14 +641,51 @@ class OverwriteableFileConsumer(PrefixingLogMixin):
                 self.f.close()
             except Exception as e:
                 self.log("suppressed %r from close of temporary file %r" % (e, self.f), level=WEIRD)
-        self.download_done(b"closed")
-        return self.done_status
-
-    def unregisterProducer(self):
-        # This will happen just before our client calls download_done, which will tell
-        # us the outcome of the download; we don't know the outcome at this point.
-        self.producer = None
-        self.log("producer unregistered", level=NOISY)
+            if self.source:
+                release_file_cache(self.source)
+
+
+# maps from read-only URIs of immutable files to caches of their contents, most recently used last
+all_file_caches = OrderedDict()
+# Caches that no handle is using are closed, least recently used first, when
+# all of the caches together hold more than this many bytes. Caches in use
+# are never closed.
+MAX_FILE_CACHE_BYTES = 64 * 1024 * 1024
+
+def get_file_cache(filenode, version, tempfile_maker):
+    """Return a SparseFileCache for the given readable version of filenode,
+    which must be passed to release_file_cache when the caller has finished
+    with it. The caches of immutable files are kept, so that handles opened
+    on the same file, by any user, share what has been fetched. Mutable files
+    may change, so each call for one of them gets a new cache."""
+    if filenode.is_mutable():
+        cache = SparseFileCache(version, tempfile_maker)
+    else:
+        key = filenode.get_readonly_uri()
+        cache = all_file_caches.pop(key, None)
+        if cache is None:
+            cache = SparseFileCache(version, tempfile_maker, key)
+        all_file_caches[key] = cache
+    cache.users += 1
+    _trim_file_caches()
+    return cache
+
+def release_file_cache(cache):
+    cache.users -= 1
+    if cache.users == 0 and all_file_caches.get(cache.key) is not cache:
+        cache.close()
+    _trim_file_caches()
+
+def _trim_file_caches():
+    total = sum([cache.get_cached_size() for cache in all_file_caches.values()])
+    for key in list(all_file_caches):
+        if total <= MAX_FILE_CACHE_BYTES:
+            break
+        cache = all_file_caches[key]
+        if cache.users == 0:
+            del all_file_caches[key]
+            total -= cache.get_cached_size()
+            cache.close()
 
 
 SIZE_THRESHOLD = 1000
@@ -658,12 +772,15 @@ class ShortReadOnlySFTPFile(PrefixingLogMixin):
 @implementer(ISFTPFile)
 class GeneralSFTPFile(PrefixingLogMixin):
     """I represent a file handle to a particular file on an SFTP connection.
-    I wrap an instance of OverwriteableFileConsumer, which is responsible for
+    I wrap an instance of OverwriteableFile, which is responsible for
     storing the file contents. In order to allow write requests to be satisfied
     immediately, there is effectively a FIFO queue between requests made to this
-    file handle, and requests to my OverwriteableFileConsumer. This queue is
+    file handle, and requests to my OverwriteableFile. This queue is
     implemented by the callback chain of self.async_.
 
+    The original contents of the file are only downloaded where they are read,
+    or, if the file is changed, when it is closed.
+
     When first constructed, I am in an 'unopened' state that causes most
     operations to be delayed until 'open' is called."""
 
@@ -687,9 +804,9 @@ class GeneralSFTPFile(PrefixingLogMixin):
         self.filenode = None
         self.metadata = None
 
-        # self.consumer should only be relied on in callbacks for self.async_, since it might
+        # self.contents should only be relied on in callbacks for self.async_, since it might
         # not be set before then.
-        self.consumer = None
+        self.contents = None
 
     def open(self, parent=None, childname=None, filenode=None, metadata=None):  # noqa: F811
         self.log(".open(parent=%r, childname=%r, filenode=%r, metadata=%r)" %
@@ -711,26 +828,15 @@ class GeneralSFTPFile(PrefixingLogMixin):
 
         if (self.flags & FXF_TRUNC) or not filenode:
             # We're either truncating or creating the file, so we don't need the old contents.
-            self.consumer = OverwriteableFileConsumer(0, tempfile_maker)
-            self.consumer.download_done(b"download not needed")
+            self.contents = OverwriteableFile(None, tempfile_maker)
         else:
             self.async_.addCallback(lambda ignored: filenode.get_best_readable_version())
 
-            def _read(version):
-                if noisy: self.log("_read", level=NOISY)
-                download_size = version.get_size()
-                _assert(download_size is not None)
-
-                self.consumer = OverwriteableFileConsumer(download_size, tempfile_maker)
-
-                d = version.read(self.consumer, 0, None)
-                def _finished(res):
-                    if not isinstance(res, Failure):
-                        res = b"download finished"
-                    self.consumer.download_done(res)
-                d.addBoth(_finished)
-                # It is correct to drop d here.
-            self.async_.addCallback(_read)
+            def _got_version(version):
+                if noisy: self.log("_got_version", level=NOISY)
+                source = get_file_cache(filenode, version, tempfile_maker)
+                self.contents = OverwriteableFile(source, tempfile_maker)
+            self.async_.addCallback(_got_version)
 
         eventually_callback(self.async_)(None)
 
@@ -784,7 +890,7 @@ class GeneralSFTPFile(PrefixingLogMixin):
         d = defer.Deferred()
         def _read(ign):
             if noisy: self.log("_read in readChunk(%r, %r)" % (offset, length), level=NOISY)
-            d2 = self.consumer.read(offset, length)
+            d2 = self.contents.read(offset, length)
             d2.addBoth(eventually_callback(d))
             # It is correct to drop d2 here.
             return None
@@ -816,13 +922,13 @@ class GeneralSFTPFile(PrefixingLogMixin):
 
         def _write(ign):
             if noisy: self.log("_write in .writeChunk(%r, <data of length %r>), current_size = %r" %
-                               (offset, len(data), self.consumer.get_current_size()), level=NOISY)
+                               (offset, len(data), self.contents.get_current_size()), level=NOISY)
             # FXF_APPEND means that we should always write at the current end of file.
             write_offset = offset
             if self.flags & FXF_APPEND:
-                write_offset = self.consumer.get_current_size()
+                write_offset = self.contents.get_current_size()
 
-            self.consumer.overwrite(write_offset, data)
+            self.contents.overwrite(write_offset, data)
             if noisy: self.log("overwrite done", level=NOISY)
             return None
         self.async_.addCallback(_write)
@@ -831,17 +937,13 @@ class GeneralSFTPFile(PrefixingLogMixin):
 
     def _do_close(self, res, d=None):
         if noisy: self.log("_do_close(%r)" % (res,), level=NOISY)
-        status = None
-        if self.consumer:
-            status = self.consumer.close()
+        if self.contents:
+            self.contents.close()
 
         # We must close_notify before re-firing self.async_.
         if self.close_notify:
             self.close_notify(self.userpath, self.parent, self.childname, self)
 
-        if not isinstance(res, Failure) and isinstance(status, Failure):
-            res = status
-
         if d:
             eventually_callback(d)(res)
         elif isinstance(res, Failure):
@@ -862,7 +964,7 @@ class GeneralSFTPFile(PrefixingLogMixin):
             # failed to download. (We could not do so deterministically, because it would
             # depend on whether we reached the point of failure before abandoning the
             # download.) Any reads that depended on file content that could not be downloaded
-            # will have failed. It is important that we don't close the consumer until
+            # will have failed. It is important that we don't close the contents until
             # previous read operations have completed.
             self.async_.addBoth(self._do_close)
             return defer.succeed(None)
@@ -880,7 +982,7 @@ class GeneralSFTPFile(PrefixingLogMixin):
         has_changed = self.has_changed
 
         def _commit(ign):
-            d2 = self.consumer.when_done()
+            d2 = self.contents.fill()
             if self.filenode and self.filenode.is_mutable():
                 self.log("update mutable file %r childname=%r metadata=%r"
                          % (self.filenode, childname, self.metadata), level=OPERATIONAL)
@@ -888,11 +990,11 @@ class GeneralSFTPFile(PrefixingLogMixin):
                     _assert(parent and childname, parent=parent, childname=childname, metadata=self.metadata)
                     d2.addCallback(lambda ign: parent.set_metadata_for(childname, self.metadata))
 
-                d2.addCallback(lambda ign: self.filenode.overwrite(MutableFileHandle(self.consumer.get_file())))
+                d2.addCallback(lambda ign: self.filenode.overwrite(MutableFileHandle(self.contents.get_file())))
             else:
                 def _add_file(ign):
                     self.log("_add_file childname=%r" % (childname,), level=OPERATIONAL)
-                    u = FileHandle(self.consumer.get_file(), self.convergence)
+                    u = FileHandle(self.contents.get_file(), self.convergence)
                     return parent.add_file(childname, u, metadata=self.metadata)
                 d2.addCallback(_add_file)
             return d2
@@ -928,7 +1030,7 @@ class GeneralSFTPFile(PrefixingLogMixin):
             if noisy: self.log("_get(%r) in %r, filenode = %r, metadata = %r" % (ign, request, self.filenode, self.metadata), level=NOISY)
 
             # self.filenode might be None, but that's ok.
-            attrs = _populate_attrs(self.filenode, self.metadata, size=self.consumer.get_current_size())
+            attrs = _populate_attrs(self.filenode, self.metadata, size=self.contents.get_current_size())
             eventually_callback(d)(attrs)
             return None
         self.async_.addCallbacks(_get, eventually_errback(d))
@@ -966,7 +1068,7 @@ class GeneralSFTPFile(PrefixingLogMixin):
             if size is not None:
                 # TODO: should we refuse to truncate a file opened with FXF_APPEND?
                 # <http://allmydata.org/trac/tahoe-lafs/ticket/1037#comment:20>
-                self.consumer.set_current_size(size)
+                self.contents.set_current_size(size)
             eventually_callback(d)(None)
             return None
         self.async_.addCallbacks(_set, eventually_errback(d))
@@ -1001,8 +1103,13 @@ class Reason(object):
 all_heisenfiles = {}
 
 def _reload():
-    global all_heisenfiles
+    global all_heisenfiles, all_file_caches
     all_heisenfiles = {}
+    # caches still in use are closed when they are released
+    for cache in all_file_caches.values():
+        if cache.users == 0:
+            cache.close()
+    all_file_caches = OrderedDict()
 
 @implementer(ISFTPServer)
 class SFTPUserHandler(ConchUser, PrefixingLogMixin):
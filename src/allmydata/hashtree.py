@@ -61,7 +61,9 @@ if PY2:
 from allmydata.util import mathutil # from the pyutil library
 
 from allmydata.util import base32
-from allmydata.util.hashutil import tagged_hash, tagged_pair_hash
+from allmydata.util.hashutil import (
+    tagged_hash, tagged_hashes, tagged_pair_hash, tagged_pair_hashes,
+)
 
 __version__ = '1.0.0-allmydata'
 
@@ -148,6 +150,26 @@ class CompleteBinaryTreeMixin(object):
             here = self.parent(here)
         return needed
 
+    def needed_for_many(self, indices):
+        """
+        Return the set of node indices that are necessary for the hash
+        chains of all of the given nodes at once: the siblings of the nodes
+        between them and the root which are not themselves between one of
+        them and the root, since those can be computed.
+        """
+        paths = set()
+        for i in indices:
+            if i < 0 or i >= len(self):
+                raise IndexError('index out of range: 0 >= %s < %s' % (i, len(self)))
+            # stop once we join a path we have already walked
+            while i not in paths:
+                paths.add(i)
+                if i == 0:
+                    break
+                i = (i - 1) // 2
+        return set(i - 1 if i % 2 == 0 else i + 1
+                   for i in paths if i != 0) - paths
+
     def depth_first(self, i=0):
         yield i, 0
         try:
@@ -184,9 +206,18 @@ def depth_of(i):
 def empty_leaf_hash(i):
     return tagged_hash(b'Merkle tree empty leaf', b"%d" % i)
 
+def empty_leaf_hashes(start, end):
+    """Return empty_leaf_hash(i) for each i in range(start, end)."""
+    return tagged_hashes(b'Merkle tree empty leaf',
+                         [b"%d" % i for i in range(start, end)])
+
 def pair_hash(a, b):
     return tagged_pair_hash(b'Merkle tree internal node', a, b)
 
+def pair_hashes(pairs):
+    """Return pair_hash(a, b) for each (a, b) in pairs."""
+    return tagged_pair_hashes(b'Merkle tree internal node', pairs)
+
 class HashTree(CompleteBinaryTreeMixin, list):
     """
     Compute Merkle hashes at any node in a complete binary tree.
@@ -216,22 +247,20 @@ class HashTree(CompleteBinaryTreeMixin, list):
         '%d'%i))}.
         """
 
-        # Augment the list.
+        # Augment the list, as the bottom row of the flattened tree.
         start = len(L)
         end   = roundup_pow2(len(L))
-        self.first_leaf_num = end - 1
-        L     = L + [None] * (end - start)
-        for i in range(start, end):
-            L[i] = empty_leaf_hash(i)
-        # Form each row of the tree.
-        rows = [L]
-        while len(rows[-1]) != 1:
-            last = rows[-1]
-            rows += [[pair_hash(last[2*i], last[2*i+1])
-                                for i in range(len(last)//2)]]
-        # Flatten the list of rows into a single list.
-        rows.reverse()
-        self[:] = sum(rows, [])
+        self.first_leaf_num = first = end - 1
+        self[:] = [None] * first
+        self.extend(L)
+        self.extend(empty_leaf_hashes(start, end))
+        # Fill in each row from the one below it: row n starts at 2**n-1.
+        while first:
+            children = self[first:2*first+1]
+            parent_first = (first - 1) // 2
+            self[parent_first:first] = pair_hashes(zip(children[0::2],
+                                                       children[1::2]))
+            first = parent_first
 
     def needed_hashes(self, leafnum, include_leaf=False):
         """Which hashes will someone need to validate a given data block?
@@ -263,6 +292,22 @@ class HashTree(CompleteBinaryTreeMixin, list):
             needed.add(self.first_leaf_num + leafnum)
         return needed
 
+    def needed_hashes_for_leaves(self, leafnums, include_leaf=False):
+        """Which hashes will someone need to validate several data blocks
+        at once?
+
+        I am like needed_hashes(), but for a set of leaf numbers. Hashes on
+        the path from one of the leaves to the root are not included (except
+        for the leaves themselves, if you pass include_leaf=True), since
+        they can be computed from the leaves, so this is usually smaller than
+        the union of needed_hashes() for each leaf.
+        """
+        leaves = [self.first_leaf_num + leafnum for leafnum in leafnums]
+        needed = self.needed_for_many(leaves)
+        if include_leaf:
+            needed.update(leaves)
+        return needed
+
 
 class NotEnoughHashesError(Exception):
     pass
@@ -294,18 +339,9 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
     """
 
     def __init__(self, num_leaves):
-        L = [None] * num_leaves
-        start = len(L)
-        end   = roundup_pow2(len(L))
+        end = roundup_pow2(num_leaves)
         self.first_leaf_num = end - 1
-        L     = L + [None] * (end - start)
-        rows = [L]
-        while len(rows[-1]) != 1:
-            last = rows[-1]
-            rows += [[None for i in range(len(last)//2)]]
-        # Flatten the list of rows into a single list.
-        rows.reverse()
-        self[:] = sum(rows, [])
+        self[:] = [None] * (2 * end - 1)
 
 
     def needed_hashes(self, leafnum, include_leaf=False):
@@ -324,6 +360,20 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
             maybe_needed.add(self.first_leaf_num + leafnum)
         return set([i for i in maybe_needed if self[i] is None])
 
+    def needed_hashes_for_leaves(self, leafnums, include_leaf=False):
+        """Which new hashes do I need to validate several data blocks at
+        once?
+
+        I am like HashTree.needed_hashes_for_leaves(), except that I don't
+        include hashes that I already know about. The leaf hashes and the
+        hashes I return can then all be given to a single set_hashes() call.
+        """
+        leaves = [self.first_leaf_num + leafnum for leafnum in leafnums]
+        maybe_needed = self.needed_for_many(leaves)
+        if include_leaf:
+            maybe_needed.update(leaves)
+        return set([i for i in maybe_needed if self[i] is None])
+
     def _name_hash(self, i):
         name = "[%d of %d]" % (i, len(self))
         if i >= self.first_leaf_num:
@@ -389,7 +439,7 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
         assert isinstance(leaves, dict)
         for h in leaves.values():
             assert isinstance(h, bytes)
-        new_hashes = hashes.copy()
+        new_hashes = hashes.copy() if leaves else hashes
         for leafnum,leafhash in leaves.items():
             hashnum = self.first_leaf_num + leafnum
             if hashnum in new_hashes:
@@ -408,14 +458,13 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
         #     holes. Don't overwrite anything, but new values must equal the
         #     existing ones. Mark everything that was added with a red dot
         #     (meaning "not yet validated")
-        #  C: start with the lowest/deepest level. Pick any red-dotted node,
-        #     hash it with its sibling to compute the parent hash. Add the
-        #     parent to the tree just like in step B (if the parent already
-        #     exists, the values must be equal; if not, add our computed
-        #     value with a red dot). If we have no sibling, throw
-        #     NotEnoughHashesError, since we won't be able to validate this
-        #     node. Remove the red dot. If there was a red dot on our
-        #     sibling, remove it too.
+        #  C: start with the lowest/deepest level. Find the parents of all
+        #     the red-dotted nodes. If any red-dotted node has no sibling,
+        #     throw NotEnoughHashesError, since we won't be able to validate
+        #     it. Hash each pair of siblings (all in one batch) to compute
+        #     their parent hash. Add the parent to the tree just like in
+        #     step B (if the parent already exists, the values must be
+        #     equal; if not, add our computed value with a red dot).
         #  D: finish all red-dotted nodes in one level before moving up to
         #     the next.
         #  E: if we hit NotEnoughHashesError or BadHashError before getting
@@ -443,44 +492,85 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
                     self[i] = h
                     remove_upon_failure.add(i)
 
-            for level in reversed(range(len(hashes_to_check))):
-                this_level = hashes_to_check[level]
-                while this_level:
-                    i = this_level.pop()
-                    if i == 0:
-                        # The root has no sibling. How lonely. You can't
-                        # really *check* the root; you either accept it
-                        # because the caller told you what it is by including
-                        # it in hashes, or you accept it because you
-                        # calculated it from its two children. You probably
-                        # want to set the root (from a trusted source) before
-                        # adding any children from an untrusted source.
-                        continue
-                    siblingnum = self.sibling(i)
-                    if self[siblingnum] is None:
+            for level in reversed(range(1, len(hashes_to_check))):
+                # The root (at level 0) has no sibling. How lonely. You
+                # can't really *check* the root; you either accept it
+                # because the caller told you what it is by including it in
+                # hashes, or you accept it because you calculated it from
+                # its two children. You probably want to set the root (from
+                # a trusted source) before adding any children from an
+                # untrusted source.
+                parents = sorted(set([(i - 1) // 2
+                                      for i in hashes_to_check[level]]))
+                for parentnum in parents:
+                    leftnum, rightnum = 2*parentnum + 1, 2*parentnum + 2
+                    if self[leftnum] is None or self[rightnum] is None:
                         # without a sibling, we can't compute a parent, and
                         # we can't verify this node
+                        i = rightnum if self[leftnum] is None else leftnum
                         raise NotEnoughHashesError("unable to validate [%d]"%i)
-                    parentnum = self.parent(i)
-                    # make sure we know right from left
-                    leftnum, rightnum = sorted([i, siblingnum])
-                    new_parent_hash = pair_hash(self[leftnum], self[rightnum])
+                new_parent_hashes = pair_hashes(
+                    [(self[2*parentnum + 1], self[2*parentnum + 2])
+                     for parentnum in parents])
+                for parentnum, new_parent_hash in zip(parents,
+                                                      new_parent_hashes):
                     if self[parentnum]:
                         if self[parentnum] != new_parent_hash:
                             raise BadHashError("h([%d]+[%d]) != h[%d]" %
-                                               (leftnum, rightnum, parentnum))
+                                               (2*parentnum + 1,
+                                                2*parentnum + 2, parentnum))
                     else:
                         self[parentnum] = new_parent_hash
                         remove_upon_failure.add(parentnum)
-                        parent_level = depth_of(parentnum)
-                        assert parent_level == level-1
-                        hashes_to_check[parent_level].add(parentnum)
-
-                    # our sibling is now as valid as this node
-                    this_level.discard(siblingnum)
+                        hashes_to_check[level-1].add(parentnum)
             # we're done!
 
         except (BadHashError, NotEnoughHashesError):
             for i in remove_upon_failure:
                 self[i] = None
             raise
+
+    def replace_leaves(self, leaves):
+        """Replace some leaves with new values, and recompute the hashes
+        between them and the root.
+
+        I am used when updating part of a file in place: the caller starts
+        with a tree holding (validated) hashes for the paths from the leaves
+        that will change to the root, as returned by needed_hashes(leafnum,
+        include_leaf=True) for each of them, then gives me the new leaf
+        hashes. Unlike set_hashes(), the new values are not checked against
+        the old ones, and the root hash changes.
+
+        'leaves' is a dictionary mapping leaf index to the new leaf hash. I
+        return the set of hash indices whose values changed, including the
+        leaves and the root. If the sibling of a node that I need to
+        recompute is missing, I raise NotEnoughHashesError and leave the
+        tree unchanged.
+        """
+        paths = set()
+        for leafnum in leaves:
+            i = self.first_leaf_num + leafnum
+            paths.add(i)
+            while i != 0:
+                i = self.parent(i)
+                paths.add(i)
+        # check that we have every sibling we need before changing anything
+        missing = set()
+        for i in paths:
+            if i != 0:
+                siblingnum = self.sibling(i)
+                if siblingnum not in paths and self[siblingnum] is None:
+                    missing.add(siblingnum)
+        if missing:
+            raise NotEnoughHashesError("unable to recompute without %s"
+                                       % sorted(missing))
+
+        for leafnum, leafhash in leaves.items():
+            assert isinstance(leafhash, bytes)
+            self[self.first_leaf_num + leafnum] = leafhash
+        # children have higher indices than their parents, so this works
+        # from the leaves up
+        for i in sorted(paths, reverse=True):
+            if i < self.first_leaf_num:
+                self[i] = pair_hash(self[self.lchild(i)], self[self.rchild(i)])
+        return paths
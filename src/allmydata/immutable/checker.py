@@ -27,6 +27,7 @@ from allmydata.util.hashutil import file_renewal_secret_hash, \
 from allmydata.util.happinessutil import servers_of_happiness
 
 from allmydata.immutable import layout
+from allmydata.storage_client import batch_add_lease, AddLeaseError
 
 class IntegrityCheckReject(Exception):
     pass
@@ -513,12 +514,17 @@ class Checker(log.PrefixingLogMixin):
         if self._add_lease:
             renew_secret = self._get_renewal_secret(lease_seed)
             cancel_secret = self._get_cancel_secret(lease_seed)
-            d2 = storage_server.add_lease(
+            # grouped with the leases for other files being checked on
+            # the same server
+            d2 = batch_add_lease(
+                s,
                 storageindex,
                 renew_secret,
                 cancel_secret,
             )
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
+        else:
+            d2 = defer.succeed(None)
 
         d = storage_server.get_buckets(storageindex)
         def _wrap_results(res):
@@ -534,6 +540,9 @@ class Checker(log.PrefixingLogMixin):
             return ({}, False)
 
         d.addCallbacks(_wrap_results, _trap_errs)
+        # wait for the lease too, so that it has been added by the time the
+        # check is finished
+        d.addCallback(lambda res: d2.addBoth(lambda _: res))
         return d
 
     def _add_lease_failed(self, f, server_name, storage_index):
@@ -551,6 +560,12 @@ class Checker(log.PrefixingLogMixin):
 
         if f.check(DeadReferenceError):
             return
+        if f.check(AddLeaseError):
+            self.log(format="error in add_leases from [%(name)s]: %(f_value)s",
+                     name=server_name,
+                     f_value=str(f.value),
+                     level=log.WEIRD, umid="Rk3ZtA")
+            return
         if f.check(RemoteException):
             if f.value.failure.check(KeyError, IndexError, NameError):
                 # this may ignore a bit too much, but that only hurts us
@@ -18,7 +18,8 @@ from twisted.internet import defer
 from foolscap.api import eventually
 from allmydata import uri
 from allmydata.codec import CRSDecoder
-from allmydata.util import base32, log, hashutil, mathutil, observer
+from allmydata.util import base32, log, hashutil, mathutil, observer, \
+     cputhreadpool
 from allmydata.interfaces import DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.hashtree import IncompleteHashTree, BadHashError, \
      NotEnoughHashesError
@@ -29,6 +30,11 @@ from .fetcher import SegmentFetcher
 from .segmentation import Segmentation
 from .common import BadCiphertextHashError
 
+# When a file is read sequentially, the DownloadNode fetches and decodes the
+# following segments before they are asked for, holding at most this much
+# segment data (fetched or in flight) at a time for each reader.
+DEFAULT_READAHEAD_BYTES = 1024*1024
+
 class IDownloadStatusHandlingConsumer(Interface):
     def set_download_status_read_event(read_ev):
         """Record the DownloadStatus 'read event', to be updated with the
@@ -51,7 +57,7 @@ class DownloadNode(object):
 
     # Share._node points to me
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history, download_status):
+                 terminator, history, download_status, segment_cache=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
@@ -68,6 +74,7 @@ class DownloadNode(object):
         self._secret_holder = secret_holder
         self._history = history
         self._download_status = download_status
+        self._segment_cache = segment_cache # a client-wide SegmentCache
 
         self.share_hash_tree = IncompleteHashTree(self._verifycap.total_shares)
 
@@ -95,6 +102,12 @@ class DownloadNode(object):
 
         self._segsize_observers = observer.OneShotObserverList()
 
+        # read-ahead: each Segmentation has a ReadAhead, which asks for
+        # segments on its behalf because they look like they will be wanted
+        # next
+        self._readahead_bytes = DEFAULT_READAHEAD_BYTES
+        self._readaheads = set()
+
         # we create one top-level logparent for this _Node, and another one
         # for each read() call. Segmentation and get_segment() messages are
         # associated with the read() call, everything else is tied to the
@@ -129,6 +142,8 @@ class DownloadNode(object):
 
     def stop(self):
         # called by the Terminator at shutdown, mostly for tests
+        for readahead in list(self._readaheads):
+            readahead.stop()
         if self._active_segment:
             self._active_segment.stop()
             self._active_segment = None
@@ -195,6 +210,8 @@ class DownloadNode(object):
         Deferred that fires with (offset,data) when the desired segment is
         available, and c is an object on which c.cancel() can be called to
         disavow interest in the segment (after which 'd' will never fire).
+        A sequential reader can use a ReadAhead to call me, which fetches the
+        following segments before they are asked for.
 
         You probably need to know the segment size before calling this,
         unless you want the first few bytes of the file. If you ask for a
@@ -212,6 +229,21 @@ class DownloadNode(object):
                      si=base32.b2a(self._verifycap.storage_index)[:8],
                      segnum=segnum,
                      level=log.OPERATIONAL, parent=logparent, umid="UKFjDQ")
+        cached = None
+        if self._segment_cache and self.segment_size is not None:
+            # we only use the cache once we know the real segment size:
+            # otherwise Segmentation might be asking for the wrong segnum,
+            # and could only recover from that with the UEB
+            found = self._segment_cache.get(self._verifycap.storage_index,
+                                            segnum)
+            if found is not None:
+                (offset, segment) = found
+                cached = (offset, segment, 0.0)
+        if cached is not None:
+            return self._deliver_ready_segment(segnum, cached, lp)
+        return self._request_segment(segnum, lp)
+
+    def _request_segment(self, segnum, lp):
         seg_ev = self._download_status.add_segment_request(segnum, now())
         d = defer.Deferred()
         c = Cancel(self._cancel_request)
@@ -219,6 +251,25 @@ class DownloadNode(object):
         self._start_new_segment()
         return (d, c)
 
+    def _deliver_ready_segment(self, segnum, result, lp):
+        # for segments which were read ahead, or found in the segment cache
+        (offset, segment, decodetime) = result
+        log.msg(format="segnum=%(segnum)d was already downloaded",
+                segnum=segnum, level=log.NOISY, parent=lp, umid="Rk3vQw")
+        when = now()
+        seg_ev = self._download_status.add_segment_request(segnum, when)
+        seg_ev.activate(when)
+        seg_ev.deliver(when, offset, len(segment), decodetime)
+        d = defer.Deferred()
+        c = Cancel(lambda c: None)
+        eventually(self._deliver, d, c, result)
+        return (d, c)
+
+    def _is_cached(self, segnum):
+        if not self._segment_cache:
+            return False
+        return (self._verifycap.storage_index, segnum) in self._segment_cache
+
     def get_segsize(self):
         """Return a Deferred that fires when we know the real segment size."""
         if self.segment_size:
@@ -432,6 +483,9 @@ class DownloadNode(object):
                     eventually(self._deliver, d, c, result)
             else:
                 (offset, segment, decodetime) = result
+                if self._segment_cache:
+                    self._segment_cache.add(self._verifycap.storage_index,
+                                            segnum, offset, segment)
                 for (d,c,seg_ev) in self._extract_requests(segnum):
                     # when we have two requests for the same segment, the
                     # second one will not be "activated" before the data is
@@ -493,22 +547,26 @@ class DownloadNode(object):
         assert self.segment_size is not None
         offset = segnum * self.segment_size
 
-        h = hashutil.crypttext_segment_hash(segment)
-        try:
-            self.ciphertext_hash_tree.set_hashes(leaves={segnum: h})
-            self._download_status.add_misc_event("CThash", start, now())
-            return (offset, segment, decodetime)
-        except (BadHashError, NotEnoughHashesError):
-            format = ("hash failure in ciphertext_hash_tree:"
-                      " segnum=%(segnum)d, SI=%(si)r")
-            log.msg(format=format, segnum=segnum, si=self._si_prefix,
-                    failure=Failure(),
-                    level=log.WEIRD, parent=self._lp, umid="MTwNnw")
-            # this is especially weird, because we made it past the share
-            # hash tree. It implies that we're using the wrong encoding, or
-            # that the uploader deliberately constructed a bad UEB.
-            msg = format % {"segnum": segnum, "si": self._si_prefix}
-            raise BadCiphertextHashError(msg)
+        d = cputhreadpool.defer_to_thread(hashutil.crypttext_segment_hash,
+                                          segment)
+        def _check(h):
+            try:
+                self.ciphertext_hash_tree.set_hashes(leaves={segnum: h})
+                self._download_status.add_misc_event("CThash", start, now())
+                return (offset, segment, decodetime)
+            except (BadHashError, NotEnoughHashesError):
+                format = ("hash failure in ciphertext_hash_tree:"
+                          " segnum=%(segnum)d, SI=%(si)r")
+                log.msg(format=format, segnum=segnum, si=self._si_prefix,
+                        failure=Failure(),
+                        level=log.WEIRD, parent=self._lp, umid="MTwNnw")
+                # this is especially weird, because we made it past the share
+                # hash tree. It implies that we're using the wrong encoding,
+                # or that the uploader deliberately constructed a bad UEB.
+                msg = format % {"segnum": segnum, "si": self._si_prefix}
+                raise BadCiphertextHashError(msg)
+        d.addCallback(_check)
+        return d
 
     def _deliver(self, d, c, result):
         # this method exists to handle cancel() that occurs between
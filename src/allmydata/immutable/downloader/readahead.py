@@ -0,0 +1,124 @@
+"""
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from allmydata.util import log
+
+
+class ReadAhead(object):
+    """I fetch segments ahead of a single sequential reader of a
+    DownloadNode, typically one Segmentation. Each reader has its own
+    ReadAhead, so readers of the same file at different places do not look
+    like seeks to each other, and one of them stopping does not cancel what
+    is being read ahead for the others. Segments wanted by several readers
+    are only fetched once, since the node merges requests for the same
+    segment.
+
+    Segments are read ahead while the reader asks for them in order: the
+    window doubles with each in-order request, and is capped by the node's
+    read-ahead memory budget. An out-of-order request counts as a seek, and
+    drops whatever was read ahead.
+    """
+
+    def __init__(self, node):
+        self._node = node
+        self._window = 0
+        self._next_sequential_segnum = None
+        self._readahead = {} # segnum -> Cancel, for requests in flight
+        self._prefetched = {} # segnum -> (offset, segment, decodetime)
+        node._readaheads.add(self)
+
+    def get_segment(self, segnum, logparent=None, readahead_until=None):
+        """Like DownloadNode.get_segment(), but if readahead_until= is given,
+        it is the number of the last segment the reader expects to want
+        after this one. While the reader asks for segments in order, I fetch
+        some of the following ones (up to that one) ahead of time, so they
+        are ready when they are asked for."""
+        node = self._node
+        if segnum in self._prefetched:
+            lp = log.msg(format="imm Node(%(si)s).get_segment(%(segnum)d)",
+                         si=node._si_prefix, segnum=segnum,
+                         level=log.OPERATIONAL, parent=logparent,
+                         umid="b7XmQA")
+            result = self._prefetched.pop(segnum)
+            (d, c) = node._deliver_ready_segment(segnum, result, lp)
+        else:
+            (d, c) = node.get_segment(segnum, logparent)
+            prefetch = self._readahead.pop(segnum, None)
+            if prefetch:
+                # the read-ahead request is now redundant. Our own request
+                # keeps the fetch alive.
+                prefetch.cancel()
+        if readahead_until is None:
+            # we can't read ahead yet, but remember where the reader is
+            self._next_sequential_segnum = segnum + 1
+        else:
+            self._update(segnum, readahead_until)
+        return (d, c)
+
+    def _update(self, segnum, readahead_until):
+        node = self._node
+        if segnum == self._next_sequential_segnum:
+            # in-order reads: read further ahead next time
+            self._window = max(1, 2 * self._window)
+        else:
+            # a seek: whatever we read ahead is probably useless now
+            self._drop()
+        self._next_sequential_segnum = segnum + 1
+        if node.segment_size is None or not self._window:
+            return
+        max_segments = node._readahead_bytes // node.segment_size
+        self._window = min(self._window, max_segments)
+        last_segnum = min(readahead_until, node.num_segments - 1,
+                          segnum + self._window)
+        for prefetch_segnum in range(segnum + 1, last_segnum + 1):
+            if (prefetch_segnum in self._readahead
+                or prefetch_segnum in self._prefetched
+                or node._is_cached(prefetch_segnum)):
+                continue
+            if len(self._readahead) + len(self._prefetched) >= max_segments:
+                break
+            self._read_ahead(prefetch_segnum)
+
+    def _read_ahead(self, segnum):
+        node = self._node
+        lp = log.msg(format="reading ahead segnum=%(segnum)d",
+                     segnum=segnum,
+                     level=log.NOISY, parent=node._lp, umid="p9u3Vw")
+        (d, c) = node._request_segment(segnum, lp)
+        self._readahead[segnum] = c
+        def _fetched(result):
+            if self._readahead.get(segnum) is c:
+                del self._readahead[segnum]
+                self._prefetched[segnum] = result
+        def _failed(f):
+            # a later get_segment() will try again, and report the error
+            if self._readahead.get(segnum) is c:
+                del self._readahead[segnum]
+            log.msg(format="read-ahead of segnum=%(segnum)d failed",
+                    segnum=segnum, failure=f,
+                    level=log.NOISY, parent=lp, umid="Lk2bJw")
+        d.addCallbacks(_fetched, _failed)
+
+    def _drop(self):
+        readahead = list(self._readahead.values())
+        self._readahead.clear()
+        self._prefetched.clear()
+        self._window = 0
+        self._next_sequential_segnum = None
+        for c in readahead:
+            c.cancel()
+
+    def stop(self):
+        """Cancel the segments I am reading ahead, and forget the ones I have
+        already read ahead. Called when my reader finishes or stops."""
+        self._node._readaheads.discard(self)
+        self._drop()
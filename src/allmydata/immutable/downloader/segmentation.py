@@ -21,6 +21,7 @@ from allmydata.util.spans import overlap
 from allmydata.interfaces import DownloadStopped
 
 from .common import BadSegmentNumberError, WrongSegmentError
+from .readahead import ReadAhead
 
 @implementer(IPushProducer)
 class Segmentation(object):
@@ -28,10 +29,12 @@ class Segmentation(object):
     segmentation: I figure out which segments are necessary, request them
     (from my CiphertextDownloader) in order, and trim the segments down to
     match the offset+size span. I use the Producer/Consumer interface to only
-    request one segment at a time.
+    request one segment at a time, but my ReadAhead knows how far my span
+    goes, so it can read the following segments ahead while I wait.
     """
     def __init__(self, node, offset, size, consumer, read_ev, logparent=None):
         self._node = node
+        self._readahead = ReadAhead(node)
         self._hungry = True
         self._active_segnum = None
         self._cancel_segment_request = None
@@ -54,6 +57,7 @@ class Segmentation(object):
         return self._deferred
 
     def _done(self, res):
+        self._readahead.stop()
         self._consumer.unregisterProducer()
         return res
 
@@ -87,7 +91,12 @@ class Segmentation(object):
                 offset=self._offset, guess=guess_s, segnum=wanted_segnum,
                 level=log.NOISY, parent=self._lp, umid="5WfN0w")
         self._active_segnum = wanted_segnum
-        d,c = n.get_segment(wanted_segnum, self._lp)
+        # if we know where our read ends, read ahead up to there
+        readahead_until = None
+        if have_actual_segment_size:
+            readahead_until = (self._offset + self._size - 1) // segment_size
+        d,c = self._readahead.get_segment(wanted_segnum, self._lp,
+                                          readahead_until)
         self._cancel_segment_request = c
         d.addBoth(self._request_retired)
         d.addCallback(self._got_segment, wanted_segnum)
@@ -165,6 +174,9 @@ class Segmentation(object):
         if self._cancel_segment_request:
             self._cancel_segment_request.cancel()
             self._cancel_segment_request = None
+        # and anything we were reading ahead, but not what other readers of
+        # this file are reading ahead
+        self._readahead.stop()
         e = DownloadStopped("our Consumer called stopProducing()")
         self._deferred.errback(e)
 
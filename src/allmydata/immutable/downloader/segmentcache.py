@@ -0,0 +1,84 @@
+"""
+A client-wide cache of downloaded immutable segments.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from allmydata.interfaces import IStatsProducer
+
+
+@implementer(IStatsProducer)
+class SegmentCache(object):
+    """I hold the most recently used ciphertext segments of immutable files,
+    keyed by (storage index, segment number), so that readers of the same
+    file (or the same reader, coming back to a range) do not have to fetch
+    and decode them again.
+
+    Only segments which have passed the ciphertext hash check are added, so
+    anything I return can be delivered as-is. I evict the least recently
+    used segments to keep the total size of the cached segments at or below
+    max_size bytes. A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._segments = OrderedDict() # (si, segnum) -> (offset, segment)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, storage_index, segnum):
+        """Return (offset, segment) for the given segment, or None if I do not
+        have it."""
+        key = (storage_index, segnum)
+        value = self._segments.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # re-insert it, so it becomes the most recently used
+        self._segments[key] = value
+        return value
+
+    def __contains__(self, key):
+        # this does not count as a use
+        return key in self._segments
+
+    def add(self, storage_index, segnum, offset, segment):
+        """Remember a segment which starts at the given offset of the
+        file."""
+        if len(segment) > self.max_size:
+            return
+        key = (storage_index, segnum)
+        old = self._segments.pop(key, None)
+        if old is not None:
+            self._size -= len(old[1])
+        self._segments[key] = (offset, segment)
+        self._size += len(segment)
+        while self._size > self.max_size:
+            (_, (_, evicted)) = self._segments.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def get_stats(self):
+        return {
+            "downloader.segment_cache.hits": self.hits,
+            "downloader.segment_cache.misses": self.misses,
+            "downloader.segment_cache.evictions": self.evictions,
+            "downloader.segment_cache.segments": len(self._segments),
+            "downloader.segment_cache.size": self._size,
+            "downloader.segment_cache.max_size": self.max_size,
+        }
@@ -19,8 +19,9 @@ from twisted.internet import defer
 from foolscap.api import fireEventually
 from allmydata import uri
 from allmydata.storage.server import si_b2a
-from allmydata.hashtree import HashTree
-from allmydata.util import mathutil, hashutil, base32, log, happinessutil
+from allmydata.hashtree import HashTree, IncompleteHashTree, empty_leaf_hash
+from allmydata.util import mathutil, hashutil, base32, log, happinessutil, \
+     cputhreadpool
 from allmydata.util.assertutil import _assert, precondition
 from allmydata.codec import CRSEncoder
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
@@ -87,11 +88,25 @@ GiB=1024*MiB
 TiB=1024*GiB
 PiB=1024*TiB
 
+# How much memory the Encoder may spend on segments which have been read but
+# not yet handed to all shareholders. Each such segment costs its ciphertext
+# plus the encoded blocks for every share.
+DEFAULT_MAX_BUFFERED_BYTES = 4*MiB
+
+def _hash_blocks(blocks):
+    """
+    Compute the block hash of each of ``blocks``.  This touches no shared
+    state, so it may run in the CPU thread pool.
+    """
+    return hashutil.block_hashes(blocks)
+
 @implementer(IEncoder)
 class Encoder(object):
 
-    def __init__(self, log_parent=None, upload_status=None):
+    def __init__(self, log_parent=None, upload_status=None,
+                 max_buffered_bytes=DEFAULT_MAX_BUFFERED_BYTES):
         object.__init__(self)
+        self._max_buffered_bytes = max_buffered_bytes
         self.uri_extension_data = {}
         self._codec = None
         self._status = None
@@ -102,6 +117,8 @@ class Encoder(object):
         self._log_number = log.msg("creating Encoder %s" % self,
                                    facility="tahoe.encoder", parent=log_parent)
         self._aborted = False
+        self._existing_shares = set()
+        self._share_hash_tree = None
 
     def __repr__(self):
         if hasattr(self, "_storage_index"):
@@ -219,6 +236,52 @@ class Encoder(object):
             assert isinstance(v, set)
         self.servermap = servermap.copy()
 
+    def set_existing_shares(self, shnums, share_hashes, share_root_hash):
+        """Tell me about shares of this file which already exist on the grid
+        and do not need to be generated again (this is used by the repairer).
+
+        shnums is the set of share numbers which exist. share_hashes is a
+        dict mapping hash index to hash, holding nodes of the share hash tree
+        that have already been validated against share_root_hash (the hash
+        chains of some of the existing shares). I only erasure-code the
+        missing shares, plus whatever other shares I need to rebuild the
+        parts of the share hash tree that share_hashes does not cover. If the
+        new shares do not match share_root_hash, the upload fails (with
+        BadHashError) before any share is closed.
+
+        Must be called after set_shareholders() and before start(). Shares
+        which have a landlord are always generated."""
+        self._existing_shares = set(shnums) - set(self.landlords)
+        t = IncompleteHashTree(self.num_shares)
+        t.set_hashes({0: share_root_hash})
+        t.set_hashes(share_hashes)
+        self._share_hash_tree = t
+
+    def _get_share_ids_to_generate(self):
+        """Return the sorted list of share numbers to erasure-code. As a side
+        effect, remember the padding leaves of the share hash tree that I
+        will need to fill in."""
+        self._padding_leaves = set()
+        if self._share_hash_tree is None:
+            return list(range(self.num_shares))
+        t = self._share_hash_tree
+        generate = set(range(self.num_shares)) - self._existing_shares
+        # Every new share needs a hash chain, so any node along the way that
+        # we do not know must be rebuilt from the leaves below it.
+        for shnum in list(generate):
+            for i in t.needed_for(t.get_leaf_index(shnum)):
+                if t[i] is not None:
+                    continue
+                below = [i]
+                while below[0] < t.first_leaf_num:
+                    below = [c for n in below for c in (t.lchild(n), t.rchild(n))]
+                for leafnum in [n - t.first_leaf_num for n in below]:
+                    if leafnum < self.num_shares:
+                        generate.add(leafnum)
+                    else:
+                        self._padding_leaves.add(leafnum)
+        return sorted(generate)
+
     @log_call_deferred(action_type=u"immutable:encode:start")
     def start(self):
         """ Returns a Deferred that will fire with the verify cap (an instance of
@@ -234,6 +297,7 @@ class Encoder(object):
         # to landlord[i]. This list contains a hash of each segment_share
         # that we sent to that landlord.
         self.share_root_hashes = [None] * self.num_shares
+        self._share_ids = self._get_share_ids_to_generate()
 
         self._times = {
             "cumulative_encoding": 0.0,
@@ -246,19 +310,7 @@ class Encoder(object):
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
-
-        for i in range(self.num_segments-1):
-            # note to self: this form doesn't work, because lambda only
-            # captures the slot, not the value
-            #d.addCallback(lambda res: self.do_segment(i))
-            # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i, is_tail=False))
-            d.addCallback(self._send_segment, i)
-            d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_segment(last_segnum, is_tail=True))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
+        d.addCallback(lambda res: self._encode_and_send_segments())
 
         d.addCallback(lambda res: self.finish_hashing())
 
@@ -288,9 +340,9 @@ class Encoder(object):
         self.log("aborting upload", level=log.UNUSUAL)
         assert self._codec, "don't call abort before start"
         self._aborted = True
-        # the next segment read (in _gather_data inside _encode_segment) will
+        # the next segment read (in _gather_data inside _read_segment) will
         # raise UploadAborted(), which will bypass the rest of the upload
-        # chain. If we've sent the final segment's shares, it's too late to
+        # chain. If we've already read the final segment, it's too late to
         # abort. TODO: allow abort any time up to close_all_shareholders.
 
     def _turn_barrier(self, res):
@@ -314,25 +366,112 @@ class Encoder(object):
             dl.append(d)
         return self._gather_responses(dl)
 
-    def _encode_segment(self, segnum, is_tail):
+    def _get_pipeline_depth(self):
         """
-        Encode one segment of input into the configured number of shares.
+        :return int: how many segments may be in flight at once (read, but
+            not yet handed to all shareholders) while staying within
+            ``max_buffered_bytes``.  This is always at least 1.
+        """
+        segment_cost = (self.segment_size +
+                        self._codec.get_block_size() * self.num_shares)
+        return max(1, self._max_buffered_bytes // segment_cost)
+
+    def _encode_and_send_segments(self):
+        """
+        Read, encode and send all of the segments.
+
+        Segments are read (and encrypted) one at a time and in order, and are
+        sent in order, but up to ``_get_pipeline_depth()`` of them may be in
+        flight at once. Reading and encoding the next segments therefore
+        overlaps with pushing the blocks of earlier ones to the shareholders.
 
-        :param segnum: Ostensibly, the number of the segment to encode.  In
-            reality, this parameter is ignored and the *next* segment is
-            encoded and returned.
+        :return: A ``Deferred`` which fires when the blocks of every segment
+            have been handed to the shareholders.
+        """
+        self._pipeline_depth = self._get_pipeline_depth()
+        self.log("encoding with up to %d segments in flight"
+                 % (self._pipeline_depth,), level=log.NOISY)
+        self._next_segment_to_read = 0
+        self._next_segment_to_send = 0
+        self._reading_segment = False
+        self._sending_segment = False
+        # segnum -> Deferred firing with the (shares, shareids) of segments
+        # which have been read but whose sending has not started
+        self._encoded_segments = {}
+        self._segments_sent = defer.Deferred()
+        if self.num_segments == 0:
+            self._segments_sent.callback(None)
+        else:
+            self._pump_segments()
+        return self._segments_sent
+
+    def _pump_segments(self):
+        if self._segments_sent.called:
+            # finished, or failed
+            return
+        segnum = self._next_segment_to_read
+        if (not self._reading_segment
+            and segnum < self.num_segments
+            and segnum - self._next_segment_to_send < self._pipeline_depth):
+            self._next_segment_to_read += 1
+            self._reading_segment = True
+            self._read_next_segment(segnum)
+        segnum = self._next_segment_to_send
+        if not self._sending_segment and segnum in self._encoded_segments:
+            self._sending_segment = True
+            self._send_next_segment(segnum)
+
+    def _read_next_segment(self, segnum):
+        is_tail = (segnum == self.num_segments - 1)
+        start = time.time()
+        d = defer.maybeDeferred(self._read_segment, is_tail)
+        def _read(chunks):
+            self._reading_segment = False
+            encoded = self._encode_chunks(chunks, is_tail)
+            def _done(res):
+                elapsed = time.time() - start
+                self._times["cumulative_encoding"] += elapsed
+                return res
+            encoded.addCallback(_done)
+            self._encoded_segments[segnum] = encoded
+            self._pump_segments()
+        d.addCallbacks(_read, self._segments_failed)
+        d.addErrback(self._segments_failed)
+
+    def _send_next_segment(self, segnum):
+        d = self._encoded_segments.pop(segnum)
+        d.addCallback(self._send_segment, segnum)
+        d.addCallback(self._turn_barrier)
+        def _sent(res):
+            self._sending_segment = False
+            self._next_segment_to_send += 1
+            if self._next_segment_to_send == self.num_segments:
+                self._segments_sent.callback(None)
+            else:
+                self._pump_segments()
+        d.addCallbacks(_sent, self._segments_failed)
+        d.addErrback(self._segments_failed)
+
+    def _segments_failed(self, f):
+        if self._segments_sent.called:
+            return
+        # nobody will ever consume the segments still being encoded
+        for d in self._encoded_segments.values():
+            d.addErrback(lambda ignored: None)
+        self._encoded_segments.clear()
+        self._segments_sent.errback(f)
+
+    def _read_segment(self, is_tail):
+        """
+        Read (and encrypt) the next segment of input.
 
         :param bool is_tail: ``True`` if this is the last segment, ``False``
             otherwise.
 
-        :return: A ``Deferred`` which fires with a two-tuple.  The first
-            element is a list of string-y objects representing the encoded
-            segment data for one of the shares.  The second element is a list
-            of integers giving the share numbers of the shares in the first
-            element.
+        :return: A ``Deferred`` which fires with the list of input pieces to
+            hand to ``_encode_chunks``.
         """
         codec = self._tail_codec if is_tail else self._codec
-        start = time.time()
 
         # the ICodecEncoder API wants to receive a total of self.segment_size
         # bytes on each encode() call, broken up into a number of
@@ -361,6 +500,8 @@ class Encoder(object):
         # 1MiB max_segment_size, we get a peak memory footprint of 4.3*1MiB =
         # 4.3MiB. Lowering max_segment_size to, say, 100KiB would drop the
         # footprint to 430KiB at the expense of more hash-tree overhead.
+        # Since several segments may be in flight at once, the total is
+        # bounded by max_buffered_bytes (see _get_pipeline_depth).
 
         d = self._gather_data(self.required_shares, input_piece_size,
                               crypttext_segment_hasher, allow_short=is_tail)
@@ -370,16 +511,24 @@ class Encoder(object):
                 # by _gather_data
                 assert len(c) == input_piece_size
             self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            # during this call, we hit 5*segsize memory
-            return codec.encode(chunks)
+            return chunks
         d.addCallback(_done_gathering)
-        def _done(res):
-            elapsed = time.time() - start
-            self._times["cumulative_encoding"] += elapsed
-            return res
-        d.addCallback(_done)
         return d
 
+    def _encode_chunks(self, chunks, is_tail):
+        """
+        Erasure-code one segment's worth of input pieces.
+
+        :return: A ``Deferred`` which fires with a two-tuple.  The first
+            element is a list of string-y objects representing the encoded
+            segment data for one of the shares.  The second element is a list
+            of integers giving the share numbers of the shares in the first
+            element.
+        """
+        codec = self._tail_codec if is_tail else self._codec
+        # during this call, we hit 5*segsize memory
+        return codec.encode(chunks, self._share_ids)
+
     def _gather_data(self, num_chunks, input_chunk_size,
                      crypttext_segment_hasher,
                      allow_short=False):
@@ -430,10 +579,11 @@ class Encoder(object):
 
     def _send_segment(self, shares_and_shareids, segnum):
         # To generate the URI, we must generate the roothash, so we must
-        # generate all shares, even if we aren't actually giving them to
-        # anybody. This means that the set of shares we create will be equal
-        # to or larger than the set of landlords. If we have any landlord who
-        # *doesn't* have a share, that's an error.
+        # generate all shares (except the ones we were told already exist),
+        # even if we aren't actually giving them to anybody. This means that
+        # the set of shares we create will be equal to or larger than the set
+        # of landlords. If we have any landlord who *doesn't* have a share,
+        # that's an error.
         (shares, shareids) = shares_and_shareids
         _assert(set(self.landlords.keys()).issubset(set(shareids)),
                 shareids=shareids, landlords=self.landlords)
@@ -449,15 +599,16 @@ class Encoder(object):
             d = self.send_block(shareid, segnum, block, lognum)
             dl.append(d)
 
-            block_hash = hashutil.block_hash(block)
-            #from allmydata.util import base32
-            #log.msg("creating block (shareid=%d, blocknum=%d) "
-            #        "len=%d %r .. %r: %s" %
-            #        (shareid, segnum, len(block),
-            #         block[:50], block[-50:], base32.b2a(block_hash)))
-            self.block_hashes[shareid].append(block_hash)
+        # the block hashes are computed (possibly in the CPU thread pool)
+        # while the blocks are on their way to the servers
+        hashed = cputhreadpool.defer_to_thread(_hash_blocks, shares)
+        def _record_block_hashes(block_hashes):
+            for (shareid, block_hash) in zip(shareids, block_hashes):
+                self.block_hashes[shareid].append(block_hash)
+        hashed.addCallback(_record_block_hashes)
 
         dl = self._gather_responses(dl)
+        dl.addCallback(lambda res: hashed.addCallback(lambda ign: res))
 
         def _logit(res):
             self.log("%s uploaded %s / %s bytes (%d%%) of your file." %
@@ -566,9 +717,10 @@ class Encoder(object):
         self.set_status("Sending Subshare Hash Trees")
         self.set_encode_and_push_progress(extra=0.4)
         dl = []
-        for shareid,hashes in enumerate(self.block_hashes):
+        for shareid in self._share_ids:
             # hashes is a list of the hashes of all blocks that were sent
             # to shareholder[shareid].
+            hashes = self.block_hashes[shareid]
             dl.append(self.send_one_block_hash_tree(shareid, hashes))
         return self._gather_responses(dl)
 
@@ -594,17 +746,30 @@ class Encoder(object):
         self.set_status("Sending Share Hash Trees")
         self.set_encode_and_push_progress(extra=0.6)
         dl = []
-        for h in self.share_root_hashes:
-            assert h
-        # create the share hash tree
-        t = HashTree(self.share_root_hashes)
+        if self._share_hash_tree is None:
+            for h in self.share_root_hashes:
+                assert h
+            # create the share hash tree
+            t = HashTree(self.share_root_hashes)
+        else:
+            # add the new leaves to the tree we got from the existing shares,
+            # which checks them against its root
+            t = self._share_hash_tree
+            leaves = dict((shnum, self.share_root_hashes[shnum])
+                          for shnum in self._share_ids)
+            for leafnum in self._padding_leaves:
+                leaves[leafnum] = empty_leaf_hash(leafnum)
+            t.set_hashes(leaves=leaves)
         # the root of this hash tree goes into our URI
         self.uri_extension_data['share_root_hash'] = t[0]
         # now send just the necessary pieces out to each shareholder
         for i in range(self.num_shares):
+            if i not in self.landlords:
+                continue
             # the HashTree is given a list of leaves: 0,1,2,3..n .
             # These become nodes A+0,A+1,A+2.. of the tree, where A=n-1
-            needed_hash_indices = t.needed_hashes(i, include_leaf=True)
+            needed_hash_indices = set(t.needed_for(t.get_leaf_index(i)))
+            needed_hash_indices.add(t.get_leaf_index(i))
             hashes = [(hi, t[hi]) for hi in needed_hash_indices]
             dl.append(self.send_one_share_hash_tree(i, hashes))
         return self._gather_responses(dl)
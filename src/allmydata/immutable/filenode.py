@@ -36,13 +36,14 @@ from allmydata.immutable.downloader.status import DownloadStatus
 
 class CiphertextFileNode(object):
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history):
+                 terminator, history, segment_cache=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._terminator = terminator
         self._history = history
+        self._segment_cache = segment_cache
         self._download_status = None
         self._node = None # created lazily, on read()
 
@@ -57,7 +58,8 @@ class CiphertextFileNode(object):
             self._node = DownloadNode(self._verifycap, self._storage_broker,
                                       self._secret_holder,
                                       self._terminator,
-                                      self._history, self._download_status)
+                                      self._history, self._download_status,
+                                      self._segment_cache)
 
     def read(self, consumer, offset=0, size=None):
         """I am the main entry point, from which FileNode.read() can get
@@ -130,7 +132,7 @@ class CiphertextFileNode(object):
             return f
         r = Repairer(self, storage_broker=self._storage_broker,
                      secret_holder=self._secret_holder,
-                     monitor=monitor)
+                     monitor=monitor, check_results=cr)
         d = r.start()
         d.addCallbacks(self._gather_repair_results, _repair_error,
                        callbackArgs=(cr, crr,))
@@ -245,11 +247,12 @@ class ImmutableFileNode(object):
 
     # I wrap a CiphertextFileNode with a decryption key
     def __init__(self, filecap, storage_broker, secret_holder, terminator,
-                 history):
+                 history, segment_cache=None):
         assert isinstance(filecap, uri.CHKFileURI)
         verifycap = filecap.get_verify_cap()
         self._cnode = CiphertextFileNode(verifycap, storage_broker,
-                                         secret_holder, terminator, history)
+                                         secret_holder, terminator, history,
+                                         segment_cache)
         assert isinstance(filecap, uri.CHKFileURI)
         self.u = filecap
         self._readkey = filecap.key
@@ -88,9 +88,14 @@ limitations described in #346.
 
 FORCE_V2 = False # set briefly by unit tests to make small-sized V2 shares
 
+# Contiguous writes smaller than this are queued up and sent to the server as
+# a single remote write() once this many bytes have accumulated.
+DEFAULT_BATCH_SIZE = 50000
+
 def make_write_bucket_proxy(rref, server,
                             data_size, block_size, num_segments,
-                            num_share_hashes, uri_extension_size_max):
+                            num_share_hashes, uri_extension_size_max,
+                            batch_size=DEFAULT_BATCH_SIZE):
     # Use layout v1 for small files, so they'll be readable by older versions
     # (<tahoe-1.3.0). Use layout v2 for large files; they'll only be readable
     # by tahoe-1.3.0 or later.
@@ -99,11 +104,13 @@ def make_write_bucket_proxy(rref, server,
             raise FileTooLargeError
         wbp = WriteBucketProxy(rref, server,
                                data_size, block_size, num_segments,
-                               num_share_hashes, uri_extension_size_max)
+                               num_share_hashes, uri_extension_size_max,
+                               batch_size=batch_size)
     except FileTooLargeError:
         wbp = WriteBucketProxy_v2(rref, server,
                                   data_size, block_size, num_segments,
-                                  num_share_hashes, uri_extension_size_max)
+                                  num_share_hashes, uri_extension_size_max,
+                                  batch_size=batch_size)
     return wbp
 
 @implementer(IStorageBucketWriter)
@@ -112,7 +119,8 @@ class WriteBucketProxy(object):
     fieldstruct = ">L"
 
     def __init__(self, rref, server, data_size, block_size, num_segments,
-                 num_share_hashes, uri_extension_size_max, pipeline_size=50000):
+                 num_share_hashes, uri_extension_size_max, pipeline_size=50000,
+                 batch_size=DEFAULT_BATCH_SIZE):
         self._rref = rref
         self._server = server
         self._data_size = data_size
@@ -135,6 +143,14 @@ class WriteBucketProxy(object):
         # filled.
         self._pipeline = pipeline.Pipeline(pipeline_size)
 
+        # Small writes to adjacent offsets (the header, small blocks, hash
+        # trees, the URI extension) are coalesced into one remote write() of
+        # up to batch_size bytes, to cut down on the number of messages sent.
+        self._batch_size = batch_size
+        self._queued = [] # pieces of data waiting to be sent
+        self._queued_offset = 0 # where the first queued piece goes
+        self._queued_size = 0
+
     def get_allocated_size(self):
         return (self._offsets['uri_extension'] + self.fieldsize +
                 self._uri_extension_size_max)
@@ -239,21 +255,45 @@ class WriteBucketProxy(object):
         return self._write(offset, length+data)
 
     def _write(self, offset, data):
-        # use a Pipeline to pipeline several writes together. TODO: another
-        # speedup would be to coalesce small writes into a single call: this
-        # would reduce the foolscap CPU overhead per share, but wouldn't
-        # reduce the number of round trips, so it might not be worth the
-        # effort.
+        # Queue the write, merging it with any previously queued data it
+        # directly follows. A write that doesn't follow the queued data
+        # forces the queue out first, since a single remote write() can only
+        # cover one contiguous range.
+        #
+        # The queued data is sent through a Pipeline, so several writes can
+        # be in flight at once while the Deferred we return still applies
+        # backpressure to the caller.
+        d = defer.succeed(None)
+        if self._queued and offset != self._queued_offset + self._queued_size:
+            d = self._send_queued()
+        if not self._queued:
+            self._queued_offset = offset
+        self._queued.append(data)
+        self._queued_size += len(data)
+        if self._queued_size >= self._batch_size:
+            d.addCallback(lambda ign: self._send_queued())
+        return d
 
+    def _send_queued(self):
+        if not self._queued:
+            return defer.succeed(None)
+        offset, data = self._queued_offset, b"".join(self._queued)
+        self._queued = []
+        self._queued_size = 0
         return self._pipeline.add(len(data),
                                   self._rref.callRemote, "write", offset, data)
 
     def close(self):
-        d = self._pipeline.add(0, self._rref.callRemote, "close")
+        d = self._send_queued()
+        d.addCallback(lambda ign: self._pipeline.add(0, self._rref.callRemote,
+                                                     "close"))
         d.addCallback(lambda ign: self._pipeline.flush())
         return d
 
     def abort(self):
+        # Anything still queued is never going to be needed.
+        self._queued = []
+        self._queued_size = 0
         return self._rref.callRemote("abort").addErrback(log.err, "Error from remote call to abort an immutable write bucket")
 
     def get_servername(self):
@@ -16,8 +16,12 @@ from allmydata.storage.server import si_b2a
 from allmydata.util import log, consumer
 from allmydata.util.assertutil import precondition
 from allmydata.interfaces import IEncryptedUploadable
+from allmydata.hashtree import IncompleteHashTree, BadHashError, \
+     NotEnoughHashesError
 
 from allmydata.immutable import upload
+from allmydata.immutable.layout import ReadBucketProxy
+from allmydata.immutable.checker import ValidatedExtendedURIProxy
 
 @implementer(IEncryptedUploadable)
 class Repairer(log.PrefixingLogMixin):
@@ -50,9 +54,17 @@ class Repairer(log.PrefixingLogMixin):
     Before I send any new request to a server, I always ask the 'monitor'
     object that was passed into my constructor whether this task has been
     cancelled (by invoking its raise_if_cancelled() method).
+
+    If I am given the results of the check which found the file unhealthy, I
+    only generate the shares which are missing from it: I read the URI
+    extension block and a few share hash chains from the shares it found, so
+    the encoder can rebuild the share hash tree (and check the new shares
+    against its root) without erasure-coding the existing shares again. If
+    none of them can be read, I generate all N shares, as before.
     """
 
-    def __init__(self, filenode, storage_broker, secret_holder, monitor):
+    def __init__(self, filenode, storage_broker, secret_holder, monitor,
+                 check_results=None):
         logprefix = si_b2a(filenode.get_storage_index())[:5]
         log.PrefixingLogMixin.__init__(self, "allmydata.immutable.repairer",
                                        prefix=logprefix)
@@ -60,6 +72,7 @@ class Repairer(log.PrefixingLogMixin):
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._monitor = monitor
+        self._check_results = check_results
         self._offset = 0
 
     def start(self):
@@ -73,12 +86,111 @@ class Repairer(log.PrefixingLogMixin):
             # (http://tahoe-lafs.org/trac/tahoe-lafs/ticket/1212)
             happy = 0
             self._encodingparams = (k, happy, N, segsize)
+            return self._get_existing_shares()
+        d.addCallback(_got_segsize)
+        def _upload(existing_shares):
             # XXX should pass a reactor to this
             ul = upload.CHKUploader(self._storage_broker, self._secret_holder)
+            if existing_shares is not None:
+                ul.set_existing_shares(*existing_shares)
             return ul.start(self) # I am the IEncryptedUploadable
-        d.addCallback(_got_segsize)
+        d.addCallback(_upload)
+        return d
+
+    def _get_existing_shares(self):
+        """Find out which shares already exist, so they need not be
+        regenerated. Returns a Deferred that fires with None (generate all
+        shares) or with a tuple of (shnums, share hash tree nodes,
+        share_root_hash), suitable for CHKUploader.set_existing_shares."""
+        if self._check_results is None:
+            return defer.succeed(None)
+        sharemap = self._check_results.get_sharemap()
+        existing = set(shnum for (shnum, servers) in sharemap.items()
+                       if servers)
+        if not existing:
+            return defer.succeed(None)
+        vcap = self._filenode.get_verify_cap()
+        # The hash chain of an existing share covers the share hash tree
+        # except for the path down to that share. For each missing share,
+        # read the chain of the existing share closest to it in the tree,
+        # which leaves the fewest other shares to regenerate.
+        missing = set(range(vcap.total_shares)) - existing
+        to_read = set()
+        for shnum in missing:
+            to_read.add(min(existing, key=lambda e: ((e ^ shnum).bit_length(), e)))
+        if not to_read:
+            to_read.add(min(existing))
+        shnums_by_server = {}
+        for shnum in to_read:
+            server = sorted(sharemap[shnum], key=lambda s: s.get_serverid())[0]
+            shnums_by_server.setdefault(server, set()).add(shnum)
+        si = vcap.get_storage_index()
+        dl = []
+        for (server, shnums) in shnums_by_server.items():
+            self._monitor.raise_if_cancelled()
+            d = server.get_storage_server().get_buckets(si)
+            def _got_buckets(buckets, server=server, shnums=shnums):
+                return [(shnum, ReadBucketProxy(buckets[shnum], server, si))
+                        for shnum in sorted(shnums) if shnum in buckets]
+            d.addCallback(_got_buckets)
+            dl.append(d)
+        d = defer.DeferredList(dl, consumeErrors=True)
+        def _got_readers(res):
+            readers = []
+            for (success, r) in res:
+                if success:
+                    readers.extend(r)
+                else:
+                    self.log("unable to list existing shares", failure=r,
+                             level=log.UNUSUAL)
+            return self._get_share_root_hash(sorted(readers), vcap)
+        d.addCallback(_got_readers)
+        def _got_share_hashes(res):
+            if res is None:
+                return None
+            (share_hashes, share_root_hash) = res
+            return (existing, share_hashes, share_root_hash)
+        d.addCallback(_got_share_hashes)
+        return d
+
+    def _get_share_root_hash(self, readers, vcap):
+        # try the shares one at a time until one of them gives us a valid URI
+        # extension block
+        if not readers:
+            return None
+        ((shnum, rbp), rest) = (readers[0], readers[1:])
+        d = ValidatedExtendedURIProxy(rbp, vcap).start()
+        def _failed(f):
+            self.log("unable to get UEB from share %d" % shnum, failure=f,
+                     level=log.UNUSUAL)
+            return self._get_share_root_hash(rest, vcap)
+        def _got_ueb(vup):
+            return self._get_share_hashes(readers, vup.share_root_hash,
+                                          vcap.total_shares)
+        d.addCallbacks(_got_ueb, _failed)
         return d
 
+    def _get_share_hashes(self, readers, share_root_hash, num_shares):
+        dl = [rbp.get_share_hashes() for (shnum, rbp) in readers]
+        d = defer.DeferredList(dl, consumeErrors=True)
+        def _got_share_hashes(res):
+            t = IncompleteHashTree(num_shares)
+            t.set_hashes({0: share_root_hash})
+            for ((shnum, rbp), (success, share_hashes)) in zip(readers, res):
+                if not success:
+                    continue
+                try:
+                    t.set_hashes(dict(share_hashes))
+                except (IndexError, BadHashError, NotEnoughHashesError) as e:
+                    # the encoder will regenerate whatever this share's chain
+                    # would have told us
+                    self.log("share %d has bad share hashes: %s" % (shnum, e),
+                             level=log.UNUSUAL)
+            share_hashes = dict((i, h) for (i, h) in enumerate(t)
+                                if h is not None)
+            return (share_hashes, share_root_hash)
+        d.addCallback(_got_share_hashes)
+        return d
 
     # methods to satisfy the IEncryptedUploader interface
     # (From the perspective of an uploader I am an IEncryptedUploadable.)
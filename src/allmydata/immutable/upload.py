@@ -1237,6 +1237,7 @@ class CHKUploader(object):
         self._upload_status.set_helper(False)
         self._upload_status.set_active(True)
         self._reactor = reactor
+        self._existing_shares = None
 
         # locate_all_shareholders() will create the following attribute:
         # self._server_trackers = {} # k: shnum, v: instance of ServerTracker
@@ -1248,6 +1249,11 @@ class CHKUploader(object):
             kwargs["facility"] = "tahoe.upload"
         return log.msg(*args, **kwargs)
 
+    def set_existing_shares(self, shnums, share_hashes, share_root_hash):
+        """Do not generate the given shares, because they already exist on
+        the grid. See Encoder.set_existing_shares."""
+        self._existing_shares = (shnums, share_hashes, share_root_hash)
+
     @log_call_deferred(action_type=u"immutable:upload:chk:start")
     def start(self, encrypted_uploadable):
         """Start uploading the file.
@@ -1297,6 +1303,8 @@ class CHKUploader(object):
             (upload_trackers, already_serverids) = yield self.locate_all_shareholders(self._encoder, started)
             action.add_success_fields(upload_trackers=upload_trackers, already_serverids=already_serverids)
         self.set_shareholders(upload_trackers, already_serverids, self._encoder)
+        if self._existing_shares is not None:
+            self._encoder.set_existing_shares(*self._existing_shares)
         verifycap = yield self._encoder.start()
         results = self._encrypted_done(verifycap)
         defer.returnValue(results)
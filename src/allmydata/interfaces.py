@@ -40,6 +40,7 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_LEASE_BATCH = 1000 # storage indexes per add_leases() call
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -164,6 +165,24 @@ class RIStorageServer(RemoteInterface):
         """
         return Any() # returns None now, but future versions might change
 
+    def add_leases(leases=ListOf(TupleOf(StorageIndex,
+                                         LeaseRenewSecret,
+                                         LeaseCancelSecret),
+                                 maxLength=MAX_LEASE_BATCH)):
+        """
+        Do what add_lease() does, for each of the given (storage_index,
+        renew_secret, cancel_secret) tuples, in a single round trip. Servers
+        which implement this advertise the maximum number of tuples they
+        accept in the 'maximum-add-leases-batch-size' key of their version
+        dictionary.
+
+        @return: a list with one item for each tuple: None if the lease was
+                 added (or there was no bucket for the storage index), or a
+                 byte string describing the error which prevented it.
+        """
+        return ListOf(ChoiceOf(None, StringConstraint(1000)),
+                      maxLength=MAX_LEASE_BATCH)
+
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
@@ -337,6 +356,13 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.add_lease``
         """
 
+    def add_leases(
+            leases,
+    ):
+        """
+        :see: ``RIStorageServer.add_leases``
+        """
+
     def get_buckets(
             storage_index,
     ):
@@ -1425,6 +1451,16 @@ class IDirectoryNode(IFilesystemNode):
         equivalent to calling set_node() multiple times, but is much more
         efficient."""
 
+    def apply_edits(edits):
+        """Apply a list of edits to the children of a directory node, in
+        order, publishing the result once. Each edit is a tuple:
+        ("set", name, child_node, metadata, overwrite), ("delete", name) or
+        ("rename", from_name, to_name, overwrite). An edit which cannot be
+        applied does not prevent the others. Returns a Deferred that fires
+        with a list with one entry per edit: None if it was applied, or the
+        exception (such as NoSuchChildError or ExistingChildError) which
+        prevented it."""
+
     def add_file(name, uploadable, metadata=None, overwrite=True):
         """I upload a file (using the given IUploadable), then attach the
         resulting ImmutableFileNode to the directory at the given name. I set
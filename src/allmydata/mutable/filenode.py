@@ -14,8 +14,10 @@ import random
 
 from zope.interface import implementer
 from twisted.internet import defer, reactor
-from foolscap.api import eventually
+from foolscap.api import eventually, fireEventually, DeadReferenceError, \
+     RemoteException
 
+from allmydata import hashtree
 from allmydata.crypto import aes
 from allmydata.crypto import rsa
 from allmydata.interfaces import IMutableFileNode, ICheckable, ICheckResults, \
@@ -29,7 +31,8 @@ from allmydata.monitor import Monitor
 from allmydata.mutable.publish import Publish, MutableData,\
                                       TransformingUploadable
 from allmydata.mutable.common import MODE_READ, MODE_WRITE, MODE_CHECK, UnrecoverableFileError, \
-     UncoordinatedWriteError
+     UncoordinatedWriteError, BadShareError
+from allmydata.mutable.layout import MDMFSlotReadProxy
 from allmydata.mutable.servermap import ServerMap, ServermapUpdater
 from allmydata.mutable.retrieve import Retrieve
 from allmydata.mutable.checker import MutableChecker, MutableCheckAndRepairer
@@ -64,11 +67,14 @@ class BackoffAgent(object):
 class MutableFileNode(object):
 
     def __init__(self, storage_broker, secret_holder,
-                 default_encoding_parameters, history):
+                 default_encoding_parameters, history, servermap_cache=None,
+                 key_cache=None):
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._default_encoding_parameters = default_encoding_parameters
         self._history = history
+        self._servermap_cache = servermap_cache # a client-wide ServermapCache
+        self._key_cache = key_cache # a client-wide KeyCache
         self._pubkey = None # filled in upon first read
         self._privkey = None # filled in if we're mutable
         # we keep track of the last encoding parameters that we use. These
@@ -128,6 +134,14 @@ class MutableFileNode(object):
         # if possible, otherwise by the first peer that Publish talks to.
         self._privkey = None
         self._encprivkey = None
+        # unless another node for this file has already learned them
+        if self._key_cache:
+            self._pubkey = self._key_cache.get_pubkey(self._fingerprint)
+            if self._writekey:
+                keys = self._key_cache.get_privkey(self._storage_index,
+                                                   self._writekey)
+                if keys is not None:
+                    (self._privkey, self._encprivkey) = keys
 
         return self
 
@@ -154,6 +168,10 @@ class MutableFileNode(object):
             self._protocol_version = version
         self._readkey = self._uri.readkey
         self._storage_index = self._uri.storage_index
+        if self._key_cache:
+            self._key_cache.add_pubkey(self._fingerprint, self._pubkey)
+            self._key_cache.add_privkey(self._storage_index, self._writekey,
+                                        self._privkey, self._encprivkey)
         initial_contents = self._get_initial_contents(contents)
         return self._upload(initial_contents, None)
 
@@ -183,16 +201,35 @@ class MutableFileNode(object):
 
     def _populate_pubkey(self, pubkey):
         self._pubkey = pubkey
+        if self._key_cache:
+            self._key_cache.add_pubkey(self._fingerprint, pubkey)
     def _populate_required_shares(self, required_shares):
         self._required_shares = required_shares
     def _populate_total_shares(self, total_shares):
         self._total_shares = total_shares
 
     def _populate_privkey(self, privkey):
+        # callers check the privkey against our writekey, and populate the
+        # encprivkey first
         self._privkey = privkey
+        if self._key_cache:
+            self._key_cache.add_privkey(self._storage_index, self._writekey,
+                                        privkey, self._encprivkey)
     def _populate_encprivkey(self, encprivkey):
         self._encprivkey = encprivkey
 
+    def _verify_signature(self, signature, prefix):
+        """
+        I check that signature is a valid signature of prefix by my public
+        key, raising BadSignature if it is not. The client's key cache lets
+        me skip signatures which have already been verified.
+        """
+        if self._key_cache:
+            self._key_cache.verify_signature(self._fingerprint, self._pubkey,
+                                             signature, prefix)
+        else:
+            rsa.verify_signature(self._pubkey, signature, prefix)
+
     def get_write_enabler(self, server):
         seed = server.get_foolscap_write_enabler_seed()
         assert len(seed) == 20
@@ -445,6 +482,8 @@ class MutableFileNode(object):
         def _maybe_retry(failure):
             failure.trap(NotEnoughSharesError)
 
+            # the servermap may have come from the cache, and be out of date
+            self._forget_cached_servermap()
             d = self.get_best_mutable_version()
             d.addCallback(self._record_size)
             d.addCallback(lambda version: version.download_to_data())
@@ -619,9 +658,22 @@ class MutableFileNode(object):
     def _get_servermap(self, mode):
         """
         I am a serialized twin to get_servermap.
+
+        In MODE_READ, I return a recent servermap from the client's
+        servermap cache, if it has one.
         """
-        servermap = ServerMap()
-        d = self._update_servermap(servermap, mode)
+        cached = None
+        if mode == MODE_READ and self._servermap_cache:
+            cached = self._servermap_cache.get(self._storage_index)
+        if cached is not None:
+            (servermap, pubkey) = cached
+            if not self._pubkey:
+                self._populate_pubkey(pubkey)
+            d = defer.succeed(servermap)
+        else:
+            servermap = ServerMap()
+            d = self._update_servermap(servermap, mode)
+            d.addCallback(self._cache_servermap)
         # The servermap will tell us about the most recent size of the
         # file, so we may as well set that so that callers might get
         # more data about us.
@@ -651,6 +703,28 @@ class MutableFileNode(object):
         return u.update()
 
 
+    def _cache_servermap(self, servermap):
+        """
+        I add a freshly updated servermap to the servermap cache, if it
+        found a recoverable version. I return the servermap.
+        """
+        if (self._servermap_cache and self._pubkey and
+            servermap.recoverable_versions()):
+            self._servermap_cache.add(self._storage_index, servermap,
+                                      self._pubkey)
+        return servermap
+
+
+    def _forget_cached_servermap(self, res=None):
+        """
+        I remove my servermap from the servermap cache, because my shares
+        have changed (or are not where it says they are). I return res.
+        """
+        if self._servermap_cache:
+            self._servermap_cache.remove(self._storage_index)
+        return res
+
+
     #def set_version(self, version):
         # I can be set in two ways:
         #  1. When the node is created.
@@ -699,6 +773,7 @@ class MutableFileNode(object):
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
+        d.addBoth(self._forget_cached_servermap)
         d.addCallback(self._did_upload, new_contents.get_size())
         return d
 
@@ -750,6 +825,9 @@ class MutableFileVersion(object):
 
         self._writekey = writekey
         self._serializer = defer.succeed(None)
+        # the list of (data, offset, Deferred) that update() is adding to,
+        # until the batch is started in the next reactor turn.
+        self._update_batch = None
 
 
     def get_sequence_number(self):
@@ -1002,6 +1080,9 @@ class MutableFileVersion(object):
         # other serialized methods within this (or any other)
         # MutableFileNode. The callable should be a bound method of this same
         # MFN instance.
+        # anything serialized after a batch of updates must also happen
+        # after them, so later updates start a new batch
+        self._update_batch = None
         d = defer.Deferred()
         self._serializer.addCallback(lambda ignore: cb(*args, **kwargs))
         # we need to put off d.callback until this Deferred is finished being
@@ -1023,6 +1104,7 @@ class MutableFileVersion(object):
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
+        d.addBoth(self._node._forget_cached_servermap)
         d.addCallback(self._did_upload, new_contents.get_size())
         return d
 
@@ -1044,8 +1126,204 @@ class MutableFileVersion(object):
         O(data.get_size()) memory/bandwidth/CPU to perform the update.
         Otherwise, it must download, re-encode, and upload the entire
         file again, which will use O(filesize) resources.
+
+        Updates made in the same reactor turn are done together. If they
+        all fall within the current contents of an MDMF file, they are
+        made with a single publish which rewrites only the segments they
+        touch and the hashes that depend upon them.
+        """
+        d = defer.Deferred()
+        batch = self._update_batch
+        if batch is None:
+            batch = []
+            self._do_serialized(self._update_batch_later, batch)
+            self._update_batch = batch
+        batch.append((data, offset, d))
+        return d
+
+
+    def _update_batch_later(self, batch):
+        """
+        I wait a turn for update() to add more writes to batch, then make
+        them all, and tell each caller how it went.
+        """
+        d = fireEventually()
+        def _start(ignored):
+            if self._update_batch is batch:
+                self._update_batch = None
+            writes = [(data, offset) for (data, offset, _) in batch]
+            return self._update_many(writes)
+        d.addCallback(_start)
+        def _done(res):
+            for (_, _, waiter) in batch:
+                eventually(waiter.callback, res)
+        def _failed(f):
+            # each caller gets the error; the serializer does not
+            for (_, _, waiter) in batch:
+                eventually(waiter.errback, f)
+        d.addCallbacks(_done, _failed)
+        return d
+
+
+    def _update_many(self, writes):
+        """
+        I make a list of (data, offset) writes, in order. If they all fall
+        within the current contents of an MDMF file, I try to do this with
+        one in-place publish of the segments that they touch. Otherwise,
+        one write is done with _update(), and several are applied to the
+        downloaded contents and uploaded again.
+        """
+        size = self.get_size()
+        segsize = self._version[3]
+        segments = set()
+        for (data, offset) in writes:
+            if offset + data.get_size() > size:
+                segments = None
+                break
+            for segnum in range(offset // segsize,
+                                mathutil.div_ceil(offset + data.get_size(),
+                                                  segsize)):
+                segments.add(segnum)
+
+        if self._version[2] or not segments:
+            # SDMF, appends, and zero-length writes
+            d = defer.succeed(False)
+        else:
+            d = self._update_in_place(writes, sorted(segments))
+        def _maybe_fall_back(done):
+            if done:
+                return None
+            if len(writes) == 1:
+                return self._update(*writes[0])
+            return self._do_modify_update(writes)
+        d.addCallback(_maybe_fall_back)
+        return d
+
+
+    def _update_in_place(self, writes, segments):
+        """
+        I make writes, which all fall within the current contents of this
+        MDMF file, with a single in-place publish of the given segments. I
+        return a Deferred that fires with True when this is done, or with
+        False (having written nothing) if the shares on the grid do not
+        allow it, in which case the caller should do something slower.
+        """
+        d = self._update_servermap()
+        d.addCallback(lambda ignored:
+                      self._get_blockhash_trees_for_update(segments))
+        def _got_trees(trees):
+            if trees is None:
+                return False
+            d2 = self._get_updated_segments(writes, segments)
+            def _publish(new_segments):
+                data = MutableData(b"".join(new_segments))
+                p = Publish(self._node, self._storage_broker, self._servermap)
+                return p.update_in_place(data, segments, trees, self._version)
+            d2.addCallback(_publish)
+            d2.addBoth(self._node._forget_cached_servermap)
+            d2.addCallback(lambda ignored: True)
+            return d2
+        d.addCallback(_got_trees)
+        return d
+
+
+    def _get_blockhash_trees_for_update(self, segments):
+        """
+        I fetch, from every share of this version, the block hash tree
+        nodes needed to recompute its root once the given segments have
+        been replaced, and validate them against our root hash. I return a
+        Deferred that fires with a dict mapping shnum to IncompleteHashTree,
+        or with None if the grid holds anything other than one complete,
+        valid set of shares of this version.
+        """
+        (seqnum, root_hash, IV, segsize, datalength, k, N, prefix,
+         offsets_tuple) = self._version
+        known_shares = self._servermap.get_known_shares()
+        versions = set([verinfo for (verinfo, timestamp)
+                        in known_shares.values()])
+        shnums = set([shnum for (server, shnum) in known_shares])
+        if versions != set([self._version]) or shnums != set(range(N)):
+            log.msg("can't update in place: shares are missing, or of "
+                    "other versions")
+            return defer.succeed(None)
+
+        num_segments = mathutil.div_ceil(datalength, segsize)
+        share_hash_tree = hashtree.IncompleteHashTree(N)
+        share_hash_tree.set_hashes({0: root_hash})
+        trees = {}
+        ds = []
+        for (server, shnum) in sorted(known_shares,
+                                      key=lambda share: share[1]):
+            reader = MDMFSlotReadProxy(server.get_storage_server(),
+                                       self._storage_index, shnum, None)
+            bht = hashtree.IncompleteHashTree(num_segments)
+            needed = bht.needed_hashes_for_leaves(segments, include_leaf=True)
+            needed.add(0)
+            d = deferredutil.gatherResults([
+                reader.get_blockhash_nodes(needed),
+                reader.get_sharehashes(),
+            ])
+            def _validate(results, shnum=shnum, bht=bht):
+                (nodes, sharehashes) = results
+                share_hash_tree.set_hashes(hashes=sharehashes,
+                                           leaves={shnum: nodes[0]})
+                bht.set_hashes(hashes=nodes)
+                trees.setdefault(shnum, bht)
+                return True
+            d.addCallback(_validate)
+            def _invalid(f, shnum=shnum):
+                f.trap(DeadReferenceError, RemoteException, BadShareError,
+                       hashtree.BadHashError, hashtree.NotEnoughHashesError,
+                       IndexError)
+                log.msg("can't update in place: share %d: %s" % (shnum, f))
+                return False
+            d.addErrback(_invalid)
+            ds.append(d)
+        d = deferredutil.gatherResults(ds)
+        d.addCallback(lambda valid: trees if all(valid) else None)
+        return d
+
+
+    def _get_updated_segments(self, writes, segments):
+        """
+        I return a Deferred that fires with a list of the new plaintext of
+        each of the given segments once writes have been applied, fetching
+        the old contents of the segments that the writes do not cover.
         """
-        return self._do_serialized(self._update, data, offset)
+        segsize = self._version[3]
+        size = self.get_size()
+        def _bounds(segnum):
+            return (segnum * segsize, min((segnum + 1) * segsize, size))
+        ds = []
+        for segnum in segments:
+            start, end = _bounds(segnum)
+            covered = [True for (data, offset) in writes
+                       if offset <= start
+                       and offset + data.get_size() >= end]
+            if covered:
+                ds.append(defer.succeed(b"\x00" * (end - start)))
+            else:
+                r = Retrieve(self._node, self._storage_broker,
+                             self._servermap, self._version)
+                c = consumer.MemoryConsumer()
+                d = r.download(c, start, end - start)
+                d.addCallback(lambda mc: b"".join(mc.chunks))
+                ds.append(d)
+        d = deferredutil.gatherResults(ds)
+        def _apply_writes(old_segments):
+            new_segments = [bytearray(old) for old in old_segments]
+            for (data, offset) in writes:
+                new_data = b"".join(data.read(data.get_size()))
+                for (segnum, new) in zip(segments, new_segments):
+                    start, end = _bounds(segnum)
+                    first = max(start, offset)
+                    last = min(end, offset + len(new_data))
+                    if first < last:
+                        new[first - start:last - start] = \
+                            new_data[first - offset:last - offset]
+            return [bytes(new) for new in new_segments]
+        d.addCallback(_apply_writes)
+        return d
 
 
     def _update(self, data, offset):
@@ -1068,7 +1346,7 @@ class MutableFileVersion(object):
         # We do a whole file re-encode if the file is an SDMF file.
         if self._version[2]: # version[2] == SDMF salt, which MDMF lacks
             log.msg("doing re-encode instead of in-place update")
-            return self._do_modify_update(data, offset)
+            return self._do_modify_update([(data, offset)])
 
         # Otherwise, we can replace just the parts that are changing.
         log.msg("updating in place")
@@ -1078,18 +1356,19 @@ class MutableFileVersion(object):
         return d
 
 
-    def _do_modify_update(self, data, offset):
+    def _do_modify_update(self, writes):
         """
         I perform a file update by modifying the contents of the file
         after downloading it, then reuploading it. I am less efficient
         than _do_update_update, but am necessary for certain updates.
+        writes is a list of (data, offset) pairs, applied in order.
         """
+        new_data = [(b"".join(data.read(data.get_size())), offset)
+                    for (data, offset) in writes]
         def m(old, servermap, first_time):
-            start = offset
-            rest = offset + data.get_size()
-            new = old[:start]
-            new += b"".join(data.read(data.get_size()))
-            new += old[rest:]
+            new = old
+            for (data, offset) in new_data:
+                new = new[:offset] + data + new[offset + len(data):]
             return new
         return self._modify(m, None)
 
@@ -1187,7 +1466,9 @@ class MutableFileVersion(object):
                                    segments_and_bht[0],
                                    segments_and_bht[1])
         p = Publish(self._node, self._storage_broker, self._servermap)
-        return p.update(u, offset, segments_and_bht[2], self._version)
+        d = p.update(u, offset, segments_and_bht[2], self._version)
+        d.addBoth(self._node._forget_cached_servermap)
+        return d
 
 
     def _update_servermap(self, mode=MODE_WRITE, update_range=None):
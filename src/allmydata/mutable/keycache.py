@@ -0,0 +1,122 @@
+"""
+A client-wide cache of the RSA work done for mutable files.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from allmydata.crypto import rsa
+from allmydata.interfaces import IStatsProducer
+from allmydata.util import hashutil
+
+SIGNED_PREFIX_TAG = b"allmydata_mutable_signed_prefix_and_signature_v1"
+
+
+@implementer(IStatsProducer)
+class KeyCache(object):
+    """I remember the results of the expensive RSA operations done for
+    mutable files (and so directories), so that reading and updating the
+    same files again, possibly through new MutableFileNode instances, does
+    not repeat them:
+
+     * signatures of share prefixes which have been verified, keyed by the
+       fingerprint of the public key and a hash of the prefix and signature
+
+     * public keys, keyed by their fingerprint
+
+     * private keys which have been decrypted and checked against the
+       writekey, keyed by storage index
+
+    None of these can go out of date: a fingerprint names exactly one public
+    key, and a private key is only handed to a caller which knows the
+    writekey it was checked against. I keep at most max_entries of each
+    kind, evicting the least recently used ones. A max_entries of 0 disables
+    the cache.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._signatures = OrderedDict() # (fingerprint, hash) -> True
+        self._pubkeys = OrderedDict() # fingerprint -> pubkey
+        self._privkeys = OrderedDict() # si -> (writekey, privkey, encprivkey)
+        self.signature_hits = 0
+        self.signature_misses = 0
+        self.key_hits = 0
+        self.key_misses = 0
+
+    def _get(self, entries, key):
+        value = entries.pop(key, None)
+        if value is not None:
+            # re-insert it, so it becomes the most recently used
+            entries[key] = value
+        return value
+
+    def _add(self, entries, key, value):
+        if not self.max_entries:
+            return
+        entries.pop(key, None)
+        entries[key] = value
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def verify_signature(self, fingerprint, pubkey, signature, prefix):
+        """Check that signature is a valid signature of prefix by pubkey,
+        whose fingerprint is given, raising BadSignature if it is not. I
+        only do the RSA verification if I have not seen this signature of
+        this prefix under this key verify successfully before."""
+        key = (fingerprint,
+               hashutil.tagged_pair_hash(SIGNED_PREFIX_TAG, prefix, signature))
+        if self._get(self._signatures, key) is not None:
+            self.signature_hits += 1
+            return
+        self.signature_misses += 1
+        rsa.verify_signature(pubkey, signature, prefix)
+        self._add(self._signatures, key, True)
+
+    def get_pubkey(self, fingerprint):
+        """Return the public key with the given fingerprint, or None."""
+        return self._get(self._pubkeys, fingerprint)
+
+    def add_pubkey(self, fingerprint, pubkey):
+        """Remember a public key whose fingerprint has been checked."""
+        self._add(self._pubkeys, fingerprint, pubkey)
+
+    def get_privkey(self, storage_index, writekey):
+        """Return (privkey, encprivkey) for the mutable file with the given
+        storage index, or None if I do not have them or if they were not
+        checked against the given writekey."""
+        entry = self._get(self._privkeys, storage_index)
+        if entry is None or entry[0] != writekey:
+            self.key_misses += 1
+            return None
+        self.key_hits += 1
+        (_, privkey, encprivkey) = entry
+        return (privkey, encprivkey)
+
+    def add_privkey(self, storage_index, writekey, privkey, encprivkey):
+        """Remember the private key of a mutable file, which has been
+        checked against its writekey, and its encrypted form."""
+        self._add(self._privkeys, storage_index,
+                  (writekey, privkey, encprivkey))
+
+    def get_stats(self):
+        return {
+            "mutable.key_cache.signature_hits": self.signature_hits,
+            "mutable.key_cache.signature_misses": self.signature_misses,
+            "mutable.key_cache.key_hits": self.key_hits,
+            "mutable.key_cache.key_misses": self.key_misses,
+            "mutable.key_cache.entries": (len(self._signatures) +
+                                          len(self._pubkeys) +
+                                          len(self._privkeys)),
+        }
@@ -580,6 +580,21 @@ VERIFICATION_KEY_SIZE = 292
 # bound. Each node requires 2 bytes of node-number plus 32 bytes of hash.
 SHARE_HASH_CHAIN_SIZE = (2+HASH_SIZE)*mathutil.log_ceil(256, 2)
 
+def _contiguous_runs(indices):
+    """
+    I turn a collection of integers into a sorted list of (first, count)
+    pairs, one for each run of consecutive integers, so that the block hash
+    tree nodes with those indices can be read or written with one vector
+    per run.
+    """
+    runs = []
+    for i in sorted(indices):
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    return [tuple(run) for run in runs]
+
 @implementer(IMutableSlotWriter)
 class MDMFSlotWriteProxy(object):
 
@@ -984,6 +999,43 @@ class MDMFSlotWriteProxy(object):
                                   blockhashes_s]))
 
 
+    def reuse_encprivkey_and_blockhashes(self, offsets):
+        """
+        I am used when updating a share in place without changing its
+        size. Instead of putting the encrypted private key and the whole
+        block hash tree again, I take their placement from offsets, the
+        offsets table of the existing share (as a dict). After this, only
+        the block hash tree nodes given to put_blockhash_nodes are written.
+        """
+        for name in ("enc_privkey", "share_data", "block_hash_tree"):
+            if offsets[name] != self._offsets[name]:
+                raise LayoutInvalid("the existing share has a different "
+                                    "layout: %s is at %d, not %d"
+                                    % (name, offsets[name],
+                                       self._offsets[name]))
+        self._offsets['share_hash_chain'] = offsets['share_hash_chain']
+        self._offsets['EOF'] = offsets['EOF']
+
+
+    def put_blockhash_nodes(self, nodes):
+        """
+        I queue write vectors for some nodes of the block hash tree, given
+        as a dict mapping node index to hash. I am used instead of
+        put_blockhashes after reuse_encprivkey_and_blockhashes.
+        """
+        if "EOF" not in self._offsets:
+            raise LayoutInvalid("You must reuse the existing block hash "
+                                "tree before putting some of its nodes")
+        base = self._offsets['block_hash_tree']
+        for (first, count) in _contiguous_runs(nodes):
+            offset = base + first * HASH_SIZE
+            if offset + count * HASH_SIZE > self._offsets['EOF']:
+                raise LayoutInvalid("block hash tree node %d is past the "
+                                    "end of the tree" % (first + count - 1))
+            data = b"".join([nodes[i] for i in range(first, first + count)])
+            self._writevs.append(tuple([offset, data]))
+
+
     def put_sharehashes(self, sharehashes):
         """
         I queue a write vector to put the share hash chain in my
@@ -1495,6 +1547,44 @@ class MDMFSlotReadProxy(object):
         return d
 
 
+    def get_blockhash_nodes(self, indices, force_remote=False):
+        """
+        I return some nodes of the block hash tree of an MDMF share, as a
+        dict mapping each of the given node indices to its hash. Unlike
+        get_blockhashes, I read only the hashes I am asked for, so that
+        updating a few segments of a large file does not need its whole
+        block hash tree.
+        """
+        if not indices:
+            return defer.succeed({})
+        runs = _contiguous_runs(indices)
+        d = self._maybe_fetch_offsets_and_header()
+        def _make_readvs(ignored):
+            if self._version_number != 1:
+                raise LayoutInvalid("only MDMF block hash trees can be "
+                                    "read by node")
+            base = self._offsets['block_hash_tree']
+            return [(base + first * HASH_SIZE, count * HASH_SIZE)
+                    for (first, count) in runs]
+        d.addCallback(_make_readvs)
+        d.addCallback(lambda readvs:
+            self._read(readvs, force_remote=force_remote))
+        def _build_nodes(results):
+            if self.shnum not in results:
+                raise BadShareError("no data for shnum %d" % self.shnum)
+            nodes = {}
+            for ((first, count), data) in zip(runs, results[self.shnum]):
+                if len(data) != count * HASH_SIZE:
+                    raise LayoutInvalid("block hash tree node %d is past "
+                                        "the end of the share"
+                                        % (first + count - 1))
+                for i in range(count):
+                    nodes[first + i] = data[i*HASH_SIZE:(i+1)*HASH_SIZE]
+            return nodes
+        d.addCallback(_build_nodes)
+        return d
+
+
     def get_sharehashes(self, needed=None, force_remote=False):
         """
         I return the part of the share hash chain placed to validate
@@ -21,7 +21,7 @@ from allmydata.crypto import aes
 from allmydata.crypto import rsa
 from allmydata.interfaces import IPublishStatus, SDMF_VERSION, MDMF_VERSION, \
                                  IMutableUploadable
-from allmydata.util import base32, hashutil, mathutil, log
+from allmydata.util import base32, hashutil, mathutil, log, cputhreadpool
 from allmydata.util.dictutil import DictOfSets
 from allmydata import hashtree, codec
 from allmydata.storage.server import si_b2a
@@ -41,6 +41,25 @@ PUSHING_BLOCKS_STATE = 0
 PUSHING_EVERYTHING_ELSE_STATE = 1
 DONE_STATE = 2
 
+
+def _encrypt_segment(key, data, piece_size, num_pieces):
+    """
+    Encrypt one segment of plaintext with the given key, and split the
+    crypttext into the padded pieces that the FEC encoder wants. This runs
+    in the CPU thread pool, so it must not touch any shared state.
+    """
+    encryptor = aes.create_encryptor(key)
+    crypttext = aes.encrypt_data(encryptor, data)
+    assert len(crypttext) == len(data)
+    crypttext_pieces = [None] * num_pieces
+    for i in range(num_pieces):
+        offset = i * piece_size
+        piece = crypttext[offset:offset+piece_size]
+        piece = piece + b"\x00"*(piece_size - len(piece)) # padding
+        crypttext_pieces[i] = piece
+        assert len(piece) == piece_size
+    return crypttext_pieces
+
 @implementer(IPublishStatus)
 class PublishStatus(object):
     statusid_counter = count(0)
@@ -121,6 +140,12 @@ class Publish(object):
     To make the initial publish, set servermap to None.
     """
 
+    # How many segments may be read and handed to the CPU thread pool for
+    # encryption and encoding ahead of the one being pushed. This bounds
+    # the amount of encoded data we buffer, while letting several segments
+    # be worked on at once.
+    ENCODE_PIPELINE_DEPTH = 4
+
     def __init__(self, filenode, storage_broker, servermap):
         self._node = filenode
         self._storage_broker = storage_broker
@@ -132,6 +157,10 @@ class Publish(object):
         self._running = True
         self._first_write_error = None
         self._last_failure = None
+        # segnum -> Deferred firing with the encoded segment and its salt
+        self._encoded_segments = {}
+        # shnum -> IncompleteHashTree, for update_in_place()
+        self._in_place_trees = None
 
         self._status = PublishStatus()
         self._status.set_storage_index(self._storage_index)
@@ -185,6 +214,101 @@ class Publish(object):
         self.log("adding new data of length %d at offset %d" % \
                     (data.get_size(), offset))
         self.log("new data length is %d" % self.datalength)
+        self._prepare_update(offset)
+        # First, we encrypt, encode, and publish the shares that we need
+        # to encrypt, encode, and publish.
+
+        # Our update process fetched these for us. We need to update
+        # them in place as publishing happens.
+        self.blockhashes = {} # (shnum, [blochashes])
+        for (i, bht) in list(blockhashes.items()):
+            # We need to extract the leaves from our old hash tree.
+            old_segcount = mathutil.div_ceil(version[4],
+                                             version[3])
+            h = hashtree.IncompleteHashTree(old_segcount)
+            bht = dict(enumerate(bht))
+            h.set_hashes(bht)
+            leaves = h[h.get_leaf_index(0):]
+            for j in range(self.num_segments - len(leaves)):
+                leaves.append(None)
+
+            assert len(leaves) >= self.num_segments
+            self.blockhashes[i] = leaves
+            # This list will now be the leaves that were set during the
+            # initial upload + enough empty hashes to make it a
+            # power-of-two. If we exceed a power of two boundary, we
+            # should be encoding the file over again, and should not be
+            # here. So, we have
+            #assert len(self.blockhashes[i]) == \
+            #    hashtree.roundup_pow2(self.num_segments), \
+            #        len(self.blockhashes[i])
+            # XXX: Except this doesn't work. Figure out why.
+
+        # These are filled in later, after we've modified the block hash
+        # tree suitably.
+        self.sharehash_leaves = None # eventually [sharehashes]
+        self.sharehashes = {} # shnum -> [sharehash leaves necessary to
+                              # validate the share]
+
+        self.log("Starting push")
+
+        self._state = PUSHING_BLOCKS_STATE
+        self._push()
+
+        return self.done_deferred
+
+
+    def update_in_place(self, data, segments, blockhash_trees, version):
+        """
+        I replace some whole segments of an MDMF file without changing its
+        size. data is an IMutableUploadable holding the new plaintext of
+        each of the segments listed in segments, in order. blockhash_trees
+        maps each share number to an IncompleteHashTree holding validated
+        hashes for the paths from the leaves of those segments to the root
+        of that share's block hash tree, and version is the verinfo of the
+        shares being updated.
+
+        Unlike update(), I only write the new blocks and the block hash
+        tree nodes which change, along with the share hash chain, the root
+        hash and the signature. I return a Deferred that fires with None
+        when the update has been completed.
+        """
+        assert IMutableUploadable.providedBy(data)
+        assert self._version == MDMF_VERSION
+        segments = sorted(segments)
+
+        self.data = data
+        self.datalength = version[4]
+        self.log("starting in-place update of %d segments" % len(segments))
+        self._prepare_update(0)
+        self._segments_to_push = segments
+
+        offsets = dict(version[8])
+        for (shnum, writers) in self.writers.items():
+            for writer in writers:
+                writer.reuse_encprivkey_and_blockhashes(offsets)
+
+        self._in_place_trees = blockhash_trees
+        # shnum -> {segnum: new block hash}, filled in as we push segments
+        self.blockhashes = dict([(shnum, {}) for shnum in blockhash_trees])
+        self.sharehash_leaves = None # eventually [sharehashes]
+        self.sharehashes = {} # shnum -> [sharehash leaves necessary to
+                              # validate the share]
+
+        self.log("Starting push")
+
+        self._state = PUSHING_BLOCKS_STATE
+        self._push()
+
+        return self.done_deferred
+
+
+    def _prepare_update(self, offset):
+        """
+        I do the setup shared by update() and update_in_place(): I pick
+        the new sequence number, set up encoding parameters, and make a
+        write proxy for each share that the servermap knows about.
+        """
         self._status.set_size(self.datalength)
         self._status.set_status("Started")
         self._started = time.time()
@@ -311,47 +435,6 @@ class Publish(object):
 
         # Now, we start pushing shares.
         self._status.timings["setup"] = time.time() - self._started
-        # First, we encrypt, encode, and publish the shares that we need
-        # to encrypt, encode, and publish.
-
-        # Our update process fetched these for us. We need to update
-        # them in place as publishing happens.
-        self.blockhashes = {} # (shnum, [blochashes])
-        for (i, bht) in list(blockhashes.items()):
-            # We need to extract the leaves from our old hash tree.
-            old_segcount = mathutil.div_ceil(version[4],
-                                             version[3])
-            h = hashtree.IncompleteHashTree(old_segcount)
-            bht = dict(enumerate(bht))
-            h.set_hashes(bht)
-            leaves = h[h.get_leaf_index(0):]
-            for j in range(self.num_segments - len(leaves)):
-                leaves.append(None)
-
-            assert len(leaves) >= self.num_segments
-            self.blockhashes[i] = leaves
-            # This list will now be the leaves that were set during the
-            # initial upload + enough empty hashes to make it a
-            # power-of-two. If we exceed a power of two boundary, we
-            # should be encoding the file over again, and should not be
-            # here. So, we have
-            #assert len(self.blockhashes[i]) == \
-            #    hashtree.roundup_pow2(self.num_segments), \
-            #        len(self.blockhashes[i])
-            # XXX: Except this doesn't work. Figure out why.
-
-        # These are filled in later, after we've modified the block hash
-        # tree suitably.
-        self.sharehash_leaves = None # eventually [sharehashes]
-        self.sharehashes = {} # shnum -> [sharehash leaves necessary to
-                              # validate the share]
-
-        self.log("Starting push")
-
-        self._state = PUSHING_BLOCKS_STATE
-        self._push()
-
-        return self.done_deferred
 
 
     def publish(self, newdata):
@@ -614,7 +697,6 @@ class Publish(object):
                                 self.total_shares)
             self.tail_fec = tail_fec
 
-        self._current_segment = self.starting_segment
         self.end_segment = self.num_segments - 1
         # Now figure out where the last segment should be.
         if self.data.get_size() != self.datalength:
@@ -630,6 +712,13 @@ class Publish(object):
         self.log("got start segment %d" % self.starting_segment)
         self.log("got end segment %d" % self.end_segment)
 
+        # The segments that we will encode and push, in order, and our
+        # position in that list for each of those steps.
+        self._segments_to_push = list(range(self.starting_segment,
+                                            self.end_segment + 1))
+        self._next_to_push = 0
+        self._next_to_encode = 0
+
 
     def _push(self, ignored=None):
         """
@@ -648,7 +737,7 @@ class Publish(object):
         # return a deferred so that we don't block execution when this
         # is first called in the upload method.
         if self._state == PUSHING_BLOCKS_STATE:
-            return self.push_segment(self._current_segment)
+            return self.push_segment()
 
         elif self._state == PUSHING_EVERYTHING_ELSE_STATE:
             return self.push_everything_else()
@@ -658,19 +747,21 @@ class Publish(object):
         return self._done()
 
 
-    def push_segment(self, segnum):
+    def push_segment(self):
         if self.num_segments == 0 and self._version == SDMF_VERSION:
             self._add_dummy_salts()
 
-        if segnum > self.end_segment:
+        if self._next_to_push == len(self._segments_to_push):
             # We don't have any more segments to push.
             self._state = PUSHING_EVERYTHING_ELSE_STATE
             return self._push()
 
-        d = self._encode_segment(segnum)
+        segnum = self._segments_to_push[self._next_to_push]
+        self._fill_encode_pipeline()
+        d = self._encoded_segments.pop(segnum)
         d.addCallback(self._push_segment, segnum)
         def _increment_segnum(ign):
-            self._current_segment += 1
+            self._next_to_push += 1
         # XXX: I don't think we need to do addBoth here -- any errBacks
         # should be handled within push_segment.
         d.addCallback(_increment_segnum)
@@ -679,6 +770,29 @@ class Publish(object):
         d.addErrback(self._failure)
 
 
+    def _fill_encode_pipeline(self):
+        """
+        I start encrypting and encoding segments, in order, until
+        ENCODE_PIPELINE_DEPTH of them (counting the one about to be pushed)
+        are either being worked on or waiting to be pushed.
+        """
+        last = min(len(self._segments_to_push),
+                   self._next_to_push + self.ENCODE_PIPELINE_DEPTH)
+        while self._next_to_encode < last:
+            segnum = self._segments_to_push[self._next_to_encode]
+            self._next_to_encode += 1
+            self._encoded_segments[segnum] = self._encode_segment(segnum)
+
+    def _abandon_encoded_segments(self):
+        """
+        I forget about segments encoded ahead of need, because the publish
+        has failed and nobody will push them.
+        """
+        for d in self._encoded_segments.values():
+            d.addErrback(lambda ignored: None)
+        self._encoded_segments.clear()
+
+
     def _turn_barrier(self, result):
         """
         I help the publish process avoid the recursion limit issues
@@ -713,7 +827,7 @@ class Publish(object):
             segsize = self.segment_size
 
 
-        self.log("Pushing segment %d of %d" % (segnum + 1, self.num_segments))
+        self.log("Encoding segment %d of %d" % (segnum + 1, self.num_segments))
         data = self.data.read(segsize)
         if not isinstance(data, bytes):
             # XXX: Why does this return a list?
@@ -724,36 +838,29 @@ class Publish(object):
         salt = os.urandom(16)
 
         key = hashutil.ssk_readkey_data_hash(salt, self.readkey)
-        self._status.set_status("Encrypting")
-        encryptor = aes.create_encryptor(key)
-        crypttext = aes.encrypt_data(encryptor, data)
-        assert len(crypttext) == len(data)
-
-        now = time.time()
-        self._status.accumulate_encrypt_time(now - started)
-        started = now
-
-        # now apply FEC
         if segnum + 1 == self.num_segments:
             fec = self.tail_fec
         else:
             fec = self.fec
 
-        self._status.set_status("Encoding")
-        crypttext_pieces = [None] * self.required_shares
-        piece_size = fec.get_block_size()
-        for i in range(len(crypttext_pieces)):
-            offset = i * piece_size
-            piece = crypttext[offset:offset+piece_size]
-            piece = piece + b"\x00"*(piece_size - len(piece)) # padding
-            crypttext_pieces[i] = piece
-            assert len(piece) == piece_size
-        d = fec.encode(crypttext_pieces)
-        def _done_encoding(res):
-            elapsed = time.time() - started
-            self._status.accumulate_encode_time(elapsed)
-            return (res, salt)
-        d.addCallback(_done_encoding)
+        # encryption and FEC both happen in the CPU thread pool, so that
+        # several segments can be worked on while we push earlier ones.
+        self._status.set_status("Encrypting")
+        d = cputhreadpool.defer_to_thread(_encrypt_segment, key, data,
+                                          fec.get_block_size(),
+                                          self.required_shares)
+        def _encode(crypttext_pieces):
+            now = time.time()
+            self._status.accumulate_encrypt_time(now - started)
+            self._status.set_status("Encoding")
+            d2 = fec.encode(crypttext_pieces)
+            def _done_encoding(res):
+                elapsed = time.time() - now
+                self._status.accumulate_encode_time(elapsed)
+                return (res, salt)
+            d2.addCallback(_done_encoding)
+            return d2
+        d.addCallback(_encode)
         return d
 
 
@@ -784,8 +891,11 @@ class Publish(object):
         I put everything else associated with a share.
         """
         self._pack_started = time.time()
-        self.push_encprivkey()
-        self.push_blockhashes()
+        if self._in_place_trees is None:
+            self.push_encprivkey()
+            self.push_blockhashes()
+        else:
+            self.push_blockhash_nodes()
         self.push_sharehashes()
         self.push_toplevel_hashes_and_signature()
         d = self.finish_publishing()
@@ -818,6 +928,24 @@ class Publish(object):
                 writer.put_blockhashes(self.blockhashes[shnum])
 
 
+    def push_blockhash_nodes(self):
+        """
+        I recompute the block hash tree of each share from the new leaves
+        of the segments we pushed during an in-place update, and push just
+        the nodes of it which changed.
+        """
+        self.sharehash_leaves = [None] * len(self.blockhashes)
+        self._status.set_status("Building and pushing block hash tree nodes")
+        for shnum, leaves in list(self.blockhashes.items()):
+            t = self._in_place_trees[shnum]
+            changed = t.replace_leaves(leaves)
+            self.sharehash_leaves[shnum] = t[0]
+            nodes = dict([(i, t[i]) for i in changed])
+            writers = self.writers[shnum]
+            for writer in writers:
+                writer.put_blockhash_nodes(nodes)
+
+
     def push_sharehashes(self):
         self._status.set_status("Building and pushing share hash chain")
         share_hash_tree = hashtree.HashTree(self.sharehash_leaves)
@@ -1189,6 +1317,7 @@ class Publish(object):
     def _failure(self, f=None):
         if f:
             self._last_failure = f
+        self._abandon_encoded_segments()
 
         if not self.surprised:
             # We ran out of servers
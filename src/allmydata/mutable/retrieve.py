@@ -113,6 +113,13 @@ class Retrieve(object):
     # Retrieve object will remain tied to a specific version of the file, and
     # will use a single ServerMap instance.
 
+    # How many segments we keep block requests in flight for. Segments are
+    # still decoded, decrypted, and written to the consumer strictly in
+    # order: the window only lets the blocks for the next few segments
+    # arrive (and be validated) while we are busy with the current one, so
+    # large files are not limited to one segment per round trip.
+    SEGMENT_WINDOW = 8
+
     def __init__(self, filenode, storage_broker, servermap, verinfo,
                  fetch_privkey=False, verify=False):
         self._node = filenode
@@ -170,6 +177,7 @@ class Retrieve(object):
         self._pause_deferred = None
         self._offset = None
         self._read_length = None
+        self._segment_fetches = {} # segnum -> Deferred of validated blocks
         self.log("got seqnum %d" % self.verinfo[0])
 
 
@@ -618,13 +626,40 @@ class Retrieve(object):
         decrypting them.
         """
         self.log("processing segment %d" % segnum)
+        self._fill_segment_window()
+        dl = self._segment_fetches.pop(segnum)
+        if self._verify:
+            dl.addCallback(lambda ignored: "")
+            dl.addCallback(self._set_segment)
+        else:
+            dl.addCallback(self._maybe_decode_and_decrypt_segment, segnum)
+        return dl
+
+    def _fill_segment_window(self):
+        """
+        I make sure that block requests are in flight for the current
+        segment and, unless our consumer has paused us, for the segments
+        after it, up to SEGMENT_WINDOW segments in all. Requests for a
+        segment go to whichever readers are active when they are sent.
+        """
+        last = self._current_segment
+        if self._pause_deferred is None:
+            last = min(self._last_segment,
+                       self._current_segment + self.SEGMENT_WINDOW - 1)
+        for segnum in range(self._current_segment, last + 1):
+            if segnum not in self._segment_fetches:
+                self._segment_fetches[segnum] = self._fetch_segment(segnum)
 
+    def _fetch_segment(self, segnum):
+        """
+        I ask each of our active readers for its block and salt for the
+        given segment, along with the hashes needed to validate them. I
+        return a Deferred that fires with a list of the results of
+        _validate_block(), one per reader, with None in place of any block
+        that could not be fetched or did not validate.
+        """
         # TODO: The old code uses a marker. Should this code do that
         # too? What did the Marker do?
-
-        # We need to ask each of our active readers for its block and
-        # salt. We will then validate those. If validation is
-        # successful, we will assemble the results into plaintext.
         ds = []
         for reader in self._active_readers:
             started = time.time()
@@ -637,13 +672,18 @@ class Retrieve(object):
             # bugs) are passed through and cause the retrieve to fail.
             d.addErrback(self._handle_bad_share, [reader])
             ds.append(d)
-        dl = deferredutil.gatherResults(ds)
-        if self._verify:
-            dl.addCallback(lambda ignored: "")
-            dl.addCallback(self._set_segment)
-        else:
-            dl.addCallback(self._maybe_decode_and_decrypt_segment, segnum)
-        return dl
+        return deferredutil.gatherResults(ds)
+
+    def _abandon_segment_fetches(self):
+        """
+        I forget about any segments fetched ahead of need that we will not
+        be using, because the download has finished or failed.
+        """
+        for segnum, d in list(self._segment_fetches.items()):
+            d.addErrback(lambda f, segnum=segnum:
+                         self.log("abandoned fetch of segment %d failed"
+                                  % segnum, failure=f, level=log.UNUSUAL))
+        self._segment_fetches.clear()
 
 
     def _maybe_decode_and_decrypt_segment(self, results, segnum):
@@ -664,6 +704,9 @@ class Retrieve(object):
 
         if None in results:
             self.log("some validation operations failed; not proceeding")
+            # Segments fetched ahead of this one asked the same readers, so
+            # any that went bad will show up as failures there too, and
+            # those segments will be fetched again from the replacements.
             return defer.succeed(None)
         self.log("everything looks ok, building segment %d" % segnum)
         d = self._decode_blocks(results, segnum)
@@ -732,6 +775,11 @@ class Retrieve(object):
         # perform integrity checks on the data.
 
         precondition(isinstance(readers, list), readers)
+        # With several segments in flight, a broken share can fail more than
+        # one request. Only the first failure needs to be acted upon.
+        readers = [r for r in readers if r in self._active_readers]
+        if not readers:
+            return None
         bad_shnums = [reader.shnum for reader in readers]
 
         self.log("validation or decoding failed on share(s) %s, server(s) %s "
@@ -975,6 +1023,7 @@ class Retrieve(object):
          offsets_tuple) = self.verinfo
         self._node._populate_required_shares(k)
         self._node._populate_total_shares(N)
+        self._abandon_segment_fetches()
 
         if self._verify:
             ret = self._bad_shares
@@ -1012,6 +1061,7 @@ class Retrieve(object):
     def _error(self, f):
         # all errors, including NotEnoughSharesError, land here
         self._running = False
+        self._abandon_segment_fetches()
         self._status.set_active(False)
         now = time.time()
         self._status.timings['total'] = now - self._started
@@ -27,6 +27,7 @@ from allmydata.util import base32, hashutil, log, deferredutil
 from allmydata.util.dictutil import DictOfSets
 from allmydata.storage.server import si_b2a
 from allmydata.interfaces import IServermapUpdaterStatus
+from allmydata.storage_client import batch_add_lease, AddLeaseError
 
 from allmydata.mutable.common import MODE_CHECK, MODE_ANYTHING, MODE_WRITE, \
      MODE_READ, MODE_REPAIR, CorruptShareError
@@ -617,7 +618,8 @@ class ServermapUpdater(object):
             # separately.
             renew_secret = self._node.get_renewal_secret(server)
             cancel_secret = self._node.get_cancel_secret(server)
-            d2 = ss.add_lease(
+            d2 = batch_add_lease(
+                server,
                 storage_index,
                 renew_secret,
                 cancel_secret,
@@ -871,7 +873,7 @@ class ServermapUpdater(object):
             # against the public key before keeping track of it.
             assert self._node.get_pubkey()
             try:
-                rsa.verify_signature(self._node.get_pubkey(), signature[1], prefix)
+                self._node._verify_signature(signature[1], prefix)
             except BadSignature:
                 raise CorruptShareError(server, shnum,
                                         "signature is invalid")
@@ -985,6 +987,12 @@ class ServermapUpdater(object):
 
         if f.check(DeadReferenceError):
             return
+        if f.check(AddLeaseError):
+            self.log(format="error in add_leases from [%(name)s]: %(f_value)s",
+                     name=server.get_name(),
+                     f_value=str(f.value),
+                     level=log.WEIRD, umid="vP3nQw")
+            return
         if f.check(RemoteException):
             if f.value.failure.check(KeyError, IndexError, NameError):
                 # this may ignore a bit too much, but that only hurts us
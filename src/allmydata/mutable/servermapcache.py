@@ -0,0 +1,86 @@
+"""
+A client-wide cache of mutable-file servermaps.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from allmydata.interfaces import IStatsProducer
+
+
+@implementer(IStatsProducer)
+class ServermapCache(object):
+    """I remember the most recently updated servermaps of mutable files (and
+    so directories), keyed by storage index, so that reading a mutable file
+    again soon afterwards can go straight to the servers which hold its
+    best version instead of querying every server first.
+
+    A servermap is only used for ttl seconds after it was added. Within that
+    time, a reader may get a version which has since been replaced by
+    another client: MutableFileNode falls back to a full servermap update
+    when the cached shares turn out to be gone. Changes made through this
+    client always remove the entry. I keep at most max_entries servermaps,
+    evicting the least recently used ones. A ttl or max_entries of 0
+    disables the cache.
+    """
+
+    def __init__(self, ttl, max_entries, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict() # si -> (when, servermap, pubkey)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, storage_index):
+        """Return (servermap, pubkey) for the given storage index, or None if
+        I do not have a fresh enough servermap. The servermap is a copy,
+        which the caller may modify."""
+        entry = self._entries.pop(storage_index, None)
+        if entry is None or self._clock.seconds() - entry[0] >= self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # re-insert it, so it becomes the most recently used
+        self._entries[storage_index] = entry
+        (_, servermap, pubkey) = entry
+        return (servermap.copy(), pubkey)
+
+    def add(self, storage_index, servermap, pubkey):
+        """Remember a servermap which has just been updated, along with the
+        (verified) public key of the file."""
+        if not self.ttl or not self.max_entries:
+            return
+        self._entries.pop(storage_index, None)
+        self._entries[storage_index] = (self._clock.seconds(),
+                                        servermap.copy(), pubkey)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def remove(self, storage_index):
+        """Forget the servermap for the given storage index, because its
+        shares have been changed."""
+        self._entries.pop(storage_index, None)
+
+    def get_stats(self):
+        return {
+            "mutable.servermap_cache.hits": self.hits,
+            "mutable.servermap_cache.misses": self.misses,
+            "mutable.servermap_cache.evictions": self.evictions,
+            "mutable.servermap_cache.entries": len(self._entries),
+        }
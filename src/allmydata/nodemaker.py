@@ -20,6 +20,7 @@ from allmydata.immutable.upload import Data
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.publish import MutableData
 from allmydata.dirnode import DirectoryNode, pack_children
+from allmydata.deep_traversal import DEFAULT_PARALLELISM, DEFAULT_FRONTIER_SIZE
 from allmydata.unknown import UnknownNode
 from allmydata.blacklist import ProhibitedNode
 from allmydata import uri
@@ -31,7 +32,11 @@ class NodeMaker(object):
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
                  default_encoding_parameters, mutable_file_default,
-                 key_generator, blacklist=None):
+                 key_generator, blacklist=None, segment_cache=None,
+                 servermap_cache=None,
+                 deep_traversal_parallelism=DEFAULT_PARALLELISM,
+                 deep_traversal_frontier_size=DEFAULT_FRONTIER_SIZE,
+                 dirnode_index_cache=None, key_cache=None):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -41,6 +46,12 @@ class NodeMaker(object):
         self.mutable_file_default = mutable_file_default
         self.key_generator = key_generator
         self.blacklist = blacklist
+        self.segment_cache = segment_cache
+        self.servermap_cache = servermap_cache
+        self.deep_traversal_parallelism = deep_traversal_parallelism
+        self.deep_traversal_frontier_size = deep_traversal_frontier_size
+        self.dirnode_index_cache = dirnode_index_cache
+        self.key_cache = key_cache
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
 
@@ -48,14 +59,17 @@ class NodeMaker(object):
         return LiteralFileNode(cap)
     def _create_immutable(self, cap):
         return ImmutableFileNode(cap, self.storage_broker, self.secret_holder,
-                                 self.terminator, self.history)
+                                 self.terminator, self.history,
+                                 self.segment_cache)
     def _create_immutable_verifier(self, cap):
         return CiphertextFileNode(cap, self.storage_broker, self.secret_holder,
-                                  self.terminator, self.history)
+                                  self.terminator, self.history,
+                                  self.segment_cache)
     def _create_mutable(self, cap):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters,
-                            self.history)
+                            self.history, self.servermap_cache,
+                            self.key_cache)
         return n.init_from_cap(cap)
     def _create_dirnode(self, filenode):
         return DirectoryNode(filenode, self, self.uploader)
@@ -130,7 +144,8 @@ class NodeMaker(object):
         if version is None:
             version = self.mutable_file_default
         n = MutableFileNode(self.storage_broker, self.secret_holder,
-                            self.default_encoding_parameters, self.history)
+                            self.default_encoding_parameters, self.history,
+                            self.servermap_cache, self.key_cache)
         d = self.key_generator.generate(keysize)
         d.addCallback(n.create_with_keys, contents, version=version)
         d.addCallback(lambda res: n)
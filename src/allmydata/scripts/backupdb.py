@@ -13,7 +13,7 @@ if PY2:
 import os.path, sys, time, random, stat
 
 from allmydata.util.netstring import netstring
-from allmydata.util.hashutil import backupdb_dirhash
+from allmydata.util.hashutil import backupdb_dirhash, backupdb_filehasher
 from allmydata.util import base32
 from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.util.encodingutil import to_bytes
@@ -67,30 +67,122 @@ CREATE TABLE directories -- added in v2
 
 SCHEMA_v2 = SCHEMA_v1 + TABLE_DIRECTORY
 
+TABLE_CONTENT_HASHES = """
+
+CREATE TABLE content_hashes -- added in v3
+(
+ contenthash VARCHAR(256) PRIMARY KEY, -- base32(hash of the whole file)
+ size INTEGER,                         -- the length of the file
+ prefixhash VARCHAR(256),              -- base32(hash of its first PREFIX_SIZE bytes)
+ fileid INTEGER
+);
+
+CREATE INDEX content_hashes_by_prefix ON content_hashes (size, prefixhash);
+
+"""
+
+SCHEMA_v3 = SCHEMA_v2 + TABLE_CONTENT_HASHES
+
 UPDATE_v1_to_v2 = TABLE_DIRECTORY + """
 UPDATE version SET version=2;
 """
 
+UPDATE_v2_to_v3 = TABLE_CONTENT_HASHES + """
+UPDATE version SET version=3;
+"""
+
 UPDATERS = {
     2: UPDATE_v1_to_v2,
+    3: UPDATE_v2_to_v3,
 }
 
 def get_backupdb(dbfile, stderr=sys.stderr,
-                 create_version=(SCHEMA_v2, 2), just_create=False):
+                 create_version=(SCHEMA_v3, 3), just_create=False):
     # Open or create the given backupdb file. The parent directory must
     # exist.
     try:
         (sqlite3, db) = get_db(dbfile, stderr, create_version, updaters=UPDATERS,
                                just_create=just_create, dbname="backupdb")
-        return BackupDB_v2(sqlite3, db)
+        return BackupDB_v3(sqlite3, db)
     except DBError as e:
         print(e, file=stderr)
         return None
 
 
+def _hash_file(path, limit=None):
+    """
+    Return base32(hash) of the contents of a local file, or of just its first
+    limit bytes.
+    """
+    hasher = backupdb_filehasher()
+    remaining = limit
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            chunk_size = 64*1024
+            if remaining is not None:
+                chunk_size = min(chunk_size, remaining)
+                remaining -= chunk_size
+            data = f.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+    return base32.b2a(hasher.digest())
+
+
+class _HashingReader(object):
+    """
+    I wrap a local file which is being uploaded, and hash the bytes that are
+    read from it, so that the backupdb can record the hashes of exactly what
+    was uploaded, even if the file changes on disk meanwhile. Seeking back
+    to the start begins again; reading from anywhere else spoils the hashes.
+    """
+
+    def __init__(self, f, prefix_size):
+        self._f = f
+        self._prefix_size = prefix_size
+        self._restart()
+
+    def _restart(self):
+        self._hasher = backupdb_filehasher()
+        self._prefixhasher = backupdb_filehasher()
+        self._hashed = 0
+        self._in_order = True
+
+    def tell(self):
+        return self._f.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._f.seek(offset, whence)
+        position = self._f.tell()
+        if position == 0:
+            self._restart()
+        elif position != self._hashed:
+            self._in_order = False
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        if self._in_order:
+            self._hasher.update(data)
+            if self._hashed < self._prefix_size:
+                self._prefixhasher.update(data[:self._prefix_size - self._hashed])
+            self._hashed += len(data)
+        return data
+
+    def get_hashes(self):
+        """
+        Return (size, prefixhash, contenthash) for the bytes read from the
+        start of the file in order, or None if they were not read that way.
+        """
+        if not self._in_order:
+            return None
+        return (self._hashed,
+                base32.b2a(self._prefixhasher.digest()),
+                base32.b2a(self._hasher.digest()))
+
+
 class FileResult(object):
     def __init__(self, bdb, filecap, should_check,
-                 path, mtime, ctime, size):
+                 path, mtime, ctime, size, prefixhash=None, contenthash=None):
         self.bdb = bdb
         self.filecap = filecap
         self.should_check_p = should_check
@@ -99,15 +191,40 @@ class FileResult(object):
         self.mtime = mtime
         self.ctime = ctime
         self.size = size
+        # the hashes of the file on disk when it was checked, if they were
+        # needed to look for other files with the same contents
+        self.prefixhash = prefixhash
+        self.contenthash = contenthash
+        self._reader = None
 
     def was_uploaded(self):
         if self.filecap:
             return self.filecap
         return False
 
+    def hash_upload(self, f):
+        """
+        Return a wrapper for f, the open local file, which hashes what is
+        read from it. If the file is uploaded by reading it through that
+        wrapper, did_upload() will record its hashes, so that other files
+        with the same contents need not be uploaded. This does not touch the
+        database, so it may be done in another thread.
+        """
+        self._reader = _HashingReader(f, self.bdb.PREFIX_SIZE)
+        return self._reader
+
     def did_upload(self, filecap):
+        prefixhash = contenthash = None
+        hashes = self._reader.get_hashes() if self._reader else None
+        if hashes is not None:
+            (size, prefixhash, contenthash) = hashes
+            if size != self.size:
+                # the file changed after it was checked, so what was
+                # uploaded is not what we know it by
+                prefixhash = contenthash = None
         self.bdb.did_upload_file(filecap, self.path,
-                                 self.mtime, self.ctime, self.size)
+                                 self.mtime, self.ctime, self.size,
+                                 prefixhash, contenthash)
 
     def should_check(self):
         return self.should_check_p
@@ -138,15 +255,33 @@ class DirectoryResult(object):
         self.bdb.did_check_directory_healthy(self.dircap, results)
 
 
-class BackupDB_v2(object):
-    VERSION = 2
+class BackupDB_v3(object):
+    VERSION = 3
     NO_CHECK_BEFORE = 1*MONTH
     ALWAYS_CHECK_AFTER = 2*MONTH
+    # files whose size and first PREFIX_SIZE bytes match no file we know
+    # of are not hashed any further before they are uploaded
+    PREFIX_SIZE = 64*1024
+    # the number of changes which are grouped into each transaction
+    COMMIT_INTERVAL = 1000
 
     def __init__(self, sqlite_module, connection):
         self.sqlite_module = sqlite_module
         self.connection = connection
         self.cursor = connection.cursor()
+        self._uncommitted = 0
+
+    def commit(self):
+        """Commit my changes to the database. I group changes into
+        transactions of up to COMMIT_INTERVAL of them rather than committing
+        each one, so please call me when you are done."""
+        self.connection.commit()
+        self._uncommitted = 0
+
+    def _changed(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_INTERVAL:
+            self.commit()
 
     def check_file(self, path, use_timestamps=True):
         """I will tell you if a given local file needs to be uploaded or not,
@@ -175,9 +310,13 @@ class BackupDB_v2(object):
         file to be unchanged if ctime, mtime, and filesize are all the same
         as the earlier version. If use_timestamps=False, I will not trust the
         timestamps, so more files (perhaps all) will be marked as needing
-        upload. A future version of this database may hash the file to make
-        equality decisions, in which case use_timestamps=False will not
-        always imply r.must_upload()==True.
+        upload.
+
+        If the file is new or has changed, I look for another file with the
+        same contents, which may have been at another path or have had
+        different timestamps, and return its filecap as though this file had
+        been uploaded. I only hash the whole file if its size and its first
+        PREFIX_SIZE bytes match one that I know of.
 
         'path' points to a local file on disk, possibly relative to the
         current working directory. The database stores absolute pathnames.
@@ -194,42 +333,80 @@ class BackupDB_v2(object):
         now = time.time()
         c = self.cursor
 
-        c.execute("SELECT size,mtime,ctime,fileid"
+        c.execute("SELECT local_files.size, local_files.mtime,"
+                  "       local_files.ctime, caps.filecap,"
+                  "       last_upload.last_checked"
                   " FROM local_files"
-                  " WHERE path=?",
+                  " LEFT JOIN caps ON caps.fileid=local_files.fileid"
+                  " LEFT JOIN last_upload"
+                  "  ON last_upload.fileid=local_files.fileid"
+                  " WHERE local_files.path=?",
                   (path,))
-        row = self.cursor.fetchone()
-        if not row:
-            return FileResult(self, None, False, path, mtime, ctime, size)
-        (last_size,last_mtime,last_ctime,last_fileid) = row
-
-        c.execute("SELECT caps.filecap, last_upload.last_checked"
-                  " FROM caps,last_upload"
-                  " WHERE caps.fileid=? AND last_upload.fileid=?",
-                  (last_fileid, last_fileid))
-        row2 = c.fetchone()
-
-        if ((last_size != size
-             or not use_timestamps
-             or last_mtime != mtime
-             or last_ctime != ctime) # the file has been changed
-            or (not row2) # we somehow forgot where we put the file last time
-            ):
+        row = c.fetchone()
+        if row:
+            (last_size, last_mtime, last_ctime, filecap, last_checked) = row
+            if (last_size == size
+                and use_timestamps
+                and last_mtime == mtime
+                and last_ctime == ctime
+                and filecap is not None and last_checked is not None):
+                # we're allowed to assume the file hasn't been changed
+                return FileResult(self, to_bytes(filecap),
+                                  self._should_check(now, last_checked),
+                                  path, mtime, ctime, size)
+            # the file has been changed, or we somehow forgot where we put
+            # the file last time
             c.execute("DELETE FROM local_files WHERE path=?", (path,))
-            self.connection.commit()
-            return FileResult(self, None, False, path, mtime, ctime, size)
+            self._changed()
 
-        # at this point, we're allowed to assume the file hasn't been changed
-        (filecap, last_checked) = row2
+        try:
+            prefixhash = _hash_file(path, self.PREFIX_SIZE)
+        except EnvironmentError:
+            # let the upload report the problem
+            return FileResult(self, None, False, path, mtime, ctime, size)
+        c.execute("SELECT contenthash FROM content_hashes"
+                  " WHERE size=? AND prefixhash=?",
+                  (size, prefixhash))
+        candidates = set([candidate for (candidate,) in c.fetchall()])
+        if not candidates:
+            return FileResult(self, None, False, path, mtime, ctime, size,
+                              prefixhash)
+
+        contenthash = self._get_contenthash(path, size, prefixhash)
+        c.execute("SELECT caps.fileid, caps.filecap, last_upload.last_checked"
+                  " FROM content_hashes, caps, last_upload"
+                  " WHERE content_hashes.contenthash=?"
+                  "  AND caps.fileid=content_hashes.fileid"
+                  "  AND last_upload.fileid=content_hashes.fileid",
+                  (contenthash,))
+        row = c.fetchone()
+        if not row:
+            return FileResult(self, None, False, path, mtime, ctime, size,
+                              prefixhash, contenthash)
+
+        # we have uploaded these contents before, so remember that this file
+        # has them too
+        (fileid, filecap, last_checked) = row
+        c.execute("INSERT INTO local_files VALUES (?,?,?,?,?)",
+                  (path, size, mtime, ctime, fileid))
+        self._changed()
+        return FileResult(self, to_bytes(filecap),
+                          self._should_check(now, last_checked),
+                          path, mtime, ctime, size, prefixhash, contenthash)
+
+    def _should_check(self, now, last_checked):
         age = now - last_checked
 
         probability = ((age - self.NO_CHECK_BEFORE) /
                        (self.ALWAYS_CHECK_AFTER - self.NO_CHECK_BEFORE))
         probability = min(max(probability, 0.0), 1.0)
-        should_check = bool(random.random() < probability)
+        return bool(random.random() < probability)
 
-        return FileResult(self, to_bytes(filecap), should_check,
-                          path, mtime, ctime, size)
+    def _get_contenthash(self, path, size, prefixhash):
+        if size <= self.PREFIX_SIZE:
+            # the prefix is the whole file
+            return prefixhash
+        return _hash_file(path)
 
     def get_or_allocate_fileid_for_cap(self, filecap):
         # find an existing fileid for this filecap, or insert a new one. The
@@ -251,7 +428,8 @@ class BackupDB_v2(object):
         fileid = foundrow[0]
         return fileid
 
-    def did_upload_file(self, filecap, path, mtime, ctime, size):
+    def did_upload_file(self, filecap, path, mtime, ctime, size,
+                        prefixhash=None, contenthash=None):
         now = time.time()
         fileid = self.get_or_allocate_fileid_for_cap(filecap)
         try:
@@ -270,7 +448,10 @@ class BackupDB_v2(object):
                                 " SET size=?, mtime=?, ctime=?, fileid=?"
                                 " WHERE path=?",
                                 (size, mtime, ctime, fileid, path))
-        self.connection.commit()
+        if contenthash is not None:
+            self.cursor.execute("REPLACE INTO content_hashes VALUES (?,?,?,?)",
+                                (contenthash, size, prefixhash, fileid))
+        self._changed()
 
     def did_check_file_healthy(self, filecap, results):
         now = time.time()
@@ -279,7 +460,7 @@ class BackupDB_v2(object):
                             " SET last_checked=?"
                             " WHERE fileid=?",
                             (now, fileid))
-        self.connection.commit()
+        self._changed()
 
     def check_directory(self, contents):
         """I will tell you if a new directory needs to be created for a given
@@ -324,12 +505,7 @@ class BackupDB_v2(object):
         if not row:
             return DirectoryResult(self, dirhash_s, None, False)
         (dircap, last_checked) = row
-        age = now - last_checked
-
-        probability = ((age - self.NO_CHECK_BEFORE) /
-                       (self.ALWAYS_CHECK_AFTER - self.NO_CHECK_BEFORE))
-        probability = min(max(probability, 0.0), 1.0)
-        should_check = bool(random.random() < probability)
+        should_check = self._should_check(now, last_checked)
 
         return DirectoryResult(self, dirhash_s, to_bytes(dircap), should_check)
 
@@ -340,7 +516,7 @@ class BackupDB_v2(object):
         # update the record in place. Otherwise create a new record.)
         self.cursor.execute("REPLACE INTO directories VALUES (?,?,?,?)",
                             (dirhash, dircap, now, now))
-        self.connection.commit()
+        self._changed()
 
     def did_check_directory_healthy(self, dircap, results):
         now = time.time()
@@ -348,4 +524,4 @@ class BackupDB_v2(object):
                             " SET last_checked=?"
                             " WHERE dircap=?",
                             (now, dircap))
-        self.connection.commit()
+        self._changed()
@@ -333,6 +333,9 @@ class BackupOptions(FileStoreOptions):
         ("verbose", "v", "Be noisy about what is happening."),
         ("ignore-timestamps", None, "Do not use backupdb timestamps to decide whether a local file is unchanged."),
         ]
+    optParameters = [
+        ("parallelism", "j", 4, "Check and upload up to this many files at once.", int),
+        ]
 
     vcs_patterns = ('CVS', 'RCS', 'SCCS', '.git', '.gitignore', '.cvsignore',
                     '.svn', '.arch-ids','{arch}', '=RELEASE-ID',
@@ -347,6 +350,11 @@ class BackupOptions(FileStoreOptions):
         self.from_dir = argv_to_abspath(localdir)
         self.to_dir = argv_to_unicode(topath)
 
+    def postOptions(self):
+        super(BackupOptions, self).postOptions()
+        if self["parallelism"] < 1:
+            raise usage.UsageError("--parallelism must be at least 1")
+
     synopsis = "[options] FROM ALIAS:TO"
 
     def opt_exclude(self, pattern):
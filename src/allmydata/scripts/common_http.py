@@ -11,6 +11,7 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
 import os
+import threading
 from io import BytesIO
 from six.moves import urllib, http_client
 import six
@@ -48,30 +49,87 @@ class BadResponse(object):
         return ""
 
 
-def do_http(method, url, body=b""):
-    if isinstance(body, bytes):
-        body = BytesIO(body)
-    elif isinstance(body, six.text_type):
-        raise TypeError("do_http body must be a bytestring, not unicode")
-    else:
-        # We must give a Content-Length header to twisted.web, otherwise it
-        # seems to get a zero-length file. I suspect that "chunked-encoding"
-        # may fix this.
-        assert body.tell
-        assert body.seek
-        assert body.read
-    scheme, host, port, path = parse_url(url)
+class HTTPConnectionPool(object):
+    """
+    I hold idle connections to HTTP servers, so that do_http() can send
+    several requests over one connection instead of connecting again for
+    each of them. I may be shared by several threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {} # (scheme, host, port) -> [connection]
+
+    def get_connection(self, scheme, host, port):
+        """
+        Return (connection, reused): an idle connection to the given server
+        if I have one, otherwise a new one.
+        """
+        with self._lock:
+            idle = self._idle.get((scheme, host, port))
+            if idle:
+                return idle.pop(), True
+        return _make_connection(scheme, host, port), False
+
+    def put_connection(self, scheme, host, port, c):
+        """
+        Give back a connection, whose last response has been read, for
+        later requests to use.
+        """
+        with self._lock:
+            self._idle.setdefault((scheme, host, port), []).append(c)
+
+    def close(self):
+        """
+        Close all of my idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for c in connections:
+                c.close()
+
+
+class ReadResponse(object):
+    """
+    I am an HTTP response whose body has already been read, so that the
+    connection it came on could be used again.
+    """
+    def __init__(self, resp, body):
+        self.status = resp.status
+        self.reason = resp.reason
+        self._headers = resp.getheaders()
+        self._body = BytesIO(body)
+
+    def getheader(self, name, default=None):
+        for (key, value) in self._headers:
+            if key.lower() == name.lower():
+                return value
+        return default
+
+    def read(self, length=None):
+        return self._body.read(length)
+
+
+def _make_connection(scheme, host, port):
     if scheme == "http":
-        c = http_client.HTTPConnection(host, port)
+        return http_client.HTTPConnection(host, port)
     elif scheme == "https":
-        c = http_client.HTTPSConnection(host, port)
+        return http_client.HTTPSConnection(host, port)
     else:
         raise ValueError("unknown scheme '%s', need http or https" % scheme)
+
+
+def _send_request(c, method, host, path, body, keep_alive):
+    """
+    Send a request, with body (a file-like object) as its body, on the
+    connection c. I raise socket.error if the server cannot be reached.
+    """
     c.putrequest(method, path)
     c.putheader("Hostname", host)
     c.putheader("User-Agent", allmydata.__full_version__ + " (tahoe-client)")
     c.putheader("Accept", "text/plain, application/octet-stream")
-    c.putheader("Connection", "close")
+    if not keep_alive:
+        c.putheader("Connection", "close")
 
     old = body.tell()
     body.seek(0, os.SEEK_END)
@@ -79,10 +137,7 @@ def do_http(method, url, body=b""):
     body.seek(old)
     c.putheader("Content-Length", str(length))
 
-    try:
-        c.endheaders()
-    except socket_error as err:
-        return BadResponse(url, err)
+    c.endheaders()
 
     while True:
         data = body.read(8192)
@@ -90,7 +145,57 @@ def do_http(method, url, body=b""):
             break
         c.send(data)
 
-    return c.getresponse()
+
+def do_http(method, url, body=b"", pool=None):
+    """
+    Make an HTTP request, and return the response.
+
+    If pool (an HTTPConnectionPool) is given, the request is sent on one of
+    its idle connections if it has one, and the response is read before it
+    is returned, so that the connection can go back to the pool.
+    """
+    if isinstance(body, bytes):
+        body = BytesIO(body)
+    elif isinstance(body, six.text_type):
+        raise TypeError("do_http body must be a bytestring, not unicode")
+    else:
+        # We must give a Content-Length header to twisted.web, otherwise it
+        # seems to get a zero-length file. I suspect that "chunked-encoding"
+        # may fix this.
+        assert body.tell
+        assert body.seek
+        assert body.read
+    scheme, host, port, path = parse_url(url)
+    if pool is None:
+        c = _make_connection(scheme, host, port)
+        try:
+            _send_request(c, method, host, path, body, keep_alive=False)
+        except socket_error as err:
+            return BadResponse(url, err)
+        return c.getresponse()
+
+    start = body.tell()
+    while True:
+        c, reused = pool.get_connection(scheme, host, port)
+        try:
+            _send_request(c, method, host, path, body, keep_alive=True)
+            resp = c.getresponse()
+            data = resp.read()
+        except (socket_error, http_client.HTTPException) as err:
+            c.close()
+            if reused:
+                # the server may have closed this connection while it was
+                # idle, so try again on another one
+                body.seek(start)
+                continue
+            if isinstance(err, socket_error):
+                return BadResponse(url, err)
+            raise
+        if resp.will_close:
+            c.close()
+        else:
+            pool.put_connection(scheme, host, port, c)
+        return ReadResponse(resp, data)
 
 
 def format_http_success(resp):
@@ -12,12 +12,15 @@ if PY2:
 
 import os.path
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote as url_quote
 import datetime
 
 from allmydata.scripts.common import get_alias, escape_path, DEFAULT_ALIAS, \
                                      UnknownAliasError
-from allmydata.scripts.common_http import do_http, HTTPError, format_http_error
+from allmydata.scripts.common_http import do_http, HTTPError, \
+     format_http_error, HTTPConnectionPool
 from allmydata.util import time_format, jsonbytes as json
 from allmydata.scripts import backupdb
 from allmydata.util.encodingutil import listdir_unicode, quote_output, \
@@ -43,7 +46,7 @@ def get_local_metadata(path):
     # TODO: extended attributes, like on OS-X's HFS+
     return metadata
 
-def mkdir(contents, options):
+def mkdir(contents, options, pool=None):
     kids = dict([ (childname, (contents[childname][0],
                                {"ro_uri": contents[childname][1],
                                 "metadata": contents[childname][2],
@@ -52,17 +55,17 @@ def mkdir(contents, options):
                   ])
     body = json.dumps(kids).encode("utf-8")
     url = options['node-url'] + "uri?t=mkdir-immutable"
-    resp = do_http("POST", url, body)
+    resp = do_http("POST", url, body, pool=pool)
     if resp.status < 200 or resp.status >= 300:
         raise HTTPError("Error during mkdir", resp)
 
     dircap = to_bytes(resp.read().strip())
     return dircap
 
-def put_child(dirurl, childname, childcap):
+def put_child(dirurl, childname, childcap, pool=None):
     assert dirurl[-1] != "/"
     url = dirurl + "/" + url_quote(unicode_to_url(childname)) + "?t=uri"
-    resp = do_http("PUT", url, childcap)
+    resp = do_http("PUT", url, childcap, pool=pool)
     if resp.status not in (200, 201):
         raise HTTPError("Error during put_child", resp)
 
@@ -75,11 +78,20 @@ class BackerUpper(object):
     :ivar int _directories_checked: The number of directories which the backup
         process has so-far inspected on the grid to determine if they need to
         be re-uploaded.
+
+    :ivar HTTPConnectionPool _pool: The connections to the gateway which are
+        used for every request of the backup.
+
+    :ivar ThreadPoolExecutor _executor: The worker threads which check and
+        upload files, when more than one file is uploaded at once.
     """
     def __init__(self, options):
         self.options = options
         self._files_checked = 0
         self._directories_checked = 0
+        self._pool = HTTPConnectionPool()
+        self._executor = None
+        self.backupdb = None
 
     def run(self):
         options = self.options
@@ -119,9 +131,9 @@ class BackerUpper(object):
 
         # first step: make sure the target directory exists, as well as the
         # Archives/ subdirectory.
-        resp = do_http("GET", archives_url + "?t=json")
+        resp = do_http("GET", archives_url + "?t=json", pool=self._pool)
         if resp.status == 404:
-            resp = do_http("POST", archives_url + "?t=mkdir")
+            resp = do_http("POST", archives_url + "?t=mkdir", pool=self._pool)
             if resp.status != 200:
                 print(format_http_error("Unable to create target directory", resp), file=stderr)
                 return 1
@@ -132,6 +144,11 @@ class BackerUpper(object):
             listdir_unicode,
             self.options.filter_listdir,
         ))
+        parallelism = options["parallelism"]
+        start_upload_file = None
+        if parallelism > 1:
+            self._executor = ThreadPoolExecutor(parallelism)
+            start_upload_file = self.start_upload
         completed = run_backup(
             warn=self.warn,
             upload_file=self.upload,
@@ -139,14 +156,16 @@ class BackerUpper(object):
             targets=targets,
             start_timestamp=start_timestamp,
             stdout=stdout,
+            start_upload_file=start_upload_file,
+            parallelism=parallelism,
         )
         new_backup_dircap = completed.dircap
 
         # third: attach the new backup to the list
         now = time_format.iso_utc(int(time.time()), sep="_") + "Z"
 
-        put_child(archives_url, now, new_backup_dircap)
-        put_child(to_url, "Latest", new_backup_dircap)
+        put_child(archives_url, now, new_backup_dircap, self._pool)
+        put_child(to_url, "Latest", new_backup_dircap, self._pool)
         print(completed.report(
             self.verbosity,
             self._files_checked,
@@ -160,6 +179,17 @@ class BackerUpper(object):
         # done!
         return 0
 
+    def close(self):
+        """
+        Wait for any files still being uploaded, commit what the backupdb has
+        learned, then close my connections to the gateway.
+        """
+        if self._executor:
+            self._executor.shutdown()
+        if self.backupdb:
+            self.backupdb.commit()
+        self._pool.close()
+
     def verboseprint(self, msg):
         precondition(isinstance(msg, str), msg)
         if self.verbosity >= 2:
@@ -173,7 +203,7 @@ class BackerUpper(object):
         must_create, r = self.check_backupdb_directory(compare_contents)
         if must_create:
             self.verboseprint(" creating directory for %s" % quote_local_unicode_path(path))
-            newdircap = mkdir(create_contents, self.options)
+            newdircap = mkdir(create_contents, self.options, self._pool)
             assert isinstance(newdircap, bytes)
             if r:
                 r.did_create(newdircap)
@@ -183,40 +213,6 @@ class BackerUpper(object):
             return False, r.was_created()
 
 
-    def check_backupdb_file(self, childpath):
-        if not self.backupdb:
-            return True, None
-        use_timestamps = not self.options["ignore-timestamps"]
-        r = self.backupdb.check_file(childpath, use_timestamps)
-
-        if not r.was_uploaded():
-            return True, r
-
-        if not r.should_check():
-            # the file was uploaded or checked recently, so we can just use
-            # it
-            return False, r
-
-        # we must check the file before using the results
-        filecap = r.was_uploaded()
-        self.verboseprint("checking %s" % quote_output(filecap))
-        nodeurl = self.options['node-url']
-        checkurl = nodeurl + "uri/%s?t=check&output=JSON" % url_quote(filecap)
-        self._files_checked += 1
-        resp = do_http("POST", checkurl)
-        if resp.status != 200:
-            # can't check, so we must assume it's bad
-            return True, r
-
-        cr = json.loads(resp.read())
-        healthy = cr["results"]["healthy"]
-        if not healthy:
-            # must upload
-            return True, r
-        # file is healthy, no need to upload
-        r.did_check_healthy(cr)
-        return False, r
-
     def check_backupdb_directory(self, compare_contents):
         if not self.backupdb:
             return True, None
@@ -231,61 +227,125 @@ class BackerUpper(object):
             return False, r
 
         # we must check the directory before re-using it
-        dircap = r.was_created()
-        self.verboseprint("checking %s" % quote_output(dircap))
-        nodeurl = self.options['node-url']
-        checkurl = nodeurl + "uri/%s?t=check&output=JSON" % url_quote(dircap)
         self._directories_checked += 1
-        resp = do_http("POST", checkurl)
-        if resp.status != 200:
-            # can't check, so we must assume it's bad
-            return True, r
-
-        cr = json.loads(resp.read())
-        healthy = cr["results"]["healthy"]
-        if not healthy:
+        cr = self.check_healthy(r.was_created())
+        if cr is None:
             # must create
             return True, r
         # directory is healthy, no need to upload
         r.did_check_healthy(cr)
         return False, r
 
+    def check_healthy(self, cap):
+        """
+        Check a file or directory on the grid. Return the de-JSONized check
+        results if it is healthy, or None if it is not (or if it could not
+        be checked, in which case we must assume that it is not).
+        """
+        self.verboseprint("checking %s" % quote_output(cap))
+        nodeurl = self.options['node-url']
+        checkurl = nodeurl + "uri/%s?t=check&output=JSON" % url_quote(cap)
+        resp = do_http("POST", checkurl, pool=self._pool)
+        if resp.status != 200:
+            return None
+
+        cr = json.loads(resp.read())
+        if not cr["results"]["healthy"]:
+            return None
+        return cr
+
     # This function will raise an IOError exception when called on an unreadable file
     def upload(self, childpath):
+        metadata, bdb_results = self.prepare_upload(childpath)
+        transferred = self.transfer(childpath, bdb_results)
+        return self.finish_upload(childpath, metadata, bdb_results,
+                                  transferred)
+
+    def start_upload(self, childpath):
+        """
+        Start backing up a file in one of my worker threads, and return a
+        function which waits for that and then returns what upload() would.
+        The backupdb is only used by this thread: here and in that function.
+        """
+        metadata, bdb_results = self.prepare_upload(childpath)
+        future = self._executor.submit(self.transfer, childpath, bdb_results)
+        return lambda: self.finish_upload(childpath, metadata, bdb_results,
+                                          future.result())
+
+    def prepare_upload(self, childpath):
+        """
+        Return the local metadata of a file, and what the backupdb knows
+        about it (or None if there is no backupdb).
+        """
         precondition_abspath(childpath)
-
-        #self.verboseprint("uploading %s.." % quote_local_unicode_path(childpath))
         metadata = get_local_metadata(childpath)
-
-        # we can use the backupdb here
-        must_upload, bdb_results = self.check_backupdb_file(childpath)
-
-        if must_upload:
-            self.verboseprint("uploading %s.." % quote_local_unicode_path(childpath))
-            infileobj = open(childpath, "rb")
-            url = self.options['node-url'] + "uri"
-            resp = do_http("PUT", url, infileobj)
-            if resp.status not in (200, 201):
-                raise HTTPError("Error during file PUT", resp)
-
-            filecap = resp.read().strip()
-            self.verboseprint(" %s -> %s" % (quote_local_unicode_path(childpath, quotemarks=False),
-                                             quote_output(filecap, quotemarks=False)))
-            #self.verboseprint(" metadata: %s" % (quote_output(metadata, quotemarks=False),))
-
+        if not self.backupdb:
+            return metadata, None
+        use_timestamps = not self.options["ignore-timestamps"]
+        return metadata, self.backupdb.check_file(childpath, use_timestamps)
+
+    def transfer(self, childpath, bdb_results):
+        """
+        Do the network part of backing up a file: check it on the grid if
+        the backupdb says we should, and upload it unless it is already
+        there. Return (check_results, filecap): the check results if the
+        file was checked and found healthy, and the filecap if it was
+        uploaded, otherwise None. I do not touch the backupdb, so I may be
+        run in a worker thread.
+        """
+        if bdb_results and bdb_results.was_uploaded():
+            if not bdb_results.should_check():
+                # the file was uploaded or checked recently, so we can just
+                # use it
+                return None, None
+            # we must check the file before using the results
+            cr = self.check_healthy(bdb_results.was_uploaded())
+            if cr is not None:
+                # file is healthy, no need to upload
+                return cr, None
+
+        self.verboseprint("uploading %s.." % quote_local_unicode_path(childpath))
+        url = self.options['node-url'] + "uri"
+        with open(childpath, "rb") as infileobj:
             if bdb_results:
-                bdb_results.did_upload(filecap)
-
-            return True, filecap, metadata
-
-        else:
+                # hash the contents as they are sent
+                infileobj = bdb_results.hash_upload(infileobj)
+            resp = do_http("PUT", url, infileobj, pool=self._pool)
+        if resp.status not in (200, 201):
+            raise HTTPError("Error during file PUT", resp)
+
+        filecap = resp.read().strip()
+        self.verboseprint(" %s -> %s" % (quote_local_unicode_path(childpath, quotemarks=False),
+                                         quote_output(filecap, quotemarks=False)))
+        return None, filecap
+
+    def finish_upload(self, childpath, metadata, bdb_results, transferred):
+        """
+        Record the results of transfer() in the backupdb, and return
+        (created, filecap, metadata) for the file.
+        """
+        (cr, filecap) = transferred
+        if bdb_results and bdb_results.was_uploaded() and \
+           bdb_results.should_check():
+            self._files_checked += 1
+        if cr is not None:
+            bdb_results.did_check_healthy(cr)
+
+        if filecap is None:
             self.verboseprint("skipping %s.." % quote_local_unicode_path(childpath))
             return False, bdb_results.was_uploaded(), metadata
 
+        if bdb_results:
+            bdb_results.did_upload(filecap)
+        return True, filecap, metadata
+
 
 def backup(options):
     bu = BackerUpper(options)
-    return bu.run()
+    try:
+        return bu.run()
+    finally:
+        bu.close()
 
 
 def collect_backup_targets(root, listdir, filter_children):
@@ -327,8 +387,13 @@ def run_backup(
         targets,
         start_timestamp,
         stdout,
+        start_upload_file=None,
+        parallelism=1,
 ):
     progress = BackupProgress(warn, start_timestamp, len(targets))
+    if start_upload_file is not None:
+        targets = start_file_uploads(targets, start_upload_file,
+                                     2 * parallelism)
     for target in targets:
         # Pass in the progress and get back a progress.  It would be great if
         # progress objects were immutable.  Then the target's backup would
@@ -340,16 +405,56 @@ def run_backup(
     return progress.backup_finished()
 
 
+def start_file_uploads(targets, start_upload_file, window):
+    """
+    Yield targets in order, while keeping the uploads of up to window of the
+    FileTargets which come after the one being yielded started in the
+    background. Each target is still backed up, and so recorded in the
+    backupdb, in order; a directory comes after everything in it, so its
+    files are all done before it is.
+    """
+    started = deque()
+    ahead = 0
+    for target in targets:
+        started.append(target)
+        if isinstance(target, FileTarget):
+            target.start(start_upload_file)
+            ahead += 1
+        while ahead > window or (started and
+                                 not isinstance(started[0], FileTarget)):
+            done = started.popleft()
+            if isinstance(done, FileTarget):
+                ahead -= 1
+            yield done
+    while started:
+        yield started.popleft()
+
+
 class FileTarget(object):
     def __init__(self, path):
         self._path = path
+        self._finish_upload = None
 
     def __repr__(self):
         return "<File {}>".format(self._path)
 
+    def start(self, start_upload_file):
+        """
+        Start uploading me in the background. backup() will wait for it.
+        """
+        try:
+            self._finish_upload = start_upload_file(self._path)
+        except EnvironmentError as e:
+            def _failed(e=e):
+                raise e
+            self._finish_upload = _failed
+
     def backup(self, progress, upload_file, upload_directory):
         try:
-            created, childcap, metadata = upload_file(self._path)
+            if self._finish_upload is not None:
+                created, childcap, metadata = self._finish_upload()
+            else:
+                created, childcap, metadata = upload_file(self._path)
         except EnvironmentError:
             target = PermissionDeniedTarget(self._path, isdir=False)
             return target.backup(progress, upload_file, upload_directory)
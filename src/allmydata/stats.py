@@ -83,6 +83,7 @@ class StatsProvider(service.MultiService):
 
         self.counters = dictutil.UnicodeKeyDict()
         self.stats_producers = []
+        self.histograms = {}
         self.cpu_monitor = CPUUsageMonitor()
         self.cpu_monitor.setServiceParent(self)
         self.register_producer(self.cpu_monitor)
@@ -94,10 +95,18 @@ class StatsProvider(service.MultiService):
     def register_producer(self, stats_producer):
         self.stats_producers.append(IStatsProducer(stats_producer))
 
+    def register_histogram(self, name, histogram):
+        """Publish an allmydata.util.histogram.Histogram, which its owner
+        keeps adding values to, under the given name."""
+        self.histograms[name] = histogram
+
     def get_stats(self):
         stats = {}
         for sp in self.stats_producers:
             stats.update(sp.get_stats())
-        ret = { 'counters': self.counters, 'stats': stats }
+        histograms = dict((name, h.get_stats())
+                          for (name, h) in self.histograms.items())
+        ret = { 'counters': self.counters, 'stats': stats,
+                'histograms': histograms }
         log.msg(format='get_stats() -> %(stats)s', stats=ret, level=log.NOISY)
         return ret
@@ -469,7 +469,9 @@ class ShareCrawler(service.MultiService):
         self.yielding(sleep_time)
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
-    def start_current_prefix(self, start_slice):
+    def start_cycle(self):
+        """Start a new cycle, unless one is already in progress. Return the
+        number of the current cycle."""
         state = self.state
         if state["current-cycle"] is None:
             self.last_cycle_started_time = time.time()
@@ -479,7 +481,24 @@ class ShareCrawler(service.MultiService):
             else:
                 state["current-cycle"] = state["last-cycle-finished"] + 1
             self.started_cycle(state["current-cycle"])
-        cycle = state["current-cycle"]
+        return state["current-cycle"]
+
+    def finish_cycle(self, cycle):
+        """Record that the current cycle is complete."""
+        state = self.state
+        self.last_complete_prefix_index = -1
+        self.last_prefix_finished_time = None # don't include the sleep
+        now = time.time()
+        if self.last_cycle_started_time is not None:
+            self.last_cycle_elapsed_time = now - self.last_cycle_started_time
+        state["last-complete-bucket"] = None
+        state["last-cycle-finished"] = cycle
+        state["current-cycle"] = None
+        self.finished_cycle(cycle)
+        self.save_state()
+
+    def start_current_prefix(self, start_slice):
+        cycle = self.start_cycle()
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
             # if we want to yield earlier, just raise TimeSliceExceeded()
@@ -509,16 +528,7 @@ class ShareCrawler(service.MultiService):
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
-        self.last_complete_prefix_index = -1
-        self.last_prefix_finished_time = None # don't include the sleep
-        now = time.time()
-        if self.last_cycle_started_time is not None:
-            self.last_cycle_elapsed_time = now - self.last_cycle_started_time
-        state["last-complete-bucket"] = None
-        state["last-cycle-finished"] = cycle
-        state["current-cycle"] = None
-        self.finished_cycle(cycle)
-        self.save_state()
+        self.finish_cycle(cycle)
 
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
@@ -12,16 +12,20 @@ import os
 import struct
 from allmydata.storage.crawler import (
     ShareCrawler,
+    TimeSliceExceeded,
     _confirm_json_format,
     _convert_cycle_data,
     _dump_json_to_file,
 )
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b, si_b2a
 from twisted.python import log as twlog
 from twisted.python.filepath import FilePath
 
+# leases are granted for this long, see LeaseInfo.get_grant_renew_time_time()
+LEASE_DURATION = 31*24*60*60
+
 
 def _convert_pickle_state_to_json(state):
     """
@@ -107,10 +111,18 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     All cycle-to-date values remain valid until the start of the next cycle.
 
+    If expiration is enabled and the storage server has a complete share
+    index, I do not visit every bucket. Instead, each cycle asks the index
+    for the shares which have a lease that had expired (according to the
+    configured mode) when the cycle started, and processes their buckets in
+    the order in which those leases expired. The 'examined' statistics then
+    only cover those buckets.
+
     """
 
     slow_start = 360 # wait 6 minutes after startup
     minimum_cycle_time = 12*60*60 # not more than twice per day
+    index_batch_size = 100 # buckets fetched from the share index at a time
 
     def __init__(self, server, statefile, historyfile,
                  expiration_enabled, mode,
@@ -144,6 +156,12 @@ class LeaseCheckingCrawler(ShareCrawler):
         # the keys individually
         for k in so_far:
             self.state["cycle-to-date"].setdefault(k, so_far[k])
+        # these are only used by cycles driven by the share index
+        self.state.setdefault("index-driven", False)
+        self.state.setdefault("expiration-cutoff", None)
+        self.state.setdefault("expiring-buckets", None)
+        self.state.setdefault("expiring-buckets-processed", 0)
+        self.state.setdefault("last-expiring-bucket", None)
 
     def create_empty_cycle_dict(self):
         recovered = self.create_empty_recovered_dict()
@@ -165,6 +183,91 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def started_cycle(self, cycle):
         self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+        if self.state["index-driven"]:
+            cutoff = self.get_expiration_cutoff(time.time())
+            share_index = self.server.get_share_index()
+            self.state["expiration-cutoff"] = cutoff
+            self.state["expiring-buckets"] = share_index.count_expiring_buckets(
+                cutoff, self.sharetypes_to_expire)
+            self.state["expiring-buckets-processed"] = 0
+            self.state["last-expiring-bucket"] = None
+
+    def get_expiration_cutoff(self, now):
+        """Return the lease expiration time before which process_share()
+        would consider a lease to have expired at time 'now'."""
+        if self.mode == "age":
+            if self.override_lease_duration is None:
+                # the age of the lease is compared with its own expiration
+                # time: now - (expiration - LEASE_DURATION) > expiration
+                return (now + LEASE_DURATION) / 2
+            return now - self.override_lease_duration + LEASE_DURATION
+        return self.cutoff_date + LEASE_DURATION
+
+    def start_current_prefix(self, start_slice):
+        if self.state["current-cycle"] is None:
+            self.state["index-driven"] = (self.expiration_enabled and
+                                          self.server.get_share_index() is not None)
+        elif (self.state["index-driven"] and
+              self.server.get_share_index() is None):
+            # the share index was disabled while we were using it: finish
+            # this cycle by visiting every bucket instead
+            self.state["index-driven"] = False
+        if not self.state["index-driven"]:
+            return ShareCrawler.start_current_prefix(self, start_slice)
+        cycle = self.start_cycle()
+        self.process_expiring_buckets(cycle, start_slice)
+        self.finish_cycle(cycle)
+
+    def process_expiring_buckets(self, cycle, start_slice):
+        """Process every bucket which the share index says has a share with
+        an expired lease, in the order in which those leases expired. Each
+        bucket is handed to process_bucket(), which removes all of the
+        expired leases in it, so it will not be returned by the index again.
+        """
+        state = self.state
+        share_index = self.server.get_share_index()
+        while True:
+            after = state["last-expiring-bucket"]
+            if after is not None:
+                (first_expiration, storage_index_b32) = after
+                after = (first_expiration,
+                         si_a2b(storage_index_b32.encode("ascii")))
+            buckets = share_index.get_expiring_buckets(
+                state["expiration-cutoff"], self.sharetypes_to_expire,
+                after=after, limit=self.index_batch_size)
+            if not buckets:
+                return
+            for (first_expiration, storage_index) in buckets:
+                storage_index_b32 = si_b2a(storage_index).decode("ascii")
+                prefix = storage_index_b32[:2]
+                prefixdir = os.path.join(self.sharedir, prefix)
+                if os.path.isdir(os.path.join(prefixdir, storage_index_b32)):
+                    self.process_bucket(cycle, prefix, prefixdir,
+                                        storage_index_b32)
+                else:
+                    # the bucket went away behind our back
+                    self.server.update_share_index(storage_index)
+                state["last-expiring-bucket"] = [first_expiration,
+                                                 storage_index_b32]
+                state["expiring-buckets-processed"] += 1
+                if time.time() >= start_slice + self.cpu_slice:
+                    raise TimeSliceExceeded()
+
+    def get_progress(self):
+        progress = ShareCrawler.get_progress(self)
+        if progress["cycle-in-progress"] and self.state["index-driven"]:
+            total = self.state["expiring-buckets"]
+            done = min(self.state["expiring-buckets-processed"], total)
+            pct = 100.0
+            if total:
+                pct = 100.0 * done / total
+            progress["cycle-complete-percentage"] = pct
+            remaining = None
+            if done and self.last_cycle_started_time is not None:
+                elapsed = time.time() - self.last_cycle_started_time
+                remaining = elapsed * (total - done) / done
+            progress["estimated-cycle-complete-time-left"] = remaining
+        return progress
 
     def stat(self, fn):
         return os.stat(fn)
@@ -193,6 +296,10 @@ class LeaseCheckingCrawler(ShareCrawler):
                 wks = (1, 1, 1, "unknown")
             would_keep_shares.append(wks)
 
+        if self.expiration_enabled:
+            # leases (and maybe whole shares) were removed
+            self.server.update_share_index(si_a2b(storage_index_b32.encode("ascii")))
+
         sharetype = None
         if wks:
             # use the last share's sharetype as the buckettype
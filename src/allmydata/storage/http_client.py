@@ -16,20 +16,27 @@ if PY2:
 else:
     # typing module not available in Python 2, and we only do type checking in
     # Python 3 anyway.
-    from typing import Union
+    from typing import Union, Set
+    from twisted.internet.defer import Deferred
     from treq.testing import StubTreq
 
 from base64 import b64encode
 
-# TODO Make sure to import Python version?
-from cbor2 import loads
-
+import attr
 
+# TODO Make sure to import Python version?
+from cbor2 import loads, dumps
+from collections_extended import RangeMap
+from werkzeug.datastructures import Range, ContentRange
 from twisted.web.http_headers import Headers
+from twisted.web import http
 from twisted.internet.defer import inlineCallbacks, returnValue, fail
 from hyperlink import DecodedURL
 import treq
 
+from .http_common import swissnum_auth_header, Secrets
+from .common import si_b2a
+
 
 class ClientException(Exception):
     """An unexpected error."""
@@ -42,11 +49,6 @@ def _decode_cbor(response):
     return fail(ClientException(response.code, response.phrase))
 
 
-def swissnum_auth_header(swissnum):  # type: (bytes) -> bytes
-    """Return value for ``Authentication`` header."""
-    return b"Tahoe-LAFS " + b64encode(swissnum).strip()
-
-
 class StorageClient(object):
     """
     HTTP client that talks to the HTTP storage server.
@@ -68,12 +70,23 @@ class StorageClient(object):
         )
         return headers
 
-    def _request(self, method, url, secrets, **kwargs):
+    def _url(self, path):
+        """Get a URL relative to the base URL."""
+        return self._base_url.click(path)
+
+    def _request(self, method, url, secrets, headers=None, **kwargs):
         """
         Like ``treq.request()``, but additional argument of secrets mapping
         ``http_server.Secret`` to the bytes value of the secret.
         """
-        headers = self._get_headers()
+        if headers is None:
+            headers = self._get_headers()
+        else:
+            headers = headers.copy()
+            headers.addRawHeader(
+                "Authorization",
+                swissnum_auth_header(self._swissnum),
+            )
         for key, value in secrets.items():
             headers.addRawHeader(
                 "X-Tahoe-Authorization",
@@ -86,7 +99,176 @@ class StorageClient(object):
         """
         Return the version metadata for the server.
         """
-        url = self._base_url.click("/v1/version")
+        url = self._url("/v1/version")
         response = yield self._request("GET", url, {})
         decoded_response = yield _decode_cbor(response)
         returnValue(decoded_response)
+
+
+@attr.s
+class UploadProgress(object):
+    """
+    Progress of immutable upload, per the server.
+    """
+
+    # True when upload has finished.
+    finished = attr.ib()  # type: bool
+    # Remaining ranges to upload.
+    required = attr.ib()  # type: RangeMap
+
+
+@attr.s
+class ImmutableCreateResult(object):
+    """Result of creating a storage index for an immutable."""
+
+    already_have = attr.ib()  # type: Set[int]
+    allocated = attr.ib()  # type: Set[int]
+
+
+class StorageClientImmutables(object):
+    """
+    APIs for interacting with immutables.
+    """
+
+    def __init__(self, client):  # type: (StorageClient) -> None
+        self._client = client
+
+    @inlineCallbacks
+    def create(
+        self,
+        storage_index,
+        share_numbers,
+        allocated_size,
+        upload_secret,
+        lease_renew_secret,
+        lease_cancel_secret,
+    ):  # type: (bytes, Set[int], int, bytes, bytes, bytes) -> Deferred[ImmutableCreateResult]
+        """
+        Create a new storage index for an immutable.
+
+        The result indicates which shares the server already has, and which
+        it allocated for this upload.
+        """
+        url = self._client._url("/v1/immutable/" + _encode_si(storage_index))
+        message = dumps(
+            {"share-numbers": share_numbers, "allocated-size": allocated_size}
+        )
+        headers = Headers()
+        headers.addRawHeader("Content-Type", "application/cbor")
+        response = yield self._client._request(
+            "POST",
+            url,
+            {
+                Secrets.LEASE_RENEW: lease_renew_secret,
+                Secrets.LEASE_CANCEL: lease_cancel_secret,
+                Secrets.UPLOAD: upload_secret,
+            },
+            headers=headers,
+            data=message,
+        )
+        decoded_response = yield _decode_cbor(response)
+        returnValue(
+            ImmutableCreateResult(
+                already_have=set(decoded_response["already-have"]),
+                allocated=set(decoded_response["allocated"]),
+            )
+        )
+
+    @inlineCallbacks
+    def write_share_chunk(
+        self, storage_index, share_number, upload_secret, offset, data
+    ):  # type: (bytes, int, bytes, int, bytes) -> Deferred[UploadProgress]
+        """
+        Upload a chunk of data for a specific share.
+
+        Once every byte of the share has been written, the server closes it
+        and the result's ``finished`` is ``True``.
+        """
+        url = self._client._url(
+            "/v1/immutable/{}/{}".format(_encode_si(storage_index), share_number)
+        )
+        headers = Headers()
+        headers.addRawHeader(
+            "Content-Range",
+            ContentRange("bytes", offset, offset + len(data)).to_header(),
+        )
+        response = yield self._client._request(
+            "PATCH",
+            url,
+            {Secrets.UPLOAD: upload_secret},
+            headers=headers,
+            data=data,
+        )
+
+        if response.code == http.OK:
+            # Upload is still unfinished.
+            finished = False
+        elif response.code == http.CREATED:
+            # Upload is done!
+            finished = True
+        else:
+            raise ClientException(response.code, response.phrase)
+        required = RangeMap()
+        if not finished:
+            body = yield _decode_cbor(response)
+            for r in body["required"]:
+                required.set(True, r["begin"], r["end"])
+        returnValue(UploadProgress(finished=finished, required=required))
+
+    @inlineCallbacks
+    def abort_upload(
+        self, storage_index, share_number, upload_secret
+    ):  # type: (bytes, int, bytes) -> Deferred[None]
+        """Abort the upload of a specific share."""
+        url = self._client._url(
+            "/v1/immutable/{}/{}/abort".format(_encode_si(storage_index), share_number)
+        )
+        response = yield self._client._request(
+            "PUT", url, {Secrets.UPLOAD: upload_secret}
+        )
+        if response.code != http.OK:
+            raise ClientException(response.code, response.phrase)
+
+    @inlineCallbacks
+    def read_share_chunk(
+        self, storage_index, share_number, offset, length
+    ):  # type: (bytes, int, int, int) -> Deferred[bytes]
+        """
+        Download a chunk of data from a share.
+
+        Reads that extend past the end of the share are truncated, and reads
+        that start at or past the end of the share return an empty string,
+        matching ``RIBucketReader.read``.
+        """
+        url = self._client._url(
+            "/v1/immutable/{}/{}".format(_encode_si(storage_index), share_number)
+        )
+        headers = Headers()
+        headers.addRawHeader(
+            "Range", Range("bytes", [(offset, offset + length)]).to_header()
+        )
+        response = yield self._client._request("GET", url, {}, headers=headers)
+        if response.code == http.PARTIAL_CONTENT:
+            body = yield response.content()
+            returnValue(body)
+        elif response.code == http.REQUESTED_RANGE_NOT_SATISFIABLE:
+            returnValue(b"")
+        else:
+            raise ClientException(response.code, response.phrase)
+
+    @inlineCallbacks
+    def list_shares(self, storage_index):  # type: (bytes) -> Deferred[Set[int]]
+        """
+        Return the set of shares for a given storage index.
+        """
+        url = self._client._url(
+            "/v1/immutable/{}/shares".format(_encode_si(storage_index))
+        )
+        response = yield self._client._request("GET", url, {})
+        body = yield _decode_cbor(response)
+        returnValue(set(body))
+
+
+def _encode_si(storage_index):  # type: (bytes) -> str
+    """Encode the storage index into Unicode string."""
+    return str(si_b2a(storage_index), "ascii")
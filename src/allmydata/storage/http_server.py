@@ -17,26 +17,27 @@ else:
     from typing import Dict, List, Set
 
 from functools import wraps
-from enum import Enum
 from base64 import b64decode
 
 from klein import Klein
 from twisted.web import http
+from twisted.internet.interfaces import IPullProducer
+from twisted.internet.defer import Deferred
+from zope.interface import implementer
+import attr
+from werkzeug.http import parse_range_header, parse_content_range_header
+from werkzeug.routing import BaseConverter, ValidationError
 
 # TODO Make sure to use pure Python versions?
-from cbor2 import dumps
+from cbor2 import dumps, loads
 
 from .server import StorageServer
-from .http_client import swissnum_auth_header
+from .immutable import BucketWriter, BucketReader
+from .common import si_a2b, si_b2a
+from .http_common import swissnum_auth_header, Secrets
+from ..interfaces import ConflictingWriteError
 from ..util.hashutil import timing_safe_compare
-
-
-class Secrets(Enum):
-    """Different kinds of secrets the client may send."""
-
-    LEASE_RENEW = "lease-renew-secret"
-    LEASE_CANCEL = "lease-cancel-secret"
-    UPLOAD = "upload-secret"
+from ..util.base32 import rfc3548_alphabet
 
 
 class ClientSecretsException(Exception):
@@ -117,6 +118,7 @@ def _authorized_route(app, required_secrets, *route_args, **route_kwargs):
     def decorator(f):
         @app.route(*route_args, **route_kwargs)
         @_authorization_decorator(required_secrets)
+        @wraps(f)
         def handle_route(*args, **kwargs):
             return f(*args, **kwargs)
 
@@ -125,18 +127,125 @@ def _authorized_route(app, required_secrets, *route_args, **route_kwargs):
     return decorator
 
 
+@attr.s
+class StorageIndexUploads(object):
+    """
+    In-progress upload to storage index.
+    """
+
+    # Map share number to BucketWriter
+    shares = attr.ib(factory=dict)  # type: Dict[int,BucketWriter]
+
+    # The upload secret, used to authorize writes and aborts:
+    upload_secret = attr.ib(default=None)  # type: bytes
+
+
+class StorageIndexConverter(BaseConverter):
+    """Parser/validator for storage index URL path segments."""
+
+    regex = "[" + str(rfc3548_alphabet, "ascii") + "]{26}"
+
+    def to_python(self, value):
+        try:
+            return si_a2b(value.encode("ascii"))
+        except (AssertionError, ValueError):
+            raise ValidationError("Invalid storage index")
+
+    def to_url(self, storage_index):
+        return str(si_b2a(storage_index), "ascii")
+
+
+class _HTTPError(Exception):
+    """
+    Raise from ``HTTPServer`` endpoint to return the given HTTP response code.
+    """
+
+    def __init__(self, code):  # type: (int) -> None
+        Exception.__init__(self, code)
+        self.code = code
+
+
+# How much data to read from a request body, or from a share, at a time.
+# Reading in bounded chunks means neither uploads nor downloads need to hold
+# an entire share in memory.
+CHUNK_SIZE = 64 * 1024
+
+
+@implementer(IPullProducer)
+@attr.s
+class _ReadRangeProducer(object):
+    """
+    Producer that writes a range of a share to the request, ``CHUNK_SIZE``
+    bytes at a time.  ``result`` fires once everything has been written, at
+    which point the request can be finished.
+    """
+
+    request = attr.ib()
+    bucket = attr.ib()  # type: BucketReader
+    start = attr.ib()  # type: int
+    remaining = attr.ib()  # type: int
+    result = attr.ib(init=False, factory=Deferred)  # type: Deferred
+
+    def resumeProducing(self):
+        if self.request is None:
+            return
+        to_read = min(self.remaining, CHUNK_SIZE)
+        data = self.bucket.read(self.start, to_read) if to_read else b""
+        if data:
+            self.request.write(data)
+            self.start += len(data)
+            self.remaining -= len(data)
+        if not data or self.remaining == 0:
+            # Either we're done, or the share was shorter than expected; in
+            # either case there is nothing more to send.
+            self.request.unregisterProducer()
+            self.request = None
+            self.result.callback(b"")
+
+    def stopProducing(self):
+        if self.request is not None:
+            self.request = None
+            self.result.callback(b"")
+
+
 class HTTPServer(object):
     """
     A HTTP interface to the storage server.
     """
 
     _app = Klein()
+    _app.url_map.converters["storage_index"] = StorageIndexConverter
+
+    @_app.handle_errors(_HTTPError)
+    def _http_error(self, request, failure):
+        """Handle ``_HTTPError`` exceptions."""
+        request.setResponseCode(failure.value.code)
+        return b""
 
     def __init__(
         self, storage_server, swissnum
     ):  # type: (StorageServer, bytes) -> None
         self._storage_server = storage_server
         self._swissnum = swissnum
+        # Maps storage index to StorageIndexUploads:
+        self._uploads = {}  # type: Dict[bytes,StorageIndexUploads]
+
+        # When an upload finishes successfully, gets aborted, or times out,
+        # make sure it gets removed from our tracking datastructure:
+        self._storage_server.register_bucket_writer_close_handler(
+            self._bucket_writer_closed
+        )
+
+    def _bucket_writer_closed(self, bucket):
+        """
+        Stop tracking a ``BucketWriter`` that has closed, for whatever reason.
+        """
+        for storage_index, uploads in list(self._uploads.items()):
+            for share_number, writer in list(uploads.shares.items()):
+                if writer is bucket:
+                    del uploads.shares[share_number]
+            if not uploads.shares:
+                del self._uploads[storage_index]
 
     def get_resource(self):
         """Return twisted.web ``Resource`` for this object."""
@@ -148,9 +257,212 @@ class HTTPServer(object):
         # TODO if data is big, maybe want to use a temporary file eventually...
         return dumps(data)
 
+    def _read_encoded(self, request):
+        """Read CBOR-encoded data from the request body."""
+        try:
+            return loads(request.content.read())
+        except Exception:
+            raise _HTTPError(http.BAD_REQUEST)
+
+    def _get_upload(self, storage_index, share_number, upload_secret):
+        """
+        Return the in-progress ``BucketWriter`` for the given share, raising
+        ``_HTTPError`` if there isn't one or the upload secret is wrong.
+        """
+        try:
+            uploads = self._uploads[storage_index]
+            bucket = uploads.shares[share_number]
+        except KeyError:
+            raise _HTTPError(http.NOT_FOUND)
+        if not timing_safe_compare(uploads.upload_secret, upload_secret):
+            raise _HTTPError(http.UNAUTHORIZED)
+        return bucket
+
     ##### Generic APIs #####
 
     @_authorized_route(_app, set(), "/v1/version", methods=["GET"])
     def version(self, request, authorization):
         """Return version information."""
         return self._cbor(request, self._storage_server.get_version())
+
+    ##### Immutable APIs #####
+
+    @_authorized_route(
+        _app,
+        {Secrets.LEASE_RENEW, Secrets.LEASE_CANCEL, Secrets.UPLOAD},
+        "/v1/immutable/<storage_index:storage_index>",
+        methods=["POST"],
+    )
+    def allocate_buckets(self, request, authorization, storage_index):
+        """Allocate buckets."""
+        upload_secret = authorization[Secrets.UPLOAD]
+        info = self._read_encoded(request)
+        try:
+            share_numbers = set(info["share-numbers"])
+            allocated_size = info["allocated-size"]
+        except (KeyError, TypeError):
+            raise _HTTPError(http.BAD_REQUEST)
+
+        in_progress = self._uploads.get(storage_index)
+        if in_progress is not None:
+            if not timing_safe_compare(in_progress.upload_secret, upload_secret):
+                # Someone else is already uploading to this storage index.
+                # We don't leak anything by refusing: the storage index alone
+                # is enough to discover the upload once it finishes.
+                raise _HTTPError(http.UNAUTHORIZED)
+
+        already_got, sharenum_to_bucket = self._storage_server.allocate_buckets(
+            storage_index,
+            renew_secret=authorization[Secrets.LEASE_RENEW],
+            cancel_secret=authorization[Secrets.LEASE_CANCEL],
+            sharenums=share_numbers,
+            allocated_size=allocated_size,
+        )
+        allocated = set(sharenum_to_bucket)
+        if in_progress is not None:
+            # Shares this upload already started (e.g. before a client
+            # restart) are still allocated to it, so it can resume them.
+            allocated |= share_numbers & set(in_progress.shares)
+        if sharenum_to_bucket:
+            uploads = self._uploads.setdefault(
+                storage_index, StorageIndexUploads(upload_secret=upload_secret)
+            )
+            uploads.shares.update(sharenum_to_bucket)
+        return self._cbor(
+            request,
+            {
+                "already-have": sorted(already_got),
+                "allocated": sorted(allocated),
+            },
+        )
+
+    @_authorized_route(
+        _app,
+        {Secrets.UPLOAD},
+        "/v1/immutable/<storage_index:storage_index>/<int(signed=False):share_number>",
+        methods=["PATCH"],
+    )
+    def write_share_data(self, request, authorization, storage_index, share_number):
+        """Write data to an in-progress immutable upload."""
+        content_range = parse_content_range_header(
+            request.getHeader("content-range")
+        )
+        if content_range is None or content_range.units != "bytes":
+            raise _HTTPError(http.BAD_REQUEST)
+        bucket = self._get_upload(
+            storage_index, share_number, authorization[Secrets.UPLOAD]
+        )
+
+        # Feed the body to the BucketWriter a chunk at a time, rather than
+        # reading what may be a whole share into memory at once.
+        offset = content_range.start
+        remaining = content_range.stop - content_range.start
+        finished = False
+        while remaining > 0:
+            data = request.content.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                break
+            try:
+                finished = bucket.write(offset, data)
+            except ConflictingWriteError:
+                raise _HTTPError(http.CONFLICT)
+            offset += len(data)
+            remaining -= len(data)
+        if remaining > 0 or request.content.read(1):
+            # The body didn't match the Content-Range it claimed.
+            raise _HTTPError(http.BAD_REQUEST)
+
+        if finished:
+            bucket.close()
+            request.setResponseCode(http.CREATED)
+            return b""
+
+        required = []
+        for start, end, _ in bucket.required_ranges().ranges():
+            required.append({"begin": start, "end": end})
+        return self._cbor(request, {"required": required})
+
+    @_authorized_route(
+        _app,
+        {Secrets.UPLOAD},
+        "/v1/immutable/<storage_index:storage_index>/<int(signed=False):share_number>/abort",
+        methods=["PUT"],
+    )
+    def abort_share_upload(self, request, authorization, storage_index, share_number):
+        """Abort an in-progress immutable share upload."""
+        try:
+            bucket = self._get_upload(
+                storage_index, share_number, authorization[Secrets.UPLOAD]
+            )
+        except _HTTPError as e:
+            if e.code == http.NOT_FOUND and (
+                share_number in self._storage_server.get_buckets(storage_index)
+            ):
+                # The upload already finished; aborting makes no sense.
+                raise _HTTPError(http.NOT_ALLOWED)
+            raise
+
+        # Abort the upload; this should close it which will eventually result
+        # in self._uploads no longer tracking it.
+        bucket.abort()
+        return b""
+
+    @_authorized_route(
+        _app,
+        set(),
+        "/v1/immutable/<storage_index:storage_index>/shares",
+        methods=["GET"],
+    )
+    def list_shares(self, request, authorization, storage_index):
+        """
+        List shares for the given storage index.
+        """
+        share_numbers = sorted(self._storage_server.get_buckets(storage_index))
+        return self._cbor(request, share_numbers)
+
+    @_authorized_route(
+        _app,
+        set(),
+        "/v1/immutable/<storage_index:storage_index>/<int(signed=False):share_number>",
+        methods=["GET"],
+    )
+    def read_share_chunk(self, request, authorization, storage_index, share_number):
+        """
+        Read a chunk of an already uploaded immutable share.
+
+        The ``Range`` header may select exactly one ``bytes`` range; without
+        it the whole share is returned.  Data is streamed to the client
+        ``CHUNK_SIZE`` bytes at a time.
+        """
+        try:
+            bucket = self._storage_server.get_buckets(storage_index)[share_number]
+        except KeyError:
+            raise _HTTPError(http.NOT_FOUND)
+        share_length = bucket.get_length()
+
+        range_header = request.getHeader("range")
+        if range_header is None:
+            start, stop = 0, share_length
+        else:
+            parsed_range = parse_range_header(range_header)
+            if parsed_range is None or parsed_range.units != "bytes":
+                raise _HTTPError(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            # Returns None for multiple ranges, which we don't support:
+            offsets = parsed_range.range_for_length(share_length)
+            if offsets is None:
+                request.setHeader("content-range", "bytes */%d" % (share_length,))
+                raise _HTTPError(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            start, stop = offsets
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader(
+                "content-range",
+                parsed_range.make_content_range(share_length).to_header(),
+            )
+
+        request.setHeader("content-type", "application/octet-stream")
+        request.setHeader("content-length", "%d" % (stop - start,))
+        if stop == start:
+            return b""
+        producer = _ReadRangeProducer(request, bucket, start, stop - start)
+        request.registerProducer(producer, False)
+        return producer.result
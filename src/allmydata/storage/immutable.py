@@ -204,6 +204,12 @@ class ShareFile(object):
     def unlink(self):
         os.unlink(self.home)
 
+    def get_length(self):
+        """
+        Return the length of the data in the share, if we're reading.
+        """
+        return self._lease_offset - self._data_offset
+
     def read_share_data(self, offset, length):
         precondition(offset >= 0)
         # reads beyond the end of the data are truncated. Reads that start
@@ -375,16 +381,31 @@ class BucketWriter(object):
     def allocated_size(self):
         return self._max_size
 
-    def write(self, offset, data):
+    def required_ranges(self):  # type: () -> RangeMap
+        """
+        Return which ranges still need to be written.
+        """
+        result = RangeMap()
+        result.set(True, 0, self._max_size)
+        for start, end, _ in self._already_written.ranges():
+            result.empty(start, end)
+        return result
+
+    def write(self, offset, data):  # type: (int, bytes) -> bool
+        """
+        Write data at given offset, return whether the upload is complete.
+        """
         # Delay the timeout, since we received data:
         self._timeout.reset(30 * 60)
         start = self._clock.seconds()
         precondition(not self.closed)
+        end = offset + len(data)
         if self.throw_out_all_data:
-            return
+            if data:
+                self._already_written.set(True, offset, end)
+            return self._is_complete()
 
         # Make sure we're not conflicting with existing data:
-        end = offset + len(data)
         for (chunk_start, chunk_stop, _) in self._already_written.ranges(offset, end):
             chunk_len = chunk_stop - chunk_start
             actual_chunk = self._sharefile.read_share_data(chunk_start, chunk_len)
@@ -398,6 +419,18 @@ class BucketWriter(object):
         self._already_written.set(True, offset, end)
         self.ss.add_latency("write", self._clock.seconds() - start)
         self.ss.count("write")
+        self.ss.count("bytes_in.write", len(data))
+        return self._is_complete()
+
+    def _is_complete(self):
+        """
+        Return whether every byte of the allocated share has been written.
+        """
+        written = sum(
+            chunk_stop - chunk_start
+            for (chunk_start, chunk_stop, _) in self._already_written.ranges()
+        )
+        return written == self._max_size
 
     def close(self):
         precondition(not self.closed)
@@ -485,7 +518,7 @@ class FoolscapBucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
         self._bucket_writer = bucket_writer
 
     def remote_write(self, offset, data):
-        return self._bucket_writer.write(offset, data)
+        self._bucket_writer.write(offset, data)
 
     def remote_close(self):
         return self._bucket_writer.close()
@@ -517,8 +550,15 @@ class BucketReader(object):
         data = self._share_file.read_share_data(offset, length)
         self.ss.add_latency("read", time.time() - start)
         self.ss.count("read")
+        self.ss.count("bytes_out.read", len(data))
         return data
 
+    def get_length(self):
+        """
+        Return the length of the data in the share.
+        """
+        return self._share_file.get_length()
+
     def advise_corrupt_share(self, reason):
         return self.ss.advise_corrupt_share(b"immutable",
                                             self.storage_index,
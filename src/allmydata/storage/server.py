@@ -22,8 +22,9 @@ from twisted.application import service
 from twisted.internet import reactor
 
 from zope.interface import implementer
-from allmydata.interfaces import RIStorageServer, IStatsProducer
+from allmydata.interfaces import RIStorageServer, IStatsProducer, MAX_LEASE_BATCH
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.histogram import WindowedHistogram
 import allmydata # for __full_version__
 
 from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
@@ -38,6 +39,7 @@ from allmydata.storage.immutable import (
 )
 from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.shareindex import ShareIndex, ShareIndexCrawler
 
 # storage/
 # storage/shares/incoming
@@ -75,6 +77,7 @@ class StorageServer(service.MultiService):
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
                  expiration_sharetypes=("mutable", "immutable"),
+                 share_index=False,
                  clock=reactor):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, bytes)
@@ -104,18 +107,20 @@ class StorageServer(service.MultiService):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        self.latencies = {}
+        for category in ["allocate", "write", "close", "read", "get", # immutable
+                         "writev", "readv", # mutable
+                         "add-lease", "renew", "cancel", # both
+                         ]:
+            self.latencies[category] = WindowedHistogram(clock)
+            if self.stats_provider:
+                self.stats_provider.register_histogram(
+                    "storage_server.latencies.%s" % category,
+                    self.latencies[category].cumulative)
         self.add_bucket_counter()
+        self._share_index = None
+        if share_index:
+            self.add_share_index()
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
@@ -146,6 +151,8 @@ class StorageServer(service.MultiService):
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
+        if self._use_share_index():
+            return self._share_index.has_shares()
         return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
 
     def add_bucket_counter(self):
@@ -153,39 +160,62 @@ class StorageServer(service.MultiService):
         self.bucket_counter = BucketCountingCrawler(self, statefile)
         self.bucket_counter.setServiceParent(self)
 
+    def add_share_index(self):
+        dbfile = os.path.join(self.storedir, "share_index.sqlite")
+        statefile = os.path.join(self.storedir, "share_index_crawler.state")
+        if not os.path.exists(dbfile):
+            # a new index must be built from scratch
+            fileutil.remove_if_possible(statefile)
+        self._share_index = ShareIndex(dbfile)
+        if not self._share_index.is_complete() and not self.have_shares():
+            # nothing to crawl
+            self._share_index.set_complete()
+        if not self._share_index.is_complete():
+            self.share_index_crawler = ShareIndexCrawler(self, statefile,
+                                                         self._share_index)
+            self.share_index_crawler.setServiceParent(self)
+
+    def _use_share_index(self):
+        return self._share_index is not None and self._share_index.is_complete()
+
+    def get_share_index(self):
+        """Return my ShareIndex, or None if it is disabled or has not been
+        built yet."""
+        if self._use_share_index():
+            return self._share_index
+        return None
+
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
 
     def get_latencies(self):
         """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
-        for unambiguous interpretation, each dict will contain the
+        latency numbers for each category, estimated from the samples
+        collected in the last ten minutes or so. If there are sufficient
+        samples for unambiguous interpretation, each dict will contain the
         following keys: mean, 01_0_percentile, 10_0_percentile,
         50_0_percentile (median), 90_0_percentile, 95_0_percentile,
         99_0_percentile, 99_9_percentile.  If there are insufficient
         samples for a given percentile to be interpreted unambiguously
         that percentile will be reported as None. If no samples have been
         collected for the given category, then that category name will
-        not be present in the return value. """
+        not be present in the return value. The cumulative histograms of
+        all samples are published through the stats provider. """
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
         for category in self.latencies:
-            if not self.latencies[category]:
+            samples = self.latencies[category].window()
+            count = samples.count
+            if not count:
                 continue
             stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
             stats["samplesize"] = count
-            samples.sort()
             if count > 1:
-                stats["mean"] = sum(samples) / count
+                stats["mean"] = samples.sum / count
             else:
                 stats["mean"] = None
 
@@ -196,7 +226,7 @@ class StorageServer(service.MultiService):
 
             for percentile, percentilestring, minnumtoobserve in orderstatlist:
                 if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
+                    stats[percentilestring] = samples.quantile(percentile)
                 else:
                     stats[percentilestring] = None
 
@@ -241,6 +271,11 @@ class StorageServer(service.MultiService):
             writeable = False
 
         stats['storage_server.accepting_immutable_shares'] = int(writeable)
+        if self._use_share_index():
+            stats['storage_server.total_bucket_count'] = self._share_index.get_bucket_count()
+            stats['storage_server.total_share_count'] = self._share_index.get_share_count()
+            stats['storage_server.total_share_bytes'] = self._share_index.get_total_size()
+            return stats
         s = self.bucket_counter.get_state()
         bucket_count = s.get("last-complete-bucket-count")
         if bucket_count:
@@ -277,6 +312,7 @@ class StorageServer(service.MultiService):
                       b"delete-mutable-shares-with-zero-length-writev": True,
                       b"fills-holes-with-zero-bytes": True,
                       b"prevents-read-past-end-of-share-data": True,
+                      b"maximum-add-leases-batch-size": MAX_LEASE_BATCH,
                       },
                     b"application-version": allmydata.__full_version__.encode("utf-8"),
                     }
@@ -332,8 +368,9 @@ class StorageServer(service.MultiService):
         # file, they'll want us to hold leases for this file.
         for (shnum, fn) in self._get_bucket_shares(storage_index):
             alreadygot[shnum] = ShareFile(fn)
-        if renew_leases:
+        if renew_leases and alreadygot:
             self._add_or_renew_leases(alreadygot.values(), lease_info)
+            self.update_share_index(storage_index)
 
         for shnum in sharenums:
             incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
@@ -369,6 +406,18 @@ class StorageServer(service.MultiService):
         return set(alreadygot), bucketwriters
 
     def _iter_share_files(self, storage_index):
+        if self._use_share_index():
+            # the index tells us what kind of share each one is
+            bucketdir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+            for (shnum, sharetype) in self._share_index.get_shares(storage_index):
+                filename = os.path.join(bucketdir, "%d" % shnum)
+                if not os.path.exists(filename):
+                    continue
+                if sharetype == "mutable":
+                    yield MutableShareFile(filename, self)
+                else:
+                    yield ShareFile(filename)
+            return
         for shnum, filename in self._get_bucket_shares(storage_index):
             with open(filename, 'rb') as f:
                 header = f.read(32)
@@ -394,9 +443,33 @@ class StorageServer(service.MultiService):
             self._iter_share_files(storage_index),
             lease_info,
         )
+        self.update_share_index(storage_index)
         self.add_latency("add-lease", self._clock.seconds() - start)
         return None
 
+    def add_leases(self, leases):
+        """Add or renew a lease on each of several storage indexes.
+
+        :param leases: a list of (storage_index, renew_secret, cancel_secret)
+            tuples.
+
+        :return: a list with one item for each tuple: None if the lease was
+            added, or a byte string describing why it could not be.
+        """
+        self.count("add-leases")
+        results = []
+        for (storage_index, renew_secret, cancel_secret) in leases:
+            try:
+                self.add_lease(storage_index, renew_secret, cancel_secret)
+            except Exception as e:
+                self.log("add_leases: error adding lease to %r: %r"
+                         % (si_b2a(storage_index), e), level=log.UNUSUAL)
+                error = "%s: %s" % (type(e).__name__, e)
+                results.append(error.encode("utf-8")[:1000])
+            else:
+                results.append(None)
+        return results
+
     def renew_lease(self, storage_index, renew_secret):
         start = self._clock.seconds()
         self.count("renew")
@@ -405,6 +478,7 @@ class StorageServer(service.MultiService):
         for sf in self._iter_share_files(storage_index):
             found_buckets = True
             sf.renew_lease(renew_secret, new_expire_time)
+        self.update_share_index(storage_index)
         self.add_latency("renew", self._clock.seconds() - start)
         if not found_buckets:
             raise IndexError("no such lease to renew")
@@ -413,6 +487,10 @@ class StorageServer(service.MultiService):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
         del self._bucket_writers[bw.incominghome]
+        if consumed_size:
+            # the share was stored (aborted uploads consume nothing)
+            (bucketdir, shnum) = os.path.split(bw.finalhome)
+            self.update_share_index(si_a2b(os.path.basename(bucketdir).encode("ascii")))
         for handler in self._call_on_bucket_writer_close:
             handler(bw)
 
@@ -427,6 +505,10 @@ class StorageServer(service.MultiService):
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'."""
         storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+        if self._use_share_index():
+            for (shnum, sharetype) in self._share_index.get_shares(storage_index):
+                yield (shnum, os.path.join(storagedir, "%d" % shnum))
+            return
         try:
             for f in os.listdir(storagedir):
                 if NUM_RE.match(f):
@@ -436,6 +518,42 @@ class StorageServer(service.MultiService):
             # Commonly caused by there being no buckets at all.
             pass
 
+    def update_share_index(self, storage_index):
+        """Bring the share index up to date with the shares on disk for the
+        given storage index. This must be called after anything creates or
+        deletes a share, or changes its leases. It does nothing if the share
+        index is disabled."""
+        if self._share_index is None:
+            return
+        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+        shares = []
+        try:
+            filenames = os.listdir(storagedir)
+        except OSError:
+            filenames = []
+        for f in filenames:
+            if not NUM_RE.match(f):
+                continue
+            filename = os.path.join(storagedir, f)
+            try:
+                with open(filename, 'rb') as fh:
+                    header = fh.read(32)
+                if MutableShareFile.is_valid_header(header):
+                    sf = MutableShareFile(filename)
+                elif ShareFile.is_valid_header(header):
+                    sf = ShareFile(filename)
+                else:
+                    continue # non-sharefile
+                expirations = [lease.get_expiration_time()
+                               for lease in sf.get_leases()]
+                size = os.stat(filename).st_size
+            except EnvironmentError:
+                continue
+            shares.append((int(f), sf.sharetype, size,
+                           min(expirations or [None]),
+                           max(expirations or [None])))
+        self._share_index.set_bucket(storage_index, shares)
+
     def get_buckets(self, storage_index):
         start = self._clock.seconds()
         self.count("get")
@@ -443,8 +561,14 @@ class StorageServer(service.MultiService):
         log.msg("storage: get_buckets %r" % si_s)
         bucketreaders = {} # k: sharenum, v: BucketReader
         for shnum, filename in self._get_bucket_shares(storage_index):
-            bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
+            try:
+                bucketreaders[shnum] = BucketReader(self, filename,
+                                                    storage_index, shnum)
+            except EnvironmentError:
+                if not self._use_share_index():
+                    raise
+                # the share went away behind our back: believe the disk
+                self.update_share_index(storage_index)
         self.add_latency("get", self._clock.seconds() - start)
         return bucketreaders
 
@@ -496,7 +620,13 @@ class StorageServer(service.MultiService):
             from integer share numbers to ``MutableShareFile`` instances.
         """
         shares = {}
-        if os.path.isdir(bucketdir):
+        if self._use_share_index():
+            for (sharenum, sharetype) in self._share_index.get_shares(si_a2b(si_s)):
+                filename = os.path.join(bucketdir, "%d" % sharenum)
+                msf = MutableShareFile(filename, self)
+                msf.check_write_enabler(write_enabler, si_s)
+                shares[sharenum] = msf
+        elif os.path.isdir(bucketdir):
             # shares exist if there is a file for them
             for sharenum_s in os.listdir(bucketdir):
                 try:
@@ -670,6 +800,15 @@ class StorageServer(service.MultiService):
             shares,
         )
 
+        self.count("bytes_in.writev",
+                   sum(len(data)
+                       for (testv, datav, new_length)
+                       in test_and_write_vectors.values()
+                       for (offset, data) in datav))
+        self.count("bytes_out.writev",
+                   sum(len(data) for datav in read_data.values()
+                       for data in datav))
+
         if testv_is_good:
             # now apply the write vectors
             remaining_shares = self._evaluate_write_vectors(
@@ -681,6 +820,7 @@ class StorageServer(service.MultiService):
             if renew_leases:
                 lease_info = self._make_lease_info(renew_secret, cancel_secret)
                 self._add_or_renew_leases(remaining_shares.values(), lease_info)
+            self.update_share_index(storage_index)
 
         # all done
         self.add_latency("writev", self._clock.seconds() - start)
@@ -705,21 +845,30 @@ class StorageServer(service.MultiService):
         si_dir = storage_index_to_dir(storage_index)
         # shares exist if there is a file for them
         bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+        if self._use_share_index():
+            sharenums = [(sharenum, "%d" % sharenum) for (sharenum, sharetype)
+                         in self._share_index.get_shares(storage_index)]
+        elif not os.path.isdir(bucketdir):
             self.add_latency("readv", self._clock.seconds() - start)
             return {}
+        else:
+            sharenums = []
+            for sharenum_s in os.listdir(bucketdir):
+                try:
+                    sharenums.append((int(sharenum_s), sharenum_s))
+                except ValueError:
+                    continue
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for (sharenum, sharenum_s) in sharenums:
             if sharenum in shares or not shares:
                 filename = os.path.join(bucketdir, sharenum_s)
                 msf = MutableShareFile(filename, self)
                 datavs[sharenum] = msf.readv(readv)
         log.msg("returning shares %s" % (list(datavs.keys()),),
                 facility="tahoe.storage", level=log.NOISY, parent=lp)
+        self.count("bytes_out.readv",
+                   sum(len(data) for datav in datavs.values()
+                       for data in datav))
         self.add_latency("readv", self._clock.seconds() - start)
         return datavs
 
@@ -833,6 +982,9 @@ class FoolscapStorageServer(Referenceable):  # type: ignore # warner/foolscap#78
                          owner_num=1):
         return self._server.add_lease(storage_index, renew_secret, cancel_secret)
 
+    def remote_add_leases(self, leases):
+        return self._server.add_leases(leases)
+
     def remote_renew_lease(self, storage_index, renew_secret):
         return self._server.renew_lease(storage_index, renew_secret)
 
@@ -0,0 +1,214 @@
+"""
+An on-disk index of the shares held by a storage server.
+
+The storage server normally finds shares by listing the bucket directory for
+a storage index and reading the header of every share file in it. On servers
+with many millions of shares, those cold directory listings dominate request
+latency. When the index is enabled, the server records every share it holds
+(storage index, share number, share type, size and the earliest and latest
+expiration times of its leases) in an SQLite database, and answers lookups
+from it instead. The lease checker also uses it to find the shares with
+expired leases, without visiting every bucket.
+
+The share files remain the authoritative copy: the index is rebuilt by
+``ShareIndexCrawler`` whenever it is created (or thrown away), and it is not
+used until that first crawl has finished. It must be deleted if shares are
+added to or removed from the storage directory by hand while the server is
+not running.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from allmydata.util.dbutil import get_db
+from allmydata.storage.common import si_a2b
+from allmydata.storage.crawler import ShareCrawler
+
+
+SCHEMA_v2 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index BLOB NOT NULL,
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9) NOT NULL, -- "immutable" or "mutable"
+ size INTEGER NOT NULL,         -- size of the share file, in bytes
+ expiration NUMBER,             -- latest lease expiration time, or NULL
+ first_expiration NUMBER,       -- earliest lease expiration time, or NULL
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX shares_expiration ON shares (expiration);
+CREATE INDEX shares_first_expiration ON shares (first_expiration);
+
+CREATE TABLE complete
+(
+ complete INTEGER  -- contains one row, set to 1 once a full crawl has finished
+);
+
+"""
+
+UPDATE_v1_to_v2 = """
+ALTER TABLE shares ADD COLUMN first_expiration NUMBER;
+CREATE INDEX shares_first_expiration ON shares (first_expiration);
+-- the new column must be filled in by crawling the shares again
+DELETE FROM complete;
+"""
+
+UPDATERS = {
+    2: UPDATE_v1_to_v2,
+}
+
+
+class ShareIndex(object):
+    """I am an SQLite database of the shares held by one storage server.
+
+    Every change I am told about is committed immediately. I keep the
+    number of buckets and shares, and their total size, in memory so that
+    they can be reported without querying the database.
+    """
+
+    def __init__(self, dbfile):
+        (self._sqlite, self._db) = get_db(dbfile, create_version=(SCHEMA_v2, 2),
+                                          updaters=UPDATERS,
+                                          dbname="share index")
+        c = self._db.cursor()
+        # the index can always be rebuilt from the share files, so there is
+        # no need to wait for every commit to reach the disk
+        c.execute("PRAGMA journal_mode = WAL")
+        c.execute("PRAGMA synchronous = NORMAL")
+        c.execute("SELECT COUNT(DISTINCT storage_index), COUNT(*),"
+                  " COALESCE(SUM(size), 0) FROM shares")
+        (self._num_buckets, self._num_shares, self._total_size) = c.fetchone()
+        c.execute("SELECT complete FROM complete")
+        row = c.fetchone()
+        self._complete = bool(row and row[0])
+
+    def close(self):
+        self._db.close()
+
+    def is_complete(self):
+        """Return True if I know about every share on disk, False if I am
+        still being built."""
+        return self._complete
+
+    def set_complete(self):
+        c = self._db.cursor()
+        c.execute("DELETE FROM complete")
+        c.execute("INSERT INTO complete (complete) VALUES (1)")
+        self._db.commit()
+        self._complete = True
+
+    def get_shares(self, storage_index):
+        """Return a sorted list of (shnum, sharetype) tuples for the shares I
+        have for the given storage index."""
+        c = self._db.cursor()
+        c.execute("SELECT shnum, sharetype FROM shares"
+                  " WHERE storage_index=? ORDER BY shnum",
+                  (storage_index,))
+        return [(shnum, str(sharetype)) for (shnum, sharetype) in c.fetchall()]
+
+    def set_bucket(self, storage_index, shares):
+        """Replace everything I know about the given storage index.
+
+        :param shares: a list of (shnum, sharetype, size, first_expiration,
+            expiration) tuples describing the shares which now exist for it.
+            ``first_expiration`` and ``expiration`` are the earliest and
+            latest expiration times of the share's leases, or None if it has
+            no leases.
+        """
+        c = self._db.cursor()
+        c.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM shares"
+                  " WHERE storage_index=?", (storage_index,))
+        (old_shares, old_size) = c.fetchone()
+        c.execute("DELETE FROM shares WHERE storage_index=?", (storage_index,))
+        c.executemany("INSERT INTO shares"
+                      " (storage_index, shnum, sharetype, size,"
+                      "  first_expiration, expiration)"
+                      " VALUES (?,?,?,?,?,?)",
+                      [(storage_index,) + tuple(share) for share in shares])
+        self._db.commit()
+        self._num_buckets += int(bool(shares)) - int(bool(old_shares))
+        self._num_shares += len(shares) - old_shares
+        self._total_size += sum([s[2] for s in shares]) - old_size
+
+    def count_expiring_buckets(self, cutoff, sharetypes):
+        """Return the number of storage indexes which have at least one share
+        of the given types with a lease that expires before 'cutoff'."""
+        c = self._db.cursor()
+        c.execute("SELECT COUNT(DISTINCT storage_index) FROM shares"
+                  " WHERE first_expiration < ? AND sharetype IN (%s)"
+                  % ",".join("?" * len(sharetypes)),
+                  (cutoff,) + tuple(sharetypes))
+        return c.fetchone()[0]
+
+    def get_expiring_buckets(self, cutoff, sharetypes, after=None, limit=100):
+        """Return up to 'limit' storage indexes which have at least one share
+        of the given types with a lease that expires before 'cutoff', ordered
+        by the earliest expiration time of those leases. Each storage index
+        is returned once, however many of its shares have expiring leases.
+
+        :param after: None, or a (first_expiration, storage_index) tuple as
+            returned by an earlier call: only storage indexes which come
+            after it in this order are returned.
+
+        :return: a list of (first_expiration, storage_index) tuples
+        """
+        args = (cutoff,) + tuple(sharetypes)
+        having = ""
+        if after is not None:
+            having = " HAVING (MIN(first_expiration), storage_index) > (?,?)"
+            args += tuple(after)
+        c = self._db.cursor()
+        c.execute("SELECT MIN(first_expiration), storage_index FROM shares"
+                  " WHERE first_expiration < ? AND sharetype IN (%s)"
+                  " GROUP BY storage_index" % ",".join("?" * len(sharetypes)) +
+                  having +
+                  " ORDER BY MIN(first_expiration), storage_index LIMIT ?",
+                  args + (limit,))
+        return [(first_expiration, bytes(storage_index))
+                for (first_expiration, storage_index) in c.fetchall()]
+
+    def has_shares(self):
+        return self._num_shares > 0
+
+    def get_bucket_count(self):
+        return self._num_buckets
+
+    def get_share_count(self):
+        return self._num_shares
+
+    def get_total_size(self):
+        return self._total_size
+
+
+class ShareIndexCrawler(ShareCrawler):
+    """I build a storage server's share index by visiting every bucket
+    once. When I have finished, the index is marked complete and I stop for
+    good: from then on the server keeps the index up to date itself.
+    """
+
+    slow_start = 0 # the server does not use the index until I am done
+    minimum_cycle_time = 0
+
+    def __init__(self, server, statefile, share_index):
+        ShareCrawler.__init__(self, server, statefile)
+        self._share_index = share_index
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        self.server.update_share_index(si_a2b(storage_index_b32.encode("ascii")))
+
+    def finished_cycle(self, cycle):
+        self._share_index.set_complete()
+        self.disownServiceParent()
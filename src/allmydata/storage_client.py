@@ -58,7 +58,7 @@ from twisted.plugin import (
 from eliot import (
     log_call,
 )
-from foolscap.api import eventually
+from foolscap.api import eventually, DeadReferenceError
 from foolscap.reconnector import (
     ReconnectionInfo,
 )
@@ -965,6 +965,15 @@ class _StorageServer(object):
             cancel_secret,
         )
 
+    def add_leases(
+            self,
+            leases,
+    ):
+        return self._rref.callRemote(
+            "add_leases",
+            leases,
+        )
+
     def get_buckets(
             self,
             storage_index,
@@ -1024,3 +1033,92 @@ class _StorageServer(object):
             shnum,
             reason,
         ).addErrback(log.err, "Error from remote call to advise_corrupt_share")
+
+
+class AddLeaseError(Exception):
+    """
+    A storage server reported that it could not add a lease which was sent
+    to it as part of an ``add_leases`` batch.
+    """
+
+
+# IServer -> [(storage_index, renew_secret, cancel_secret, Deferred)]
+_lease_batches = {}
+
+
+def batch_add_lease(server, storage_index, renew_secret, cancel_secret):
+    """
+    Add a lease on ``server``, like ``IStorageServer.add_lease``.
+
+    The leases added to the same server during one reactor turn (for
+    example, by the checkers of several files being checked at the same
+    time) are sent together, with as few ``add_leases`` calls as the server
+    allows. Servers which do not implement ``add_leases`` get one
+    ``add_lease`` call per lease, as before.
+
+    :param IServer server: the server to add the lease on.
+
+    :return Deferred: fires with None once the lease has been added, or
+        fails with the error from the server (``AddLeaseError`` if the lease
+        was part of a batch).
+    """
+    d = defer.Deferred()
+    if server not in _lease_batches:
+        _lease_batches[server] = []
+        eventually(_send_lease_batch, server)
+    _lease_batches[server].append((storage_index, renew_secret, cancel_secret, d))
+    return d
+
+
+def _get_add_leases_batch_size(server):
+    """
+    :return int: the largest number of leases ``server`` accepts in one
+        ``add_leases`` call, or 0 if it does not implement ``add_leases``.
+    """
+    version = server.get_version()
+    if version is None:
+        return 0
+    protocol_v1_version = version.get(b'http://allmydata.org/tahoe/protocols/storage/v1', BytesKeyDict())
+    return protocol_v1_version.get(b'maximum-add-leases-batch-size', 0)
+
+
+def _send_lease_batch(server):
+    batch = _lease_batches.pop(server)
+    storage_server = server.get_storage_server()
+    if storage_server is None:
+        for (_, _, _, d) in batch:
+            d.errback(DeadReferenceError("storage server is not connected"))
+        return
+    batch_size = _get_add_leases_batch_size(server)
+    if len(batch) < 2 or not batch_size:
+        for (storage_index, renew_secret, cancel_secret, d) in batch:
+            storage_server.add_lease(
+                storage_index,
+                renew_secret,
+                cancel_secret,
+            ).chainDeferred(d)
+        return
+    for i in range(0, len(batch), batch_size):
+        _send_add_leases(storage_server, batch[i:i+batch_size])
+
+
+def _send_add_leases(storage_server, batch):
+    d = storage_server.add_leases(
+        [(storage_index, renew_secret, cancel_secret)
+         for (storage_index, renew_secret, cancel_secret, _) in batch],
+    )
+    def _got_results(results):
+        if len(results) != len(batch):
+            raise AddLeaseError("expected %d add_leases results, got %d"
+                                % (len(batch), len(results)))
+        for ((_, _, _, lease_d), error) in zip(batch, results):
+            if error is None:
+                lease_d.callback(None)
+            else:
+                lease_d.errback(AddLeaseError(error))
+    def _failed(f):
+        for (_, _, _, lease_d) in batch:
+            if not lease_d.called:
+                lease_d.errback(f)
+    d.addCallback(_got_results)
+    d.addErrback(_failed)
@@ -16,13 +16,14 @@ from datetime import timedelta
 import re
 
 from twisted.trial import unittest
+from twisted.python import usage
 from twisted.python.monkey import MonkeyPatcher
 
 from allmydata.util import fileutil
 from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.util.encodingutil import get_io_encoding, unicode_to_argv
 from allmydata.util.namespace import Namespace
-from allmydata.scripts import cli, backupdb
+from allmydata.scripts import cli, backupdb, common_http
 from ..common_util import StallMixin
 from ..no_network import GridTestMixin
 from .common import (
@@ -317,6 +318,74 @@ class Backup(GridTestMixin, CLITestMixin, StallMixin, unittest.TestCase):
 
         return d
 
+    def test_parallel_backup(self):
+        """
+        With --parallelism, several files are uploaded at once over a few
+        reused connections to the gateway, and the backup and backupdb come
+        out the same as when they are uploaded one at a time.
+        """
+        self.basedir = "cli/Backup/parallel_backup"
+        self.set_up_grid(oneshare=True)
+        source = os.path.join(self.basedir, "home")
+        for i in range(9):
+            self.writeto("dir%d/file%d.txt" % (i % 3, i), "contents %d" % i)
+
+        connections = []
+        original = common_http._make_connection
+        def _make_connection(scheme, host, port):
+            c = original(scheme, host, port)
+            connections.append(c)
+            return c
+        self.patch(common_http, "_make_connection", _make_connection)
+
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda res: connections.clear())
+        d.addCallback(lambda res: self.do_cli("backup", "-j", "3", source,
+                                              "tahoe:backups"))
+        def _check_backup(args):
+            (rc, out, err) = args
+            self.assertEqual(len(err), 0, err)
+            self.failUnlessReallyEqual(rc, 0)
+            fu, fr, fs, dc, dr, ds = self.count_output(out)
+            self.failUnlessReallyEqual((fu, fr, fs), (9, 0, 0))
+            # home, dir0, dir1, dir2
+            self.failUnlessReallyEqual((dc, dr, ds), (4, 0, 0))
+            # one for each worker thread, and one for the main thread
+            self.assertTrue(len(connections) <= 4, connections)
+        d.addCallback(_check_backup)
+        d.addCallback(lambda res: self.do_cli("get",
+                                              "tahoe:backups/Latest/dir2/file8.txt"))
+        d.addCallback(lambda args: self.assertEqual(args[1], "contents 8"))
+
+        d.addCallback(self.stall, 1.1)
+        # the worker threads hashed what they uploaded, so a copy of a file
+        # is recognised by its contents
+        d.addCallback(lambda res: self.writeto("dir0/copy.txt", "contents 8"))
+        d.addCallback(lambda res: self.do_cli("backup", "-j", "1", source,
+                                              "tahoe:backups"))
+        def _check_reused(args):
+            (rc, out, err) = args
+            self.assertEqual(len(err), 0, err)
+            self.failUnlessReallyEqual(rc, 0)
+            fu, fr, fs, dc, dr, ds = self.count_output(out)
+            self.failUnlessReallyEqual((fu, fr, fs), (0, 10, 0))
+            # home and dir0 have changed
+            self.failUnlessReallyEqual((dc, dr, ds), (2, 2, 0))
+        d.addCallback(_check_reused)
+        return d
+
+    def test_parallelism_option(self):
+        basedir = "cli/Backup/parallelism_option"
+        fileutil.make_dirs(basedir)
+        nodeurl_path = os.path.join(basedir, 'node.url')
+        fileutil.write(nodeurl_path, 'http://example.net:2357/')
+        def parse(args): return parse_options(basedir, "backup", args)
+
+        self.assertEqual(parse(["from", "to"])["parallelism"], 4)
+        self.assertEqual(parse(["-j", "8", "from", "to"])["parallelism"], 8)
+        self.assertRaises(usage.UsageError, parse,
+                          ["--parallelism", "0", "from", "to"])
+
     def _check_filtering(self, filtered, all, included, excluded):
         filtered = set(filtered)
         all = set(all)
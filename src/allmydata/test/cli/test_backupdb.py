@@ -33,7 +33,7 @@ class BackupDB(unittest.TestCase):
         fileutil.make_dirs(basedir)
         dbfile = os.path.join(basedir, "dbfile")
         bdb = self.create(dbfile)
-        self.failUnlessEqual(bdb.VERSION, 2)
+        self.failUnlessEqual(bdb.VERSION, 3)
 
     def test_upgrade_v1_v2(self):
         self.basedir = basedir = os.path.join("backupdb", "upgrade_v1_v2")
@@ -46,7 +46,26 @@ class BackupDB(unittest.TestCase):
         self.failUnless(created, "unable to create v1 backupdb")
         # now we should have a v1 database on disk
         bdb = self.create(dbfile)
-        self.failUnlessEqual(bdb.VERSION, 2)
+        self.failUnlessEqual(bdb.VERSION, 3)
+
+    def test_upgrade_v2_v3(self):
+        self.basedir = basedir = os.path.join("backupdb", "upgrade_v2_v3")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        stderr = StringIO()
+        created = backupdb.get_backupdb(dbfile, stderr=stderr,
+                                        create_version=(backupdb.SCHEMA_v2, 2))
+        self.failUnless(created, "unable to create v2 backupdb")
+        foo_fn = self.writeto("foo.txt", "foo.txt")
+        created.did_upload_file(b"foo-cap", foo_fn, 1, 2, 7)
+        created.commit()
+
+        bdb = self.create(dbfile)
+        self.failUnlessEqual(bdb.VERSION, 3)
+        # what the old version learned is kept, but it knows no content
+        # hashes, so a copy of that file is new
+        r = bdb.check_file(foo_fn, use_timestamps=False)
+        self.failUnlessEqual(r.was_uploaded(), False)
 
     def test_fail(self):
         self.basedir = basedir = os.path.join("backupdb", "fail")
@@ -87,6 +106,14 @@ class BackupDB(unittest.TestCase):
         fileutil.write(fn, data)
         return fn
 
+    def upload(self, r, fn, filecap):
+        # read the file the way that tahoe backup sends it
+        with open(fn, "rb") as f:
+            reader = r.hash_upload(f)
+            while reader.read(4):
+                pass
+        r.did_upload(filecap)
+
     def test_check(self):
         self.basedir = basedir = os.path.join("backupdb", "check")
         fileutil.make_dirs(basedir)
@@ -114,7 +141,7 @@ class BackupDB(unittest.TestCase):
 
         r = bdb.check_file(foo_fn)
         self.failUnlessEqual(r.was_uploaded(), False)
-        r.did_upload(b"new-cap")
+        self.upload(r, foo_fn, b"new-cap")
 
         r = bdb.check_file(foo_fn)
         self.failUnlessEqual(r.was_uploaded(), b"new-cap")
@@ -123,8 +150,10 @@ class BackupDB(unittest.TestCase):
         # break
         r.did_upload(b"new-cap")
 
+        # without timestamps the file is hashed, and found to have the
+        # contents we uploaded before
         r = bdb.check_file(foo_fn, use_timestamps=False)
-        self.failUnlessEqual(r.was_uploaded(), False)
+        self.failUnlessEqual(r.was_uploaded(), b"new-cap")
         r.did_upload(b"new-cap")
 
         r = bdb.check_file(foo_fn)
@@ -151,6 +180,126 @@ class BackupDB(unittest.TestCase):
         r = bdb.check_file(foo_fn)
         self.failUnlessEqual(r.was_uploaded(), False)
 
+    def test_same_contents(self):
+        self.basedir = basedir = os.path.join("backupdb", "same_contents")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create(dbfile)
+
+        foo_fn = self.writeto("foo.txt", "foo.txt")
+        r = bdb.check_file(foo_fn)
+        self.failUnlessEqual(r.was_uploaded(), False)
+        self.upload(r, foo_fn, b"foo-cap")
+
+        # a copy of the file, or the file after it was moved, needs no upload
+        copy_fn = self.writeto("sub/copy.txt", "foo.txt")
+        r = bdb.check_file(copy_fn)
+        self.failUnlessEqual(r.was_uploaded(), b"foo-cap")
+        self.failUnlessEqual(type(r.was_uploaded()), bytes)
+        self.failUnlessEqual(r.should_check(), False)
+        # and the copy is now known by its path and timestamps
+        r = bdb.check_file(copy_fn)
+        self.failUnlessEqual(r.was_uploaded(), b"foo-cap")
+
+        # the same size and different contents is still new
+        other_fn = self.writeto("other.txt", "bar.txt")
+        r = bdb.check_file(other_fn)
+        self.failUnlessEqual(r.was_uploaded(), False)
+        self.upload(r, other_fn, b"other-cap")
+        r = bdb.check_file(self.writeto("other2.txt", "bar.txt"))
+        self.failUnlessEqual(r.was_uploaded(), b"other-cap")
+
+    def test_same_contents_large(self):
+        self.basedir = basedir = os.path.join("backupdb", "same_contents_large")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create(dbfile)
+        bdb.PREFIX_SIZE = 10
+
+        big = "0123456789" * 10
+        big_fn = self.writeto("big.txt", big)
+        r = bdb.check_file(big_fn)
+        self.failUnlessEqual(r.was_uploaded(), False)
+        # nothing else has this size and prefix, so it was not hashed
+        self.failUnlessEqual(r.contenthash, None)
+        self.upload(r, big_fn, b"big-cap")
+
+        # the same size and prefix, but a different end
+        changed_fn = self.writeto("changed.txt", big[:-1] + "X")
+        r = bdb.check_file(changed_fn)
+        self.failUnlessEqual(r.was_uploaded(), False)
+        self.failIfEqual(r.contenthash, None)
+        self.upload(r, changed_fn, b"changed-cap")
+
+        r = bdb.check_file(self.writeto("copy.txt", big))
+        self.failUnlessEqual(r.was_uploaded(), b"big-cap")
+        r = bdb.check_file(self.writeto("copy2.txt", big[:-1] + "X"))
+        self.failUnlessEqual(r.was_uploaded(), b"changed-cap")
+
+    def test_changed_during_upload(self):
+        self.basedir = basedir = os.path.join("backupdb", "changed_during_upload")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create(dbfile)
+
+        # the contents are known by the bytes that were sent, not by what
+        # is on disk when the upload has finished
+        foo_fn = self.writeto("foo.txt", "foo.txt")
+        r = bdb.check_file(foo_fn)
+        self.upload(r, foo_fn, b"foo-cap")
+        self.writeto("foo.txt", "FOO.TXT")
+        r = bdb.check_file(self.writeto("copy.txt", "foo.txt"))
+        self.failUnlessEqual(r.was_uploaded(), b"foo-cap")
+        r = bdb.check_file(self.writeto("other.txt", "FOO.TXT"))
+        self.failUnlessEqual(r.was_uploaded(), False)
+
+        # a file which grew after it was checked is not known by its
+        # contents at all
+        bar_fn = self.writeto("bar.txt", "bar.txt")
+        r = bdb.check_file(bar_fn)
+        self.writeto("bar.txt", "bar.txt and more")
+        self.upload(r, bar_fn, b"bar-cap")
+        r = bdb.check_file(self.writeto("bar2.txt", "bar.txt and more"))
+        self.failUnlessEqual(r.was_uploaded(), False)
+
+        # nor is one which was not read from the start in order
+        baz_fn = self.writeto("baz.txt", "baz.txt")
+        r = bdb.check_file(baz_fn)
+        with open(baz_fn, "rb") as f:
+            reader = r.hash_upload(f)
+            reader.seek(3)
+            reader.read()
+        r.did_upload(b"baz-cap")
+        r = bdb.check_file(self.writeto("baz2.txt", "baz.txt"))
+        self.failUnlessEqual(r.was_uploaded(), False)
+
+    def test_batched_commits(self):
+        self.basedir = basedir = os.path.join("backupdb", "batched_commits")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create(dbfile)
+        bdb.COMMIT_INTERVAL = 3
+
+        def uploaded_paths():
+            # what another connection to the database can see
+            other = self.create(dbfile)
+            other.cursor.execute("SELECT path FROM local_files")
+            paths = set(path for (path,) in other.cursor.fetchall())
+            other.connection.close()
+            return paths
+
+        fns = [os.path.abspath(self.writeto("file%d.txt" % i, "contents %d" % i))
+               for i in range(4)]
+        for (i, fn) in enumerate(fns[:2]):
+            bdb.check_file(fn).did_upload(b"cap-%d" % i)
+        self.failUnlessEqual(uploaded_paths(), set())
+        bdb.check_file(fns[2]).did_upload(b"cap-2")
+        self.failUnlessEqual(uploaded_paths(), set(fns[:3]))
+        bdb.check_file(fns[3]).did_upload(b"cap-3")
+        self.failUnlessEqual(uploaded_paths(), set(fns[:3]))
+        bdb.commit()
+        self.failUnlessEqual(uploaded_paths(), set(fns))
+
     def test_wrong_version(self):
         self.basedir = basedir = os.path.join("backupdb", "wrong_version")
         fileutil.make_dirs(basedir)
@@ -10,16 +10,26 @@ from future.utils import PY2
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
+import threading
+
 from six.moves import cStringIO as StringIO
 from twisted.internet import defer, reactor
+from twisted.internet.task import Clock
 from twisted.trial import unittest
 from allmydata import uri, client
+from allmydata.crypto import rsa
+from allmydata.crypto.error import BadSignature
+from allmydata.util import cputhreadpool
 from allmydata.util.consumer import MemoryConsumer
 from allmydata.interfaces import SDMF_VERSION, MDMF_VERSION, DownloadStopped
 from allmydata.mutable.filenode import MutableFileNode, BackoffAgent
 from allmydata.mutable.common import MODE_ANYTHING, MODE_WRITE, MODE_READ, UncoordinatedWriteError
 
+from allmydata.mutable import publish
 from allmydata.mutable.publish import MutableData
+from allmydata.mutable.servermap import ServerMap
+from allmydata.mutable.servermapcache import ServermapCache
+from allmydata.mutable.keycache import KeyCache
 from ..test_download import PausingConsumer, PausingAndStoppingConsumer, \
      StoppingConsumer, ImmediatelyStoppingConsumer
 from .. import common_util as testutil
@@ -684,3 +694,272 @@ class Filenode(unittest.TestCase, testutil.ShouldFailMixin):
         d.addCallback(lambda ignored:
             self.failUnlessEqual(self.n.get_size(), 9))
         return d
+
+
+class ServermapCaching(unittest.TestCase):
+    """
+    Tests for the use of a ``ServermapCache`` by mutable file nodes.
+    """
+    def setUp(self):
+        self._storage = FakeStorage()
+        self._peers = list(make_peer(self._storage, n) for n in range(10))
+        self.clock = Clock()
+        self.cache = ServermapCache(60, 10, clock=self.clock)
+        self.nodemaker = make_nodemaker_with_peers(self._peers)
+        self.nodemaker.servermap_cache = self.cache
+        self.updates = []
+        original = MutableFileNode._update_servermap
+        def _update_servermap(node, servermap, mode):
+            self.updates.append(mode)
+            return original(node, servermap, mode)
+        self.patch(MutableFileNode, "_update_servermap", _update_servermap)
+
+    @defer.inlineCallbacks
+    def _create(self, contents):
+        n = yield self.nodemaker.create_mutable_file(MutableData(contents))
+        # start from a node which knows nothing about the file
+        cap = n.get_uri()
+        del n
+        self.updates[:] = []
+        defer.returnValue(cap)
+
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        """
+        A second read of a mutable file uses the servermap found by the first
+        one, even through a different node.
+        """
+        cap = yield self._create(b"contents 1")
+        n = self.nodemaker.create_from_cap(cap)
+        data = yield n.download_best_version()
+        self.assertEqual(data, b"contents 1")
+        self.assertEqual(self.updates, [MODE_READ])
+        n2 = MutableFileNode(self.nodemaker.storage_broker,
+                             self.nodemaker.secret_holder,
+                             self.nodemaker.default_encoding_parameters,
+                             self.nodemaker.history,
+                             self.cache).init_from_cap(uri.from_string(cap))
+        data = yield n2.download_best_version()
+        self.assertEqual(data, b"contents 1")
+        self.assertEqual(self.updates, [MODE_READ])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    @defer.inlineCallbacks
+    def test_expire(self):
+        """
+        A cached servermap is not used once it is older than the TTL.
+        """
+        cap = yield self._create(b"contents 1")
+        n = self.nodemaker.create_from_cap(cap)
+        yield n.download_best_version()
+        self.clock.advance(60)
+        data = yield n.download_best_version()
+        self.assertEqual(data, b"contents 1")
+        self.assertEqual(self.updates, [MODE_READ, MODE_READ])
+
+    @defer.inlineCallbacks
+    def test_overwrite(self):
+        """
+        Changing a mutable file removes its servermap from the cache.
+        """
+        cap = yield self._create(b"contents 1")
+        n = self.nodemaker.create_from_cap(cap)
+        yield n.download_best_version()
+        yield n.overwrite(MutableData(b"contents 2"))
+        self.assertEqual(self.cache.get_stats()["mutable.servermap_cache.entries"], 0)
+        data = yield n.download_best_version()
+        self.assertEqual(data, b"contents 2")
+
+    @defer.inlineCallbacks
+    def test_changed_elsewhere(self):
+        """
+        If another client changes the file, a reader holding a stale cached
+        servermap falls back to a full servermap update and gets the new
+        contents.
+        """
+        cap = yield self._create(b"contents 1")
+        n = self.nodemaker.create_from_cap(cap)
+        yield n.download_best_version()
+        other = make_nodemaker_with_peers(self._peers).create_from_cap(cap)
+        yield other.overwrite(MutableData(b"contents 2"))
+        self.updates[:] = []
+        data = yield n.download_best_version()
+        self.assertEqual(data, b"contents 2")
+        # the retry of a writeable node looks for the best version in
+        # MODE_WRITE
+        self.assertEqual(self.updates, [MODE_WRITE])
+
+    def test_evict(self):
+        """
+        The cache keeps at most max_entries servermaps, evicting the least
+        recently used ones.
+        """
+        cache = ServermapCache(60, 2, clock=self.clock)
+        smap = ServerMap()
+        cache.add(b"si1", smap, "pubkey1")
+        cache.add(b"si2", smap, "pubkey2")
+        self.assertEqual(cache.get(b"si1")[1], "pubkey1")
+        cache.add(b"si3", smap, "pubkey3")
+        self.assertIs(cache.get(b"si2"), None)
+        self.assertIsNot(cache.get(b"si1")[0], smap)
+        self.assertEqual(cache.evictions, 1)
+        cache.remove(b"si1")
+        self.assertIs(cache.get(b"si1"), None)
+
+
+class PublishPipeline(unittest.TestCase):
+    """
+    Tests for the encoding pipeline of ``Publish``.
+    """
+    def setUp(self):
+        self._storage = FakeStorage()
+        self._peers = list(make_peer(self._storage, n) for n in range(10))
+        self.nodemaker = make_nodemaker_with_peers(self._peers)
+        cputhreadpool.set_max_threads(2)
+        self.addCleanup(cputhreadpool.set_max_threads, 0)
+        self.threads = set()
+        original_encrypt = publish._encrypt_segment
+        def _encrypt_segment(*args):
+            self.threads.add(threading.current_thread())
+            return original_encrypt(*args)
+        self.patch(publish, "_encrypt_segment", _encrypt_segment)
+        self.in_flight = []
+        original_fill = publish.Publish._fill_encode_pipeline
+        def _fill_encode_pipeline(p):
+            original_fill(p)
+            self.in_flight.append(len(p._encoded_segments))
+        self.patch(publish.Publish, "_fill_encode_pipeline",
+                   _fill_encode_pipeline)
+
+    @defer.inlineCallbacks
+    def test_mdmf(self):
+        """
+        The segments of an MDMF file are encrypted in the CPU thread pool,
+        with several but at most ``ENCODE_PIPELINE_DEPTH`` of them in flight
+        at once, and the file reads back correctly.
+        """
+        contents = b"pipelined" * 200000 # 14 segments
+        n = yield self.nodemaker.create_mutable_file(MutableData(contents),
+                                                     version=MDMF_VERSION)
+        self.assertNotIn(threading.current_thread(), self.threads)
+        self.assertEqual(max(self.in_flight),
+                         publish.Publish.ENCODE_PIPELINE_DEPTH)
+        data = yield n.download_best_version()
+        self.assertEqual(data, contents)
+
+        # updates in the middle of the file go through the same pipeline
+        self.in_flight[:] = []
+        version = yield n.get_best_mutable_version()
+        yield version.update(MutableData(b"X" * 600000), 300000)
+        self.assertEqual(max(self.in_flight),
+                         publish.Publish.ENCODE_PIPELINE_DEPTH)
+        data = yield n.download_best_version()
+        self.assertEqual(data,
+                         contents[:300000] + b"X" * 600000 + contents[900000:])
+
+
+class KeyCaching(unittest.TestCase):
+    """
+    Tests for ``KeyCache`` and its use by mutable file nodes.
+    """
+    def setUp(self):
+        self._storage = FakeStorage()
+        self._peers = list(make_peer(self._storage, n) for n in range(10))
+        self.cache = KeyCache(10)
+        self.nodemaker = make_nodemaker_with_peers(self._peers)
+        self.nodemaker.key_cache = self.cache
+        self.verified = []
+        original = rsa.verify_signature
+        def verify_signature(public_key, alleged_signature, data):
+            self.verified.append(data)
+            return original(public_key, alleged_signature, data)
+        self.patch(rsa, "verify_signature", verify_signature)
+
+    def _make_node(self, cap):
+        # a node which shares nothing with any other except the cache
+        return MutableFileNode(self.nodemaker.storage_broker,
+                               self.nodemaker.secret_holder,
+                               self.nodemaker.default_encoding_parameters,
+                               self.nodemaker.history, None,
+                               self.cache).init_from_cap(uri.from_string(cap))
+
+    @defer.inlineCallbacks
+    def test_signatures(self):
+        """
+        A signed prefix is verified once, for all of its shares, and not
+        again when the file is read through another node.
+        """
+        n = yield self.nodemaker.create_mutable_file(MutableData(b"contents"))
+        cap = n.get_uri()
+        data = yield self._make_node(cap).download_best_version()
+        self.assertEqual(data, b"contents")
+        self.assertEqual(len(self.verified), 1)
+        data = yield self._make_node(cap).download_best_version()
+        self.assertEqual(data, b"contents")
+        self.assertEqual(len(self.verified), 1)
+        self.assertEqual((self.cache.signature_hits,
+                          self.cache.signature_misses), (1, 1))
+
+        # a new version has a new signature to check
+        yield n.overwrite(MutableData(b"contents 2"))
+        data = yield self._make_node(cap).download_best_version()
+        self.assertEqual(data, b"contents 2")
+        self.assertEqual(len(self.verified), 2)
+
+    @defer.inlineCallbacks
+    def test_keys(self):
+        """
+        A new node for a file whose keys are cached starts with them, and
+        can change the file without fetching the private key again.
+        """
+        n = yield self.nodemaker.create_mutable_file(MutableData(b"contents"))
+        n2 = self._make_node(n.get_uri())
+        self.assertEqual(n2.get_pubkey(), n.get_pubkey())
+        self.assertEqual(n2.get_privkey(), n.get_privkey())
+        self.assertEqual(n2.get_encprivkey(), n.get_encprivkey())
+        ro = self._make_node(n.get_readonly_uri())
+        self.assertEqual(ro.get_pubkey(), n.get_pubkey())
+        self.assertIs(ro.get_privkey(), None)
+
+        yield n2.overwrite(MutableData(b"contents 2"))
+        data = yield self._make_node(n.get_uri()).download_best_version()
+        self.assertEqual(data, b"contents 2")
+
+    def test_bad_signature(self):
+        """
+        A signature which fails to verify is not remembered.
+        """
+        (privkey, pubkey) = rsa.create_signing_keypair(2048)
+        signature = rsa.sign_data(privkey, b"prefix")
+        for i in range(2):
+            self.assertRaises(BadSignature, self.cache.verify_signature,
+                              b"fingerprint", pubkey, signature, b"other")
+        self.assertEqual(len(self.verified), 2)
+        self.cache.verify_signature(b"fingerprint", pubkey, signature,
+                                    b"prefix")
+        self.cache.verify_signature(b"fingerprint", pubkey, signature,
+                                    b"prefix")
+        self.assertEqual(len(self.verified), 3)
+
+    def test_privkey_needs_writekey(self):
+        """
+        A cached private key is only returned for the writekey that it was
+        checked against.
+        """
+        self.cache.add_privkey(b"si", b"writekey", b"privkey", b"encprivkey")
+        self.assertIs(self.cache.get_privkey(b"si", b"other writekey"), None)
+        self.assertEqual(self.cache.get_privkey(b"si", b"writekey"),
+                         (b"privkey", b"encprivkey"))
+
+    def test_evict(self):
+        """
+        I keep at most max_entries of each kind, dropping the least recently
+        used first.
+        """
+        for i in range(11):
+            self.cache.add_pubkey(b"fingerprint %d" % i, i)
+        self.assertIs(self.cache.get_pubkey(b"fingerprint 0"), None)
+        self.assertEqual(self.cache.get_pubkey(b"fingerprint 1"), 1)
+        self.cache.add_pubkey(b"fingerprint 11", 11)
+        self.assertEqual(self.cache.get_pubkey(b"fingerprint 1"), 1)
+        self.assertIs(self.cache.get_pubkey(b"fingerprint 2"), None)
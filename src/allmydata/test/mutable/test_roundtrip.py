@@ -14,7 +14,8 @@ from six.moves import cStringIO as StringIO
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from allmydata.util import base32, consumer
+from allmydata.util import base32, consumer, mathutil
+from foolscap.api import fireEventually
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.monitor import Monitor
 from allmydata.mutable.common import MODE_READ, UnrecoverableFileError
@@ -419,3 +420,101 @@ class Roundtrip(unittest.TestCase, testutil.ShouldFailMixin, PublishMixin):
     def test_corrupt_some_mdmf(self):
         return self._test_corrupt_some(("share_data", 12 * 40),
                                        mdmf=True)
+
+
+class SegmentWindow(unittest.TestCase, PublishMixin):
+    def setUp(self):
+        # about 2MB, or sixteen 128KiB segments
+        return self.publish_mdmf(b"segment window test data" * 87382)
+
+    def make_retrieve(self, servermap):
+        r = Retrieve(self._fn, self._storage_broker, servermap,
+                     servermap.best_recoverable_version())
+        self.fetches = []
+        original = r._fetch_segment
+        def _fetch_segment(segnum):
+            self.fetches.append((segnum, r._current_segment,
+                                 r._pause_deferred is not None))
+            return original(segnum)
+        r._fetch_segment = _fetch_segment
+        return r
+
+    def download(self, r, c=None):
+        if c is None:
+            c = consumer.MemoryConsumer()
+        d = r.download(consumer=c)
+        d.addCallback(lambda mc: b"".join(mc.chunks))
+        return d
+
+    def test_window(self):
+        d = ServermapUpdater(self._fn, self._storage_broker, Monitor(),
+                             ServerMap(), MODE_READ).update()
+        d.addCallback(lambda servermap:
+                      self.download(self.make_retrieve(servermap)))
+        def _check(contents):
+            self.failUnlessEqual(contents, self.CONTENTS)
+            window = Retrieve.SEGMENT_WINDOW
+            # every segment was asked for exactly once, and the first
+            # window's worth of them before the first one was delivered.
+            self.failUnlessEqual(sorted(segnum for (segnum, _, _)
+                                        in self.fetches),
+                                 list(range(16)))
+            self.failUnlessEqual(self.fetches[:window],
+                                 [(segnum, 0, False)
+                                  for segnum in range(window)])
+            for (segnum, current, paused) in self.fetches:
+                self.failUnless(current <= segnum < current + window,
+                                (segnum, current))
+        d.addCallback(_check)
+        return d
+
+    def test_paused(self):
+        # a consumer that pauses us after every write, and resumes us a
+        # little later: nothing past the current segment may be requested
+        # while we are paused.
+        class PausingConsumer(consumer.MemoryConsumer):
+            def write(self, data):
+                consumer.MemoryConsumer.write(self, data)
+                self.producer.pauseProducing()
+                fireEventually().addCallback(
+                    lambda ign: self.producer.resumeProducing())
+        d = ServermapUpdater(self._fn, self._storage_broker, Monitor(),
+                             ServerMap(), MODE_READ).update()
+        d.addCallback(lambda servermap:
+                      self.download(self.make_retrieve(servermap),
+                                    PausingConsumer()))
+        def _check(contents):
+            self.failUnlessEqual(contents, self.CONTENTS)
+            self.failUnlessEqual(sorted(segnum for (segnum, _, _)
+                                        in self.fetches),
+                                 list(range(16)))
+            for (segnum, current, paused) in self.fetches:
+                if paused:
+                    self.failUnlessEqual(segnum, current)
+        d.addCallback(_check)
+        return d
+
+    def test_bad_shares_in_window(self):
+        # corrupt two blocks in the middle of the file on two of the shares
+        # that the download starts out using. Segments fetched ahead from
+        # those shares fail too, and must be fetched again from others.
+        blocksize = mathutil.div_ceil(mathutil.next_multiple(128 * 1024, 3),
+                                      3)
+        d = corrupt(None, self._storage, ("share_data", blocksize * 5 + 10),
+                    [0, 1])
+        d.addCallback(corrupt, self._storage,
+                      ("share_data", blocksize * 7 + 10), [0, 1])
+        d.addCallback(lambda ignored:
+                      ServermapUpdater(self._fn, self._storage_broker,
+                                       Monitor(), ServerMap(),
+                                       MODE_READ).update())
+        def _retrieve(servermap):
+            self.r = self.make_retrieve(servermap)
+            return self.download(self.r)
+        d.addCallback(_retrieve)
+        def _check(contents):
+            self.failUnlessEqual(contents, self.CONTENTS)
+            bad = sorted(shnum for (server, shnum, f) in self.r._bad_shares)
+            self.failUnlessEqual(bad, [0, 1])
+        d.addCallback(_check)
+        return d
@@ -15,7 +15,9 @@ from twisted.trial import unittest
 from twisted.internet import defer
 from allmydata.interfaces import MDMF_VERSION
 from allmydata.mutable.filenode import MutableFileNode
-from allmydata.mutable.publish import MutableData, DEFAULT_MAX_SEGMENT_SIZE
+from allmydata.mutable.publish import MutableData, DEFAULT_MAX_SEGMENT_SIZE, \
+     Publish
+from allmydata.mutable.layout import MDMFSlotReadProxy
 from ..no_network import GridTestMixin
 from .. import common_util as testutil
 
@@ -246,3 +248,134 @@ class Update(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
             return d
         d0.addCallback(_run)
         return d0
+
+
+    def _spy(self, cls, name):
+        calls = []
+        original = getattr(cls, name)
+        def _spied(*args, **kwargs):
+            calls.append((args, kwargs))
+            return original(*args, **kwargs)
+        self.patch(cls, name, _spied)
+        return calls
+
+    def test_update_in_place(self):
+        # A small write inside the file should be published in place,
+        # reading only the block hash tree nodes on the paths from the
+        # segment it touches to the root.
+        offset = SEGSIZE + 10
+        new_data = (self.data[:offset] + b"replaced" +
+                    self.data[offset + len(b"replaced"):])
+        in_place = self._spy(Publish, "update_in_place")
+        fetched = self._spy(MDMFSlotReadProxy, "get_blockhash_nodes")
+        d0 = self.do_upload_mdmf()
+        def _run(ign):
+            d = self.mdmf_node.get_best_mutable_version()
+            def _update(mv):
+                self.old_seqnum = mv.get_sequence_number()
+                return mv.update(MutableData(b"replaced"), offset)
+            d.addCallback(_update)
+            d.addCallback(lambda ign: self.mdmf_node.download_best_version())
+            d.addCallback(lambda results:
+                          self.failUnlessEqual(results, new_data))
+            def _check_in_place(ign):
+                self.failUnlessEqual(len(in_place), 1)
+                (args, kwargs) = in_place[0]
+                self.failUnlessEqual(sorted(args[2]), [1])
+                self.failUnlessEqual(len(fetched), 10)
+                for (args, kwargs) in fetched:
+                    # the root, segment 1's leaf (node 4 of the 7-node
+                    # tree for 4 segments), its sibling, and its uncle
+                    self.failUnlessEqual(sorted(args[1]), [0, 2, 3, 4])
+            d.addCallback(_check_in_place)
+            d.addCallback(lambda ign: self.mdmf_node.get_best_mutable_version())
+            d.addCallback(lambda mv:
+                          self.failUnlessEqual(mv.get_sequence_number(),
+                                               self.old_seqnum + 1))
+            return d
+        d0.addCallback(_run)
+        return d0
+
+    def test_update_batch(self):
+        # Updates made together on one version should be published
+        # together, and applied in order.
+        writes = [(b"first", 10),
+                  (b"A" * SEGSIZE, 2 * SEGSIZE),
+                  (b"second", 2 * SEGSIZE - 3),
+                  (b"third", 12)]
+        expected = self.data
+        for (data, offset) in writes:
+            expected = (expected[:offset] + data +
+                        expected[offset + len(data):])
+        in_place = self._spy(Publish, "update_in_place")
+        d0 = self.do_upload_mdmf()
+        def _run(ign):
+            d = self.mdmf_node.get_best_mutable_version()
+            def _update(mv):
+                self.old_seqnum = mv.get_sequence_number()
+                return defer.gatherResults([mv.update(MutableData(data),
+                                                      offset)
+                                            for (data, offset) in writes])
+            d.addCallback(_update)
+            d.addCallback(lambda ign: self.mdmf_node.download_best_version())
+            d.addCallback(self._check_differences, expected)
+            d.addCallback(lambda ign:
+                          self.failUnlessEqual(len(in_place), 1))
+            d.addCallback(lambda ign: self.mdmf_node.get_best_mutable_version())
+            d.addCallback(lambda mv:
+                          self.failUnlessEqual(mv.get_sequence_number(),
+                                               self.old_seqnum + 1))
+            return d
+        d0.addCallback(_run)
+        return d0
+
+    def test_update_batch_failure(self):
+        # If a batch of updates fails, each of them should fail, and later
+        # updates should still be made.
+        class BrokenUpdate(Exception):
+            pass
+        d0 = self.do_upload_mdmf()
+        def _run(ign):
+            d = self.mdmf_node.get_best_mutable_version()
+            def _update(mv):
+                mv._update_many = lambda writes: defer.fail(BrokenUpdate())
+                results = [mv.update(MutableData(b"first"), 10),
+                           mv.update(MutableData(b"second"), 20)]
+                for r in results:
+                    self.assertFailure(r, BrokenUpdate)
+                d1 = defer.gatherResults(results)
+                def _then(ign):
+                    del mv._update_many
+                    return mv.update(MutableData(b"third"), 30)
+                d1.addCallback(_then)
+                return d1
+            d.addCallback(_update)
+            d.addCallback(lambda ign: self.mdmf_node.download_best_version())
+            d.addCallback(lambda results:
+                          self.failUnlessEqual(results,
+                                               self.data[:30] + b"third" +
+                                               self.data[35:]))
+            return d
+        d0.addCallback(_run)
+        return d0
+
+    def test_update_batch_with_append(self):
+        # If any update in a batch extends the file, they are all made by
+        # uploading the file again.
+        writes = [(b"first", 10), (b"appended", len(self.data))]
+        expected = self.data[:10] + b"first" + self.data[15:] + b"appended"
+        in_place = self._spy(Publish, "update_in_place")
+        d0 = self.do_upload_mdmf()
+        def _run(ign):
+            d = self.mdmf_node.get_best_mutable_version()
+            d.addCallback(lambda mv:
+                          defer.gatherResults([mv.update(MutableData(data),
+                                                         offset)
+                                               for (data, offset) in writes]))
+            d.addCallback(lambda ign: self.mdmf_node.download_best_version())
+            d.addCallback(lambda results:
+                          self.failUnlessEqual(results, expected))
+            d.addCallback(lambda ign: self.failUnlessEqual(in_place, []))
+            return d
+        d0.addCallback(_run)
+        return d0
@@ -305,6 +305,7 @@ class SimpleStats(object):
     def __init__(self):
         self.counters = {}
         self.stats_producers = []
+        self.histograms = {}
 
     def count(self, name, delta=1):
         val = self.counters.setdefault(name, 0)
@@ -313,11 +314,17 @@ class SimpleStats(object):
     def register_producer(self, stats_producer):
         self.stats_producers.append(stats_producer)
 
+    def register_histogram(self, name, histogram):
+        self.histograms[name] = histogram
+
     def get_stats(self):
         stats = {}
         for sp in self.stats_producers:
             stats.update(sp.get_stats())
-        ret = { 'counters': self.counters, 'stats': stats }
+        histograms = dict((name, h.get_stats())
+                          for (name, h) in self.histograms.items())
+        ret = { 'counters': self.counters, 'stats': stats,
+                'histograms': histograms }
         return ret
 
 class NoNetworkGrid(service.MultiService):
@@ -324,6 +324,23 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         )
         self.assertFalse(client.anonymous_storage_enabled(config))
 
+    @defer.inlineCallbacks
+    def test_share_index(self):
+        """
+        share_index option enables the storage server's share index
+        """
+        basedir = "client.Basic.test_share_index"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "share_index = true\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnless(ss._use_share_index())
+        self.failUnless(os.path.exists(os.path.join(ss.storedir, "share_index.sqlite")))
+
     @defer.inlineCallbacks
     def test_reserved_1(self):
         """
@@ -401,6 +418,144 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         with self.assertRaises(ValueError):
             yield client.create_client(basedir)
 
+    @defer.inlineCallbacks
+    def test_segment_cache_default(self):
+        """
+        There is no segment cache unless one is configured.
+        """
+        basedir = "client.Basic.test_segment_cache_default"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertIs(c.segment_cache, None)
+        self.assertIs(c.nodemaker.segment_cache, None)
+
+    @defer.inlineCallbacks
+    def test_segment_cache_size(self):
+        """
+        download.segment_cache_size creates a segment cache of that size,
+        which is used by the nodemaker and reports its statistics.
+        """
+        basedir = "client.Basic.test_segment_cache_size"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "download.segment_cache_size = 2MiB\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.segment_cache.max_size, 2*1024*1024)
+        self.assertIs(c.nodemaker.segment_cache, c.segment_cache)
+        stats = c.stats_provider.get_stats()["stats"]
+        self.assertEqual(stats["downloader.segment_cache.hits"], 0)
+
+    @defer.inlineCallbacks
+    def test_segment_cache_size_bad(self):
+        """
+        download.segment_cache_size produces errors on non-numbers
+        """
+        basedir = "client.Basic.test_segment_cache_size_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "download.segment_cache_size = bogus\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+    @defer.inlineCallbacks
+    def test_servermap_cache_default(self):
+        """
+        There is no servermap cache unless a TTL is configured.
+        """
+        basedir = "client.Basic.test_servermap_cache_default"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertIs(c.servermap_cache, None)
+        self.assertIs(c.nodemaker.servermap_cache, None)
+
+    @defer.inlineCallbacks
+    def test_servermap_cache_ttl(self):
+        """
+        mutable.servermap_cache_ttl creates a servermap cache, which is used
+        by the nodemaker and reports its statistics.
+        """
+        basedir = "client.Basic.test_servermap_cache_ttl"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "mutable.servermap_cache_ttl = 30\n" + \
+                           "mutable.servermap_cache_entries = 50\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.servermap_cache.ttl, 30)
+        self.assertEqual(c.servermap_cache.max_entries, 50)
+        self.assertIs(c.nodemaker.servermap_cache, c.servermap_cache)
+        stats = c.stats_provider.get_stats()["stats"]
+        self.assertEqual(stats["mutable.servermap_cache.hits"], 0)
+
+    @defer.inlineCallbacks
+    def test_dirnode_index_cache(self):
+        """
+        There is a directory index cache of 32MiB unless configured otherwise,
+        and dirnode.index_cache_size = 0 disables it.
+        """
+        basedir = "client.Basic.test_dirnode_index_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.dirnode_index_cache.max_size, 32*1024*1024)
+        self.assertIs(c.nodemaker.dirnode_index_cache, c.dirnode_index_cache)
+
+        basedir = "client.Basic.test_dirnode_index_cache_disabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "dirnode.index_cache_size = 0\n")
+        c = yield client.create_client(basedir)
+        self.assertIs(c.nodemaker.dirnode_index_cache, None)
+
+    @defer.inlineCallbacks
+    def test_key_cache(self):
+        """
+        There is a key cache of 1000 entries unless configured otherwise,
+        and mutable.key_cache_entries = 0 disables it.
+        """
+        basedir = "client.Basic.test_key_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.key_cache.max_entries, 1000)
+        self.assertIs(c.nodemaker.key_cache, c.key_cache)
+        stats = c.stats_provider.get_stats()["stats"]
+        self.assertEqual(stats["mutable.key_cache.signature_hits"], 0)
+
+        basedir = "client.Basic.test_key_cache_disabled"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "mutable.key_cache_entries = 0\n")
+        c = yield client.create_client(basedir)
+        self.assertIs(c.nodemaker.key_cache, None)
+
+    @defer.inlineCallbacks
+    def test_deep_traversal(self):
+        """
+        The deep_traversal.* options are passed to the nodemaker.
+        """
+        basedir = "client.Basic.test_deep_traversal"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "deep_traversal.parallelism = 4\n" + \
+                           "deep_traversal.frontier_size = 500\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.nodemaker.deep_traversal_parallelism, 4)
+        self.assertEqual(c.nodemaker.deep_traversal_frontier_size, 500)
+
     @defer.inlineCallbacks
     def test_web_apiauthtoken(self):
         """
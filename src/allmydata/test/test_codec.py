@@ -17,7 +17,7 @@ from twisted.trial import unittest
 from twisted.python import log
 from allmydata.codec import CRSEncoder, CRSDecoder, parse_params
 import random
-from allmydata.util import mathutil
+from allmydata.util import mathutil, cputhreadpool
 
 class T(unittest.TestCase):
     def do_test(self, size, required_shares, max_shares, fewer_shares=None):
@@ -110,3 +110,12 @@ class T(unittest.TestCase):
 
     def test_encode2(self):
         return self.do_test(125, 25, 100, 90)
+
+
+class Threaded(T):
+    """
+    The codec tests again, with the CPU thread pool enabled.
+    """
+    def setUp(self):
+        cputhreadpool.set_max_threads(2)
+        self.addCleanup(cputhreadpool.set_max_threads, 0)
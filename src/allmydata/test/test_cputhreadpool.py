@@ -0,0 +1,101 @@
+"""
+Tests for allmydata.util.cputhreadpool.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import threading
+
+from twisted.trial import unittest
+
+from allmydata.util import cputhreadpool
+
+
+class CPUThreadPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(cputhreadpool.set_max_threads, 0)
+
+    def test_disabled_by_default(self):
+        """
+        With no pool configured, ``defer_to_thread`` runs the function
+        synchronously in the calling thread.
+        """
+        self.assertEqual(cputhreadpool.get_max_threads(), 0)
+        d = cputhreadpool.defer_to_thread(threading.current_thread)
+        self.assertIs(self.successResultOf(d), threading.current_thread())
+
+    def test_disabled_failure(self):
+        """
+        With no pool configured, exceptions raised by the function are
+        delivered as a failed ``Deferred``.
+        """
+        d = cputhreadpool.defer_to_thread(int, "not a number")
+        self.failureResultOf(d, ValueError)
+
+    def test_enabled(self):
+        """
+        With a pool configured, ``defer_to_thread`` runs the function in
+        another thread and delivers its result.
+        """
+        cputhreadpool.set_max_threads(2)
+        self.assertEqual(cputhreadpool.get_max_threads(), 2)
+        d = cputhreadpool.defer_to_thread(
+            lambda a, b=0: (threading.current_thread(), a + b), 1, b=2)
+        def _check(result):
+            (thread, value) = result
+            self.assertIsNot(thread, threading.current_thread())
+            self.assertEqual(value, 3)
+        d.addCallback(_check)
+        return d
+
+    def test_enabled_failure(self):
+        """
+        With a pool configured, exceptions raised by the function are
+        delivered as a failed ``Deferred``.
+        """
+        cputhreadpool.set_max_threads(2)
+        d = cputhreadpool.defer_to_thread(int, "not a number")
+        return self.assertFailure(d, ValueError)
+
+    def test_disable(self):
+        """
+        Setting the maximum to 0 stops the pool and work is done inline
+        again.
+        """
+        cputhreadpool.set_max_threads(2)
+        cputhreadpool.set_max_threads(0)
+        self.assertEqual(cputhreadpool.get_max_threads(), 0)
+        d = cputhreadpool.defer_to_thread(threading.current_thread)
+        self.assertIs(self.successResultOf(d), threading.current_thread())
+
+    def test_parse_max_threads(self):
+        """
+        ``parse_max_threads`` accepts ``auto`` and non-negative integers.
+        """
+        self.assertEqual(cputhreadpool.parse_max_threads("0"), 0)
+        self.assertEqual(cputhreadpool.parse_max_threads(" 3 "), 3)
+        self.assertEqual(cputhreadpool.parse_max_threads("Auto"),
+                         cputhreadpool.default_max_threads())
+        self.assertRaises(ValueError, cputhreadpool.parse_max_threads, "-1")
+        self.assertRaises(ValueError, cputhreadpool.parse_max_threads, "many")
+
+    def test_default_max_threads(self):
+        """
+        ``default_max_threads`` is the number of CPUs, or 1 if that cannot be
+        determined.
+        """
+        self.patch(cputhreadpool.multiprocessing, "cpu_count", lambda: 6)
+        self.assertEqual(cputhreadpool.default_max_threads(), 6)
+        def cpu_count():
+            raise NotImplementedError()
+        self.patch(cputhreadpool.multiprocessing, "cpu_count", cpu_count)
+        self.assertEqual(cputhreadpool.default_max_threads(), 1)
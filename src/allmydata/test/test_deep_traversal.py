@@ -0,0 +1,200 @@
+"""
+Tests for allmydata.deep_traversal.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from allmydata.deep_traversal import Frontier, FoundSet, DeepTraversal
+from allmydata.interfaces import IDirectoryNode
+from allmydata.monitor import Monitor, OperationCancelledError
+
+
+class FakeVerifier(object):
+    def __init__(self, cap):
+        self._cap = cap
+
+    def to_string(self):
+        return b"verify-" + self._cap
+
+
+class FakeFile(object):
+    def __init__(self, cap):
+        self._cap = cap
+
+    def get_uri(self):
+        return self._cap
+
+    def get_verify_cap(self):
+        return FakeVerifier(self._cap)
+
+
+@implementer(IDirectoryNode)
+class FakeDirectory(FakeFile):
+    """
+    A directory whose list() results are fired by the test, if ``manual`` is
+    set.
+    """
+    def __init__(self, cap, children=(), manual=False):
+        FakeFile.__init__(self, cap)
+        self._children = children
+        self._manual = manual
+        self.pending = []
+
+    def list(self):  # noqa: F811
+        children = dict((name, (child, {})) for (name, child) in self._children)
+        if not self._manual:
+            return defer.succeed(children)
+        d = defer.Deferred()
+        self.pending.append((d, children))
+        return d
+
+    def fire(self):
+        for (d, children) in self.pending:
+            d.callback(children)
+        self.pending = []
+
+
+class FakeNodeMaker(object):
+    def __init__(self, nodes):
+        self._nodes = dict((node.get_uri(), node) for node in nodes)
+
+    def create_from_cap(self, cap):
+        return self._nodes[cap]
+
+
+class Walker(object):
+    def __init__(self):
+        self.added = []
+        self.entered = []
+
+    def add_node(self, node, path):
+        self.added.append(tuple(path))
+
+    def enter_directory(self, parent, children):
+        self.entered.append(parent.get_uri())
+
+
+class FrontierTests(unittest.TestCase):
+    """
+    Tests for ``Frontier``.
+    """
+    def test_spill(self):
+        """
+        Entries beyond the maximum size are spilled to disk, recreated with
+        the nodemaker, and popped in last-in, first-out order.
+        """
+        nodes = [FakeFile(b"cap-%d" % (i,)) for i in range(25)]
+        frontier = Frontier(FakeNodeMaker(nodes), max_size=4)
+        for i, node in enumerate(nodes):
+            frontier.push(node, ["dir", "file-%d" % (i,)])
+        self.assertEqual(len(frontier), 25)
+        self.assertTrue(len(frontier._memory) <= 4)
+        popped = [frontier.pop() for i in range(25)]
+        self.assertEqual(len(frontier), 0)
+        self.assertEqual([node for (node, path) in popped], nodes[::-1])
+        self.assertEqual(popped[-1][1], ["dir", "file-0"])
+        frontier.close()
+
+
+class FoundSetTests(unittest.TestCase):
+    """
+    Tests for ``FoundSet``.
+    """
+    def test_add(self):
+        """
+        ``FoundSet.add`` returns True only the first time it sees a verifier.
+        """
+        found = FoundSet()
+        self.assertTrue(found.add(FakeVerifier(b"a")))
+        self.assertTrue(found.add(FakeVerifier(b"b")))
+        self.assertFalse(found.add(FakeVerifier(b"a")))
+        found.close()
+
+
+class DeepTraversalTests(unittest.TestCase):
+    """
+    Tests for ``DeepTraversal``.
+    """
+    def _traverse(self, root, nodes, **kwargs):
+        walker = Walker()
+        monitor = Monitor()
+        traversal = DeepTraversal(root, walker, monitor, FakeNodeMaker(nodes),
+                                  **kwargs)
+        return (walker, monitor, traversal.run())
+
+    def test_depth_first(self):
+        """
+        With a parallelism of 1, nodes are visited depth-first, files before
+        directories, and nodes reachable through several paths only once.
+        """
+        shared = FakeFile(b"shared")
+        sub1 = FakeDirectory(b"sub1", [("b", FakeFile(b"b")), ("s", shared)])
+        sub2 = FakeDirectory(b"sub2", [("s", shared)])
+        root = FakeDirectory(b"root", [("sub2", sub2), ("sub1", sub1),
+                                       ("a", FakeFile(b"a"))])
+        (walker, _, d) = self._traverse(root, [], parallelism=1)
+        self.successResultOf(d)
+        self.assertEqual(walker.added, [(), ("a",), ("sub1",), ("sub1", "b"),
+                                        ("sub1", "s"), ("sub2",)])
+        self.assertEqual(walker.entered, [b"root", b"sub1", b"sub2"])
+
+    def test_parallel(self):
+        """
+        Up to ``parallelism`` directories are read at the same time.
+        """
+        subdirs = [FakeDirectory(b"sub%d" % (i,), [("f", FakeFile(b"f%d" % (i,)))],
+                                 manual=True)
+                   for i in range(5)]
+        root = FakeDirectory(b"root", [("sub%d" % (i,), sub)
+                                       for (i, sub) in enumerate(subdirs)])
+        (walker, _, d) = self._traverse(root, [], parallelism=3)
+        self.assertEqual([len(sub.pending) for sub in subdirs], [1, 1, 1, 0, 0])
+        for sub in subdirs[:3]:
+            sub.fire()
+        self.assertEqual([len(sub.pending) for sub in subdirs], [0, 0, 0, 1, 1])
+        self.assertNoResult(d)
+        for sub in subdirs[3:]:
+            sub.fire()
+        self.successResultOf(d)
+        self.assertEqual(len(walker.added), 11)
+
+    def test_spill(self):
+        """
+        A traversal with a small frontier recreates spilled nodes with the
+        nodemaker and still visits every node once.
+        """
+        files = [FakeFile(b"file-%d" % (i,)) for i in range(50)]
+        subdirs = [FakeDirectory(b"sub%d" % (i,), [("f%d" % (j,), files[j])
+                                                  for j in range(i, 50, 3)])
+                   for i in range(3)]
+        root = FakeDirectory(b"root", [("sub%d" % (i,), sub)
+                                       for (i, sub) in enumerate(subdirs)])
+        (walker, _, d) = self._traverse(root, files + subdirs,
+                                        parallelism=2, frontier_size=4)
+        self.successResultOf(d)
+        self.assertEqual(len(walker.added), 1 + 3 + 50)
+        self.assertEqual(len(set(walker.added)), len(walker.added))
+
+    def test_cancel(self):
+        """
+        Cancelling the monitor stops the traversal with
+        ``OperationCancelledError``.
+        """
+        sub = FakeDirectory(b"sub", [("f", FakeFile(b"f"))], manual=True)
+        root = FakeDirectory(b"root", [("sub", sub), ("g", FakeFile(b"g"))])
+        (walker, monitor, d) = self._traverse(root, [], parallelism=1)
+        monitor.cancel()
+        sub.fire()
+        self.failureResultOf(d, OperationCancelledError)
+        self.assertNotIn(("sub", "f"), walker.added)
@@ -1426,6 +1426,59 @@ class Packing(testutil.ReallyEqualMixin, unittest.TestCase):
         children = node._unpack_contents(packed_children)
         self._check_children(children)
 
+    def test_lazy_lookup(self):
+        """
+        Looking up one child in a ``DirectoryIndex`` only creates the node for
+        that child.
+        """
+        known_tree = b32decode(self.known_tree)
+        nodemaker = NodeMaker(None, None, None,
+                              None, None,
+                              {"k": 3, "n": 10}, None, None)
+        write_uri = b"URI:SSK-RO:e3mdrzfwhoq42hy5ubcz6rp3o4:ybyibhnp3vvwuq2vaw2ckjmesgkklfs6ghxleztqidihjyofgw7q"
+        filenode = nodemaker.create_from_cap(write_uri)
+        node = dirnode.DirectoryNode(filenode, nodemaker, None)
+        created = []
+        create_from_cap = nodemaker.create_from_cap
+        def _create_from_cap(*args, **kwargs):
+            created.append(args)
+            return create_from_cap(*args, **kwargs)
+        self.patch(nodemaker, "create_from_cap", _create_from_cap)
+
+        index = node._index_contents(known_tree)
+        self.assertEqual(sorted(index.get_names()),
+                         [u"file1", u"file2", u"file3"])
+        self.assertEqual(created, [])
+        (child, metadata) = node._unpack_child(index, u"file2")
+        self.assertEqual(len(created), 1)
+        children = node._unpack_contents(known_tree)
+        self.assertEqual(child.get_uri(), children[u"file2"][0].get_uri())
+        self.assertEqual(metadata, children[u"file2"][1])
+        self.assertIs(node._unpack_child(index, u"file4"), None)
+
+    def test_malformed_index(self):
+        """
+        ``DirectoryIndex`` rejects contents which are not a list of
+        netstrings.
+        """
+        self.assertRaises(ValueError, dirnode.DirectoryIndex, b"9:abc,")
+        self.assertRaises(ValueError, dirnode.DirectoryIndex, b"3:abc;")
+
+    def test_index_cache(self):
+        """
+        ``DirectoryIndexCache`` returns the same index for the same version of
+        a directory, and evicts the least recently used indexes.
+        """
+        known_tree = b32decode(self.known_tree)
+        cache = dirnode.DirectoryIndexCache(2 * len(known_tree))
+        index = cache.get_index(b"si1", known_tree)
+        self.assertIs(cache.get_index(b"si1", known_tree), index)
+        self.assertIsNot(cache.get_index(b"si2", known_tree), index)
+        cache.get_index(b"si3", known_tree)
+        self.assertEqual(cache.get_stats()["dirnode.index_cache.hits"], 1)
+        self.assertEqual(cache.get_stats()["dirnode.index_cache.evictions"], 1)
+        self.assertIsNot(cache.get_index(b"si1", known_tree), index)
+
     def _check_children(self, children):
         # Are all the expected child nodes there?
         self.failUnless(u'file1' in children)
@@ -1924,6 +1977,69 @@ class Deleter(GridTestMixin, testutil.ReallyEqualMixin, unittest.TestCase):
 
         return d
 
+class Editor(unittest.TestCase):
+    """
+    Tests for ``DirectoryNode.apply_edits``.
+    """
+    def setUp(self):
+        self.nodemaker = FakeClient2().nodemaker
+
+    def _file(self, i):
+        return self.nodemaker.create_from_cap(make_chk_file_uri(1000 + i))
+
+    @defer.inlineCallbacks
+    def test_apply_edits(self):
+        """
+        All the edits are applied in a single modify cycle, and an edit
+        which cannot be applied is reported without preventing the others.
+        """
+        b_node = self._file(2)
+        n = yield self.nodemaker.create_new_mutable_directory(
+            {u"a": (self._file(1), {}),
+             u"b": (b_node, {"key": "value"}),
+             u"c": (self._file(3), {})})
+        modifies = []
+        modify = n._node.modify
+        def _modify(modifier):
+            modifies.append(modifier)
+            return modify(modifier)
+        self.patch(n._node, "modify", _modify)
+
+        d_node = self._file(4)
+        results = yield n.apply_edits([
+            ("set", u"d", d_node, {"new": True}, True),
+            ("delete", u"a"),
+            ("rename", u"b", u"e", True),
+            ("delete", u"missing"),
+            ("rename", u"c", u"d", False),
+            ("set", u"e", self._file(5), None, False),
+        ])
+        self.assertEqual(len(modifies), 1)
+        self.assertEqual(results[:3], [None, None, None])
+        self.assertIsInstance(results[3], NoSuchChildError)
+        self.assertIsInstance(results[4], ExistingChildError)
+        self.assertIsInstance(results[5], ExistingChildError)
+
+        children = yield n.list()
+        self.assertEqual(sorted(children), [u"c", u"d", u"e"])
+        self.assertEqual(children[u"d"][0].get_uri(), d_node.get_uri())
+        self.assertEqual(children[u"d"][1]["new"], True)
+        self.assertEqual(children[u"e"][0].get_uri(), b_node.get_uri())
+        self.assertEqual(children[u"e"][1]["key"], "value")
+
+    @defer.inlineCallbacks
+    def test_nothing_applied(self):
+        """
+        If none of the edits can be applied, the directory is not
+        rewritten.
+        """
+        n = yield self.nodemaker.create_new_mutable_directory()
+        contents = yield n._node.download_best_version()
+        editor = dirnode.Editor(n, [("delete", u"missing")])
+        self.assertIs(editor.modify(contents, None, True), None)
+        self.assertIsInstance(editor.results[0], NoSuchChildError)
+
+
 class Adder(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
 
     def test_overwrite(self):
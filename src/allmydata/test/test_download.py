@@ -25,7 +25,7 @@ from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from allmydata import uri
 from allmydata.storage.server import storage_index_to_dir
-from allmydata.util import base32, fileutil, spans, log, hashutil
+from allmydata.util import base32, fileutil, spans, log, hashutil, pollmixin
 from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.immutable import upload, layout
 from allmydata.test.no_network import GridTestMixin, NoNetworkServer
@@ -36,6 +36,9 @@ from allmydata.immutable.downloader.common import BadSegmentNumberError, \
      BadCiphertextHashError, COMPLETE, OVERDUE, DEAD
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.segmentcache import SegmentCache
+from allmydata.immutable.downloader.readahead import ReadAhead
+from allmydata.immutable.filenode import ImmutableFileNode
 from allmydata.codec import CRSDecoder
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 
@@ -887,6 +890,244 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_ciphertext)
         return d
 
+class ReadAheadTests(_Base, pollmixin.PollMixin, unittest.TestCase):
+    """
+    A ReadAhead fetches segments ahead of a sequential reader.
+    """
+    def upload(self):
+        """
+        Upload a file of five segments and return a DownloadNode for it.
+        """
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.data = (plaintext*100)[:30000] # multiple of k
+        u = upload.Data(self.data, None)
+        u.max_segment_size = 6000 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.n = self.c0.create_node_from_uri(ur.get_uri())
+            self.n._cnode._maybe_create_download_node()
+            return self.n._cnode._node
+        d.addCallback(_uploaded)
+        return d
+
+    def get_segment(self, ra, segnum):
+        (d, c) = ra.get_segment(segnum, None, 4)
+        def _check(result):
+            (offset, segment, decodetime) = result
+            self.assertEqual(offset, segnum * 6000)
+            self.assertEqual(len(segment), 6000)
+        d.addCallback(_check)
+        return d
+
+    @defer.inlineCallbacks
+    def test_sequential(self):
+        """
+        In-order requests make the node fetch an increasing number of the
+        following segments, which are then delivered without another fetch.
+        """
+        node = yield self.upload()
+        ra = ReadAhead(node)
+        yield self.get_segment(ra, 0)
+        self.assertEqual((ra._readahead, ra._prefetched), ({}, {}))
+        yield self.get_segment(ra, 1)
+        yield self.poll(lambda: 2 in ra._prefetched)
+        requested = len(node._download_status.segment_events)
+        yield self.get_segment(ra, 2)
+        # segment 2 was already there, so only segments 3 and 4 were fetched
+        yield self.poll(lambda: sorted(ra._prefetched) == [3, 4])
+        self.assertEqual(len(node._download_status.segment_events),
+                         requested + 3)
+        yield self.get_segment(ra, 3)
+        yield self.get_segment(ra, 4)
+        self.assertEqual((ra._readahead, ra._prefetched), ({}, {}))
+
+    @defer.inlineCallbacks
+    def test_memory_limit(self):
+        """
+        The node does not read ahead more than its memory budget allows.
+        """
+        node = yield self.upload()
+        node._readahead_bytes = 6000
+        ra = ReadAhead(node)
+        for segnum in range(3):
+            yield self.get_segment(ra, segnum)
+        yield self.poll(lambda: 3 in ra._prefetched)
+        yield self.get_segment(ra, 3)
+        yield self.poll(lambda: 4 in ra._prefetched)
+        self.assertEqual(ra._window, 1)
+
+    @defer.inlineCallbacks
+    def test_seek(self):
+        """
+        A request out of order drops whatever was read ahead.
+        """
+        node = yield self.upload()
+        ra = ReadAhead(node)
+        yield self.get_segment(ra, 0)
+        yield self.get_segment(ra, 1)
+        yield self.poll(lambda: 2 in ra._prefetched)
+        yield self.get_segment(ra, 4)
+        self.assertEqual((ra._readahead, ra._prefetched), ({}, {}))
+        self.assertEqual(ra._window, 0)
+
+    @defer.inlineCallbacks
+    def test_interleaved(self):
+        """
+        Readers at different places in the same file each keep their own
+        read-ahead, and one of them stopping leaves the other's alone.
+        """
+        node = yield self.upload()
+        # keep the segments out of the cache, so they must be read ahead
+        self.patch(node, "_segment_cache", None)
+        ra1 = ReadAhead(node)
+        ra2 = ReadAhead(node)
+        yield self.get_segment(ra1, 0)
+        yield self.get_segment(ra2, 2)
+        yield self.get_segment(ra1, 1)
+        yield self.get_segment(ra2, 3)
+        self.assertEqual((ra1._window, ra2._window), (1, 1))
+        self.assertEqual(list(ra2._readahead), [4])
+        ra1.stop()
+        self.assertEqual(list(ra2._readahead), [4])
+        yield self.poll(lambda: 4 in ra2._prefetched)
+        yield self.get_segment(ra2, 4)
+        self.assertEqual(node._readaheads, set([ra2]))
+        ra2.stop()
+        self.assertEqual(node._readaheads, set())
+
+    @defer.inlineCallbacks
+    def test_stop_producing(self):
+        """
+        When the consumer of a read stops it, the segments being read ahead
+        for it are cancelled.
+        """
+        node = yield self.upload()
+        stopped = []
+        class Consumer(MemoryConsumer):
+            def write(self, data):
+                MemoryConsumer.write(self, data)
+                if len(self.chunks) == 2:
+                    # segment 2 is being read ahead by now
+                    [ra] = node._readaheads
+                    stopped.append((ra, list(ra._readahead)))
+                    self.producer.stopProducing()
+        yield self.shouldFail(DownloadStopped, "test_stop_producing",
+                              "our Consumer called stopProducing()",
+                              self.n.read, Consumer())
+        [(ra, readahead)] = stopped
+        self.assertEqual(readahead, [2])
+        self.assertEqual((ra._readahead, ra._prefetched), ({}, {}))
+        self.assertEqual(node._readaheads, set())
+        self.assertEqual(node._active_segment, None)
+
+    @defer.inlineCallbacks
+    def test_read(self):
+        """
+        Reading a whole file and part of it with read-ahead gives the right
+        data.
+        """
+        node = yield self.upload()
+        data = yield download_to_data(self.n)
+        self.assertEqual(data, self.data)
+        c = MemoryConsumer()
+        yield self.n.read(c, 7000, 15000)
+        self.assertEqual(b"".join(c.chunks), self.data[7000:22000])
+        self.assertEqual(node._readaheads, set())
+
+
+class SegmentCacheTests(unittest.TestCase):
+    def test_get_and_add(self):
+        cache = SegmentCache(100)
+        self.assertIs(cache.get(b"si", 0), None)
+        cache.add(b"si", 0, 0, b"a"*10)
+        self.assertEqual(cache.get(b"si", 0), (0, b"a"*10))
+        self.assertIs(cache.get(b"si", 1), None)
+        self.assertIs(cache.get(b"other", 0), None)
+        stats = cache.get_stats()
+        self.assertEqual(stats["downloader.segment_cache.hits"], 1)
+        self.assertEqual(stats["downloader.segment_cache.misses"], 3)
+        self.assertEqual(stats["downloader.segment_cache.size"], 10)
+
+    def test_lru_eviction(self):
+        """
+        The least recently used segments are evicted to stay within the size
+        limit.
+        """
+        cache = SegmentCache(30)
+        for segnum in range(3):
+            cache.add(b"si", segnum, segnum*10, b"x"*10)
+        # segment 0 is now more recently used than segment 1
+        cache.get(b"si", 0)
+        cache.add(b"si", 3, 30, b"x"*10)
+        self.assertNotIn((b"si", 1), cache)
+        for segnum in (0, 2, 3):
+            self.assertIn((b"si", segnum), cache)
+        cache.add(b"si", 4, 40, b"x"*20)
+        self.assertEqual(sorted(k[1] for k in cache._segments), [3, 4])
+        stats = cache.get_stats()
+        self.assertEqual(stats["downloader.segment_cache.evictions"], 3)
+        self.assertEqual(stats["downloader.segment_cache.size"], 30)
+        self.assertEqual(stats["downloader.segment_cache.segments"], 2)
+
+    def test_too_large(self):
+        """
+        Segments larger than the whole cache are not kept.
+        """
+        cache = SegmentCache(10)
+        cache.add(b"si", 0, 0, b"x"*11)
+        self.assertNotIn((b"si", 0), cache)
+        self.assertEqual(cache.get_stats()["downloader.segment_cache.size"], 0)
+
+    def test_replace(self):
+        cache = SegmentCache(100)
+        cache.add(b"si", 0, 0, b"x"*10)
+        cache.add(b"si", 0, 0, b"y"*10)
+        self.assertEqual(cache.get(b"si", 0), (0, b"y"*10))
+        self.assertEqual(cache.get_stats()["downloader.segment_cache.size"], 10)
+
+
+class SharedSegmentCache(_Base, unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_second_reader(self):
+        """
+        A second node for the same file gets the segments from the client-wide
+        cache instead of fetching them again.
+        """
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        data = (plaintext*100)[:30000] # multiple of k
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs
+        ur = yield self.c0.upload(u)
+        cache = SegmentCache(1000000)
+
+        def make_node():
+            return ImmutableFileNode(uri.from_string(ur.get_uri()),
+                                     self.c0.storage_broker,
+                                     self.c0._secret_holder,
+                                     self.c0.terminator, None, cache)
+
+        n1 = make_node()
+        downloaded = yield download_to_data(n1)
+        self.assertEqual(downloaded, data)
+        self.assertEqual(cache.get_stats()["downloader.segment_cache.segments"],
+                         5)
+
+        n2 = make_node()
+        c = MemoryConsumer()
+        yield n2.read(c, 7000, 15000)
+        self.assertEqual(b"".join(c.chunks), data[7000:22000])
+        events = n2._cnode._download_status.segment_events
+        # the first segment has to come from the grid, for the UEB
+        self.assertEqual([e["segment_number"] for e in events], [0, 1, 2, 3])
+        self.assertEqual([e["active_time"] == e["finish_time"] for e in events],
+                         [False, True, True, True])
+        self.assertEqual(cache.hits, 3)
+
+
 class BrokenDecoder(CRSDecoder):
     def decode(self, shares, shareids):
         d = CRSDecoder.decode(self, shares, shareids)
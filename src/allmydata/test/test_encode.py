@@ -15,10 +15,10 @@ from zope.interface import implementer
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.python.failure import Failure
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, flushEventualQueue
 from allmydata import uri
 from allmydata.immutable import encode, upload, checker
-from allmydata.util import hashutil
+from allmydata.util import hashutil, cputhreadpool
 from allmydata.util.assertutil import _assert
 from allmydata.util.consumer import download_to_data
 from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader
@@ -360,6 +360,117 @@ class Encode(unittest.TestCase):
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
 
+class BlockingBucketProxy(FakeBucketReaderWriterProxy):
+    """
+    A shareholder which does not accept blocks until the test says so.
+    """
+    def __init__(self, *args, **kwargs):
+        FakeBucketReaderWriterProxy.__init__(self, *args, **kwargs)
+        self.pending = []
+
+    def put_block(self, segmentnum, data):
+        d = defer.Deferred()
+        d.addCallback(lambda ign: FakeBucketReaderWriterProxy.put_block(
+            self, segmentnum, data))
+        self.pending.append(d)
+        return d
+
+
+class Pipelining(unittest.TestCase):
+    """
+    The Encoder reads and encodes later segments while earlier ones are still
+    being sent, within its memory limit.
+    """
+    def start_encoder(self, max_buffered_bytes, blocking):
+        """
+        Start encoding five 25-byte segments into 100 shares, with one
+        ``BlockingBucketProxy`` shareholder if ``blocking``.
+
+        :return: the Encoder, the Deferred from ``Encoder.start``, the list of
+            sizes that were read from the uploadable, and the first
+            shareholder.
+        """
+        e = encode.Encoder(max_buffered_bytes=max_buffered_bytes)
+        u = upload.Data(make_data(125), convergence=b"some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 25,
+                                           'k': 25, 'happy': 75, 'n': 100})
+        eu = upload.EncryptAnUploadable(u)
+        reads = []
+        read_encrypted = eu.read_encrypted
+        def _read_encrypted(length, hash_only):
+            reads.append(length)
+            return read_encrypted(length, hash_only)
+        eu.read_encrypted = _read_encrypted
+        d = e.set_encrypted_uploadable(eu)
+
+        shareholders = {}
+        servermap = {}
+        for shnum in range(100):
+            if blocking and shnum == 0:
+                peer = BlockingBucketProxy(peerid=b"peer%d" % shnum)
+            else:
+                peer = FakeBucketReaderWriterProxy(peerid=b"peer%d" % shnum)
+            shareholders[shnum] = peer
+            servermap[shnum] = {peer.get_peerid()}
+        def _ready(res):
+            e.set_shareholders(shareholders, servermap)
+            return e.start()
+        d.addCallback(_ready)
+        return e, d, reads, shareholders[0]
+
+    @defer.inlineCallbacks
+    def check_read_ahead(self, max_buffered_bytes, depth):
+        # each segment costs 25 bytes of ciphertext and 100 1-byte blocks
+        _, d, reads, blocker = self.start_encoder(max_buffered_bytes, True)
+        for segnum in range(5):
+            yield flushEventualQueue()
+            self.assertEqual(len(reads), min(5, segnum + depth))
+            self.assertEqual(len(blocker.pending), 1)
+            blocker.pending.pop(0).callback(None)
+        verifycap = yield d
+        self.assertEqual(len(blocker.blocks), 5)
+        self.assertTrue(blocker.closed)
+        defer.returnValue(verifycap)
+
+    def test_no_read_ahead(self):
+        """
+        With room for just one segment, the next one is only read once the
+        previous one has been sent.
+        """
+        return self.check_read_ahead(1, 1)
+
+    def test_read_ahead(self):
+        """
+        With room for three segments, two more are read while the first one is
+        being sent.
+        """
+        return self.check_read_ahead(3 * 125, 3)
+
+    @defer.inlineCallbacks
+    def test_same_result(self):
+        """
+        The amount of read-ahead does not change the encoded file.
+        """
+        serial = yield self.start_encoder(1, False)[1]
+        pipelined = yield self.start_encoder(
+            encode.DEFAULT_MAX_BUFFERED_BYTES, False)[1]
+        self.assertEqual(serial.to_string(), pipelined.to_string())
+
+    @defer.inlineCallbacks
+    def test_abort(self):
+        """
+        An upload aborted while segments are in flight stops reading and fails
+        with ``UploadAborted``.
+        """
+        e, d, reads, blocker = self.start_encoder(2 * 125, True)
+        yield flushEventualQueue()
+        e.abort()
+        blocker.pending.pop(0).callback(None)
+        yield self.assertFailure(d, encode.UploadAborted)
+        self.assertEqual(len(reads), 2)
+        self.assertEqual(len(blocker.blocks), 1)
+
+
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
     # a series of 3*3 tests to check out edge conditions. One axis is how the
@@ -418,3 +529,14 @@ class Roundtrip(GridTestMixin, unittest.TestCase):
             self.failUnlessEqual(newdata, DATA)
         d.addCallback(_downloaded)
         return d
+
+
+class ThreadedRoundtrip(Roundtrip):
+    """
+    Upload and download with erasure coding and hashing done in the CPU
+    thread pool.
+    """
+    def setUp(self):
+        super(ThreadedRoundtrip, self).setUp()
+        cputhreadpool.set_max_threads(4)
+        self.addCleanup(cputhreadpool.set_max_threads, 0)
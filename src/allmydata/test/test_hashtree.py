@@ -18,6 +18,7 @@ from twisted.trial import unittest
 
 from allmydata.util.hashutil import tagged_hash
 from allmydata import hashtree
+from allmydata.hashtree import empty_leaf_hash, pair_hash, roundup_pow2
 
 
 def make_tree(numleaves):
@@ -26,6 +27,19 @@ def make_tree(numleaves):
     ht = hashtree.HashTree(leaf_hashes)
     return ht
 
+def make_rows(numleaves):
+    # the original row-by-row construction, one hash at a time, which
+    # HashTree must still agree with
+    L = [tagged_hash(b"tag", b"%d" % i) for i in range(numleaves)]
+    L += [empty_leaf_hash(i) for i in range(numleaves, roundup_pow2(numleaves))]
+    rows = [L]
+    while len(rows[-1]) != 1:
+        last = rows[-1]
+        rows += [[pair_hash(last[2*i], last[2*i+1])
+                  for i in range(len(last)//2)]]
+    rows.reverse()
+    return sum(rows, [])
+
 class Complete(unittest.TestCase):
     def test_create(self):
         # try out various sizes, since we pad to a power of two
@@ -49,6 +63,30 @@ class Complete(unittest.TestCase):
         self.failUnlessEqual(ht.needed_hashes(7, False), set([13, 5, 1]))
         self.failUnlessEqual(ht.needed_hashes(7, True), set([14, 13, 5, 1]))
 
+    def test_same_as_rows(self):
+        for numleaves in list(range(1, 34)) + [100]:
+            ht = make_tree(numleaves)
+            self.failUnlessEqual(list(ht), make_rows(numleaves),
+                                 "numleaves=%d" % numleaves)
+
+    def test_needed_hashes_for_leaves(self):
+        ht = make_tree(8)
+        self.failUnlessEqual(ht.needed_hashes_for_leaves([0]),
+                             ht.needed_hashes(0))
+        # 9 is on the path from leaf 2, and 3, 4 and 1 from both leaves
+        self.failUnlessEqual(ht.needed_hashes_for_leaves([0, 2]),
+                             set([8, 10, 2]))
+        self.failUnlessEqual(ht.needed_hashes_for_leaves([0, 2], True),
+                             set([7, 8, 9, 10, 2]))
+        self.failUnlessEqual(ht.needed_hashes_for_leaves(range(8)), set())
+        self.failUnlessEqual(ht.needed_hashes_for_leaves([]), set())
+        for leaves in ([1, 6], [3, 4, 5], [0, 7]):
+            union = set()
+            for leafnum in leaves:
+                union.update(ht.needed_hashes(leafnum, True))
+            self.failUnless(ht.needed_hashes_for_leaves(leaves, True) <= union)
+        self.failUnlessRaises(IndexError, ht.needed_hashes_for_leaves, [8])
+
     def test_dump(self):
         ht = make_tree(6)
         expected = [(0,0),
@@ -75,6 +113,9 @@ class Incomplete(unittest.TestCase):
         self.failUnlessEqual(ht.get_leaf(0), None)
         self.failUnlessRaises(IndexError, ht.get_leaf, 8)
         self.failUnlessEqual(ht.get_leaf_index(0), 7)
+        for numleaves in (1, 2, 6, 9, 100):
+            self.failUnlessEqual(len(hashtree.IncompleteHashTree(numleaves)),
+                                 len(make_rows(numleaves)))
 
     def test_needed_hashes(self):
         ht = hashtree.IncompleteHashTree(8)
@@ -231,3 +272,65 @@ class Incomplete(unittest.TestCase):
             iht.set_hashes(chain, leaves={4: tagged_hash(b"tag", b"4")})
         except hashtree.BadHashError as e:
             self.fail("bad hash: %s" % e)
+
+    def test_replace_leaves(self):
+        ht = make_tree(11)
+        iht = hashtree.IncompleteHashTree(11)
+        needed = set([0])
+        for leafnum in (2, 3, 9):
+            needed.update(ht.needed_hashes(leafnum, include_leaf=True))
+        iht.set_hashes(hashes=dict([(i, ht[i]) for i in needed]))
+
+        new_leaves = [tagged_hash(b"tag", b"%d" % i) for i in range(11)]
+        for leafnum in (2, 3, 9):
+            new_leaves[leafnum] = tagged_hash(b"tag", b"new %d" % leafnum)
+        new_ht = hashtree.HashTree(new_leaves)
+
+        changed = iht.replace_leaves(dict([(leafnum, new_leaves[leafnum])
+                                           for leafnum in (2, 3, 9)]))
+        self.failUnlessEqual(changed,
+                             set([i for i in range(len(ht))
+                                  if ht[i] != new_ht[i]]))
+        for i in changed:
+            self.failUnlessEqual(iht[i], new_ht[i])
+
+        # without the sibling of a leaf, the new root can't be computed
+        iht = hashtree.IncompleteHashTree(11)
+        needed = ht.needed_hashes(4, include_leaf=True)
+        needed.discard(ht.get_leaf_index(5))
+        needed.add(0)
+        iht.set_hashes(hashes={0: ht[0]})
+        for i in needed:
+            iht[i] = ht[i]
+        self.failUnlessRaises(hashtree.NotEnoughHashesError,
+                              iht.replace_leaves, {4: new_leaves[4]})
+        self.failUnlessEqual(iht[0], ht[0])
+
+    def test_set_many_leaves(self):
+        ht = make_tree(11)
+        leaves = dict((leafnum, tagged_hash(b"tag", b"%d" % leafnum))
+                      for leafnum in (0, 2, 3, 9))
+        iht = hashtree.IncompleteHashTree(11)
+        needed = iht.needed_hashes_for_leaves(leaves)
+        needed.add(0)
+        self.failUnlessEqual(needed, set([0, 4, 6, 12, 16, 23]))
+        chain = dict((i, ht[i]) for i in needed)
+        iht.set_hashes(chain, leaves)
+        for i in range(len(ht)):
+            if iht[i] is not None:
+                self.failUnlessEqual(iht[i], ht[i], "i=%d" % i)
+        self.failUnlessEqual(iht.needed_hashes_for_leaves([1, 2]), set())
+        self.failUnlessEqual(iht.needed_hashes_for_leaves([4]), set([10, 20]))
+
+        # a single bad leaf among several is caught
+        iht = hashtree.IncompleteHashTree(11)
+        bad_leaves = dict(leaves)
+        bad_leaves[3] = tagged_hash(b"bad tag", b"3")
+        self.failUnlessRaises(hashtree.BadHashError,
+                              iht.set_hashes, chain, bad_leaves)
+
+        # as is a missing sibling
+        iht = hashtree.IncompleteHashTree(11)
+        del chain[16]
+        self.failUnlessRaises(hashtree.NotEnoughHashesError,
+                              iht.set_hashes, chain, leaves)
@@ -90,6 +90,21 @@ class HashUtilTests(unittest.TestCase):
         self.failUnlessEqual(h1, h2.digest())
         self.assertIsInstance(h1, bytes)
 
+    def test_batches(self):
+        values = [b"", b"foo", b"bar" * 100]
+        self.failUnlessEqual(hashutil.tagged_hashes(b"tag", values),
+                             [hashutil.tagged_hash(b"tag", v) for v in values])
+        self.failUnlessEqual(hashutil.tagged_hashes(b"tag", values, 16),
+                             [hashutil.tagged_hash(b"tag", v, 16)
+                              for v in values])
+        self.failUnlessEqual(hashutil.tagged_hashes(b"tag", []), [])
+        pairs = [(b"foo", b"bar"), (b"foob", b"ar"), (b"", b"")]
+        self.failUnlessEqual(hashutil.tagged_pair_hashes(b"tag", pairs),
+                             [hashutil.tagged_pair_hash(b"tag", a, b)
+                              for (a, b) in pairs])
+        self.failUnlessEqual(hashutil.block_hashes(values),
+                             [hashutil.block_hash(v) for v in values])
+
     def test_timing_safe_compare(self):
         self.failUnless(hashutil.timing_safe_compare(b"a", b"a"))
         self.failUnless(hashutil.timing_safe_compare(b"ab", b"ab"))
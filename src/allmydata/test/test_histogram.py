@@ -0,0 +1,136 @@
+"""
+Tests for allmydata.util.histogram.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import math
+import struct
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from allmydata.util.histogram import (
+    BUCKET_BOUNDS,
+    NUM_BOUNDS,
+    Histogram,
+    WindowedHistogram,
+    bucket_index,
+)
+
+
+def _nextafter(x, y):
+    # math.nextafter() is only in Python 3.9 and later. For positive
+    # floats, adjacent bit patterns are adjacent values.
+    (bits,) = struct.unpack("<q", struct.pack("<d", x))
+    bits += 1 if y > x else -1
+    return struct.unpack("<d", struct.pack("<q", bits))[0]
+
+nextafter = getattr(math, "nextafter", _nextafter)
+
+
+class Buckets(unittest.TestCase):
+    def test_bounds(self):
+        self.failUnlessEqual(len(BUCKET_BOUNDS), NUM_BOUNDS)
+        self.failUnless(BUCKET_BOUNDS[0] < 0.00001)
+        self.failUnlessEqual(BUCKET_BOUNDS[-1], 128)
+        for (lower, upper) in zip(BUCKET_BOUNDS, BUCKET_BOUNDS[1:]):
+            self.failUnless(abs(upper / lower - 2 ** 0.5) < 1e-9)
+
+    def test_bucket_index(self):
+        # each bound is the largest value in its bucket
+        for i, bound in enumerate(BUCKET_BOUNDS):
+            self.failUnlessEqual(bucket_index(bound), i)
+            self.failUnlessEqual(bucket_index(bound * 1.000001), i + 1)
+            self.failUnlessEqual(bucket_index(nextafter(bound, 0)), i)
+            self.failUnlessEqual(bucket_index(nextafter(bound, float("inf"))),
+                                 i + 1)
+        self.failUnlessEqual(bucket_index(0), 0)
+        self.failUnlessEqual(bucket_index(1), BUCKET_BOUNDS.index(1))
+        self.failUnlessEqual(bucket_index(3600), NUM_BOUNDS)
+
+
+class Histograms(unittest.TestCase):
+    def test_empty(self):
+        h = Histogram()
+        self.failUnlessEqual(h.quantile(0.5), None)
+        stats = h.get_stats()
+        self.failUnlessEqual(stats["count"], 0)
+        self.failUnlessEqual(stats["sum"], 0)
+        self.failUnlessEqual(len(stats["buckets"]), NUM_BOUNDS + 1)
+        self.failUnlessEqual(stats["buckets"][-1], (None, 0))
+
+    def test_quantile(self):
+        h = Histogram()
+        for i in range(1000):
+            h.add(0.001 * (i + 1))
+        self.failUnlessEqual(h.count, 1000)
+        self.failUnless(abs(h.sum - 500.5) < 1e-6, h.sum)
+        for q in (0.01, 0.1, 0.5, 0.9, 0.999):
+            self.failUnless(abs(h.quantile(q) - q) < q / 20,
+                            (q, h.quantile(q)))
+
+    def test_overflow(self):
+        h = Histogram()
+        h.add(1000)
+        self.failUnlessEqual(h.quantile(0.5), BUCKET_BOUNDS[-1])
+        self.failUnlessEqual(h.get_stats()["buckets"][-2:],
+                             [(BUCKET_BOUNDS[-1], 0), (None, 1)])
+
+    def test_cumulative_buckets(self):
+        h = Histogram()
+        h.add(0.5)
+        h.add(1)
+        h.add(2)
+        buckets = dict(h.get_stats()["buckets"])
+        self.failUnlessEqual(buckets[0.5], 1)
+        self.failUnlessEqual(buckets[1], 2)
+        self.failUnlessEqual(buckets[2], 3)
+        self.failUnlessEqual(buckets[None], 3)
+
+    def test_update(self):
+        a, b = Histogram(), Histogram()
+        a.add(0.25)
+        b.add(4)
+        b.add(4)
+        a.update(b)
+        self.failUnlessEqual(a.count, 3)
+        self.failUnlessEqual(a.sum, 8.25)
+        self.failUnless(BUCKET_BOUNDS[bucket_index(4) - 1] < a.quantile(0.5) <= 4)
+        a.clear()
+        self.failUnlessEqual((a.count, a.sum, sum(a.buckets)), (0, 0, 0))
+
+
+class Windows(unittest.TestCase):
+    def test_window(self):
+        clock = Clock()
+        w = WindowedHistogram(clock)
+        w.add(1)
+        clock.advance(w.INTERVAL * (w.SLOTS - 1))
+        w.add(2)
+        self.failUnlessEqual(w.window().count, 2)
+        clock.advance(w.INTERVAL)
+        self.failUnlessEqual(w.window().count, 1)
+        self.failUnlessEqual(w.window().sum, 2)
+        self.failUnlessEqual(w.cumulative.count, 2)
+
+    def test_idle(self):
+        # after a long pause, every slot is emptied, however long ago it
+        # was last used
+        clock = Clock()
+        w = WindowedHistogram(clock)
+        for i in range(w.SLOTS):
+            w.add(1)
+            clock.advance(w.INTERVAL)
+        clock.advance(w.INTERVAL * w.SLOTS * 100)
+        self.failUnlessEqual(w.window().count, 0)
+        w.add(1)
+        self.failUnlessEqual(w.window().count, 1)
+        self.failUnlessEqual(w.cumulative.count, w.SLOTS + 1)
@@ -504,6 +504,22 @@ class IStorageServerImmutableAPIsTestsMixin(object):
         self.assertEqual(lease1.get_expiration_time(), initial_expiration_time)
         self.assertEqual(lease2.get_expiration_time() - initial_expiration_time, 167)
 
+    @inlineCallbacks
+    def test_add_leases(self):
+        """
+        ``add_leases()`` adds a lease for each storage index it is given,
+        and reports success even for storage indexes with no shares.
+        """
+        storage_index, renew_secret, cancel_secret = yield self.create_share()
+        renew_secret2 = new_secret()
+        cancel_secret2 = new_secret()
+        results = yield self.storage_client.add_leases([
+            (storage_index, renew_secret2, cancel_secret2),
+            (new_storage_index(), renew_secret2, cancel_secret2),
+        ])
+        self.assertEqual(results, [None, None])
+        self.assertEqual(len(list(self.server.get_leases(storage_index))), 2)
+
 
 class IStorageServerMutableAPIsTestsMixin(object):
     """
@@ -34,6 +34,7 @@ from testtools.matchers import (
 )
 from testtools.content import text_content
 
+from allmydata.util.histogram import BUCKET_BOUNDS, Histogram, bucket_index
 from allmydata.web.status import Statistics
 from allmydata.test.common import SyncTestCase
 
@@ -125,6 +126,7 @@ class FakeStatsProvider(object):
                 "storage_server.latencies.read.samplesize": 170,
                 "storage_server.latencies.allocate.samplesize": 406,
                 "storage_server.latencies.allocate.95_0_percentile": 0.0008411407470703125,
+                "storage_server.latencies.add-lease.mean": 0.0002,
             },
             "counters": {
                 "storage_server.writev": 309,
@@ -136,10 +138,20 @@ class FakeStatsProvider(object):
                 "storage_server.write": 3775,
                 "storage_server.get": 472,
             },
+            "histograms": {
+                "storage_server.latencies.add-lease": _add_lease_histogram().get_stats(),
+            },
         }
         return stats
 
 
+def _add_lease_histogram():
+    histogram = Histogram()
+    for latency in (0.0001, 0.0002, 0.0002, 0.003, 200):
+        histogram.add(latency)
+    return histogram
+
+
 class HackItResource(Resource, object):
     """
     A bridge between ``RequestTraversalAgent`` and ``MultiFormatResource``
@@ -170,6 +182,47 @@ class OpenMetrics(SyncTestCase):
         d = rta.request(b"GET", b"http://localhost/?t=openmetrics")
         self.assertThat(d, succeeded(matches_stats(self)))
 
+    def test_histograms(self):
+        """
+        Histograms are rendered as OpenMetrics histograms, with cumulative
+        buckets and their count and sum.
+        """
+        root = HackItResource()
+        root.putChild(b"", Statistics(FakeStatsProvider()))
+        rta = RequestTraversalAgent(root)
+        d = rta.request(b"GET", b"http://localhost/?t=openmetrics")
+        d.addCallback(readBodyText)
+        d.addCallback(lambda body: dict(
+            (family.name, family)
+            for family in parser.text_string_to_metric_families(body)
+        ))
+        name = "tahoe_histograms_storage_server_latencies_add_lease"
+
+        def le(latency):
+            # the bound of the bucket holding latency
+            return str(BUCKET_BOUNDS[bucket_index(latency)])
+
+        def samples(families):
+            family = families[name]
+            return (family.type, dict(
+                (sample.name + sample.labels.get("le", ""), sample.value)
+                for sample in family.samples
+            ))
+
+        self.assertThat(d, succeeded(AfterPreprocessing(
+            samples,
+            MatchesAll(
+                AfterPreprocessing(lambda result: result[0], Equals("histogram")),
+                AfterPreprocessing(lambda result: (
+                    result[1][name + "_count"],
+                    result[1][name + "_bucket" + le(0.0001)],
+                    result[1][name + "_bucket" + le(0.0002)],
+                    result[1][name + "_bucket" + le(100)],
+                    result[1][name + "_bucket+Inf"],
+                ), Equals((5, 1, 3, 4, 5))),
+            ),
+        )))
+
 
 def matches_stats(testcase):
     """
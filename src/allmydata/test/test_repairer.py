@@ -13,7 +13,7 @@ if PY2:
 
 from allmydata.test import common
 from allmydata.monitor import Monitor
-from allmydata import check_results
+from allmydata import check_results, codec
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.immutable import upload
 from allmydata.util.consumer import download_to_data
@@ -522,6 +522,81 @@ class Repairer(GridTestMixin, unittest.TestCase, RepairTestMixin,
                       self.failUnlessEqual(newdata, common.TEST_DATA))
         return d
 
+    def _record_encoded_share_ids(self):
+        encoded = []
+        original_encode = codec.CRSEncoder.encode
+        def encode(encoder, inshares, desired_share_ids=None):
+            encoded.append(desired_share_ids)
+            return original_encode(encoder, inshares, desired_share_ids)
+        self.patch(codec.CRSEncoder, "encode", encode)
+        return encoded
+
+    def test_repair_generates_only_missing_shares(self):
+        """ Repair erasure-codes only the shares that it places on servers:
+        the missing ones, and any which server selection decided to move. """
+        self.basedir = "repairer/Repairer/repair_generates_only_missing_shares"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        d.addCallback(lambda ignored:
+                      self.delete_shares_numbered(self.uri, [4, 5]))
+        def _repair(ignored):
+            self.before = set((shnum, serverid) for (shnum, serverid, sharefile)
+                              in self.find_uri_shares(self.uri))
+            self.encoded = self._record_encoded_share_ids()
+            return self.c0_filenode.check_and_repair(Monitor(), verify=False)
+        d.addCallback(_repair)
+        def _check_results(crr):
+            self.failUnless(crr.get_repair_attempted())
+            self.failUnless(crr.get_post_repair_results().is_healthy())
+            after = set((shnum, serverid) for (shnum, serverid, sharefile)
+                        in self.find_uri_shares(self.uri))
+            placed = set(shnum for (shnum, serverid) in after - self.before)
+            self.failUnless(set([4, 5]).issubset(placed))
+            self.failUnless(self.encoded)
+            for share_ids in self.encoded:
+                self.failUnlessEqual(share_ids, sorted(placed))
+                self.failIfEqual(share_ids, list(range(10)))
+        d.addCallback(_check_results)
+
+        d.addCallback(lambda ignored:
+                      self.c0_filenode.check(Monitor(), verify=True))
+        d.addCallback(lambda vr: self.failUnless(vr.is_healthy()))
+        d.addCallback(lambda ignored:
+                      self.delete_shares_numbered(self.uri, [0, 1, 2, 3, 6, 7, 8]))
+        d.addCallback(lambda ignored: download_to_data(self.c1_filenode))
+        d.addCallback(lambda newdata:
+                      self.failUnlessEqual(newdata, common.TEST_DATA))
+        return d
+
+    def test_repair_with_bad_share_hashes(self):
+        """ If the share hash chain of the nearest existing share is bad,
+        repair regenerates the shares needed to rebuild the share hash tree
+        instead. """
+        self.basedir = "repairer/Repairer/repair_with_bad_share_hashes"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        d.addCallback(lambda ignored:
+                      self.delete_shares_numbered(self.uri, [2]))
+        # share 3 holds the other half of share 2's hash chain
+        d.addCallback(lambda ignored:
+                      self.corrupt_shares_numbered(self.uri, [3],
+                                                   common._corrupt_share_hashes))
+        def _repair(ignored):
+            self.encoded = self._record_encoded_share_ids()
+            return self.c0_filenode.check_and_repair(Monitor(), verify=False)
+        d.addCallback(_repair)
+        def _check_results(crr):
+            self.failUnless(crr.get_post_repair_results().is_healthy())
+            for share_ids in self.encoded:
+                self.failUnlessEqual(share_ids, list(range(10)))
+        d.addCallback(_check_results)
+        d.addCallback(lambda ignored:
+                      self.delete_shares_numbered(self.uri, [0, 1, 3, 4, 5, 6, 7]))
+        d.addCallback(lambda ignored: download_to_data(self.c1_filenode))
+        d.addCallback(lambda newdata:
+                      self.failUnlessEqual(newdata, common.TEST_DATA))
+        return d
+
     def test_repairer_servers_of_happiness(self):
         # The repairer is supposed to generate and place as many of the
         # missing shares as possible without caring about how they are
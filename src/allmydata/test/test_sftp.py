@@ -33,6 +33,7 @@ from allmydata.interfaces import IDirectoryNode, ExistingChildError, NoSuchChild
 from allmydata.mutable.common import NotWriteableError
 
 from allmydata.util.consumer import download_to_data
+from allmydata.util.fileutil import EncryptedTemporaryFile
 from allmydata.immutable import upload
 from allmydata.mutable import publish
 from allmydata.test.no_network import GridTestMixin
@@ -527,7 +528,9 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
 
         # check that failed downloads cause failed reads. Note that this
         # trashes the grid (by deleting all shares), so this must be at the
-        # end of the test function.
+        # end of the test function. The file has been read already, so
+        # forget what was fetched first.
+        d.addCallback(lambda ign: sftpd._reload())
         d.addCallback(lambda ign: self.handler.openFile(b"uri/"+self.gross_uri, sftp.FXF_READ, {}))
         def _read_broken(rf):
             d2 = defer.succeed(None)
@@ -569,6 +572,111 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    def test_openFile_read_ranges(self):
+        self.patch(sftpd.SparseFileCache, "BLOCK_SIZE", 100)
+        d = self._set_up("openFile_read_ranges")
+        d.addCallback(lambda ign: self._set_up_tree())
+
+        gross = u"gro\u00DF".encode("utf-8")
+        d.addCallback(lambda ign: self.handler.openFile(gross, sftp.FXF_READ, {}))
+        def _blocks():
+            return sftpd.all_file_caches[self.gross.get_readonly_uri()].blocks
+        def _read_end(rf):
+            d2 = rf.readChunk(1005, 10)
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, b"56789"))
+            # only the last block was downloaded
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(_blocks(), set([10])))
+
+            d2.addCallback(lambda ign: rf.readChunk(395, 10))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, b"5678901234"))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(_blocks(), set([3, 4, 10])))
+            d2.addCallback(lambda ign: rf.close())
+            return d2
+        d.addCallback(_read_end)
+
+        # another handle for the same file uses what has been downloaded
+        d.addCallback(lambda ign: self.handler.openFile(b"uri/"+self.gross_uri, sftp.FXF_READ, {}))
+        def _read_again(rf):
+            # reads of the same block at once share one download
+            d2 = deferredutil.gatherResults([rf.readChunk(0, 10), rf.readChunk(50, 10)])
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, [b"0123456789", b"0123456789"]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(_blocks(), set([0, 3, 4, 10])))
+            d2.addCallback(lambda ign: rf.close())
+            return d2
+        d.addCallback(_read_again)
+
+        # a handle opened for writing reads the blocks it needs, and the rest
+        # when it is closed after changing the file
+        d.addCallback(lambda ign: self.handler.openFile(gross, sftp.FXF_READ | sftp.FXF_WRITE, {}))
+        def _write(rwf):
+            d2 = rwf.writeChunk(498, b"abcd")
+            d2.addCallback(lambda ign: rwf.readChunk(495, 10))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, b"567abcd234"))
+            d2.addCallback(lambda ign: rwf.close())
+            # the rest was not added to the cache, since it is not read again
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(_blocks(), set([0, 3, 4, 5, 10])))
+            return d2
+        d.addCallback(_write)
+        d.addCallback(lambda ign: self.root.get(u"gro\u00DF"))
+        d.addCallback(lambda node: download_to_data(node))
+        d.addCallback(lambda data:
+                      self.failUnlessReallyEqual(data, b"0123456789"*49 + b"01234567abcd23456789" + b"0123456789"*50))
+        return d
+
+    def test_openFile_read_cache_limit(self):
+        self.patch(sftpd.SparseFileCache, "BLOCK_SIZE", 100)
+        self.patch(sftpd, "MAX_FILE_CACHE_BYTES", 250)
+        d = self._set_up("openFile_read_cache_limit")
+        d.addCallback(lambda ign: self._set_up_tree())
+
+        gross = u"gro\u00DF".encode("utf-8")
+        caches = []
+        d.addCallback(lambda ign: self.handler.openFile(gross, sftp.FXF_READ, {}))
+        def _read(rf):
+            d2 = rf.readChunk(0, 10)
+            d2.addCallback(lambda ign: rf.readChunk(395, 10))
+            def _in_use(ign):
+                # a cache in use is kept, however large it is
+                cache = sftpd.all_file_caches[self.gross.get_readonly_uri()]
+                self.failUnlessReallyEqual(cache.blocks, set([0, 3, 4]))
+                self.failUnlessReallyEqual(cache.users, 1)
+                caches.append(cache)
+            d2.addCallback(_in_use)
+            d2.addCallback(lambda ign: rf.close())
+            return d2
+        d.addCallback(_read)
+        def _released(ign):
+            self.failIfIn(self.gross.get_readonly_uri(), sftpd.all_file_caches)
+            self.failUnless(caches[0].is_closed)
+        d.addCallback(_released)
+
+        # a smaller cache is kept for the next handle after it is released
+        d.addCallback(lambda ign: self.handler.openFile(gross, sftp.FXF_READ, {}))
+        d.addCallback(lambda rf: rf.readChunk(0, 10).addCallback(lambda ign: rf.close()))
+        def _kept(ign):
+            cache = sftpd.all_file_caches[self.gross.get_readonly_uri()]
+            self.failUnlessReallyEqual(cache.blocks, set([0]))
+            self.failUnlessReallyEqual(cache.users, 0)
+            self.failIf(cache.is_closed)
+        d.addCallback(_kept)
+        return d
+
+    def test_sparse_file_cache_fetch_error(self):
+        class BrokenVersion(object):
+            def get_size(self):
+                return 1000
+            def read(self, consumer, offset, size):
+                return defer.fail(IOError("no shares"))
+
+        cache = sftpd.SparseFileCache(BrokenVersion(), EncryptedTemporaryFile)
+        self.addCleanup(cache.close)
+        d = self.shouldFail(IOError, "read", "no shares", cache.read, 0, 10)
+        # the blocks can be fetched again by a later read
+        d.addCallback(lambda ign: self.failUnlessReallyEqual(cache.fetching, {}))
+        d.addCallback(lambda ign: self.shouldFail(IOError, "read again", "no shares",
+                                                  cache.read, 0, 10))
+        return d
+
     def test_openFile_write(self):
         d = self._set_up("openFile_write")
         d.addCallback(lambda ign: self._set_up_tree())
@@ -56,6 +56,7 @@ from twisted.trial import unittest
 from twisted.internet.defer import (
     Deferred,
     inlineCallbacks,
+    succeed,
 )
 from twisted.python.filepath import (
     FilePath,
@@ -94,6 +95,8 @@ from allmydata.storage_client import (
     StorageFarmBroker,
     _FoolscapStorage,
     _NullStorage,
+    AddLeaseError,
+    batch_add_lease,
 )
 from ..storage.server import (
     StorageServer,
@@ -115,6 +118,90 @@ class NativeStorageServerWithVersion(NativeStorageServer):  # type: ignore  # ta
         return self.version
 
 
+@attr.s
+class LeaseRecordingStorageServer(object):
+    """
+    Just enough of an ``IStorageServer`` to record the lease calls it gets.
+    """
+    add_leases_error = attr.ib(default=None)
+    calls = attr.ib(default=attr.Factory(list))
+
+    def add_lease(self, storage_index, renew_secret, cancel_secret):
+        self.calls.append(("add_lease", storage_index))
+        return succeed(None)
+
+    def add_leases(self, leases):
+        self.calls.append(("add_leases", [l[0] for l in leases]))
+        return succeed([self.add_leases_error if l[0] == b"bad" else None
+                        for l in leases])
+
+
+@attr.s(eq=False)
+class LeaseRecordingServer(object):
+    """
+    Just enough of an ``IServer`` for ``batch_add_lease``.
+    """
+    storage_server = attr.ib()
+    batch_size = attr.ib()
+
+    def get_version(self):
+        v1 = {}
+        if self.batch_size:
+            v1[b"maximum-add-leases-batch-size"] = self.batch_size
+        return {b"http://allmydata.org/tahoe/protocols/storage/v1": v1}
+
+    def get_storage_server(self):
+        return self.storage_server
+
+
+class BatchAddLease(unittest.TestCase):
+    """
+    Tests for ``batch_add_lease``.
+    """
+    def _add_leases(self, server, storage_indexes):
+        return [batch_add_lease(server, si, b"r" * 32, b"c" * 32)
+                for si in storage_indexes]
+
+    @inlineCallbacks
+    def test_batched(self):
+        """
+        Leases added to one server during a reactor turn are sent in batches
+        no larger than the server accepts, and each lease gets its own
+        result.
+        """
+        storage_server = LeaseRecordingStorageServer(add_leases_error=b"KeyError: 'x'")
+        server = LeaseRecordingServer(storage_server, batch_size=2)
+        other_storage_server = LeaseRecordingStorageServer()
+        other_server = LeaseRecordingServer(other_storage_server, batch_size=2)
+        ds = self._add_leases(server, [b"a", b"bad", b"c"])
+        [other_d] = self._add_leases(other_server, [b"d"])
+        self.assertEqual(storage_server.calls, [])
+
+        yield ds[0]
+        yield ds[2]
+        yield other_d
+        with self.assertRaises(AddLeaseError):
+            yield ds[1]
+        self.assertEqual(storage_server.calls,
+                         [("add_leases", [b"a", b"bad"]),
+                          ("add_leases", [b"c"])])
+        # a lone lease is sent with add_lease
+        self.assertEqual(other_storage_server.calls, [("add_lease", b"d")])
+
+    @inlineCallbacks
+    def test_not_supported(self):
+        """
+        Servers which do not advertise ``add_leases`` get one ``add_lease``
+        call for each lease.
+        """
+        storage_server = LeaseRecordingStorageServer()
+        server = LeaseRecordingServer(storage_server, batch_size=0)
+        for d in self._add_leases(server, [b"a", b"b"]):
+            yield d
+        self.assertEqual(storage_server.calls,
+                         [("add_lease", b"a"), ("add_lease", b"b")])
+
+
 class TestNativeStorageServer(unittest.TestCase):
     def test_get_available_space_new(self):
         nss = NativeStorageServerWithVersion(
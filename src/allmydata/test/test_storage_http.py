@@ -15,17 +15,23 @@ if PY2:
     # fmt: on
 
 from base64 import b64encode
+from os import urandom
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock, LoopingCall
+from twisted.web import http
+from twisted.web.http_headers import Headers
 
 from hypothesis import assume, given, strategies as st
 from fixtures import Fixture, TempDir
 from treq.testing import StubTreq
 from klein import Klein
 from hyperlink import DecodedURL
+from collections_extended import RangeMap
 
 from .common import AsyncTestCase, SyncTestCase
 from ..storage.server import StorageServer
+from ..storage.common import si_b2a
 from ..storage.http_server import (
     HTTPServer,
     _extract_secrets,
@@ -33,7 +39,13 @@ from ..storage.http_server import (
     ClientSecretsException,
     _authorized_route,
 )
-from ..storage.http_client import StorageClient, ClientException
+from ..storage.http_client import (
+    StorageClient,
+    ClientException,
+    StorageClientImmutables,
+    ImmutableCreateResult,
+    UploadProgress,
+)
 
 
 def _post_process(params):
@@ -203,14 +215,23 @@ class HttpTestFixture(Fixture):
 
     def _setUp(self):
         self.tempdir = self.useFixture(TempDir())
-        self.storage_server = StorageServer(self.tempdir.path, b"\x00" * 20)
+        self.clock = Clock()
+        self.storage_server = StorageServer(
+            self.tempdir.path, b"\x00" * 20, clock=self.clock
+        )
         # TODO what should the swissnum _actually_ be?
         self.http_server = HTTPServer(self.storage_server, SWISSNUM_FOR_TEST)
+        self.treq = StubTreq(self.http_server.get_resource())
         self.client = StorageClient(
             DecodedURL.from_text("http://127.0.0.1"),
             SWISSNUM_FOR_TEST,
-            treq=StubTreq(self.http_server.get_resource()),
+            treq=self.treq,
         )
+        # Share data is streamed to the client by a producer driven by the
+        # reactor, and StubTreq only delivers it when flushed:
+        self._flusher = LoopingCall(self.treq.flush)
+        self._flusher.start(0.001)
+        self.addCleanup(self._flusher.stop)
 
 
 class GenericHTTPAPITests(AsyncTestCase):
@@ -263,3 +284,424 @@ class GenericHTTPAPITests(AsyncTestCase):
             b"maximum-immutable-share-size"
         )
         self.assertEqual(version, expected_version)
+
+
+class ImmutableHTTPAPITests(AsyncTestCase):
+    """
+    Tests for immutable upload/download APIs.
+    """
+
+    def setUp(self):
+        if PY2:
+            self.skipTest("Not going to bother supporting Python 2")
+        super(ImmutableHTTPAPITests, self).setUp()
+        self.http = self.useFixture(HttpTestFixture())
+        self.im_client = StorageClientImmutables(self.http.client)
+
+    @inlineCallbacks
+    def create_upload(self, share_numbers, length):
+        """
+        Create a write bucket on server, return:
+
+            (upload_secret, lease_secret, storage_index, result)
+        """
+        upload_secret = urandom(32)
+        lease_secret = urandom(32)
+        storage_index = urandom(16)
+        created = yield self.im_client.create(
+            storage_index,
+            share_numbers,
+            length,
+            upload_secret,
+            lease_secret,
+            lease_secret,
+        )
+        return (upload_secret, lease_secret, storage_index, created)
+
+    @inlineCallbacks
+    def test_upload_can_be_downloaded(self):
+        """
+        A single share can be uploaded in (possibly overlapping) chunks, and
+        then a random chunk can be downloaded, and it will match the original
+        file.
+        """
+        length = 100
+        expected_data = bytes(range(100))
+
+        (upload_secret, _, storage_index, created) = yield self.create_upload(
+            {1}, length
+        )
+        self.assertEqual(
+            created, ImmutableCreateResult(already_have=set(), allocated={1})
+        )
+
+        remaining = RangeMap()
+        remaining.set(True, 0, 100)
+
+        # Three writes: 10-19, 30-39, 50-59. This allows for a bunch of holes.
+        def write(offset, length):
+            remaining.empty(offset, offset + length)
+            return self.im_client.write_share_chunk(
+                storage_index,
+                1,
+                upload_secret,
+                offset,
+                expected_data[offset : offset + length],
+            )
+
+        upload_progress = yield write(10, 10)
+        self.assertEqual(
+            upload_progress, UploadProgress(finished=False, required=remaining)
+        )
+        upload_progress = yield write(30, 10)
+        self.assertEqual(
+            upload_progress, UploadProgress(finished=False, required=remaining)
+        )
+        upload_progress = yield write(50, 10)
+        self.assertEqual(
+            upload_progress, UploadProgress(finished=False, required=remaining)
+        )
+
+        # Then, an overlapping write with matching data (15-35):
+        upload_progress = yield write(15, 20)
+        self.assertEqual(
+            upload_progress, UploadProgress(finished=False, required=remaining)
+        )
+
+        # Now fill in the holes:
+        upload_progress = yield write(0, 10)
+        self.assertEqual(
+            upload_progress, UploadProgress(finished=False, required=remaining)
+        )
+        upload_progress = yield write(40, 10)
+        self.assertEqual(
+            upload_progress, UploadProgress(finished=False, required=remaining)
+        )
+        upload_progress = yield write(60, 40)
+        self.assertEqual(
+            upload_progress, UploadProgress(finished=True, required=RangeMap())
+        )
+
+        # We can now read:
+        for offset, length in [(0, 100), (10, 19), (99, 1), (49, 200)]:
+            downloaded = yield self.im_client.read_share_chunk(
+                storage_index, 1, offset, length
+            )
+            self.assertEqual(downloaded, expected_data[offset : offset + length])
+
+    @inlineCallbacks
+    def test_large_share_is_streamed(self):
+        """
+        Shares larger than the server's read/write chunk size can be uploaded
+        in one request and downloaded in one request.
+        """
+        length = 300 * 1024
+        expected_data = urandom(length)
+        (upload_secret, _, storage_index, _) = yield self.create_upload(
+            {0}, length
+        )
+        upload_progress = yield self.im_client.write_share_chunk(
+            storage_index, 0, upload_secret, 0, expected_data
+        )
+        self.assertTrue(upload_progress.finished)
+
+        downloaded = yield self.im_client.read_share_chunk(
+            storage_index, 0, 0, length
+        )
+        self.assertEqual(downloaded, expected_data)
+
+    @inlineCallbacks
+    def test_allocate_buckets_second_time_wrong_upload_key(self):
+        """
+        If allocate buckets endpoint is called second time with wrong upload
+        key on the same shares, the result is an error.
+        """
+        (upload_secret, lease_secret, storage_index, _) = yield self.create_upload(
+            {1, 2, 3}, 100
+        )
+        with self.assertRaises(ClientException) as e:
+            yield self.im_client.create(
+                storage_index, {2, 3}, 100, b"x" * 32, lease_secret, lease_secret
+            )
+        self.assertEqual(e.exception.args[0], http.UNAUTHORIZED)
+
+    @inlineCallbacks
+    def test_allocate_buckets_second_time_different_shares(self):
+        """
+        If allocate buckets endpoint is called second time with same upload
+        key on different shares, that creates the buckets.
+        """
+        (upload_secret, lease_secret, storage_index, _) = yield self.create_upload(
+            {1, 2, 3}, 100
+        )
+
+        # Add different shares:
+        created2 = yield self.im_client.create(
+            storage_index, {4, 6}, 100, upload_secret, lease_secret, lease_secret
+        )
+        self.assertEqual(created2.allocated, {4, 6})
+
+    @inlineCallbacks
+    def test_list_shares(self):
+        """
+        Once a share is finished uploading, it's possible to list it.
+        """
+        (upload_secret, _, storage_index, created) = yield self.create_upload(
+            {1, 2, 3}, 10
+        )
+
+        # Initially there are no shares:
+        self.assertEqual((yield self.im_client.list_shares(storage_index)), set())
+
+        # Upload shares 1 and 3:
+        for share_number in [1, 3]:
+            progress = yield self.im_client.write_share_chunk(
+                storage_index,
+                share_number,
+                upload_secret,
+                0,
+                b"0123456789",
+            )
+            self.assertTrue(progress.finished)
+
+        # Now shares 1 and 3 exist:
+        self.assertEqual((yield self.im_client.list_shares(storage_index)), {1, 3})
+
+    @inlineCallbacks
+    def test_upload_bad_content_range(self):
+        """
+        Malformed or invalid Content-Range headers to the immutable upload
+        endpoint result in a 400 error.
+        """
+        (upload_secret, _, storage_index, created) = yield self.create_upload(
+            {1}, 10
+        )
+
+        @inlineCallbacks
+        def check_invalid(bad_content_range_value):
+            response = yield self.http.client._request(
+                "PATCH",
+                self.http.client._url(
+                    "/v1/immutable/{}/1".format(str(si_b2a(storage_index), "ascii"))
+                ),
+                {Secrets.UPLOAD: upload_secret},
+                headers=Headers({"content-range": [bad_content_range_value]}),
+                data=b"01234",
+            )
+            self.assertEqual(response.code, http.BAD_REQUEST)
+
+        yield check_invalid("not a valid content-range header at all")
+        yield check_invalid("bytes -1-9/10")
+        # Body is shorter than the range claims:
+        yield check_invalid("bytes 0-9/10")
+
+    @inlineCallbacks
+    def test_list_shares_unknown_storage_index(self):
+        """
+        Listing unknown storage index's shares results in empty list of shares.
+        """
+        storage_index = b"".join(bytes([i]) for i in range(16))
+        self.assertEqual((yield self.im_client.list_shares(storage_index)), set())
+
+    @inlineCallbacks
+    def test_upload_non_existent_storage_index(self):
+        """
+        Uploading to a non-existent storage index or share number results in
+        404.
+        """
+        (upload_secret, _, storage_index, _) = yield self.create_upload({1}, 10)
+
+        @inlineCallbacks
+        def unknown_check(storage_index, share_number):
+            with self.assertRaises(ClientException) as e:
+                yield self.im_client.write_share_chunk(
+                    storage_index,
+                    share_number,
+                    upload_secret,
+                    0,
+                    b"0123456789",
+                )
+            self.assertEqual(e.exception.args[0], http.NOT_FOUND)
+
+        # Wrong share number:
+        yield unknown_check(storage_index, 7)
+        # Wrong storage index:
+        yield unknown_check(b"X" * 16, 7)
+
+    @inlineCallbacks
+    def test_multiple_shares_uploaded_to_different_place(self):
+        """
+        If a storage index has multiple shares, uploads to different shares are
+        stored separately and can be downloaded separately.
+        """
+        (upload_secret, _, storage_index, _) = yield self.create_upload({1, 2}, 10)
+        yield self.im_client.write_share_chunk(
+            storage_index,
+            1,
+            upload_secret,
+            0,
+            b"1" * 10,
+        )
+        yield self.im_client.write_share_chunk(
+            storage_index,
+            2,
+            upload_secret,
+            0,
+            b"2" * 10,
+        )
+        self.assertEqual(
+            (yield self.im_client.read_share_chunk(storage_index, 1, 0, 10)),
+            b"1" * 10,
+        )
+        self.assertEqual(
+            (yield self.im_client.read_share_chunk(storage_index, 2, 0, 10)),
+            b"2" * 10,
+        )
+
+    @inlineCallbacks
+    def test_mismatching_upload_fails(self):
+        """
+        If an uploaded chunk conflicts with an already uploaded chunk, a
+        CONFLICT error is returned.
+        """
+        (upload_secret, _, storage_index, created) = yield self.create_upload(
+            {1}, 100
+        )
+
+        # Write:
+        yield self.im_client.write_share_chunk(
+            storage_index,
+            1,
+            upload_secret,
+            0,
+            b"0" * 10,
+        )
+
+        # Conflicting write:
+        with self.assertRaises(ClientException) as e:
+            yield self.im_client.write_share_chunk(
+                storage_index,
+                1,
+                upload_secret,
+                0,
+                b"0123456789",
+            )
+        self.assertEqual(e.exception.args[0], http.CONFLICT)
+
+    @inlineCallbacks
+    def test_wrong_upload_secret_fails(self):
+        """
+        Writing or aborting with the wrong upload secret results in an
+        ``UNAUTHORIZED`` error.
+        """
+        (upload_secret, _, storage_index, _) = yield self.create_upload({1}, 10)
+        with self.assertRaises(ClientException) as e:
+            yield self.im_client.write_share_chunk(
+                storage_index, 1, b"wrong" * 4, 0, b"0123456789"
+            )
+        self.assertEqual(e.exception.args[0], http.UNAUTHORIZED)
+        with self.assertRaises(ClientException) as e:
+            yield self.im_client.abort_upload(storage_index, 1, b"wrong" * 4)
+        self.assertEqual(e.exception.args[0], http.UNAUTHORIZED)
+
+    @inlineCallbacks
+    def test_abort_upload(self):
+        """
+        An aborted upload can be restarted from scratch, possibly with
+        different data; aborting a finished upload fails with
+        ``NOT_ALLOWED``.
+        """
+        (upload_secret, lease_secret, storage_index, _) = yield self.create_upload(
+            {1}, 10
+        )
+        yield self.im_client.write_share_chunk(
+            storage_index, 1, upload_secret, 0, b"0" * 5
+        )
+        yield self.im_client.abort_upload(storage_index, 1, upload_secret)
+
+        # The bucket is gone:
+        with self.assertRaises(ClientException) as e:
+            yield self.im_client.write_share_chunk(
+                storage_index, 1, upload_secret, 5, b"0" * 5
+            )
+        self.assertEqual(e.exception.args[0], http.NOT_FOUND)
+
+        # Start again, with different data:
+        created = yield self.im_client.create(
+            storage_index, {1}, 10, upload_secret, lease_secret, lease_secret
+        )
+        self.assertEqual(created.allocated, {1})
+        progress = yield self.im_client.write_share_chunk(
+            storage_index, 1, upload_secret, 0, b"1" * 10
+        )
+        self.assertTrue(progress.finished)
+
+        with self.assertRaises(ClientException) as e:
+            yield self.im_client.abort_upload(storage_index, 1, upload_secret)
+        self.assertEqual(e.exception.args[0], http.NOT_ALLOWED)
+
+    @inlineCallbacks
+    def test_upload_timeout_removes_bucket(self):
+        """
+        If an upload times out, the server forgets about it.
+        """
+        (upload_secret, _, storage_index, _) = yield self.create_upload({1}, 10)
+        self.http.clock.advance(30 * 60 + 1)
+        with self.assertRaises(ClientException) as e:
+            yield self.im_client.write_share_chunk(
+                storage_index, 1, upload_secret, 0, b"0" * 10
+            )
+        self.assertEqual(e.exception.args[0], http.NOT_FOUND)
+        self.assertEqual(self.http.http_server._uploads, {})
+
+    @inlineCallbacks
+    def test_read_of_wrong_storage_index_fails(self):
+        """
+        Reading from unknown storage index results in 404.
+        """
+        with self.assertRaises(ClientException) as e:
+            yield self.im_client.read_share_chunk(b"1" * 16, 1, 0, 10)
+        self.assertEqual(e.exception.args[0], http.NOT_FOUND)
+
+    @inlineCallbacks
+    def test_read_with_no_range(self):
+        """
+        A read with no range returns the whole immutable.
+        """
+        (upload_secret, _, storage_index, _) = yield self.create_upload({1}, 100)
+        yield self.im_client.write_share_chunk(
+            storage_index,
+            1,
+            upload_secret,
+            0,
+            b"0123456789" * 10,
+        )
+        response = yield self.http.client._request(
+            "GET",
+            self.http.client._url(
+                "/v1/immutable/{}/1".format(str(si_b2a(storage_index), "ascii"))
+            ),
+            {},
+        )
+        self.assertEqual(response.code, http.OK)
+        body = yield response.content()
+        self.assertEqual(body, b"0123456789" * 10)
+
+    @inlineCallbacks
+    def test_read_with_multiple_ranges_is_rejected(self):
+        """
+        Only a single range may be requested at a time.
+        """
+        (upload_secret, _, storage_index, _) = yield self.create_upload({1}, 10)
+        yield self.im_client.write_share_chunk(
+            storage_index, 1, upload_secret, 0, b"0123456789"
+        )
+        response = yield self.http.client._request(
+            "GET",
+            self.http.client._url(
+                "/v1/immutable/{}/1".format(str(si_b2a(storage_index), "ascii"))
+            ),
+            {},
+            headers=Headers({"range": ["bytes=0-1,5-6"]}),
+        )
+        self.assertEqual(response.code, http.REQUESTED_RANGE_NOT_SATISFIABLE)
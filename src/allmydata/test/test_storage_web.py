@@ -638,6 +638,132 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_expire_age_share_index(self):
+        basedir = "storage/LeaseCrawler/expire_age_share_index"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           share_index=True)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        webstatus = StorageStatus(ss)
+
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+        def count_leases(si):
+            return len(list(_get_sharefile(si).get_leases()))
+
+        # expire the only lease of immutable_si_0, and one of the two leases
+        # of immutable_si_1 and mutable_si_3. Nothing in mutable_si_2 has
+        # expired, so that bucket should not even be looked at.
+        now = time.time()
+        for (si, renew_secret) in [(immutable_si_0, self.renew_secrets[0]),
+                                   (immutable_si_1, self.renew_secrets[1]),
+                                   (mutable_si_3, self.renew_secrets[4])]:
+            self.backdate_lease(_get_sharefile(si), renew_secret, now - 1000)
+            ss.update_share_index(si)
+
+        ss.setServiceParent(self.s)
+
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 1)
+            self.failUnlessEqual(count_leases(mutable_si_2), 1)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+
+            s = lc.get_state()
+            self.failUnless(s["index-driven"])
+            self.failUnlessEqual(s["expiring-buckets"], 3)
+            self.failUnlessEqual(s["expiring-buckets-processed"], 3)
+            rec = s["history"]["0"]["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 3)
+            self.failUnlessEqual(rec["examined-shares"], 3)
+            self.failUnlessEqual(rec["actual-buckets"], 1)
+            self.failUnlessEqual(rec["actual-shares"], 1)
+
+            # the index has been brought up to date, so nothing is left
+            # for the next cycle
+            share_index = ss.get_share_index()
+            self.failUnlessEqual(share_index.get_share_count(), 3)
+            cutoff = lc.get_expiration_cutoff(time.time())
+            self.failUnlessEqual(
+                share_index.get_expiring_buckets(cutoff, ("mutable", "immutable")),
+                [])
+        d.addCallback(_after_first_cycle)
+        d.addCallback(lambda ign: renderDeferred(webstatus))
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn(b" recovered: 1 shares, 1 buckets (0 mutable / 1 immutable), ", s)
+        d.addCallback(_check_html)
+        return d
+
+    def test_expire_age_share_index_many_shares(self):
+        # a bucket with several expiring shares is processed only once
+        basedir = "storage/LeaseCrawler/expire_age_share_index_many_shares"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           share_index=True)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.index_batch_size = 1
+
+        si = b"\x04" * 16
+        rs = hashutil.tagged_hash(b"renew", si)
+        cs = hashutil.tagged_hash(b"cancel", si)
+        a,w = ss.allocate_buckets(si, rs, cs, [0, 1, 2], 1000)
+        for shnum in (0, 1, 2):
+            w[shnum].write(0, b"\xff" * 1000)
+            w[shnum].close()
+        now = time.time()
+        for sf in ss._iter_share_files(si):
+            self.backdate_lease(sf, rs, now - 1000)
+        ss.update_share_index(si)
+        share_index = ss.get_share_index()
+        cutoff = lc.get_expiration_cutoff(now)
+        self.failUnlessEqual(
+            [s for (e, s) in share_index.get_expiring_buckets(
+                cutoff, ("mutable", "immutable"))],
+            [si])
+
+        ss.setServiceParent(self.s)
+
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(len(list(ss._iter_share_files(si))), 0)
+            s = lc.get_state()
+            self.failUnlessEqual(s["expiring-buckets"], 1)
+            self.failUnlessEqual(s["expiring-buckets-processed"], 1)
+            rec = s["history"]["0"]["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 1)
+            self.failUnlessEqual(rec["examined-shares"], 3)
+            self.failUnlessEqual(rec["actual-buckets"], 1)
+            self.failUnlessEqual(rec["actual-shares"], 3)
+            histogram = s["history"]["0"]["lease-age-histogram"]
+            self.failUnlessEqual(sum([count for (minage, maxage, count)
+                                      in histogram]), 3)
+        d.addCallback(_after_first_cycle)
+        return d
+
     def test_expire_cutoff_date(self):
         basedir = "storage/LeaseCrawler/expire_cutoff_date"
         fileutil.make_dirs(basedir)
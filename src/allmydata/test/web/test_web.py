@@ -75,6 +75,7 @@ from ..common_web import (
 from ...web.common import (
     humanize_exception,
 )
+from ...web.filenode import FileDownloader
 
 from allmydata.client import _Client, SecretHolder
 
@@ -1397,6 +1398,55 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got)
         return d
 
+    def _multipart_byteranges(self, headers, ranges):
+        ctype = headers.getRawHeaders("content-type")[0]
+        self.failUnless(ctype.startswith("multipart/byteranges; boundary="),
+                        ctype)
+        boundary = ctype.split("boundary=", 1)[1].encode("ascii")
+        length = len(self.BAR_CONTENTS)
+        return b"".join([b"\r\n--%s\r\n"
+                         b"Content-Type: text/plain\r\n"
+                         b"Content-Range: bytes %d-%d/%d\r\n\r\n%s"
+                         % (boundary, first, last, length,
+                            self.BAR_CONTENTS[first:last+1])
+                         for (first, last) in ranges] +
+                        [b"\r\n--%s--\r\n" % boundary])
+
+    @inlineCallbacks
+    def test_GET_FILEURL_multiple_ranges(self):
+        # overlapping ranges are merged, and the parts are sent in order
+        for read_gap in (FileDownloader.READ_GAP, 0):
+            self.patch(FileDownloader, "READ_GAP", read_gap)
+            (res, status, headers) = yield self.GET(
+                self.public_url + "/foo/bar.txt",
+                headers={"range": "bytes=12-14, 1-3,2-5"},
+                return_response=True)
+            self.failUnlessReallyEqual(int(status), 206)
+            self.failIf(headers.hasHeader("content-range"))
+            self.failUnlessReallyEqual(
+                res, self._multipart_byteranges(headers, [(1, 5), (12, 14)]))
+
+    @inlineCallbacks
+    def test_GET_FILEURL_multiple_ranges_one_satisfiable(self):
+        headers = {"range": "bytes=1-3,100-200"}
+        (res, status, headers) = yield self.GET(
+            self.public_url + "/foo/bar.txt", headers=headers,
+            return_response=True)
+        self.failUnlessReallyEqual(int(status), 206)
+        self.failUnlessReallyEqual(headers.getRawHeaders("content-range")[0],
+                                   "bytes 1-3/%d" % len(self.BAR_CONTENTS))
+        self.failUnlessReallyEqual(res, self.BAR_CONTENTS[1:4])
+
+    @inlineCallbacks
+    def test_HEAD_FILEURL_multiple_ranges(self):
+        headers = {"range": "bytes=1-3,12-"}
+        (res, status, headers) = yield self.HEAD(
+            self.public_url + "/foo/bar.txt", headers=headers,
+            return_response=True)
+        self.failUnlessReallyEqual(int(status), 206)
+        self.failUnless(headers.getRawHeaders("content-type")[0].startswith(
+            "multipart/byteranges; boundary="))
+
     def test_HEAD_FILEURL(self):
         d = self.HEAD(self.public_url + "/foo/bar.txt", return_response=True)
         def _got(res_and_status_and_headers):
@@ -1776,7 +1826,8 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         target = self.public_url + "/foo/new.txt"
         d = self.shouldFail2(error.Error, "test_PUT_NEWFILEURL_range_bad",
                              "501 Not Implemented",
-                             "Content-Range in PUT not yet supported",
+                             "Content-Range in PUT is only supported for"
+                             " existing mutable files",
                              # (and certainly not for immutable files)
                              self.PUT, target, self.NEWFILE_CONTENTS[1:11],
                              headers=headers)
@@ -1835,6 +1886,49 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
                   "to not replace it")
         return d
 
+    def test_PUT_NEWFILEURL_not_convergent(self):
+        # the body is large enough to arrive in several pieces, and to be
+        # paused while it is being uploaded
+        contents = b"".join(b"%d\n" % i for i in range(300000))
+        d = self.PUT(self.public_url + "/foo/new.txt?convergent=false",
+                     contents)
+        d.addCallback(self.failUnlessURIMatchesROChild, self._foo_node, u"new.txt")
+        d.addCallback(lambda res:
+                      self.failUnlessChildContentsAre(self._foo_node, u"new.txt",
+                                                      contents))
+        return d
+
+    def test_PUT_NEWFILEURL_not_convergent_no_replace(self):
+        # the error is known before the body has been received, which is
+        # then discarded
+        d = self.PUT(self.public_url + "/foo/bar.txt?convergent=false&replace=false",
+                     b"x" * 3000000)
+        d.addBoth(self.shouldFail, error.Error,
+                  "PUT_NEWFILEURL_not_convergent_no_replace",
+                  "409 Conflict",
+                  "There was already a child by that name, and you asked me "
+                  "to not replace it")
+        d.addCallback(lambda ign:
+                      self.failUnlessChildContentsAre(self._foo_node, u"bar.txt",
+                                                      self.BAR_CONTENTS))
+        return d
+
+    def test_PUT_NEWFILEURL_mutable_not_convergent(self):
+        d = self.shouldFail2(error.Error, "PUT_NEWFILEURL_mutable_not_convergent",
+                             "400 Bad Request",
+                             "convergent=false is only for immutable files",
+                             self.PUT,
+                             self.public_url + "/foo/new.txt?mutable=true&convergent=false",
+                             self.NEWFILE_CONTENTS)
+        d.addCallback(lambda ign:
+                      self.shouldFail2(error.Error, "PUT_MUTABLEFILE_not_convergent",
+                                       "400 Bad Request",
+                                       "convergent=false is only for immutable files",
+                                       self.PUT,
+                                       self.public_url + "/foo/baz.txt?convergent=false",
+                                       self.NEWFILE_CONTENTS))
+        return d
+
     def test_PUT_NEWFILEURL_mkdirs(self):
         d = self.PUT(self.public_url + "/foo/newdir/new.txt", self.NEWFILE_CONTENTS)
         fn = self._foo_node
@@ -3839,6 +3933,53 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
     def test_POST_set_children_with_hyphen(self):
         return self.test_POST_set_children(command_name="set-children")
 
+    @inlineCallbacks
+    def test_POST_edit(self):
+        """
+        t=edit applies a list of edits, and reports the result of each.
+        """
+        contents, n, newuri = self.makefile(9)
+        reqbody = json.dumps([
+            {"op": "set", "name": "new.txt", "rw_uri": str(newuri, "ascii"),
+             "metadata": {"key": "value"}},
+            {"op": "rename", "from_name": "bar.txt", "to_name": "renamed.txt"},
+            {"op": "delete", "name": "missing"},
+            {"op": "set", "name": "baz.txt", "rw_uri": str(newuri, "ascii"),
+             "replace": False},
+            {"op": "delete", "name": "quux.txt"},
+        ]).encode("utf-8")
+        url = self.webish_url + self.public_url + "/foo?t=edit"
+        res = yield do_http("post", url, data=reqbody)
+        results = json.loads(res)
+        self.assertEqual([r["success"] for r in results],
+                         [True, True, False, False, True])
+        self.assertEqual(results[2]["error"], "NoSuchChildError")
+        self.assertEqual(results[3]["error"], "ExistingChildError")
+
+        children = yield self._foo_node.list()
+        self.failUnlessURIMatchesROChild(newuri, self._foo_node, u"new.txt")
+        self.assertEqual(children[u"new.txt"][1]["key"], "value")
+        self.failUnlessURIMatchesROChild(self._bar_txt_uri, self._foo_node,
+                                         u"renamed.txt")
+        self.assertNotIn(u"bar.txt", children)
+        self.assertNotIn(u"quux.txt", children)
+        self.assertEqual(children[u"baz.txt"][0].get_uri(), self._baz_txt_uri)
+
+    @inlineCallbacks
+    def test_POST_edit_bad(self):
+        """
+        t=edit rejects edits it does not understand, without applying any.
+        """
+        reqbody = json.dumps([
+            {"op": "delete", "name": "bar.txt"},
+            {"op": "frobnicate", "name": "baz.txt"},
+        ]).encode("utf-8")
+        url = self.webish_url + self.public_url + "/foo?t=edit"
+        yield self.shouldFail2(error.Error, "test_POST_edit_bad",
+                               "400 Bad Request", "unknown edit",
+                               do_http, "post", url, data=reqbody)
+        self.failUnlessNodeHasChild(self._foo_node, u"bar.txt")
+
     def test_POST_link_uri(self):
         contents, n, newuri = self.makefile(8)
         d = self.POST(self.public_url + "/foo", t="uri", name="new.txt", uri=newuri)
@@ -4527,6 +4668,15 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check2)
         return d
 
+    def test_PUT_NEWFILE_URI_not_convergent(self):
+        file_contents = b"New file contents here\n" * 1000
+        d = self.PUT("/uri?convergent=false", file_contents)
+        def _check(uri):
+            self.failUnlessReallyEqual(self.get_all_contents()[uri],
+                                       file_contents)
+        d.addCallback(_check)
+        return d
+
     def test_PUT_NEWFILE_URI_not_mutable(self):
         file_contents = b"New file contents here\n"
         d = self.PUT("/uri?mutable=false", file_contents)
@@ -4672,6 +4822,63 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         yield self.assertHTTPError(url, 400, "immutable",
                                    method="put", data=b"foo")
 
+    @inlineCallbacks
+    def test_PUT_update_content_range(self):
+        file_contents = b"test file" * 100000 # about 900 KiB
+        filecap = yield self.PUT("/uri?format=mdmf", file_contents)
+        headers = {"content-range": "bytes 200000-200004/*"}
+        yield self.PUT("/uri/%s" % str(filecap, "utf-8"), b"hello",
+                       headers=headers)
+        n = self.s.create_node_from_uri(filecap)
+        results = yield n.download_best_version()
+        self.failUnlessEqual(results, file_contents[:200000] + b"hello" +
+                             file_contents[200005:])
+
+    @inlineCallbacks
+    def test_PUT_content_range_convergent_false(self):
+        # convergent=false would otherwise stream the body to the uploader,
+        # but a ranged write needs all of it first, so these are rejected
+        # just as they are without convergent=false
+        headers = {"content-range": "bytes 5-9/*"}
+        filecap = yield self.PUT("/uri", b"Test file" * 100000)
+        url = self.webish_url + "/uri/%s?convergent=false" % str(filecap, "utf-8")
+        yield self.assertHTTPError(url, 400, "immutable",
+                                   method="put", data=b"hello",
+                                   headers=headers)
+        url = self.webish_url + self.public_url + "/foo/bar.txt?convergent=false"
+        yield self.assertHTTPError(url, 400, "immutable",
+                                   method="put", data=b"hello",
+                                   headers=headers)
+        url = self.webish_url + self.public_url + "/foo/new.txt?convergent=false"
+        yield self.assertHTTPError(url, 501,
+                                   "Content-Range in PUT is only supported for"
+                                   " existing mutable files",
+                                   method="put", data=b"hello",
+                                   headers=headers)
+
+    @inlineCallbacks
+    def test_PUT_update_content_range_bad(self):
+        filecap = yield self.PUT("/uri?format=mdmf", b"test file" * 1000)
+        url = self.webish_url + "/uri/%s" % str(filecap, "utf-8")
+        yield self.assertHTTPError(url, 400, "Bad Content-Range header",
+                                   method="put", data=b"hello",
+                                   headers={"content-range": "bytes 10-/*"})
+        yield self.assertHTTPError(url, 400, "body does not match",
+                                   method="put", data=b"hello",
+                                   headers={"content-range": "bytes 10-20/*"})
+        yield self.assertHTTPError(url + "?offset=10", 400,
+                                   "cannot both be given",
+                                   method="put", data=b"hello",
+                                   headers={"content-range": "bytes 10-14/*"})
+
+    @inlineCallbacks
+    def test_PUT_update_content_range_immutable(self):
+        filecap = yield self.PUT("/uri", b"Test file" * 100000)
+        url = self.webish_url + "/uri/%s" % str(filecap, "utf-8")
+        yield self.assertHTTPError(url, 400, "immutable",
+                                   method="put", data=b"foo",
+                                   headers={"content-range": "bytes 5-7/*"})
+
     @inlineCallbacks
     def test_bad_method(self):
         url = self.webish_url + self.public_url + "/foo/bar.txt"
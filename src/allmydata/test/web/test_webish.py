@@ -38,6 +38,9 @@ from testtools.matchers import (
     IsInstance,
     HasLength,
 )
+from testtools.twistedsupport import (
+    succeeded,
+)
 
 from twisted.python.runtime import (
     platform,
@@ -48,6 +51,9 @@ from twisted.python.filepath import (
 from twisted.web.test.requesthelper import (
     DummyChannel,
 )
+from twisted.internet.testing import (
+    StringTransport,
+)
 from twisted.web.resource import (
     Resource,
 )
@@ -57,6 +63,7 @@ from ..common import (
 )
 
 from ...webish import (
+    StreamingRequestBody,
     TahoeLAFSRequest,
     TahoeLAFSSite,
 )
@@ -341,6 +348,74 @@ class TahoeLAFSSiteTests(SyncTestCase):
         """
         self._large_request_test(request_body_size)
 
+    def test_request_line(self):
+        """
+        The channel built by ``TahoeLAFSSite`` gives each request its request
+        line before the request body arrives.
+        """
+        site = TahoeLAFSSite(self.mktemp(), Resource(), logPath=self.mktemp())
+        channel = site.buildProtocol(None)
+        channel.makeConnection(StringTransport())
+        channel.dataReceived(
+            b"POST /foo?bar=baz HTTP/1.1\r\n"
+            b"Content-Length: 10\r\n"
+            b"\r\n"
+            b"01234"
+        )
+        self.assertThat(
+            channel.requests,
+            HasLength(1),
+        )
+        self.assertThat(
+            channel.requests[0].request_line,
+            Equals((b"POST", b"/foo?bar=baz", b"HTTP/1.1")),
+        )
+        channel.connectionLost(None)
+
+
+class FlowControlChannel(object):
+    """
+    Just enough of an ``HTTPChannel`` to see how a ``StreamingRequestBody``
+    throttles it.
+    """
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class StreamingRequestBodyTests(SyncTestCase):
+    """
+    Tests for ``StreamingRequestBody``.
+    """
+    def test_flow_control(self):
+        """
+        ``StreamingRequestBody`` pauses its channel while it holds
+        ``buffer_size`` bytes that have not been read, and resumes it once
+        they are.
+        """
+        channel = FlowControlChannel()
+        size = StreamingRequestBody.buffer_size * 2
+        body = StreamingRequestBody(channel, size)
+        body.write(b"x" * (StreamingRequestBody.buffer_size - 1))
+        self.assertThat(channel.paused, Equals(False))
+        body.write(b"x")
+        self.assertThat(channel.paused, Equals(True))
+
+        self.assertThat(
+            body.read(StreamingRequestBody.buffer_size),
+            succeeded(
+                AfterPreprocessing(
+                    b"".join,
+                    HasLength(StreamingRequestBody.buffer_size),
+                ),
+            ),
+        )
+        self.assertThat(channel.paused, Equals(False))
+
 
 def param(name, value):
     return u"; {}={}".format(name, value)
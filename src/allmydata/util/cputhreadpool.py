@@ -0,0 +1,124 @@
+"""
+A thread pool for CPU-bound work (erasure coding, hashing) that would
+otherwise block the reactor.
+
+The pool is disabled by default, in which case ``defer_to_thread`` simply
+runs the function synchronously, preserving the historical behavior.  It is
+enabled by calling ``set_max_threads`` with a positive number, which the
+client does based on the ``[client]cpu-threads`` setting in ``tahoe.cfg``.
+
+zfec and ``hashlib`` both release the GIL while they work on large buffers,
+so segments processed in the pool can make progress on several cores at
+once.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import multiprocessing
+
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+# The currently running pool, or None if CPU work is done inline.
+_pool = None
+
+
+def default_max_threads():
+    """
+    :return int: the number of threads used when ``cpu-threads = auto``,
+        which is the number of CPUs available to this process.
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def parse_max_threads(value):
+    """
+    Parse the value of the ``[client]cpu-threads`` setting.
+
+    :param str value: ``"auto"``, or a non-negative integer.
+
+    :return int: the number of threads to use, 0 meaning "disabled".
+
+    :raise ValueError: if the value is not understood.
+    """
+    value = value.strip().lower()
+    if value == "auto":
+        return default_max_threads()
+    threads = int(value)
+    if threads < 0:
+        raise ValueError("cpu-threads must be 'auto' or >= 0, not %d" % (threads,))
+    return threads
+
+
+def set_max_threads(max_threads, reactor=None):
+    """
+    Configure the CPU thread pool.
+
+    :param int max_threads: the maximum number of worker threads.  0
+        disables the pool, so CPU-bound work runs in the reactor thread.
+
+    :param reactor: the reactor whose shutdown stops the pool; defaults to
+        the global reactor.
+    """
+    global _pool
+    if reactor is None:
+        from twisted.internet import reactor
+    if _pool is not None:
+        if max_threads and _pool.max == max_threads:
+            return
+        _pool.stop()
+        _pool = None
+    if max_threads <= 0:
+        return
+    _pool = ThreadPool(minthreads=0, maxthreads=max_threads, name="tahoe-cpu")
+    _pool.start()
+    reactor.addSystemEventTrigger("during", "shutdown", _stop, _pool)
+
+
+def _stop(pool):
+    """
+    Stop ``pool`` at reactor shutdown, unless it was already replaced.
+    """
+    global _pool
+    if _pool is pool:
+        _pool = None
+    if pool.started:
+        pool.stop()
+
+
+def get_max_threads():
+    """
+    :return int: the current maximum number of worker threads, 0 if the
+        pool is disabled.
+    """
+    return 0 if _pool is None else _pool.max
+
+
+def defer_to_thread(f, *args, **kwargs):
+    """
+    Run ``f(*args, **kwargs)`` in the CPU thread pool.
+
+    ``f`` must not touch Twisted or any other state shared with the reactor
+    thread: it should be a pure function of its arguments.
+
+    :return Deferred: fires with the result of ``f``.  If the pool is
+        disabled, ``f`` is called synchronously and the Deferred has already
+        fired.
+    """
+    if _pool is None:
+        return defer.maybeDeferred(f, *args, **kwargs)
+    from twisted.internet import reactor
+    return deferToThreadPool(reactor, _pool, f, *args, **kwargs)
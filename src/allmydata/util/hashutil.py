@@ -75,6 +75,33 @@ def tagged_pair_hash(tag, val1, val2, truncate_to=None):
     s.update(netstring(val2))
     return s.digest()
 
+def tagged_hashes(tag, values, truncate_to=None):
+    """
+    Return a list of tagged_hash(tag, value) for each of values, hashing the
+    tag only once.
+    """
+    prefix = hashlib.sha256(netstring(tag))
+    sha256 = hashlib.sha256
+    digests = []
+    for value in values:
+        assert isinstance(value, bytes)  # no unicode
+        h = prefix.copy()
+        h.update(value)
+        digest = sha256(h.digest()).digest()
+        if truncate_to:
+            digest = digest[:truncate_to]
+        digests.append(digest)
+    return digests
+
+
+def tagged_pair_hashes(tag, pairs, truncate_to=None):
+    """
+    Return a list of tagged_pair_hash(tag, val1, val2) for each (val1, val2)
+    of pairs, hashing the tag only once.
+    """
+    return tagged_hashes(tag, [netstring(val1) + netstring(val2)
+                               for (val1, val2) in pairs], truncate_to)
+
 # specific hash tags that we use
 
 
@@ -122,6 +149,10 @@ def block_hash(data):
     return tagged_hash(BLOCK_TAG, data)
 
 
+def block_hashes(blocks):
+    return tagged_hashes(BLOCK_TAG, blocks)
+
+
 def block_hasher():
     return tagged_hasher(BLOCK_TAG)
 
@@ -312,5 +343,12 @@ def backupdb_dirhash(contents):
     return tagged_hash(BACKUPDB_DIRHASH_TAG, contents)
 
 
+BACKUPDB_FILEHASH_TAG = b"allmydata_backupdb_filehash_v1"
+
+
+def backupdb_filehasher():
+    return tagged_hasher(BACKUPDB_FILEHASH_TAG)
+
+
 def permute_server_hash(peer_selection_index, server_permutation_seed):
     return hashlib.sha1(peer_selection_index + server_permutation_seed).digest()
@@ -0,0 +1,143 @@
+"""
+Fixed-memory histograms with logarithmic buckets, for latencies.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import math
+
+# The exponent (in half-powers of two) of the upper bound of the first
+# bucket, and the number of bounded buckets. The bounds are sqrt(2) apart,
+# from about 7.6us to 128s; a final bucket holds anything slower.
+FIRST_EXPONENT = -34
+NUM_BOUNDS = 49
+BUCKET_BOUNDS = tuple(2 ** ((FIRST_EXPONENT + i) / 2)
+                      for i in range(NUM_BOUNDS))
+
+
+def bucket_index(value):
+    """Return the index of the bucket which holds value: that of the first
+    bound which is at least value, or NUM_BOUNDS if value is larger than all
+    of them."""
+    if value <= BUCKET_BOUNDS[0]:
+        return 0
+    i = int(math.ceil(2 * math.log(value, 2))) - FIRST_EXPONENT
+    # correct for rounding errors in the logarithm, which can put i one
+    # bucket either side of the right one (even at either end)
+    i = max(1, min(i, NUM_BOUNDS))
+    if value <= BUCKET_BOUNDS[i-1]:
+        return i - 1
+    if i < NUM_BOUNDS and value > BUCKET_BOUNDS[i]:
+        return i + 1
+    return i
+
+
+class Histogram(object):
+    """I count values in buckets whose bounds are BUCKET_BOUNDS, and keep
+    their total, so I use the same small amount of memory however many
+    values I have seen."""
+
+    def __init__(self):
+        self.buckets = [0] * (NUM_BOUNDS + 1)
+        self.count = 0
+        self.sum = 0
+
+    def add(self, value):
+        self.buckets[bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def update(self, other):
+        """Add in all the values counted by another Histogram."""
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.sum += other.sum
+
+    def clear(self):
+        self.buckets = [0] * (NUM_BOUNDS + 1)
+        self.count = 0
+        self.sum = 0
+
+    def quantile(self, q):
+        """Estimate the value below which the fraction q of my values fall,
+        assuming the values in each bucket are spread evenly across it, or
+        return None if I have no values. Values beyond the last bound are
+        taken to be equal to it."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                lower = BUCKET_BOUNDS[i-1] if i else 0
+                if i == NUM_BOUNDS:
+                    return lower
+                upper = BUCKET_BOUNDS[i]
+                return lower + (upper - lower) * max(0, rank - seen) / n
+            seen += n
+        return BUCKET_BOUNDS[-1]
+
+    def get_stats(self):
+        """Return a dict of my cumulative bucket counts, in the form used by
+        OpenMetrics and Prometheus: "buckets" is a list of (bound, number
+        of values no greater than bound) pairs, the last with a bound of
+        None for +Inf, and "count" and "sum" are the number and total of all
+        my values."""
+        buckets = []
+        seen = 0
+        for bound, n in zip(BUCKET_BOUNDS + (None,), self.buckets):
+            seen += n
+            buckets.append((bound, seen))
+        return {"buckets": buckets, "count": self.count, "sum": self.sum}
+
+
+class WindowedHistogram(object):
+    """I keep a Histogram of every value ever added to me, as well as one of
+    the values added in each of the last few intervals, which together make
+    a sliding window over the recent past. Slots for intervals which have
+    gone by are reused, so my memory use is fixed."""
+
+    INTERVAL = 60 # seconds
+    SLOTS = 10
+
+    def __init__(self, clock):
+        self._clock = clock
+        self.cumulative = Histogram()
+        self._slots = [Histogram() for i in range(self.SLOTS)]
+        self._current = self._interval_number()
+
+    def _interval_number(self):
+        return int(self._clock.seconds() // self.INTERVAL)
+
+    def _advance(self):
+        now = self._interval_number()
+        if now <= self._current:
+            return
+        # empty the slots of the intervals which have begun since the last
+        # value was added, at most all of them
+        for n in range(max(self._current + 1, now - self.SLOTS + 1), now + 1):
+            self._slots[n % self.SLOTS].clear()
+        self._current = now
+
+    def add(self, value):
+        self._advance()
+        self.cumulative.add(value)
+        self._slots[self._current % self.SLOTS].add(value)
+
+    def window(self):
+        """Return a new Histogram of the values added during the current
+        interval and the SLOTS-1 before it."""
+        self._advance()
+        window = Histogram()
+        for slot in self._slots:
+            window.update(slot)
+        return window
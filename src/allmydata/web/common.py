@@ -82,8 +82,10 @@ from allmydata.interfaces import (
     NotEnoughSharesError,
     MDMF_VERSION,
     SDMF_VERSION,
+    IUploadable,
 )
 from allmydata.mutable.common import UnrecoverableFileError
+from allmydata.immutable.upload import FileHandle
 from allmydata.util.time_format import (
     format_delta,
     format_time,
@@ -165,6 +167,29 @@ def get_mutable_type(file_format): # accepts result of get_format()
         #      do_immutable()
         return None
 
+def get_immutable_uploadable(req, client):
+    """
+    Return an IUploadable for the body of a request that uploads an immutable
+    file. With ``convergent=false`` the file is encrypted with a random key,
+    and the request may be passing its body to the upload as it arrives (see
+    ``webish.StreamingRequestBody``).
+    """
+    if IUploadable.providedBy(req.content):
+        return req.content
+    convergence = client.convergence
+    if not boolean_of_arg(get_arg(req, "convergent", "true")):
+        convergence = None
+    return FileHandle(req.content, convergence=convergence)
+
+def check_mutable_upload(req):
+    """
+    Refuse ``convergent=false`` for a request that uploads a mutable file:
+    it only makes sense for immutable files.
+    """
+    if not boolean_of_arg(get_arg(req, "convergent", "true")):
+        raise WebError("convergent=false is only for immutable files",
+                       http.BAD_REQUEST)
+
 
 def parse_offset_arg(offset):  # type: (bytes) -> Union[int,None]
     # XXX: This will raise a ValueError when invoked on something that
@@ -178,6 +203,30 @@ def parse_offset_arg(offset):  # type: (bytes) -> Union[int,None]
     return offset
 
 
+def parse_content_range_header(content_range):  # type: (str) -> Tuple[int,int]
+    """
+    Parse the Content-Range header of a PUT, "bytes first-last/length" or
+    "bytes first-last/*", into an inclusive (first, last) tuple. The complete
+    length is not checked, since a write may extend the file.
+
+    :raise WebError: if the header does not describe a byte range.
+    """
+    try:
+        units, rest = content_range.strip().split(" ", 1)
+        if units != "bytes":
+            raise ValueError
+        byte_range, length = rest.strip().split("/", 1)
+        first, last = byte_range.split("-", 1)
+        first, last = int(first), int(last)
+        if length != "*":
+            int(length)
+        if first < 0 or last < first:
+            raise ValueError
+    except ValueError:
+        raise WebError("Bad Content-Range header: %s" % content_range)
+    return (first, last)
+
+
 def get_root(req):  # type: (IRequest) -> str
     """
     Get a relative path with parent directory segments that refers to the root
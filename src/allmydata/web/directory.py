@@ -321,6 +321,8 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
             d = self._POST_stream_manifest(req)
         elif t == "set_children" or t == "set-children":
             d = self._POST_set_children(req)
+        elif t == "edit":
+            d = self._POST_edit(req)
         else:
             raise WebError("POST to a directory with bad t=%s" % t)
 
@@ -656,6 +658,83 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         # TODO: results
         return d
 
+    def _POST_edit(self, req):
+        replace = parse_replace_arg(get_arg(req, "replace", "true"))
+        req.content.seek(0)
+        body = req.content.read()
+        try:
+            ops = json.loads(body)
+        except ValueError:
+            raise WebError("t=edit requires a JSON list of edits",
+                           http.BAD_REQUEST)
+        if not isinstance(ops, list):
+            raise WebError("t=edit requires a JSON list of edits",
+                           http.BAD_REQUEST)
+        edits = [self._parse_edit(op, replace) for op in ops]
+        d = self.node.apply_edits(edits)
+        def _done(results):
+            req.setHeader("content-type", "application/json")
+            return json.dumps([_edit_result(e) for e in results],
+                              indent=1) + "\n"
+        d.addCallback(_done)
+        return d
+
+    def _parse_edit(self, op, default_replace):
+        """
+        Convert one edit from the body of a t=edit request into the form
+        taken by ``IDirectoryNode.apply_edits``.
+        """
+        def _name(key):
+            name = op.get(key) if isinstance(op, dict) else None
+            if not isinstance(name, str):
+                raise WebError("each edit needs a %s= string" % (key,),
+                               http.BAD_REQUEST)
+            return name
+
+        def _replace():
+            replace = op.get("replace")
+            if replace is None:
+                return default_replace
+            if isinstance(replace, bool):
+                return replace
+            return parse_replace_arg(str(replace).encode("utf-8"))
+
+        kind = op.get("op") if isinstance(op, dict) else None
+        if kind == "set":
+            name = _name("name")
+            writecap = to_bytes(op.get("rw_uri"))
+            readcap = to_bytes(op.get("ro_uri"))
+            # any problem with the caps is reported as the result of this
+            # edit, rather than failing them all
+            child = self.client.nodemaker.create_from_cap(writecap, readcap,
+                                                          name=name)
+            return ("set", name, child, op.get("metadata"), _replace())
+        if kind == "delete":
+            return ("delete", _name("name"))
+        if kind == "rename":
+            from_name = _name("from_name")
+            to_name = _name("to_name")
+            # as for t=rename
+            if "/" in from_name or "/" in to_name:
+                raise WebError("from_name= and to_name= may not contain a slash",
+                               http.BAD_REQUEST)
+            return ("rename", from_name, to_name, _replace())
+        raise WebError("unknown edit %r: op= must be one of set, delete or"
+                       " rename" % (kind,), http.BAD_REQUEST)
+
+
+def _edit_result(exception):
+    """
+    Describe the result of one edit of a t=edit request.
+    """
+    if exception is None:
+        return {"success": True}
+    (text, code) = humanize_exception(exception)
+    return {"success": False,
+            "error": exception.__class__.__name__,
+            "message": text}
+
+
 def abbreviated_dirnode(dirnode):
     u = from_string_dirnode(dirnode.get_uri())
     return u.abbrev_si()
@@ -14,6 +14,8 @@ if PY2:
     from past.builtins import unicode as str
 from past.builtins import long
 
+import os
+
 from twisted.web import http, static
 from twisted.internet import defer
 from twisted.web.resource import (
@@ -21,7 +23,7 @@ from twisted.web.resource import (
     ErrorPage,
 )
 
-from allmydata.interfaces import ExistingChildError
+from allmydata.interfaces import ExistingChildError, DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.monitor import Monitor
 from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
@@ -40,6 +42,9 @@ from allmydata.web.common import (
     get_filenode_metadata,
     get_format,
     get_mutable_type,
+    get_immutable_uploadable,
+    check_mutable_upload,
+    parse_content_range_header,
     parse_offset_arg,
     parse_replace_arg,
     render_exception,
@@ -63,6 +68,7 @@ class ReplaceMeMixin(object):
         file_format = get_format(req, "CHK")
         mutable_type = get_mutable_type(file_format)
         if mutable_type is not None:
+            check_mutable_upload(req)
             data = MutableFileHandle(req.content)
             d = client.create_mutable_file(data, version=mutable_type)
             def _uploaded(newnode):
@@ -73,7 +79,7 @@ class ReplaceMeMixin(object):
             d.addCallback(_uploaded)
         else:
             assert file_format == "CHK"
-            uploadable = FileHandle(req.content, convergence=client.convergence)
+            uploadable = get_immutable_uploadable(req, client)
             d = self.parentnode.add_file(self.name, uploadable,
                                          overwrite=replace)
         def _done(filenode):
@@ -137,7 +143,8 @@ class PlaceHolderNodeHandler(Resource, ReplaceMeMixin):
 
         assert self.parentnode and self.name
         if req.getHeader("content-range"):
-            raise WebError("Content-Range in PUT not yet supported",
+            raise WebError("Content-Range in PUT is only supported for"
+                           " existing mutable files",
                            http.NOT_IMPLEMENTED)
         if not t:
             return self.replace_me_with_a_child(req, self.client, replace)
@@ -267,6 +274,13 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
         offset = parse_offset_arg(get_arg(req, b"offset", None))
 
         if not t:
+            content_range = req.getHeader("content-range")
+            if content_range:
+                if offset is not None:
+                    raise WebError("PUT to a file: offset= and Content-Range"
+                                   " cannot both be given")
+                offset = self._offset_of_content_range(req, content_range)
+
             if not replace:
                 # this is the early trap: if someone else modifies the
                 # directory while we're uploading, the add_file(overwrite=)
@@ -279,6 +293,7 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
                 if self.node.is_readonly():
                     raise WebError("PUT to a mutable file: replace or update"
                                    " requested with read-only cap")
+                check_mutable_upload(req)
                 if offset is None:
                     return self.replace_my_contents(req)
 
@@ -359,6 +374,15 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
         return d
 
 
+    def _offset_of_content_range(self, req, content_range):
+        # a PUT with Content-Range writes the body in place at the start of
+        # the range, just like offset=, so the body must fill the range
+        first, last = parse_content_range_header(content_range)
+        req.content.seek(0, os.SEEK_END)
+        if req.content.tell() != last - first + 1:
+            raise WebError("PUT to a file: body does not match Content-Range")
+        return first
+
     def update_my_contents(self, req, offset):
         req.content.seek(0)
         added_contents = MutableFileHandle(req.content)
@@ -382,7 +406,43 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
         return d
 
 
+class _MultipartConsumer(object):
+    """I consume a read of the file which covers one or more parts of a
+    multipart/byteranges response, starting at the given offset. I write
+    each part to the request, preceded by its headers, and drop the bytes
+    between them. The request flow-controls the read directly."""
+
+    def __init__(self, req, offset, parts):
+        self._req = req
+        self._offset = offset
+        self._parts = parts # list of [first, last, headers-or-None]
+
+    def registerProducer(self, producer, streaming):
+        self._req.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._req.unregisterProducer()
+
+    def write(self, data):
+        start, end = self._offset, self._offset + len(data)
+        self._offset = end
+        while self._parts and self._parts[0][0] < end:
+            part = self._parts[0]
+            (first, last, headers) = part
+            if headers is not None:
+                self._req.write(headers)
+                part[2] = None
+            self._req.write(data[max(first, start)-start:min(last+1, end)-start])
+            if last >= end:
+                break
+            self._parts.pop(0)
+
+
 class FileDownloader(Resource, object):
+    # ranges of a multipart/byteranges response which are closer together
+    # than this are fetched by a single read
+    READ_GAP = DEFAULT_MAX_SEGMENT_SIZE
+
     def __init__(self, filenode, filename):
         super(FileDownloader, self).__init__()
         self.filenode = filenode
@@ -436,6 +496,61 @@ class FileDownloader(Resource, object):
         except ValueError:
             return None
 
+    def coalesce_ranges(self, ranges, filesize):
+        # Clip (first,last) ranges to the file, dropping those which start
+        # beyond its end, and merge any which overlap or abut, as RFC 7233
+        # allows. Returns the remaining ranges in ascending order, which is
+        # empty if none of them can be satisfied.
+        coalesced = []
+        for (first, last) in sorted(ranges):
+            if first >= filesize:
+                continue
+            first, last = max(0, first), min(filesize-1, last)
+            if coalesced and first <= coalesced[-1][1] + 1:
+                coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], last))
+            else:
+                coalesced.append((first, last))
+        return coalesced
+
+    def _plan_multipart(self, req, ctype, filesize, ranges):
+        # Set up a multipart/byteranges response, returning the reads which
+        # will produce it and the trailer which ends it. Ranges closer
+        # together than READ_GAP are fetched by a single read, so a segment
+        # which holds the end of one range and the start of the next is only
+        # downloaded once; the bytes between them are thrown away.
+        boundary = base32.b2a(os.urandom(16))
+        req.setHeader("content-type",
+                      b"multipart/byteranges; boundary=%s" % boundary)
+        reads = []
+        contentsize = 0
+        for (first, last) in ranges:
+            headers = (b"\r\n--%s\r\n"
+                       b"Content-Type: %s\r\n"
+                       b"Content-Range: bytes %d-%d/%d\r\n\r\n"
+                       % (boundary, ctype.encode("ascii"), first, last,
+                          filesize))
+            contentsize += len(headers) + last - first + 1
+            if reads and first - reads[-1][1] <= self.READ_GAP:
+                reads[-1][1] = last
+                reads[-1][2].append([first, last, headers])
+            else:
+                reads.append([first, last, [[first, last, headers]]])
+        trailer = b"\r\n--%s--\r\n" % boundary
+        contentsize += len(trailer)
+
+        req.setHeader("content-length", b"%d" % contentsize)
+        return reads, trailer
+
+    def _read_multipart(self, req, reads, trailer):
+        d = defer.succeed(None)
+        for (first, last, parts) in reads:
+            d.addCallback(lambda ign, first=first, last=last, parts=parts:
+                          self.filenode.read(
+                              _MultipartConsumer(req, first, parts),
+                              first, last - first + 1))
+        d.addCallback(lambda ign: req.write(trailer))
+        return d
+
     @render_exception
     def render(self, req):
         gte = static.getTypeAndEncoding
@@ -457,42 +572,46 @@ class FileDownloader(Resource, object):
 
         filesize = self.filenode.get_size()
         assert isinstance(filesize, (int,long)), filesize
-        first, size = 0, None
-        contentsize = filesize
         req.setHeader("accept-ranges", "bytes")
 
         # TODO: for mutable files, use the roothash. For LIT, hash the data.
         # or maybe just use the URI for CHK and LIT.
         rangeheader = req.getHeader('range')
+        ranges = None
         if rangeheader:
-            ranges = self.parse_range_header(rangeheader)
-
             # ranges = None means the header didn't parse, so ignore
-            # the header as if it didn't exist.  If is more than one
-            # range, then just return the first for now, until we can
-            # generate multipart/byteranges.
+            # the header as if it didn't exist.
+            ranges = self.parse_range_header(rangeheader)
+        if ranges is not None:
+            ranges = self.coalesce_ranges(ranges, filesize)
+            if not ranges:
+                req.setHeader('content-range', "bytes */%d" % filesize)
+                raise WebError('First beyond end of file',
+                               http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            req.setResponseCode(http.PARTIAL_CONTENT)
+
+        multipart = ranges is not None and len(ranges) > 1
+        if multipart:
+            reads, trailer = self._plan_multipart(req, ctype, filesize, ranges)
+        else:
+            first, size = 0, None
+            contentsize = filesize
             if ranges is not None:
-                first, last = ranges[0]
-
-                if first >= filesize:
-                    raise WebError('First beyond end of file',
-                                   http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                else:
-                    first = max(0, first)
-                    last = min(filesize-1, last)
+                [(first, last)] = ranges
+                req.setHeader('content-range',"bytes %s-%s/%s" %
+                              (str(first), str(last),
+                               str(filesize)))
+                contentsize = last - first + 1
+                size = contentsize
+            req.setHeader("content-length", b"%d" % contentsize)
 
-                    req.setResponseCode(http.PARTIAL_CONTENT)
-                    req.setHeader('content-range',"bytes %s-%s/%s" %
-                                  (str(first), str(last),
-                                   str(filesize)))
-                    contentsize = last - first + 1
-                    size = contentsize
-
-        req.setHeader("content-length", b"%d" % contentsize)
         if req.method == b"HEAD":
             return b""
 
-        d = self.filenode.read(req, first, size)
+        if multipart:
+            d = self._read_multipart(req, reads, trailer)
+        else:
+            d = self.filenode.read(req, first, size)
 
         def _error(f):
             if f.check(defer.CancelledError):
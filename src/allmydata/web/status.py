@@ -1568,7 +1568,7 @@ class Statistics(MultiFormatResource):
             return re.sub(
                 u"_(\d\d)_(\d)_percentile",
                 u'{quantile="0.\g<1>\g<2>"}',
-                name.replace(u".", u"_")
+                name.replace(u".", u"_").replace(u"-", u"_")
             )
 
         def mangle_value(val):
@@ -1576,6 +1576,14 @@ class Statistics(MultiFormatResource):
 
         for (k, v) in sorted(stats['counters'].items()):
             ret.append(u"tahoe_counters_%s %s" % (mangle_name(k), mangle_value(v)))
+        for (k, v) in sorted(stats.get('histograms', {}).items()):
+            name = u"tahoe_histograms_%s" % mangle_name(k)
+            ret.append(u"# TYPE %s histogram" % (name,))
+            for (bound, count) in v["buckets"]:
+                le = u"+Inf" if bound is None else str(bound)
+                ret.append(u'%s_bucket{le="%s"} %s' % (name, le, count))
+            ret.append(u"%s_count %s" % (name, v["count"]))
+            ret.append(u"%s_sum %s" % (name, v["sum"]))
         for (k, v) in sorted(stats['stats'].items()):
             ret.append(u"tahoe_stats_%s %s" % (mangle_name(k), mangle_value(v)))
 
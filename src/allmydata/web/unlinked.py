@@ -31,6 +31,8 @@ from allmydata.web.common import (
     WebError,
     get_format,
     get_mutable_type,
+    get_immutable_uploadable,
+    check_mutable_upload,
     render_exception,
     url_for_string,
 )
@@ -38,7 +40,7 @@ from allmydata.web import status
 
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    uploadable = get_immutable_uploadable(req, client)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.get_uri())
     # that fires with the URI of the new file
@@ -46,6 +48,7 @@ def PUTUnlinkedCHK(req, client):
 
 def PUTUnlinkedSSK(req, client, version):
     # SDMF: files are small, and we can only upload data
+    check_mutable_upload(req)
     req.content.seek(0)
     data = MutableFileHandle(req.content)
     d = client.create_mutable_file(data, version=version)
@@ -12,7 +12,7 @@ if PY2:
 
 from six import ensure_str
 
-import re, time, tempfile
+import os, re, time, tempfile
 
 from cgi import (
     FieldStorage,
@@ -24,6 +24,7 @@ from io import (
 from twisted.application import service, strports, internet
 from twisted.web import static
 from twisted.web.http import (
+    HTTPChannel,
     parse_qs,
 )
 from twisted.web.server import (
@@ -35,9 +36,19 @@ from twisted.internet.address import (
     IPv4Address,
     IPv6Address,
 )
+from zope.interface import implementer
+from foolscap.api import eventually
+from allmydata.interfaces import IUploadable
+from allmydata.immutable.upload import BaseUploadable
 from allmydata.util import log, fileutil
 
 from allmydata.web import introweb, root
+from allmydata.web.common import (
+    WebError,
+    boolean_of_arg,
+    get_arg,
+    get_format,
+)
 from allmydata.web.operations import OphandleTable
 
 from .web.storage_plugins import (
@@ -81,6 +92,125 @@ else:
             self._mime_filename = value
 
 
+@implementer(IUploadable)
+class StreamingRequestBody(BaseUploadable):
+    """
+    I am the body of a request that is being uploaded as an immutable file
+    while it is still being received, so that it is never spooled to disk.
+    Since the contents are not known in advance, the file is encrypted with
+    a random key rather than a convergent one.
+
+    I hold at most ``buffer_size`` bytes that the upload has not asked for
+    yet, pausing the channel when I have that much so that the client
+    sends no faster than the file is encoded and pushed to the servers.
+
+    :ivar bool complete: Whether the whole body has been received.
+    """
+    buffer_size = 1024 * 1024
+
+    def __init__(self, channel, size):
+        self._channel = channel
+        self._size = size
+        self._key = None
+        self._chunks = []
+        self._buffered = 0
+        self._received = 0
+        self._read = None  # (length, Deferred) while a read is waiting for data
+        self._failure = None
+        self._discarding = False
+        self._paused = False
+        self.complete = False
+
+    # These are used by the request, as the body is received.
+
+    def write(self, data):
+        self._received += len(data)
+        if self._discarding:
+            return
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self._maybe_read()
+
+    def all_received(self):
+        self.complete = True
+        self._maybe_read()
+
+    def discard(self):
+        """
+        Drop the rest of the body, because the upload no longer needs it.
+        """
+        self._discarding = True
+        self._chunks = []
+        self._buffered = 0
+        self._maybe_read()
+
+    def fail(self, failure):
+        """
+        The rest of the body will never arrive: fail the upload.
+        """
+        self._failure = failure
+        self._maybe_read()
+
+    # These provide IUploadable.
+
+    def get_encryption_key(self):
+        if self._key is None:
+            self._key = os.urandom(16)
+        return defer.succeed(self._key)
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def read(self, length):
+        assert self._read is None, "only one read at a time"
+        d = defer.Deferred()
+        self._read = (length, d)
+        self._maybe_read()
+        return d
+
+    def close(self):
+        # The upload has finished, perhaps unsuccessfully, so it will not
+        # read any more.
+        self.discard()
+
+    def _maybe_read(self):
+        if self._read is not None:
+            (length, d) = self._read
+            if self._failure is not None:
+                self._read = None
+                d.errback(self._failure)
+            elif self._discarding:
+                self._read = None
+                d.errback(WebError("request body was discarded"))
+            elif self._buffered >= length or self.complete:
+                self._read = None
+                d.callback(self._take(length))
+        self._update_flow()
+
+    def _take(self, length):
+        data = []
+        while self._chunks and length > 0:
+            chunk = self._chunks.pop(0)
+            if len(chunk) > length:
+                self._chunks.insert(0, chunk[length:])
+                chunk = chunk[:length]
+            data.append(chunk)
+            length -= len(chunk)
+            self._buffered -= len(chunk)
+        return data
+
+    def _update_flow(self):
+        if self._buffered >= self.buffer_size and self._read is None \
+           and not (self.complete or self._discarding):
+            # The transport may have resumed the channel when its send buffer
+            # drained, so pause it every time more arrives.
+            self._channel.pauseProducing()
+            self._paused = True
+        elif self._paused:
+            self._paused = False
+            self._channel.resumeProducing()
+
+
 class TahoeLAFSRequest(Request, object):
     """
     ``TahoeLAFSRequest`` adds several features to a Twisted Web ``Request``
@@ -89,8 +219,57 @@ class TahoeLAFSRequest(Request, object):
     :ivar NoneType|FieldStorage fields: For POST requests, a structured
         representation of the contents of the request body.  For anything
         else, ``None``.
+
+    :ivar NoneType|StreamingRequestBody streaming_body: For an upload whose
+        body is passed to the uploader as it is received, that body (which is
+        also ``content``).  For anything else, ``None``.
+
+    :ivar NoneType|tuple request_line: The ``(command, path, version)`` of the
+        request line, recorded by ``TahoeLAFSHTTPChannel`` so that the request
+        can be examined before its body arrives.  ``None`` if the request was
+        made over some other channel.
     """
     fields = None
+    request_line = None
+    streaming_body = None
+    _held_writes = None
+    _finish_when_received = False
+
+    def gotLength(self, length):
+        """
+        Called by channel when the headers have been received.
+
+        Immutable uploads with ``convergent=false`` (``PUT /uri`` or ``PUT
+        /uri/$DIRCAP/[SUBDIRS../]FILENAME``) whose length is known are handled
+        from here, reading the body as it arrives, rather than once it has
+        all been written to a temporary file.
+        """
+        if self.request_line is not None and length:
+            self._parse_request_line(*self.request_line)
+            if self._can_stream_body():
+                self.streaming_body = self.content = StreamingRequestBody(
+                    self.channel, length)
+                # Let the channel finish with the headers (perhaps sending
+                # "100 Continue") before we respond.
+                eventually(self._start_processing)
+                return
+        Request.gotLength(self, length)
+
+    def _can_stream_body(self):
+        if self.method != b"PUT":
+            return False
+        if self.path != b"/uri" and not self.path.startswith(b"/uri/"):
+            return False
+        if self.requestHeaders.hasHeader(b"content-range"):
+            # a ranged write seeks in the body, so it needs all of it
+            return False
+        try:
+            return (not get_arg(self, "t", "").strip()
+                    and not boolean_of_arg(get_arg(self, "convergent", "true"))
+                    and get_format(self, "CHK") == "CHK")
+        except WebError:
+            # let the resource report it
+            return False
 
     def requestReceived(self, command, path, version):
         """
@@ -100,19 +279,18 @@ class TahoeLAFSRequest(Request, object):
         and to provide less memory-intensive multipart/form-post handling for
         large file uploads.
         """
-        self.content.seek(0)
-        self.args = {}
-        self.stack = []
+        if self.streaming_body is not None:
+            # we started processing this request when its headers arrived
+            self.streaming_body.all_received()
+            for data in self._held_writes or []:
+                Request.write(self, data)
+            self._held_writes = None
+            if self._finish_when_received:
+                Request.finish(self)
+            return
 
-        self.method, self.uri = command, path
-        self.clientproto = version
-        x = self.uri.split(b'?', 1)
-
-        if len(x) == 1:
-            self.path = self.uri
-        else:
-            self.path, argstring = x
-            self.args = parse_qs(argstring, 1)
+        self.content.seek(0)
+        self._parse_request_line(command, path, version)
 
         content_type = (self.requestHeaders.getRawHeaders("content-type") or [""])[0]
         if self.method == b'POST' and content_type.split(";")[0] in ("multipart/form-data", "application/x-www-form-urlencoded"):
@@ -136,11 +314,62 @@ class TahoeLAFSRequest(Request, object):
                 self.content, headers, environ={'REQUEST_METHOD': 'POST'})
             self.content.seek(0)
 
+        self._start_processing()
+
+    def _parse_request_line(self, command, path, version):
+        self.args = {}
+        self.stack = []
+
+        self.method, self.uri = command, path
+        self.clientproto = version
+        x = self.uri.split(b'?', 1)
+
+        if len(x) == 1:
+            self.path = self.uri
+        else:
+            self.path, argstring = x
+            self.args = parse_qs(argstring, 1)
+
+    def _start_processing(self):
+        if self._disconnected:
+            return
         self._tahoeLAFSSecurityPolicy()
 
         self.processing_started_timestamp = time.time()
         self.process()
 
+    def write(self, data):
+        """
+        Write some of the response, or, if the body of a streaming upload is
+        still being received (so the upload must have failed), hold it until
+        the body has all been received: clients may not read the response
+        until they have sent their request.
+        """
+        if self.streaming_body is not None and not self.streaming_body.complete:
+            if self._held_writes is None:
+                self._held_writes = []
+            self._held_writes.append(data)
+            return
+        Request.write(self, data)
+
+    def finish(self):
+        """
+        Finish the response, or, if the body of a streaming upload is still
+        being received, discard the rest of the body and finish once it has
+        all been received: the channel cannot move on to another request
+        until then.
+        """
+        if self.streaming_body is not None and not self.streaming_body.complete:
+            self.streaming_body.discard()
+            self._finish_when_received = True
+            return
+        Request.finish(self)
+
+    def connectionLost(self, reason):
+        if self.streaming_body is not None and not self.streaming_body.complete:
+            self.streaming_body.fail(reason)
+        Request.connectionLost(self, reason)
+
     def _tahoeLAFSSecurityPolicy(self):
         """
         Set response properties related to Tahoe-LAFS-imposed security policy.
@@ -207,6 +436,22 @@ def _logFormatter(logDateTime, request):
     )
 
 
+class TahoeLAFSHTTPChannel(HTTPChannel, object):
+    """
+    An HTTP channel that gives each ``TahoeLAFSRequest`` its request line as
+    soon as it arrives, rather than only once the whole request has been
+    received.
+    """
+    def lineReceived(self, line):
+        requests = len(self.requests)
+        HTTPChannel.lineReceived(self, line)
+        if len(self.requests) > requests:
+            # This line started a new request, so it is the request line.
+            parts = line.split()
+            if len(parts) == 3:
+                self.requests[-1].request_line = tuple(parts)
+
+
 class TahoeLAFSSite(Site, object):
     """
     The HTTP protocol factory used by Tahoe-LAFS.
@@ -220,6 +465,7 @@ class TahoeLAFSSite(Site, object):
       strings to help keep them secret.
     """
     requestFactory = TahoeLAFSRequest
+    protocol = TahoeLAFSHTTPChannel
 
     def __init__(self, tempdir, *args, **kwargs):
         Site.__init__(self, *args, logFormatter=_logFormatter, **kwargs)